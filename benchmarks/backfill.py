@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+
+
+import argparse
+import heapq
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                "daemon"))
+
+from scheduler import RESERVATIONS, PendingQueue, Planner
+
+
+""" Simulates a stream of jobs on a single machine under each scheduling
+policy, and compares utilization and wait times against the greedy policy. """
+
+
+# VRAM on each simulated GPU.
+_GPU_VRAM = 16000000000
+
+
+class _SimulatedJob:
+  """ A job in the simulation. """
+
+  def __init__(self, arrival, requirements, runtime, declared_runtime):
+    """
+    Args:
+      arrival: When the job is submitted.
+      requirements: The requirement vector for the job.
+      runtime: How long the job actually runs for.
+      declared_runtime: The MaxRuntime that the job declares. """
+    self.arrival = arrival
+    self.requirements = requirements
+    self.runtime = runtime
+    self.declared_runtime = declared_runtime
+    self.start = None
+
+
+def _make_workload(num_jobs, num_gpus, large_fraction, load, rng):
+  """ Makes a random stream of jobs. Most of them use part of a single GPU, and
+  the rest need every GPU on the machine.
+  Args:
+    num_jobs: The number of jobs to make.
+    num_gpus: The number of GPUs on the machine.
+    large_fraction: The fraction of jobs that need every GPU.
+    load: How much work arrives, relative to what the machine can do.
+    rng: The random number generator to use.
+  Returns:
+    A list of jobs, in order of arrival. """
+  jobs = []
+  for _ in range(num_jobs):
+    if rng.random() < large_fraction:
+      requirements = (10, 10, num_gpus, 100, _GPU_VRAM // 2)
+      runtime = rng.uniform(600, 1800)
+    else:
+      requirements = (5, 5, 1, rng.choice((50, 100)), _GPU_VRAM // 4)
+      runtime = rng.uniform(60, 600)
+
+    # Users tend to overestimate how long their jobs take.
+    jobs.append((requirements, runtime, runtime * rng.uniform(1.0, 2.0)))
+
+  # Space out the arrivals so that the machine gets the requested load.
+  work = sum([requirements[2] * requirements[3] / 100 * runtime \
+              for requirements, runtime, _ in jobs])
+  mean_gap = work / (num_gpus * load) / num_jobs
+
+  arrival = 0.0
+  workload = []
+  for requirements, runtime, declared_runtime in jobs:
+    arrival += rng.expovariate(1 / mean_gap)
+    workload.append(_SimulatedJob(arrival, requirements, runtime,
+                                  declared_runtime))
+  return workload
+
+def _simulate(workload, policy, num_gpus):
+  """ Runs a workload on a simulated machine.
+  Args:
+    workload: The jobs to run, in order of arrival.
+    policy: The scheduling policy to use.
+    num_gpus: The number of GPUs on the machine.
+  Returns:
+    A dictionary of statistics about the run. """
+  queue = PendingQueue()
+  # Heap of (end time, job ID, job, GPUs) for the running jobs.
+  running = []
+  cpu = 0
+  ram = 0
+  gpu_usage = [0] * num_gpus
+  vram_usage = [0] * num_gpus
+  total_vram = [_GPU_VRAM] * num_gpus
+
+  def update_usage(requirements, gpus, sign):
+    nonlocal cpu, ram
+    cpu += sign * requirements[0]
+    ram += sign * requirements[1]
+    for gpu_id in gpus:
+      gpu_usage[gpu_id] += sign * requirements[3]
+      vram_usage[gpu_id] += sign * requirements[4]
+
+  next_arrival = 0
+  finished = 0
+  now = 0.0
+  while finished < len(workload):
+    # Advance to the next event.
+    times = []
+    if next_arrival < len(workload):
+      times.append(workload[next_arrival].arrival)
+    if running:
+      times.append(running[0][0])
+    now = min(times)
+
+    while running and running[0][0] <= now:
+      _, _, job, gpus = heapq.heappop(running)
+      update_usage(job.requirements, gpus, -1)
+      finished += 1
+    while next_arrival < len(workload) and \
+          workload[next_arrival].arrival <= now:
+      job = workload[next_arrival]
+      queue.add(job, job.requirements)
+      next_arrival += 1
+
+    planner = Planner(now, (cpu, ram, gpu_usage, vram_usage), total_vram,
+                      [(job.start + job.declared_runtime, job.requirements,
+                        gpus) for _, _, job, gpus in running],
+                      max_reservations=RESERVATIONS[policy])
+    place = lambda job, requirements: planner.place(requirements,
+                                                    job.declared_runtime)
+    for job, requirements, gpus in queue.pop_runnable(place):
+      job.start = now
+      update_usage(requirements, gpus, 1)
+      heapq.heappush(running, (now + job.runtime, id(job), job, gpus))
+
+  waits = sorted([job.start - job.arrival for job in workload])
+  large_waits = [job.start - job.arrival for job in workload \
+                 if job.requirements[2] == num_gpus]
+  work = sum([job.requirements[2] * job.requirements[3] / 100 * job.runtime \
+              for job in workload])
+  makespan = now - workload[0].arrival
+
+  return {"mean_wait": sum(waits) / len(waits),
+          "p95_wait": waits[int(len(waits) * 0.95)],
+          "large_wait": sum(large_waits) / max(1, len(large_waits)),
+          "max_wait": waits[-1],
+          "utilization": work / (makespan * num_gpus),
+          "makespan": makespan}
+
+def main():
+  parser = argparse.ArgumentParser( \
+      description="Compare backfill scheduling against greedy scheduling.")
+  parser.add_argument("--jobs", type=int, default=2000,
+                      help="Number of jobs to simulate.")
+  parser.add_argument("--gpus", type=int, default=4,
+                      help="Number of GPUs on the simulated machine.")
+  parser.add_argument("--large-fraction", type=float, default=0.05,
+                      help="Fraction of jobs that need every GPU.")
+  parser.add_argument("--load", type=float, default=0.8,
+                      help="Offered load, relative to the machine capacity.")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="Random seed.")
+  args = parser.parse_args()
+
+  workload = _make_workload(args.jobs, args.gpus, args.large_fraction,
+                            args.load, random.Random(args.seed))
+
+  results = {}
+  for policy in ("greedy", "easy", "conservative"):
+    for job in workload:
+      job.start = None
+    results[policy] = _simulate(workload, policy, args.gpus)
+
+  print("%-13s %10s %10s %12s %10s %12s %10s" % \
+        ("policy", "mean wait", "p95 wait", "large wait", "max wait",
+         "utilization", "makespan"))
+  for policy, stats in results.items():
+    print("%-13s %10.0f %10.0f %12.0f %10.0f %11.1f%% %10.0f" % \
+          (policy, stats["mean_wait"], stats["p95_wait"], stats["large_wait"],
+           stats["max_wait"], stats["utilization"] * 100, stats["makespan"]))
+
+  greedy = results["greedy"]
+  for policy in ("easy", "conservative"):
+    stats = results[policy]
+    print("%s vs greedy: mean wait %+.1f%%, large job wait %+.1f%%," \
+          " utilization %+.1f points" % \
+          (policy, (stats["mean_wait"] / greedy["mean_wait"] - 1) * 100,
+           (stats["large_wait"] / greedy["large_wait"] - 1) * 100,
+           (stats["utilization"] - greedy["utilization"]) * 100))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+
+
+import argparse
+import asyncio
+import functools
+import json
+import logging
+from multiprocessing import Process
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                "daemon"))
+
+from admission import AdmissionPipeline
+from control import ControlPlane
+from fake_backends import FakeBackend, make_gpus
+from job import Job
+from manager import Manager
+from stoplightd import Daemon
+
+
+""" Measures how many requests per second the daemon's control plane can
+answer, over HTTP and the unix socket, with many clients at once. It can also
+be pointed at a daemon that is already running, such as an older version, to
+compare against. """
+
+
+# A job that runs on the fake backend.
+_JOB_YAML = """Name: benchmark
+Description: Benchmark job.
+Container: benchmark:latest
+ResourceUsage:
+  - CpuUsage: 1
+  - RamUsage: 1000000
+  - GpuCount: 0
+"""
+
+
+def _make_job_dirs(directory, count):
+  """ Makes job directories.
+  Args:
+    directory: The directory to make them in.
+    count: The number to make.
+  Returns:
+    The paths to the job directories. """
+  job_dirs = []
+  for job_number in range(count):
+    job_dir = os.path.join(directory, str(job_number))
+    os.mkdir(job_dir)
+    with open(os.path.join(job_dir, "job.yaml"), "w") as job_file:
+      job_file.write(_JOB_YAML)
+    with open(os.path.join(job_dir, "run_job.sh"), "w") as script:
+      script.write("#!/bin/sh\n")
+    job_dirs.append(job_dir)
+
+  return job_dirs
+
+def _run_daemon(port, socket_path, runtime):
+  """ Runs a daemon with fake backends. Meant to be run in its own process.
+  Args:
+    port: The port to serve HTTP on.
+    socket_path: The path to serve the unix socket at.
+    runtime: How long each job runs for, in seconds. """
+  logging.basicConfig(level=logging.WARNING)
+  backend = FakeBackend(1, default_runtime=runtime)
+  make_job = functools.partial(Job, container_class=backend.make_container)
+  manager = Manager(gpus=make_gpus(1), make_job=make_job)
+  daemon = Daemon(manager, AdmissionPipeline(), 5.0)
+  control_plane = ControlPlane(daemon, port=port, socket_path=socket_path)
+  daemon.run(on_start=control_plane.start)
+
+
+class _HttpClient:
+  """ A minimal HTTP/1.1 client, which keeps its connection open. """
+
+  def __init__(self, host, port):
+    """
+    Args:
+      host: The host of the server.
+      port: The port of the server. """
+    self.__host = host
+    self.__port = port
+    self.__reader = None
+    self.__writer = None
+    # Whether the server is going to close the connection.
+    self.__closing = False
+
+  async def connect(self):
+    """ Connects to the server. """
+    self.__reader, self.__writer = \
+        await asyncio.open_connection(self.__host, self.__port)
+    self.__closing = False
+
+  def close(self):
+    """ Closes the connection. """
+    self.__writer.close()
+
+  async def request(self, method, path, body=None):
+    """ Makes a request.
+    Args:
+      method: The request method.
+      path: The path to request.
+      body: Optional data to send as JSON.
+    Returns:
+      The status, and the parsed body of the response. """
+    if self.__closing:
+      self.close()
+      await self.connect()
+
+    data = b"" if body is None else json.dumps(body).encode("utf-8")
+    self.__writer.write(("%s %s HTTP/1.1\r\nHost: %s\r\n" \
+                         "Content-Type: application/json\r\n" \
+                         "Content-Length: %d\r\n\r\n" % \
+                         (method, path, self.__host, len(data))) \
+                        .encode("latin-1") + data)
+
+    status_line = await self.__reader.readline()
+    if not status_line:
+      raise ConnectionError("The server closed the connection.")
+    status = int(status_line.split()[1])
+    length = 0
+    while True:
+      line = await self.__reader.readline()
+      if line in (b"\r\n", b""):
+        break
+      name, _, value = line.decode("latin-1").partition(":")
+      name = name.strip().lower()
+      if name == "content-length":
+        length = int(value)
+      elif name == "connection" and value.strip().lower() == "close":
+        self.__closing = True
+    return status, json.loads(await self.__reader.readexactly(length))
+
+
+class _SocketClient:
+  """ A client for the unix socket, which sends one command at a time. """
+
+  def __init__(self, path):
+    """
+    Args:
+      path: The path to the socket. """
+    self.__path = path
+    self.__reader = None
+    self.__writer = None
+    self.__next_id = 0
+
+  async def connect(self):
+    """ Connects to the daemon. """
+    self.__reader, self.__writer = \
+        await asyncio.open_unix_connection(self.__path, limit=2 ** 24)
+
+  def close(self):
+    """ Closes the connection. """
+    self.__writer.close()
+
+  async def call(self, command):
+    """ Sends a command, and waits for the reply.
+    Args:
+      command: The command.
+    Returns:
+      The result. """
+    command["id"] = self.__next_id
+    self.__next_id += 1
+    self.__writer.write((json.dumps(command) + "\n").encode("utf-8"))
+    line = await self.__reader.readline()
+    if not line:
+      raise ConnectionError("The daemon closed the connection.")
+    reply = json.loads(line)
+    if "error" in reply:
+      raise RuntimeError(reply["error"])
+    return reply["result"]
+
+
+async def _add_job(client, job_dir, unix):
+  """ Adds a single job.
+  Args:
+    client: The _HttpClient or _SocketClient.
+    job_dir: The directory of the job.
+    unix: Whether the client is a _SocketClient.
+  Returns:
+    The ID of the job. """
+  if unix:
+    result = await client.call({"type": "add_jobs", "job_dirs": [job_dir]})
+  else:
+    status, result = await client.request("POST", "/add_jobs",
+                                          {"job_dirs": [job_dir]})
+    if status != 200:
+      raise RuntimeError("Request failed with status %d." % (status))
+  if not result["accepted"]:
+    raise RuntimeError("Job was rejected: %s" % (result["rejected"]))
+  return result["job_ids"][0][0] if "job_ids" in result else None
+
+async def _get_job(client, job_id, unix):
+  """ Gets the state of a job.
+  Args:
+    client: The _HttpClient or _SocketClient.
+    job_id: The ID of the job.
+    unix: Whether the client is a _SocketClient. """
+  if unix:
+    await client.call({"type": "get_job", "job_id": job_id})
+  else:
+    status, _ = await client.request("GET", "/jobs/%d" % (job_id))
+    if status != 200:
+      raise RuntimeError("Request failed with status %d." % (status))
+
+def _get_percentile(values, percentile):
+  """
+  Args:
+    values: A sorted list of values.
+    percentile: The percentile to get, from 0 to 100.
+  Returns:
+    The value at that percentile. """
+  if not values:
+    return 0.0
+  index = min(len(values) - 1, int(len(values) * percentile / 100))
+  return values[index]
+
+async def _run_phase(make_client, clients, requests):
+  """ Makes requests from a number of clients at once.
+  Args:
+    make_client: Function that makes a client that isn't connected yet.
+    clients: The number of clients.
+    requests: A list of functions that take a client and make a request. The
+    clients take them from the list in turn.
+  Returns:
+    A dictionary of results. Requests that fail are counted as errors, and
+    the client reconnects. """
+  connected = [make_client() for _ in range(clients)]
+  await asyncio.gather(*[client.connect() for client in connected])
+
+  latencies = []
+  errors = []
+  remaining = iter(requests)
+
+  async def run_client(client):
+    for request in remaining:
+      start_time = time.perf_counter()
+      try:
+        await request(client)
+      except (OSError, ValueError, RuntimeError,
+              asyncio.IncompleteReadError) as error:
+        errors.append(str(error))
+        client.close()
+        try:
+          await client.connect()
+        except OSError:
+          return
+        continue
+      latencies.append(time.perf_counter() - start_time)
+
+  start_time = time.perf_counter()
+  await asyncio.gather(*[run_client(client) for client in connected])
+  elapsed = time.perf_counter() - start_time
+  for client in connected:
+    client.close()
+
+  latencies.sort()
+  return {"requests": len(latencies), "errors": len(errors),
+          "elapsed": elapsed,
+          "per_second": len(latencies) / elapsed,
+          "p50_ms": _get_percentile(latencies, 50) * 1000,
+          "p99_ms": _get_percentile(latencies, 99) * 1000}
+
+async def _run_transport(make_client, unix, job_dirs, args):
+  """ Benchmarks adding and getting jobs over one transport.
+  Args:
+    make_client: Function that makes a client that isn't connected yet.
+    unix: Whether the clients are _SocketClients.
+    job_dirs: The job directories to add.
+    args: The parsed command line arguments.
+  Returns:
+    A dictionary of results for each phase. """
+  job_ids = []
+
+  async def add(job_dir, client):
+    job_ids.append(await _add_job(client, job_dir, unix))
+
+  results = {}
+  results["add_job"] = await _run_phase(
+      make_client, args.clients,
+      [functools.partial(add, job_dir) for job_dir in job_dirs])
+
+  job_ids = [job_id for job_id in job_ids if job_id is not None]
+  if job_ids:
+    rng = random.Random(args.seed)
+
+    async def get(job_id, client):
+      await _get_job(client, job_id, unix)
+
+    results["get_job"] = await _run_phase(
+        make_client, args.clients,
+        [functools.partial(get, rng.choice(job_ids)) \
+         for _ in range(args.requests)])
+
+  return results
+
+def _wait_for_server(host, port, timeout=30):
+  """ Waits until a server accepts connections.
+  Args:
+    host: The host of the server.
+    port: The port of the server.
+    timeout: How long to wait, in seconds. """
+  deadline = time.monotonic() + timeout
+  while True:
+    try:
+      socket.create_connection((host, port)).close()
+      return
+    except OSError:
+      if time.monotonic() > deadline:
+        raise
+      time.sleep(0.1)
+
+def main():
+  parser = argparse.ArgumentParser( \
+      description="Benchmark the throughput of the control plane.")
+  parser.add_argument("--clients", type=int, default=1000,
+                      help="Number of clients making requests at once.")
+  parser.add_argument("--jobs", type=int, default=5000,
+                      help="Number of jobs for the clients to add, one per" \
+                           " request.")
+  parser.add_argument("--requests", type=int, default=20000,
+                      help="Number of requests for the states of jobs.")
+  parser.add_argument("--runtime", type=float, default=0.1,
+                      help="How long each job runs for, in seconds.")
+  parser.add_argument("--port", type=int, default=5900,
+                      help="Port to run the benchmark daemon on.")
+  parser.add_argument("--server", metavar="HOST:PORT",
+                      help="Benchmark a daemon that is already running, over" \
+                           " HTTP, instead of starting one. Its jobs have to" \
+                           " be able to run in a temporary directory.")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="Random seed.")
+  parser.add_argument("-o", "--output",
+                      help="File to save the results to, as JSON.")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARNING)
+
+  results = {"time": time.time(), "config": vars(args), "transports": {}}
+  directory = tempfile.mkdtemp(prefix="stoplight-benchmark-")
+  daemon = None
+  try:
+    host, port = "127.0.0.1", args.port
+    socket_path = None
+    if args.server:
+      host, _, port = args.server.rpartition(":")
+      port = int(port)
+    else:
+      socket_path = os.path.join(directory, "stoplight.sock")
+      daemon = Process(target=_run_daemon,
+                       args=(port, socket_path, args.runtime), daemon=True)
+      daemon.start()
+    _wait_for_server(host, port)
+
+    transports = [("http", False,
+                   functools.partial(_HttpClient, host, port))]
+    if socket_path:
+      transports.append(("unix", True,
+                         functools.partial(_SocketClient, socket_path)))
+
+    for name, unix, make_client in transports:
+      job_directory = os.path.join(directory, name)
+      os.mkdir(job_directory)
+      job_dirs = _make_job_dirs(job_directory, args.jobs)
+      result = asyncio.run(_run_transport(make_client, unix, job_dirs, args))
+      results["transports"][name] = result
+
+      for phase, phase_result in result.items():
+        print("%-4s %-7s %6d requests in %6.2f s: %8.0f requests/s," \
+              " p50 %7.2f ms, p99 %7.2f ms, %d errors" % \
+              (name, phase, phase_result["requests"], phase_result["elapsed"],
+               phase_result["per_second"], phase_result["p50_ms"],
+               phase_result["p99_ms"], phase_result["errors"]))
+  finally:
+    if daemon:
+      daemon.terminate()
+    shutil.rmtree(directory, ignore_errors=True)
+
+  if args.output:
+    with open(args.output, "w") as output_file:
+      json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+
+
+import argparse
+import functools
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                "daemon"))
+
+from fake_backends import FakeBackend, make_gpus, make_sysfs
+from job import Job, JobConfig
+from manager import Manager
+from topology import CpuAllocator, parse_cpu_list, read_topology
+
+
+""" Runs a stream of GPU jobs with different numbers of cores on a fake
+multi-socket machine, read from a generated sysfs tree, and checks how well
+jobs get pinned: how many get cores at all, how many of those are on the NUMA
+node of their GPU, and how many get a contiguous range. """
+
+
+def _make_nodes(args):
+  """ Makes the CPU lists of the NUMA nodes, numbered the way Linux does on
+  multi-socket machines, with the second hardware thread of every core after
+  all the first ones.
+  Args:
+    args: The parsed command line arguments.
+  Returns:
+    A list with the kernel CPU list of each node. """
+  total_cores = args.sockets * args.cores
+  nodes = []
+  for socket in range(args.sockets):
+    ranges = []
+    for thread in range(args.threads):
+      first = thread * total_cores + socket * args.cores
+      ranges.append("%d-%d" % (first, first + args.cores - 1))
+    nodes.append(",".join(ranges))
+  return nodes
+
+def _make_jobs(directory, args, rng):
+  """ Makes the jobs to run.
+  Args:
+    directory: The directory to make job directories in.
+    args: The parsed command line arguments.
+    rng: The random number generator.
+  Returns:
+    A list of (job directory, config, runtime) tuples. """
+  configs = {}
+  jobs = []
+  for job_number in range(args.jobs):
+    cores = rng.choice(args.job_cores)
+    config = configs.get(cores)
+    if config is None:
+      config = JobConfig({"Name": "pinned-%d" % (cores),
+                          "Description": "Benchmark job.",
+                          "Container": "benchmark:latest",
+                          "ResourceUsage": [
+                              {"CpuUsage": cores * 100},
+                              {"RamUsage": 1000000},
+                              {"GpuCount": 1},
+                              {"GpuUsage": 100 // args.jobs_per_gpu},
+                              {"VramUsage": 1000000}]})
+      configs[cores] = config
+
+    job_directory = os.path.join(directory, str(job_number))
+    os.mkdir(job_directory)
+    jobs.append((job_directory, config,
+                 rng.uniform(0.5, 1.5) * args.mean_runtime))
+
+  return jobs
+
+def main():
+  parser = argparse.ArgumentParser( \
+      description="Measure how well jobs are pinned to cores near their GPUs.")
+  parser.add_argument("--sockets", type=int, default=2,
+                      help="Number of sockets, each of which is a NUMA node.")
+  parser.add_argument("--cores", type=int, default=16,
+                      help="Number of cores in each socket.")
+  parser.add_argument("--threads", type=int, default=2,
+                      help="Number of hardware threads in each core.")
+  parser.add_argument("--gpus", type=int, default=8,
+                      help="Number of GPUs, which are split evenly between" \
+                           " the sockets.")
+  parser.add_argument("--jobs", type=int, default=400,
+                      help="Number of jobs to run.")
+  parser.add_argument("--job-cores", type=int, nargs="+", default=[2, 4, 8],
+                      help="Numbers of cores that jobs ask for, picked at" \
+                           " random.")
+  parser.add_argument("--jobs-per-gpu", type=int, default=2,
+                      help="Number of jobs that share each GPU.")
+  parser.add_argument("--mean-runtime", type=float, default=0.2,
+                      help="Mean runtime of the jobs, in seconds.")
+  parser.add_argument("--tick", type=float, default=0.005,
+                      help="Time to sleep between updates, in seconds.")
+  parser.add_argument("--timeout", type=float, default=600,
+                      help="Maximum time to run for, in seconds.")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="Random seed.")
+  parser.add_argument("-o", "--output",
+                      help="File to save the results to, as JSON.")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARNING)
+
+  directory = tempfile.mkdtemp(prefix="stoplight-benchmark-")
+  try:
+    sysfs_root = os.path.join(directory, "root")
+    make_sysfs(sysfs_root, _make_nodes(args),
+               [gpu_id * args.sockets // args.gpus \
+                for gpu_id in range(args.gpus)])
+    gpus = make_gpus(args.gpus)
+    topology = read_topology(gpus, root=sysfs_root)
+
+    job_directory = os.path.join(directory, "jobs")
+    os.mkdir(job_directory)
+    jobs = _make_jobs(job_directory, args, random.Random(args.seed))
+    backend = FakeBackend(args.gpus)
+    for job_dir, _, runtime in jobs:
+      backend.add_job(job_dir, runtime, 0.0, 0.0)
+
+    make_job = functools.partial(Job, container_class=backend.make_container)
+    manager = Manager(gpus=gpus, make_job=make_job,
+                      cpu_allocator=CpuAllocator(topology))
+    manager.admit_jobs([(job_dir, config) for job_dir, config, _ in jobs])
+
+    start_time = time.monotonic()
+    while backend.finished < len(jobs):
+      if time.monotonic() - start_time > args.timeout:
+        break
+      manager.update()
+      time.sleep(args.tick)
+    elapsed = time.monotonic() - start_time
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+  pinned = 0
+  local = 0
+  contiguous = 0
+  for gpu_ids, cpu_list, node_list in backend.placements.values():
+    if not cpu_list:
+      continue
+    pinned += 1
+    cpus = parse_cpu_list(cpu_list)
+    if cpus == list(range(cpus[0], cpus[-1] + 1)):
+      contiguous += 1
+    if all([topology.get_gpu_node(gpu_id) == int(node_list) \
+            for gpu_id in gpu_ids]):
+      local += 1
+
+  started = len(backend.placements)
+  results = {"time": time.time(), "config": vars(args),
+             "completed": backend.finished == len(jobs), "elapsed": elapsed,
+             "started": started, "pinned": pinned, "local": local,
+             "contiguous": contiguous}
+  print("%d jobs in %.1f s: %d pinned (%.1f%%), %d on their GPU's node" \
+        " (%.1f%% of pinned), %d contiguous (%.1f%% of pinned)" % \
+        (started, elapsed, pinned, pinned * 100 / max(started, 1), local,
+         local * 100 / max(pinned, 1), contiguous,
+         contiguous * 100 / max(pinned, 1)))
+  if not results["completed"]:
+    print("Timed out before every job finished.")
+
+  if args.output:
+    with open(args.output, "w") as output_file:
+      json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,314 @@
+""" Fake GPUs, containers and sysfs trees, so that the manager can be
+benchmarked without Docker, any GPUs, or a NUMA machine. """
+
+
+from multiprocessing import cpu_count
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                "daemon"))
+
+import nvidia
+
+
+def _get_bus_id(gpu_id):
+  """
+  Args:
+    gpu_id: The ID of a fake GPU.
+  Returns:
+    The PCI bus ID of the GPU, the same as the fake nvidia-smi uses. """
+  return "00000000:%02X:00.0" % (gpu_id + 1)
+
+def make_gpus(count, total_vram=16000000000):
+  """ Makes fake GPUs.
+  Args:
+    count: The number of GPUs to make.
+    total_vram: The amount of VRAM on each GPU, in bytes.
+  Returns:
+    A list of nvidia.Gpu objects. """
+  return [nvidia.Gpu(gpu_id, "GPU-fake-%d" % (gpu_id), total_vram,
+                     _get_bus_id(gpu_id)) \
+          for gpu_id in range(count)]
+
+def make_sysfs(root, nodes, gpu_nodes):
+  """ Makes the parts of a sysfs tree that topology.read_topology() reads.
+  Args:
+    root: The directory to make it in, which stands in for /.
+    nodes: A list with the kernel CPU list of each NUMA node, such as
+    "0-15,32-47".
+    gpu_nodes: A list with the node that each fake GPU is attached to, or -1
+    for none. """
+  cpu_dir = os.path.join(root, "sys", "devices", "system", "cpu")
+  os.makedirs(cpu_dir)
+  with open(os.path.join(cpu_dir, "online"), "w") as online_file:
+    online_file.write(",".join(nodes) + "\n")
+
+  for node, cpu_list in enumerate(nodes):
+    node_dir = os.path.join(root, "sys", "devices", "system", "node",
+                            "node%d" % (node))
+    os.makedirs(node_dir)
+    with open(os.path.join(node_dir, "cpulist"), "w") as cpulist_file:
+      cpulist_file.write(cpu_list + "\n")
+
+  for gpu_id, node in enumerate(gpu_nodes):
+    # sysfs uses a 4 digit domain, and lowercase.
+    device_dir = os.path.join(root, "sys", "bus", "pci", "devices",
+                              _get_bus_id(gpu_id)[4:].lower())
+    os.makedirs(device_dir)
+    with open(os.path.join(device_dir, "numa_node"), "w") as node_file:
+      node_file.write("%d\n" % (node))
+
+
+class FakeBackend:
+  """ Runs fake containers. Each job runs for however long it was registered
+  with, and uses the resources that it was registered with, which are
+  normally what it declared. This also keeps track of how many jobs were
+  dispatched and how busy the machine was. Containers can be started from
+  several threads at once. """
+
+  def __init__(self, num_gpus, default_runtime=None, launch_delay=0.0):
+    """
+    Args:
+      num_gpus: The number of GPUs on the machine.
+      default_runtime: Optional time, in seconds, that jobs which weren't
+      registered run for, without using anything. By default, every job has
+      to be registered.
+      launch_delay: How long it takes to start a container, in seconds. This
+      blocks whoever starts it, like creating and starting a real container
+      does. """
+    self.__num_gpus = num_gpus
+    self.__default_runtime = default_runtime
+    self.launch_delay = launch_delay
+    self.__lock = threading.Lock()
+
+    # Maps job directories to (runtime, CPU fraction, GPU fraction, RAM
+    # fraction) tuples, where the fractions are of the whole machine.
+    self.__jobs = {}
+    # Containers that are running right now.
+    self.__running = set()
+    # Maps the names of running containers to their job directories.
+    self.__names = {}
+    # Maps the names of containers that were started to the GPUs that they
+    # were given, and the CPU and NUMA node lists that they were pinned to, as
+    # given to docker.
+    self.placements = {}
+
+    # The number of containers that have been started.
+    self.dispatched = 0
+    # The number of containers that have finished.
+    self.finished = 0
+    # Busy time of the CPU and GPUs, integrated over time, in machine-seconds.
+    self.__busy_cpu = 0.0
+    self.__busy_gpu = 0.0
+    # The CPU and GPU fractions that are busy right now.
+    self.__cpu = 0.0
+    self.__gpu = 0.0
+    self.__last_update = None
+    # The most CPU that was ever in use at once, as a fraction of the machine.
+    # This can be more than 1 if the machine was oversubscribed.
+    self.peak_cpu = 0.0
+
+  def add_job(self, job_directory, runtime, cpu, gpu, ram=0.0):
+    """ Registers a job, so that containers know how long to run for.
+    Args:
+      job_directory: The directory of the job.
+      runtime: How long the job runs for, in seconds.
+      cpu: The fraction of the machine's CPU that the job uses.
+      gpu: The fraction of the machine's GPUs that the job uses.
+      ram: The fraction of the machine's RAM that the job uses. """
+    self.__jobs[job_directory] = (runtime, cpu, gpu, ram)
+
+  def __get_job(self, job_dir):
+    """
+    Args:
+      job_dir: The directory of a job.
+    Returns:
+      The (runtime, CPU fraction, GPU fraction, RAM fraction) tuple for the
+      job. """
+    if self.__default_runtime is not None and job_dir not in self.__jobs:
+      return (self.__default_runtime, 0.0, 0.0, 0.0)
+    return self.__jobs[job_dir]
+
+  def make_container(self, container, job_dir, name):
+    """ Makes a container. This has the same arguments as docker.Container,
+    so it can be passed as the container class for jobs. """
+    return FakeContainer(self, container, job_dir, name)
+
+  def __accumulate(self):
+    """ Adds the usage since the last update to the busy time. """
+    now = time.monotonic()
+    if self.__last_update is not None:
+      elapsed = now - self.__last_update
+      self.__busy_cpu += self.__cpu * elapsed
+      self.__busy_gpu += self.__gpu * elapsed
+    self.__last_update = now
+
+  def start(self, container, job_dir):
+    """ Called when a container starts.
+    Args:
+      container: The container.
+      job_dir: The directory of its job.
+    Returns:
+      How long the container should run for, in seconds. """
+    runtime, cpu, gpu, _ = self.__get_job(job_dir)
+    with self.__lock:
+      self.__accumulate()
+      self.__running.add(container)
+      self.__names[container.get_name()] = job_dir
+      self.__cpu += cpu
+      self.__gpu += gpu
+      self.peak_cpu = max(self.peak_cpu, self.__cpu)
+      self.dispatched += 1
+    return runtime
+
+  def finish(self, container, job_dir):
+    """ Called when a container exits.
+    Args:
+      container: The container.
+      job_dir: The directory of its job. """
+    _, cpu, gpu, _ = self.__get_job(job_dir)
+    with self.__lock:
+      self.__accumulate()
+      self.__running.discard(container)
+      self.__names.pop(container.get_name(), None)
+      self.__cpu -= cpu
+      self.__gpu -= gpu
+      self.finished += 1
+
+  def get_num_running(self):
+    """
+    Returns:
+      The number of containers that are running. """
+    return len(self.__running)
+
+  def get_usage(self, name):
+    """
+    Args:
+      name: The name of a container.
+    Returns:
+      The fractions of the machine's CPU and RAM that the container uses, or
+      None if it isn't running. """
+    job_dir = self.__names.get(name)
+    if job_dir is None:
+      return None
+    _, cpu, _, ram = self.__get_job(job_dir)
+    return cpu, ram
+
+  def get_busy_time(self):
+    """
+    Returns:
+      The CPU and GPU busy time so far, in machine-seconds. """
+    with self.__lock:
+      self.__accumulate()
+    return self.__busy_cpu, self.__busy_gpu
+
+
+class FakeContainer:
+  """ Stands in for docker.Container. The job "runs" until its runtime is up,
+  and exits cleanly. Signals and kills make it exit right away. """
+
+  def __init__(self, backend, container, job_dir, name):
+    """
+    Args:
+      backend: The FakeBackend that the container runs on.
+      container: The image to run.
+      job_dir: The directory of the job.
+      name: The name of the container. """
+    self.__backend = backend
+    self.__job_dir = job_dir
+    self.__name = name
+    # When the container will exit, or None if it isn't running.
+    self.__end_time = None
+    self.__finished = False
+
+  def run_exe(self, exe, stdout, stderr, environment=None, gpus=(), cpus=None,
+              memory=None, cpuset_cpus=None, cpuset_mems=None):
+    """ Starts the container. Takes the same arguments as
+    docker.Container.run_exe(). """
+    self.__backend.placements[self.__name] = (tuple(gpus), cpuset_cpus,
+                                              cpuset_mems)
+    if self.__backend.launch_delay:
+      time.sleep(self.__backend.launch_delay)
+    runtime = self.__backend.start(self, self.__job_dir)
+    self.__end_time = time.monotonic() + runtime
+
+  def reattach(self, stdout, stderr):
+    """ Fake containers don't survive restarts, so this just acts as though it
+    already exited. """
+    self.__end_time = time.monotonic()
+    self.__finished = True
+
+  def get_name(self):
+    """
+    Returns:
+      The name of the container. """
+    return self.__name
+
+  def get_output_fd(self):
+    """
+    Returns:
+      None, since fake containers don't produce output. """
+    return None
+
+  def pump_output(self):
+    """
+    Returns:
+      True if the container has exited. """
+    return self.__finished or time.monotonic() >= self.__end_time
+
+  def signal(self, signal_name):
+    """ Signals the container, which makes it exit. """
+    self.__end_time = time.monotonic()
+
+  def kill(self, reason):
+    """ Kills the container. """
+    self.__end_time = time.monotonic()
+
+  def is_finished(self):
+    """
+    Returns:
+      True if the container is finished executing, False otherwise. """
+    if self.__finished:
+      return True
+    if not self.pump_output():
+      return False
+
+    self.__finished = True
+    self.__backend.finish(self, self.__job_dir)
+    return True
+
+
+class FakeContainerTelemetry:
+  """ Stands in for telemetry.ContainerTelemetry. Containers are measured as
+  using exactly what they were registered with in the FakeBackend, as soon as
+  they start. """
+
+  def __init__(self, backend):
+    """
+    Args:
+      backend: The FakeBackend that the containers run on. """
+    self.__backend = backend
+    self.__cores = cpu_count()
+    self.__total_ram = os.sysconf("SC_PAGE_SIZE") * \
+                       os.sysconf("SC_PHYS_PAGES")
+
+  def start(self):
+    """ Does nothing, since there is nothing to sample. """
+
+  def add(self, name):
+    """ Does nothing, since every container is measured. """
+
+  def remove(self, name):
+    """ Does nothing, since every container is measured. """
+
+  def get_usage(self, name):
+    """ Takes the same arguments as telemetry.ContainerTelemetry.get_usage(),
+    and returns the same thing. """
+    usage = self.__backend.get_usage(name)
+    if usage is None:
+      return None
+    cpu, ram = usage
+    return cpu * self.__cores * 100, ram * self.__total_ram
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+
+
+import argparse
+import functools
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                "daemon"))
+
+from fake_backends import FakeBackend, make_gpus
+from job import Job, JobConfig
+from launcher import Launcher
+from manager import Manager
+
+
+""" Simulates bursts of job starts with containers that are slow to start, as
+when a job that used every GPU finishes and a batch of small jobs takes its
+place. It compares starting containers one at a time during the update with
+starting them in the background, by how long updates stall and how long it
+takes the burst to get running. """
+
+
+def _make_config(name, gpu_count, gpu):
+  """ Makes the configuration for a kind of job.
+  Args:
+    name: The name of the job.
+    gpu_count: The number of GPUs it uses.
+    gpu: The percentage of each GPU that it uses.
+  Returns:
+    The JobConfig. """
+  return JobConfig({"Name": name,
+                    "Description": "Benchmark job.",
+                    "Container": "benchmark:latest",
+                    "ResourceUsage": [
+                        {"CpuUsage": 1},
+                        {"RamUsage": 1000000},
+                        {"GpuCount": gpu_count},
+                        {"GpuUsage": gpu},
+                        {"VramUsage": 1000000}]})
+
+def _make_jobs(directory, args):
+  """ Makes the jobs to run. Each round is a job that takes up every GPU,
+  followed by a burst of small jobs that can only start once it's done.
+  Args:
+    directory: The directory to make job directories in.
+    args: The parsed command line arguments.
+  Returns:
+    A list of (job directory, config, runtime, GPU fraction) tuples, in the
+    order that they are submitted. """
+  big = _make_config("big", args.gpus, 100)
+  # The small jobs share GPUs, so the whole burst fits at once.
+  per_gpu = -(-args.burst // args.gpus)
+  small = _make_config("small", 1, 100 // per_gpu)
+
+  jobs = []
+  for round_number in range(args.rounds):
+    for job_number in range(args.burst + 1):
+      job_directory = os.path.join(directory,
+                                   "%d-%d" % (round_number, job_number))
+      os.mkdir(job_directory)
+      if job_number == 0:
+        jobs.append((job_directory, big, args.big_runtime, 1.0))
+      else:
+        jobs.append((job_directory, small, args.small_runtime,
+                     1 / args.burst))
+
+  return jobs
+
+def _get_percentile(values, percentile):
+  """
+  Args:
+    values: A sorted list of values.
+    percentile: The percentile to get, from 0 to 100.
+  Returns:
+    The value at that percentile. """
+  if not values:
+    return 0.0
+  index = min(len(values) - 1, int(len(values) * percentile / 100))
+  return values[index]
+
+def _run(jobs, args, workers):
+  """ Runs the jobs to completion.
+  Args:
+    jobs: The jobs to run, as returned by _make_jobs().
+    args: The parsed command line arguments.
+    workers: The number of threads to start containers with, or 0 to start
+    them during the update.
+  Returns:
+    A dictionary of results. """
+  backend = FakeBackend(args.gpus, launch_delay=args.launch_delay)
+  for job_directory, _, runtime, gpu in jobs:
+    backend.add_job(job_directory, runtime, 0.0, gpu)
+
+  make_job = functools.partial(Job, container_class=backend.make_container)
+  launcher = None
+  if workers:
+    launcher = Launcher(workers=workers)
+  manager = Manager(gpus=make_gpus(args.gpus), make_job=make_job,
+                    launcher=launcher)
+  job_ids = []
+  for result in manager.admit_jobs([(job_directory, config) \
+                                    for job_directory, config, _, _ in jobs]):
+    job_ids.extend(result)
+
+  update_times = []
+  start_time = time.monotonic()
+  while backend.finished < len(jobs):
+    if time.monotonic() - start_time > args.timeout:
+      break
+    update_start = time.perf_counter()
+    manager.update()
+    update_times.append(time.perf_counter() - update_start)
+    time.sleep(args.tick)
+  elapsed = time.monotonic() - start_time
+
+  index = manager.get_index()
+  launch_times = sorted([index.get(job_id)["launch_time"] \
+                         for job_id in job_ids \
+                         if index.get(job_id)["launch_time"] is not None])
+  update_times.sort()
+  return {"jobs": len(jobs),
+          "completed": backend.finished == len(jobs),
+          "elapsed": elapsed,
+          "updates": len(update_times),
+          "p50_update_ms": _get_percentile(update_times, 50) * 1000,
+          "p99_update_ms": _get_percentile(update_times, 99) * 1000,
+          "max_update_ms": update_times[-1] * 1000 if update_times else 0.0,
+          "p50_launch_ms": _get_percentile(launch_times, 50) * 1000,
+          "p99_launch_ms": _get_percentile(launch_times, 99) * 1000}
+
+def main():
+  parser = argparse.ArgumentParser( \
+      description="Compare starting containers during updates with starting" \
+                  " them in the background.")
+  parser.add_argument("--gpus", type=int, default=8,
+                      help="Number of fake GPUs.")
+  parser.add_argument("--rounds", type=int, default=10,
+                      help="Number of bursts of jobs.")
+  parser.add_argument("--burst", type=int, default=16,
+                      help="Number of small jobs that start at once in each" \
+                           " burst.")
+  parser.add_argument("--big-runtime", type=float, default=0.2,
+                      help="How long the job that uses every GPU runs for, in" \
+                           " seconds.")
+  parser.add_argument("--small-runtime", type=float, default=0.5,
+                      help="How long each small job runs for, in seconds.")
+  parser.add_argument("--launch-delay", type=float, default=0.1,
+                      help="How long it takes to start a container, in" \
+                           " seconds.")
+  parser.add_argument("--workers", type=int, action="append",
+                      help="Number of threads to start containers with. Can" \
+                           " be given more than once. Defaults to 4 and 16.")
+  parser.add_argument("--tick", type=float, default=0.005,
+                      help="Time to sleep between updates, in seconds.")
+  parser.add_argument("--timeout", type=float, default=600,
+                      help="Maximum time to run each simulation for, in" \
+                           " seconds.")
+  parser.add_argument("-o", "--output",
+                      help="File to save the results to, as JSON.")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARNING)
+
+  results = {"time": time.time(), "config": vars(args), "runs": {}}
+  directory = tempfile.mkdtemp(prefix="stoplight-benchmark-")
+  try:
+    jobs = _make_jobs(directory, args)
+    for workers in [0] + (args.workers or [4, 16]):
+      name = "inline" if not workers else "%d workers" % (workers)
+      result = _run(jobs, args, workers)
+      results["runs"][name] = result
+
+      print("%-10s %4d jobs in %5.1f s: update p50 %6.2f ms, p99 %7.2f ms," \
+            " max %7.2f ms; launch p50 %6.1f ms, p99 %6.1f ms" % \
+            (name, result["jobs"], result["elapsed"], result["p50_update_ms"],
+             result["p99_update_ms"], result["max_update_ms"],
+             result["p50_launch_ms"], result["p99_launch_ms"]))
+      if not result["completed"]:
+        print("%s: timed out before every job finished" % (name))
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+  if args.output:
+    with open(args.output, "w") as output_file:
+      json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,434 @@
+#!/usr/bin/python3
+
+
+import argparse
+import functools
+import json
+import logging
+from multiprocessing import cpu_count
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                "daemon"))
+
+from fake_backends import FakeBackend, make_gpus
+from fairshare import FairShare
+from job import Job, JobConfig
+from manager import Manager
+from scheduler import RESERVATIONS
+
+
+""" Measures how long Manager.update() takes under synthetic workloads, using
+fake GPUs and containers, and saves the results as JSON so that regressions in
+the scheduling loop can be caught. """
+
+
+# VRAM on each fake GPU.
+_GPU_VRAM = 16000000000
+# Owners that submit jobs.
+_OWNERS = ("alice", "bob", "carol", "dave")
+
+
+class _Workload:
+  """ A stream of job batches to submit. """
+
+  def __init__(self, name, directory, num_gpus):
+    """
+    Args:
+      name: The name of the workload.
+      directory: The directory to make job directories in.
+      num_gpus: The number of GPUs on the machine. """
+    self.name = name
+    self.__directory = directory
+    self.__num_gpus = num_gpus
+    self.__cores = cpu_count()
+    self.__total_ram = os.sysconf("SC_PAGE_SIZE") * \
+                       os.sysconf("SC_PHYS_PAGES")
+    # Configs are shared between jobs with the same shape, as they are when
+    # jobs are loaded.
+    self.__configs = {}
+
+    # List of (arrival time, owner, [(job directory, config)]) tuples.
+    self.batches = []
+    # Maps job directories to (runtime, CPU fraction, GPU fraction) tuples.
+    self.jobs = {}
+
+  def __get_config(self, cpu, gpu_count, gpu, vram, max_runtime):
+    """ Gets the config for a job shape.
+    Args:
+      cpu: The fraction of the machine's CPU that the job uses.
+      gpu_count: The number of GPUs that the job uses.
+      gpu: The percentage of each GPU that the job uses.
+      vram: The VRAM that the job uses on each GPU.
+      max_runtime: The MaxRuntime of the job, or None.
+    Returns:
+      The JobConfig. """
+    key = (cpu, gpu_count, gpu, vram, max_runtime)
+    config = self.__configs.get(key)
+    if config is None:
+      data = {"Name": "%s-%d-%d" % (self.name, gpu_count, gpu),
+              "Description": "Benchmark job.",
+              "Container": "benchmark:latest",
+              "ResourceUsage": [{"CpuUsage": cpu * self.__cores * 100},
+                                {"RamUsage": self.__total_ram // 100},
+                                {"GpuCount": gpu_count},
+                                {"GpuUsage": gpu},
+                                {"VramUsage": vram}]}
+      if max_runtime is not None:
+        data["MaxRuntime"] = max_runtime
+      config = JobConfig(data)
+      self.__configs[key] = config
+
+    return config
+
+  def add_batch(self, arrival, owner, jobs):
+    """ Adds a batch of jobs that are submitted together.
+    Args:
+      arrival: When the batch is submitted, in seconds from the start.
+      owner: The owner of the jobs.
+      jobs: A list of (CPU fraction, GPU count, GPU percentage, VRAM, runtime,
+      MaxRuntime) tuples. """
+    batch = []
+    for cpu, gpu_count, gpu, vram, runtime, max_runtime in jobs:
+      job_directory = os.path.join(self.__directory, str(len(self.jobs)))
+      os.mkdir(job_directory)
+      config = self.__get_config(cpu, gpu_count, gpu, vram, max_runtime)
+      batch.append((job_directory, config))
+      self.jobs[job_directory] = (runtime, cpu,
+                                  gpu_count * gpu / 100 / self.__num_gpus)
+
+    self.batches.append((arrival, owner, batch))
+
+  def get_num_jobs(self):
+    """
+    Returns:
+      The number of jobs in the workload. """
+    return len(self.jobs)
+
+
+def _make_shape(rng, num_gpus, mean_runtime):
+  """ Makes a random job from a mix of sizes. Most jobs share a GPU, some use
+  a whole one, and a few use every GPU.
+  Args:
+    rng: The random number generator to use.
+    num_gpus: The number of GPUs on the machine.
+    mean_runtime: The mean runtime of small jobs, in seconds.
+  Returns:
+    A job tuple, as accepted by _Workload.add_batch(). """
+  kind = rng.random()
+  if kind < 0.7:
+    shape = (0.25 / num_gpus, 1, rng.choice((25, 50)), _GPU_VRAM // 4)
+    runtime = rng.uniform(0.5, 1.5) * mean_runtime
+  elif kind < 0.95:
+    shape = (0.5 / num_gpus, 1, 100, _GPU_VRAM // 2)
+    runtime = rng.uniform(1, 3) * mean_runtime
+  else:
+    shape = (0.25, num_gpus, 100, _GPU_VRAM // 2)
+    runtime = rng.uniform(2, 5) * mean_runtime
+
+  # Half of the jobs declare a MaxRuntime, which is an overestimate.
+  max_runtime = None
+  if rng.random() < 0.5:
+    max_runtime = runtime * rng.uniform(1.0, 2.0)
+  return shape + (runtime, max_runtime)
+
+def _get_gpu_work(shape, num_gpus):
+  """
+  Args:
+    shape: A job tuple, as accepted by _Workload.add_batch().
+    num_gpus: The number of GPUs on the machine.
+  Returns:
+    The amount of work in the job, in machine-seconds. """
+  _, gpu_count, gpu, _, runtime, _ = shape
+  return gpu_count * gpu / 100 * runtime / num_gpus
+
+def _make_sweep(workload, args, rng):
+  """ A parameter sweep: lots of identical jobs submitted at once. """
+  shapes = []
+  for _ in range(args.jobs):
+    runtime = rng.uniform(0.5, 1.5) * args.mean_runtime
+    shapes.append((0.5 / args.gpus, 1, 100, _GPU_VRAM // 2, runtime, None))
+  workload.add_batch(0.0, _OWNERS[0], shapes)
+
+def _make_mixed(workload, args, rng):
+  """ Jobs of mixed sizes from several owners, arriving one at a time. """
+  shapes = [_make_shape(rng, args.gpus, args.mean_runtime) \
+            for _ in range(args.jobs)]
+  # Space out the arrivals so that the machine gets the requested load.
+  work = sum([_get_gpu_work(shape, args.gpus) for shape in shapes])
+  mean_gap = work / args.load / len(shapes)
+
+  arrival = 0.0
+  for shape in shapes:
+    arrival += rng.expovariate(1 / mean_gap)
+    workload.add_batch(arrival, rng.choice(_OWNERS), [shape])
+
+def _make_bursty(workload, args, rng):
+  """ Bursts of mixed jobs, with quiet periods in between. """
+  shapes = [_make_shape(rng, args.gpus, args.mean_runtime) \
+            for _ in range(args.jobs)]
+  work = sum([_get_gpu_work(shape, args.gpus) for shape in shapes])
+  num_bursts = max(1, len(shapes) // args.burst_size)
+  gap = work / args.load / num_bursts
+
+  for burst in range(num_bursts):
+    end = len(shapes) if burst == num_bursts - 1 \
+          else (burst + 1) * args.burst_size
+    workload.add_batch(burst * gap, rng.choice(_OWNERS),
+                       shapes[burst * args.burst_size:end])
+
+# Maps workload names to the functions that generate them.
+_WORKLOADS = {"sweep": _make_sweep, "mixed": _make_mixed,
+              "bursty": _make_bursty}
+
+
+def _make_manager(backend, args):
+  """ Makes a manager that runs jobs on a fake backend.
+  Args:
+    backend: The FakeBackend.
+    args: The parsed command line arguments.
+  Returns:
+    The Manager. """
+  make_job = functools.partial(Job, container_class=backend.make_container)
+  fair_share = None
+  if args.fair_share:
+    fair_share = FairShare(half_life=60)
+  return Manager(policy=args.policy, fair_share=fair_share,
+                 gpus=make_gpus(args.gpus, _GPU_VRAM), make_job=make_job)
+
+def _measure_memory(workload, args):
+  """ Measures how much memory each queued job takes up.
+  Args:
+    workload: The workload to queue.
+    args: The parsed command line arguments.
+  Returns:
+    The memory used per queued job, in bytes. """
+  manager = _make_manager(FakeBackend(args.gpus), args)
+
+  tracemalloc.start()
+  before = tracemalloc.take_snapshot()
+  for _, owner, batch in workload.batches:
+    manager.admit_jobs(batch, owner=owner)
+  after = tracemalloc.take_snapshot()
+  tracemalloc.stop()
+
+  used = sum([stat.size_diff for stat in after.compare_to(before, "filename")])
+  return used / workload.get_num_jobs()
+
+def _get_percentile(values, percentile):
+  """
+  Args:
+    values: A sorted list of values.
+    percentile: The percentile to get, from 0 to 100.
+  Returns:
+    The value at that percentile. """
+  if not values:
+    return 0.0
+  index = min(len(values) - 1, int(len(values) * percentile / 100))
+  return values[index]
+
+def _summarize_ticks(tick_times):
+  """
+  Args:
+    tick_times: A list of tick times, in seconds.
+  Returns:
+    A dictionary of statistics about the tick times, in milliseconds. """
+  tick_times = sorted(tick_times)
+  return {"mean": sum(tick_times) / max(1, len(tick_times)) * 1000,
+          "p50": _get_percentile(tick_times, 50) * 1000,
+          "p90": _get_percentile(tick_times, 90) * 1000,
+          "p99": _get_percentile(tick_times, 99) * 1000,
+          "max": _get_percentile(tick_times, 100) * 1000}
+
+def _run(workload, args):
+  """ Runs a workload to completion, and measures every update.
+  Args:
+    workload: The workload to run.
+    args: The parsed command line arguments.
+  Returns:
+    A dictionary of results. """
+  backend = FakeBackend(args.gpus)
+  for job_directory, (runtime, cpu, gpu) in workload.jobs.items():
+    backend.add_job(job_directory, runtime, cpu, gpu)
+  manager = _make_manager(backend, args)
+
+  num_jobs = workload.get_num_jobs()
+  submitted = 0
+  next_batch = 0
+  tick_times = []
+  # Maps queue depth buckets to the tick times at those depths.
+  depth_ticks = {}
+  max_dispatched = 0
+
+  start_time = time.monotonic()
+  while backend.finished < num_jobs:
+    now = time.monotonic() - start_time
+    if now > args.timeout:
+      break
+
+    tick_start = time.perf_counter()
+    while next_batch < len(workload.batches) and \
+          workload.batches[next_batch][0] <= now:
+      _, owner, batch = workload.batches[next_batch]
+      manager.admit_jobs(batch, owner=owner)
+      submitted += len(batch)
+      next_batch += 1
+    queue_depth = submitted - backend.dispatched
+
+    dispatched = backend.dispatched
+    manager.update()
+    tick_time = time.perf_counter() - tick_start
+    max_dispatched = max(max_dispatched, backend.dispatched - dispatched)
+
+    tick_times.append(tick_time)
+    # Group queue depths by powers of two.
+    depth_ticks.setdefault(queue_depth.bit_length(), []).append(tick_time)
+
+    time.sleep(args.tick)
+
+  elapsed = time.monotonic() - start_time
+  busy_cpu, busy_gpu = backend.get_busy_time()
+  update_time = sum(tick_times)
+
+  by_depth = []
+  for bucket, times in sorted(depth_ticks.items()):
+    stats = _summarize_ticks(times)
+    by_depth.append({"min_depth": (1 << bucket) >> 1,
+                     "max_depth": (1 << bucket) - 1, "ticks": len(times),
+                     "mean_ms": stats["mean"], "p99_ms": stats["p99"]})
+
+  return {"jobs": num_jobs,
+          "completed": backend.finished == num_jobs,
+          "elapsed": elapsed,
+          "ticks": len(tick_times),
+          "tick_ms": _summarize_ticks(tick_times),
+          "dispatched": backend.dispatched,
+          "dispatch_per_second": backend.dispatched / elapsed,
+          "dispatch_per_update_second": backend.dispatched / update_time,
+          "max_dispatched_per_tick": max_dispatched,
+          "queue_depth": by_depth,
+          "utilization": {"cpu": busy_cpu / elapsed,
+                          "gpu": busy_gpu / elapsed}}
+
+def _compare(results, baseline, tolerance):
+  """ Compares tick times against a baseline.
+  Args:
+    results: The results of this run.
+    baseline: The results of an earlier run.
+    tolerance: How much slower, as a fraction, counts as a regression.
+  Returns:
+    A list of messages about regressions. """
+  regressions = []
+  for name, result in results["workloads"].items():
+    old = baseline["workloads"].get(name)
+    if old is None:
+      continue
+
+    for stat in ("p50", "p99"):
+      new_time = result["tick_ms"][stat]
+      old_time = old["tick_ms"][stat]
+      if old_time and new_time > old_time * (1 + tolerance):
+        regressions.append("%s: %s tick time went from %.3f ms to %.3f ms" % \
+                           (name, stat, old_time, new_time))
+
+    new_memory = result["memory_per_job"]
+    old_memory = old["memory_per_job"]
+    if old_memory and new_memory > old_memory * (1 + tolerance):
+      regressions.append("%s: memory per job went from %.0f to %.0f bytes" % \
+                         (name, old_memory, new_memory))
+
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser( \
+      description="Benchmark Manager.update() with fake backends.")
+  parser.add_argument("--workloads", default="sweep,mixed,bursty",
+                      help="Comma-separated workloads to run. Options are: %s" \
+                           % (", ".join(sorted(_WORKLOADS))))
+  parser.add_argument("--jobs", type=int, default=2000,
+                      help="Number of jobs in each workload.")
+  parser.add_argument("--gpus", type=int, default=8,
+                      help="Number of fake GPUs.")
+  parser.add_argument("--mean-runtime", type=float, default=0.5,
+                      help="Mean runtime of small jobs, in seconds.")
+  parser.add_argument("--load", type=float, default=0.9,
+                      help="Offered load, relative to the machine capacity.")
+  parser.add_argument("--burst-size", type=int, default=200,
+                      help="Number of jobs in each burst.")
+  parser.add_argument("--policy", default="greedy", choices=RESERVATIONS,
+                      help="Scheduling policy.")
+  parser.add_argument("--fair-share", action="store_true",
+                      help="Order jobs by fair-share.")
+  parser.add_argument("--tick", type=float, default=0.01,
+                      help="Time to sleep between updates, in seconds.")
+  parser.add_argument("--timeout", type=float, default=600,
+                      help="Maximum time to run each workload for, in" \
+                           " seconds.")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="Random seed.")
+  parser.add_argument("-o", "--output",
+                      help="File to save the results to, as JSON.")
+  parser.add_argument("--baseline",
+                      help="Results from an earlier run to compare against.")
+  parser.add_argument("--tolerance", type=float, default=0.2,
+                      help="Slowdown relative to the baseline that counts as" \
+                           " a regression.")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARNING)
+
+  names = args.workloads.split(",")
+  for name in names:
+    if name not in _WORKLOADS:
+      parser.error("Unknown workload: %s" % (name))
+
+  results = {"time": time.time(), "python": platform.python_version(),
+             "machine": platform.machine(), "cores": cpu_count(),
+             "config": vars(args), "workloads": {}}
+  directory = tempfile.mkdtemp(prefix="stoplight-benchmark-")
+  try:
+    for name in names:
+      workload_directory = os.path.join(directory, name)
+      os.mkdir(workload_directory)
+      workload = _Workload(name, workload_directory, args.gpus)
+      _WORKLOADS[name](workload, args, random.Random(args.seed))
+
+      result = _run(workload, args)
+      result["memory_per_job"] = _measure_memory(workload, args)
+      results["workloads"][name] = result
+
+      ticks = result["tick_ms"]
+      print("%-7s %5d jobs in %6.1f s: tick p50 %.3f ms, p99 %.3f ms," \
+            " max %.3f ms; %.0f jobs/s dispatched, %.0f bytes/queued job," \
+            " %.1f%% GPU utilization" % \
+            (name, result["dispatched"], result["elapsed"], ticks["p50"],
+             ticks["p99"], ticks["max"], result["dispatch_per_update_second"],
+             result["memory_per_job"], result["utilization"]["gpu"] * 100))
+      if not result["completed"]:
+        print("%s: timed out before every job finished" % (name))
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+  if args.output:
+    with open(args.output, "w") as output_file:
+      json.dump(results, output_file, indent=2)
+
+  if args.baseline:
+    with open(args.baseline) as baseline_file:
+      baseline = json.load(baseline_file)
+    regressions = _compare(results, baseline, args.tolerance)
+    for regression in regressions:
+      print("Regression: %s" % (regression))
+    if regressions:
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+
+
+import argparse
+import functools
+import json
+import logging
+from multiprocessing import cpu_count
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                "daemon"))
+
+from fake_backends import FakeBackend, FakeContainerTelemetry, make_gpus
+from job import Job, JobConfig
+from manager import Manager
+from overcommit import Overcommit
+
+
+""" Simulates a queue of CPU jobs that declare more CPU and RAM than they use,
+with and without overcommitting, to show how much more work gets done when
+jobs are placed against their measured usage. """
+
+
+def _make_jobs(directory, args, rng):
+  """ Makes the jobs to run.
+  Args:
+    directory: The directory to make job directories in.
+    args: The parsed command line arguments.
+  Returns:
+    A list of (job directory, config, runtime, CPU fraction, RAM fraction)
+    tuples, where the fractions are what the job really uses, of the whole
+    machine. """
+  cores = cpu_count()
+  total_ram = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+  # Every job declares the same thing, as in a parameter sweep.
+  config = JobConfig({"Name": "overcommit",
+                      "Description": "Benchmark job.",
+                      "Container": "benchmark:latest",
+                      "ResourceUsage": [
+                          {"CpuUsage": args.cpu * cores * 100},
+                          {"RamUsage": int(args.ram * total_ram)},
+                          {"GpuCount": 0}]})
+
+  jobs = []
+  for job_number in range(args.jobs):
+    job_directory = os.path.join(directory, str(job_number))
+    os.mkdir(job_directory)
+    used = rng.uniform(args.min_used, args.max_used)
+    runtime = rng.uniform(0.5, 1.5) * args.mean_runtime
+    jobs.append((job_directory, config, runtime, args.cpu * used,
+                 args.ram * used))
+
+  return jobs
+
+def _run(jobs, args, overcommit):
+  """ Runs the jobs to completion.
+  Args:
+    jobs: The jobs to run, as returned by _make_jobs().
+    args: The parsed command line arguments.
+    overcommit: The Overcommit to use, or None to place jobs against what
+    they declared.
+  Returns:
+    A dictionary of results. """
+  backend = FakeBackend(1)
+  for job_directory, _, runtime, cpu, ram in jobs:
+    backend.add_job(job_directory, runtime, cpu, 0.0, ram=ram)
+
+  make_job = functools.partial(Job, container_class=backend.make_container)
+  container_telemetry = None
+  if overcommit:
+    container_telemetry = FakeContainerTelemetry(backend)
+  manager = Manager(warmup=args.warmup, gpus=make_gpus(1), make_job=make_job,
+                    container_telemetry=container_telemetry,
+                    overcommit=overcommit, enforce_limits=True)
+  manager.admit_jobs([(job_directory, config) \
+                      for job_directory, config, _, _, _ in jobs])
+
+  max_running = 0
+  start_time = time.monotonic()
+  while backend.finished < len(jobs):
+    if time.monotonic() - start_time > args.timeout:
+      break
+    manager.update()
+    max_running = max(max_running, backend.get_num_running())
+    time.sleep(args.tick)
+
+  elapsed = time.monotonic() - start_time
+  busy_cpu, _ = backend.get_busy_time()
+  return {"jobs": len(jobs),
+          "completed": backend.finished == len(jobs),
+          "elapsed": elapsed,
+          "jobs_per_second": backend.finished / elapsed,
+          "max_running": max_running,
+          "cpu_utilization": busy_cpu / elapsed,
+          "peak_cpu": backend.peak_cpu}
+
+def main():
+  parser = argparse.ArgumentParser( \
+      description="Simulate overcommitting CPU and RAM with fake backends.")
+  parser.add_argument("--jobs", type=int, default=400,
+                      help="Number of jobs to run.")
+  parser.add_argument("--cpu", type=float, default=0.125,
+                      help="Fraction of the machine's CPU that each job" \
+                           " declares.")
+  parser.add_argument("--ram", type=float, default=0.05,
+                      help="Fraction of the machine's RAM that each job" \
+                           " declares.")
+  parser.add_argument("--min-used", type=float, default=0.2,
+                      help="Least that a job really uses, as a fraction of" \
+                           " what it declared.")
+  parser.add_argument("--max-used", type=float, default=0.6,
+                      help="Most that a job really uses, as a fraction of" \
+                           " what it declared.")
+  parser.add_argument("--mean-runtime", type=float, default=0.5,
+                      help="Mean runtime of the jobs, in seconds.")
+  parser.add_argument("--ratio", type=float, default=1.5,
+                      help="The most that the declared usage can be, as a" \
+                           " multiple of the machine.")
+  parser.add_argument("--headroom", type=float, default=10.0,
+                      help="Percentage of the machine to leave free on top" \
+                           " of the measured usage.")
+  parser.add_argument("--warmup", type=float, default=0.1,
+                      help="How long after a job starts before its" \
+                           " measurements are used, in seconds.")
+  parser.add_argument("--tick", type=float, default=0.01,
+                      help="Time to sleep between updates, in seconds.")
+  parser.add_argument("--timeout", type=float, default=600,
+                      help="Maximum time to run each simulation for, in" \
+                           " seconds.")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="Random seed.")
+  parser.add_argument("-o", "--output",
+                      help="File to save the results to, as JSON.")
+  args = parser.parse_args()
+
+  if args.ratio < 1:
+    parser.error("--ratio must be at least 1.")
+  logging.basicConfig(level=logging.WARNING)
+
+  results = {"time": time.time(), "cores": cpu_count(), "config": vars(args)}
+  directory = tempfile.mkdtemp(prefix="stoplight-benchmark-")
+  try:
+    jobs = _make_jobs(directory, args, random.Random(args.seed))
+    results["declared"] = _run(jobs, args, None)
+    results["overcommit"] = _run(jobs, args,
+                                 Overcommit(max_ratio=args.ratio,
+                                            headroom=args.headroom))
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+  for name in ("declared", "overcommit"):
+    result = results[name]
+    print("%-10s %4d jobs in %6.1f s: %.1f jobs/s, up to %d running," \
+          " %.1f%% mean CPU utilization, %.1f%% peak CPU" % \
+          (name, result["jobs"], result["elapsed"],
+           result["jobs_per_second"], result["max_running"],
+           result["cpu_utilization"] * 100, result["peak_cpu"] * 100))
+    if not result["completed"]:
+      print("%s: timed out before every job finished" % (name))
+  results["speedup"] = results["overcommit"]["jobs_per_second"] / \
+                       results["declared"]["jobs_per_second"]
+  print("Overcommitting got %.2fx the throughput." % (results["speedup"]))
+
+  if args.output:
+    with open(args.output, "w") as output_file:
+      json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+  main()
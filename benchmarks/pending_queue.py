@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+
+
+import argparse
+from collections import deque
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                "daemon"))
+
+from scheduler import PendingQueue, choose_gpus
+
+
+""" Measures how long it takes the scheduler to find runnable jobs, as a
+function of the number of queued jobs. Jobs run on a simulated machine with
+several GPUs, so that every tick some of them finish and others get placed,
+and the queue holds many distinct kinds of job, from different owners, with
+different priorities and images. The indexed PendingQueue is compared with the
+loop that the manager used before it, which rotated through every pending job
+and worked out its requirements each time it looked at it. """
+
+
+# The simulated machine.
+_CPU_CORES = 32
+_TOTAL_RAM = 256 * 2 ** 30
+_NUM_GPUS = 8
+_GPU_VRAM = 32 * 2 ** 30
+
+
+class _Job:
+  """ A queued job. """
+
+  def __init__(self, kind, runtime):
+    """
+    Args:
+      kind: The (owner, priority, usage, image) tuple that the job was made
+      from, where the usage is a (CPU percent of a core, RAM bytes, GPU count,
+      GPU percent, VRAM bytes) tuple, like a ResourceUsage.
+      runtime: The number of ticks that the job runs for. """
+    self.owner, self.priority, self.usage, self.image = kind
+    self.runtime = runtime
+
+
+class _Machine:
+  """ Keeps track of what is in use on the simulated machine. """
+
+  def __init__(self):
+    self.__cpu = 0
+    self.__ram = 0
+    self.__gpu_usage = [0] * _NUM_GPUS
+    self.__vram_usage = [0] * _NUM_GPUS
+    self.__total_vram = [_GPU_VRAM] * _NUM_GPUS
+
+  def get_remaining(self):
+    """
+    Returns:
+      The CPU and RAM percentages that are left, and whether any GPU has room
+      left. """
+    return 100 - self.__cpu, 100 - self.__ram, \
+           min(self.__gpu_usage) < 100
+
+  def place(self, requirements):
+    """ Reserves resources for a job, if it fits.
+    Args:
+      requirements: The requirement vector of the job.
+    Returns:
+      The IDs of the GPUs for the job, or None if it doesn't fit. """
+    cpu, ram, count, gpu, vram = requirements
+    if cpu > 100 - self.__cpu or ram > 100 - self.__ram:
+      return None
+    gpus = choose_gpus(count, gpu, vram, self.__gpu_usage, self.__vram_usage,
+                       self.__total_vram)
+    if gpus is None:
+      return None
+
+    self.__add(requirements, gpus, 1)
+    return gpus
+
+  def has_room(self, smallest):
+    """ Checks whether a job could still fit, the same way as
+    scheduler.Planner.has_room().
+    Args:
+      smallest: The smallest value of each requirement over the queued jobs.
+    Returns:
+      False if no job that needs at least that much can fit. """
+    cpu, ram, count, gpu, vram = smallest
+    if cpu > 100 - self.__cpu or ram > 100 - self.__ram:
+      return False
+    free = [gpu_id for gpu_id in range(_NUM_GPUS) \
+            if gpu <= 100 - self.__gpu_usage[gpu_id] and \
+               vram <= self.__total_vram[gpu_id] - self.__vram_usage[gpu_id]]
+    return len(free) >= count
+
+  def release(self, requirements, gpus):
+    """ Frees the resources of a job that finished.
+    Args:
+      requirements: The requirement vector of the job.
+      gpus: The IDs of its GPUs. """
+    self.__add(requirements, gpus, -1)
+
+  def __add(self, requirements, gpus, sign):
+    """ Adds to or removes from the usage.
+    Args:
+      requirements: The requirement vector of a job.
+      gpus: The IDs of its GPUs.
+      sign: 1 to add the job, or -1 to remove it. """
+    cpu, ram, _, gpu, vram = requirements
+    self.__cpu += sign * cpu
+    self.__ram += sign * ram
+    for gpu_id in gpus:
+      self.__gpu_usage[gpu_id] += sign * gpu
+      self.__vram_usage[gpu_id] += sign * vram
+
+
+def _calculate_requirements(job):
+  """ Works out the requirement vector of a job, the way that the manager
+  does.
+  Args:
+    job: The job.
+  Returns:
+    The requirement vector. """
+  cpu, ram, count, gpu, vram = job.usage
+  return cpu / _CPU_CORES, ram / _TOTAL_RAM * 100, count, gpu, vram
+
+def _make_kinds(num_kinds, rng):
+  """ Makes the distinct kinds of job that are queued. Each one ends up in its
+  own bucket of the PendingQueue.
+  Args:
+    num_kinds: The number of kinds to make.
+    rng: The random number generator to use.
+  Returns:
+    A list of (owner, priority, usage, image) tuples. """
+  kinds = set()
+  while len(kinds) < num_kinds:
+    usage = (rng.choice((100, 200, 400, 800)),
+             rng.randint(1, 32) * 2 ** 30,
+             rng.choice((1, 1, 1, 2, 4)),
+             rng.choice((10, 25, 50, 100)),
+             rng.randint(1, 16) * 2 ** 30)
+    kinds.add(("user%d" % (rng.randrange(16)), rng.choice((0, 0, 0, 1, 2)),
+               usage, "image%d:latest" % (rng.randrange(8))))
+
+  return sorted(kinds)
+
+def _make_job(kinds, rng):
+  """
+  Args:
+    kinds: The kinds of job to pick from.
+    rng: The random number generator to use.
+  Returns:
+    A new random job. """
+  return _Job(rng.choice(kinds), rng.randint(1, 8))
+
+
+class _LinearScheduler:
+  """ The scheduling loop that the manager used before the PendingQueue. """
+
+  def __init__(self, machine):
+    """
+    Args:
+      machine: The _Machine to place jobs on. """
+    self.__machine = machine
+    self.__pending_jobs = deque()
+    self.__maybe_runnable = deque()
+    self.__already_started = set()
+
+  def add(self, job):
+    """ Queues a job.
+    Args:
+      job: The job. """
+    self.__pending_jobs.appendleft(job)
+    self.__maybe_runnable.appendleft(job)
+
+  def start_jobs(self, finished_job):
+    """ Finds the jobs that can be started.
+    Args:
+      finished_job: Whether any job finished since the last call.
+    Returns:
+      A list of (job, requirements, GPUs) tuples for the jobs to start. """
+    pending_queue = self.__pending_jobs
+    if not finished_job:
+      pending_queue = self.__maybe_runnable
+
+    started = []
+    seen_jobs = 0
+    while True:
+      cpu_remaining, ram_remaining, gpu_remaining = \
+          self.__machine.get_remaining()
+      if cpu_remaining <= 0 or ram_remaining <= 0 or not gpu_remaining:
+        break
+      if not len(pending_queue):
+        break
+      if seen_jobs >= len(pending_queue):
+        break
+
+      job = pending_queue.pop()
+      if job in self.__already_started:
+        self.__already_started.remove(job)
+        continue
+
+      requirements = _calculate_requirements(job)
+      gpus = self.__machine.place(requirements)
+      if gpus is not None:
+        started.append((job, requirements, gpus))
+        if pending_queue is self.__maybe_runnable:
+          self.__already_started.add(job)
+      else:
+        pending_queue.appendleft(job)
+
+      seen_jobs += 1
+
+    self.__maybe_runnable.clear()
+    return started
+
+
+class _IndexedScheduler:
+  """ The scheduling loop that the manager uses now. """
+
+  def __init__(self, machine):
+    """
+    Args:
+      machine: The _Machine to place jobs on. """
+    self.__machine = machine
+    self.__pending_jobs = PendingQueue()
+
+  def add(self, job):
+    """ Queues a job.
+    Args:
+      job: The job. """
+    self.__pending_jobs.add(job, _calculate_requirements(job),
+                            image=job.image, owner=job.owner,
+                            priority=job.priority)
+
+  def start_jobs(self, finished_job):
+    """ Finds the jobs that can be started.
+    Args:
+      finished_job: Whether any job finished since the last call. This one
+      looks at the buckets until the machine is full.
+    Returns:
+      A list of (job, requirements, GPUs) tuples for the jobs to start. """
+    def place(job, requirements):
+      return self.__machine.place(requirements)
+
+    return self.__pending_jobs.pop_runnable(place,
+                                            has_room=self.__machine.has_room)
+
+def _simulate(make_scheduler, depth, kinds, ticks, seed):
+  """ Runs a queue of jobs through the simulated machine, and times the
+  scheduling passes. New jobs are submitted as others start, so that the queue
+  depth stays the same.
+  Args:
+    make_scheduler: The scheduler class to use.
+    depth: The number of queued jobs.
+    kinds: The kinds of job to queue.
+    ticks: The number of ticks to time.
+    seed: The random seed, so that every scheduler gets the same jobs.
+  Returns:
+    The average time of a scheduling pass, in seconds, and the average number
+    of jobs started in each pass. """
+  rng = random.Random(seed)
+  machine = _Machine()
+  scheduler = make_scheduler(machine)
+  for _ in range(depth):
+    scheduler.add(_make_job(kinds, rng))
+
+  # Maps the tick that jobs finish on to their (requirements, GPUs).
+  running = {}
+  elapsed = 0.0
+  started_total = 0
+  # The first pass fills up an empty machine, which isn't what a typical tick
+  # looks like, so it isn't timed.
+  for tick in range(ticks + 1):
+    finished = running.pop(tick, [])
+    for requirements, gpus in finished:
+      machine.release(requirements, gpus)
+
+    start_time = time.perf_counter()
+    started = scheduler.start_jobs(bool(finished) or tick == 0)
+    if tick:
+      elapsed += time.perf_counter() - start_time
+      started_total += len(started)
+
+    for job, requirements, gpus in started:
+      running.setdefault(tick + job.runtime, []).append((requirements, gpus))
+      scheduler.add(_make_job(kinds, rng))
+
+  return elapsed / ticks, started_total / ticks
+
+def main():
+  parser = argparse.ArgumentParser( \
+      description="Benchmark scheduler tick time against queue depth.")
+  parser.add_argument("--kinds", type=int, default=1000,
+                      help="Number of distinct kinds of job, by owner," \
+                           " priority, requirements and image.")
+  parser.add_argument("--ticks", type=int, default=20,
+                      help="Number of ticks to average over.")
+  parser.add_argument("--depths", type=int, nargs="+",
+                      default=[100, 1000, 10000, 100000],
+                      help="Queue depths to measure.")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="Random seed.")
+  args = parser.parse_args()
+
+  kinds = _make_kinds(args.kinds, random.Random(args.seed))
+
+  print("%10s %15s %15s %15s %15s" % ("depth", "indexed (us)", "linear (us)",
+                                      "indexed starts", "linear starts"))
+  for depth in args.depths:
+    indexed_time, indexed_starts = _simulate(_IndexedScheduler, depth, kinds,
+                                             args.ticks, args.seed)
+    linear_time, linear_starts = _simulate(_LinearScheduler, depth, kinds,
+                                           args.ticks, args.seed)
+    print("%10d %15.1f %15.1f %15.1f %15.1f" % \
+          (depth, indexed_time * 1000000, linear_time * 1000000,
+           indexed_starts, linear_starts))
+
+
+if __name__ == "__main__":
+  main()
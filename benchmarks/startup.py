@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+
+""" Measures how long the daemon takes to start accepting submissions, and to
+be ready to schedule them, with and without cached hardware information. The
+daemon is run against the fake nvidia-smi in tools/fake_gpu. """
+
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+# Where the server listens.
+_HOST = "127.0.0.1"
+_PORT = 5000
+
+
+def _request(path, body=None):
+  """ Makes a request to the server.
+  Args:
+    path: The path to request.
+    body: Optional object to POST as JSON.
+  Returns:
+    True if the server answered successfully. """
+  data = None
+  headers = {}
+  if body is not None:
+    data = json.dumps(body).encode("utf-8")
+    headers["Content-Type"] = "application/json"
+
+  request = urllib.request.Request("http://%s:%d%s" % (_HOST, _PORT, path),
+                                   data=data, headers=headers)
+  try:
+    with urllib.request.urlopen(request, timeout=10) as response:
+      return response.status == 200
+  except (OSError, urllib.error.URLError):
+    return False
+
+def _is_listening():
+  """
+  Returns:
+    True if something is listening on the server port. """
+  try:
+    with socket.create_connection((_HOST, _PORT), timeout=0.1):
+      return True
+  except OSError:
+    return False
+
+def _start_once(daemon, state_dir, work_dir, env, timeout):
+  """ Starts the daemon, waits until it is ready, and stops it again.
+  Args:
+    daemon: The path to stoplightd.py.
+    state_dir: The state directory to use.
+    work_dir: The directory to run the daemon in.
+    env: The environment to run the daemon with.
+    timeout: How long to wait for the daemon, in seconds.
+  Returns:
+    A dictionary with the times, in seconds, at which the server started
+    listening, started accepting submissions, and the daemon was ready to
+    schedule them. """
+  if _is_listening():
+    raise RuntimeError("Something is already listening on port %d." % (_PORT))
+
+  command = [sys.executable, daemon, "--state-dir", state_dir,
+             "--image-pulls", "0", "--log-level", "info"]
+  start_time = time.monotonic()
+  process = subprocess.Popen(command, cwd=work_dir, env=env,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL,
+                             start_new_session=True)
+
+  times = {}
+  try:
+    while len(times) < 3:
+      now = time.monotonic() - start_time
+      if now > timeout:
+        raise RuntimeError("Daemon did not start within %s seconds." % \
+                           (timeout))
+      if process.poll() is not None:
+        raise RuntimeError("Daemon exited with status %d." % \
+                           (process.returncode))
+
+      # Requests can block until the daemon answers, so the time is taken
+      # once they succeed.
+      if "listening" not in times:
+        if _is_listening():
+          times["listening"] = time.monotonic() - start_time
+      elif "accepting" not in times:
+        # An empty batch is answered by the server without the daemon.
+        if _request("/add_jobs", {"job_dirs": []}):
+          times["accepting"] = time.monotonic() - start_time
+      # The metrics come from the daemon itself, so this only works once its
+      # main loop is running.
+      elif _request("/metrics"):
+        times["ready"] = time.monotonic() - start_time
+
+      time.sleep(0.005)
+
+  finally:
+    # Stop the daemon and the server.
+    os.killpg(process.pid, signal.SIGTERM)
+    process.wait()
+    while _is_listening():
+      time.sleep(0.01)
+
+  return times
+
+def _summarize(runs):
+  """
+  Args:
+    runs: A list of results from _start_once().
+  Returns:
+    The median and maximum of each time. """
+  summary = {}
+  for name in ("listening", "accepting", "ready"):
+    times = sorted([run[name] for run in runs])
+    summary[name] = {"median": times[len(times) // 2], "max": times[-1]}
+  return summary
+
+def main():
+  parser = argparse.ArgumentParser( \
+      description="Benchmark how long the daemon takes to start.")
+  parser.add_argument("--runs", type=int, default=5,
+                      help="Number of times to start the daemon in each mode.")
+  parser.add_argument("--gpus", type=int, default=8,
+                      help="Number of fake GPUs.")
+  parser.add_argument("--nvidia-smi-delay", type=float, default=0.5,
+                      help="How long each fake nvidia-smi call takes, in" \
+                           " seconds.")
+  parser.add_argument("--daemon",
+                      default=os.path.join(_ROOT, "daemon", "stoplightd.py"),
+                      help="The daemon to start, to compare against other" \
+                           " versions.")
+  parser.add_argument("--timeout", type=float, default=30,
+                      help="Maximum time to wait for the daemon, in seconds.")
+  parser.add_argument("-o", "--output",
+                      help="File to save the results to, as JSON.")
+  args = parser.parse_args()
+
+  env = dict(os.environ)
+  env["PATH"] = os.path.join(_ROOT, "tools", "fake_gpu") + os.pathsep + \
+                env.get("PATH", "")
+  env["FAKE_NVIDIA_SMI_GPUS"] = str(args.gpus)
+  env["FAKE_NVIDIA_SMI_DELAY"] = str(args.nvidia_smi_delay)
+
+  cold = []
+  warm = []
+  directory = tempfile.mkdtemp(prefix="stoplight-startup-")
+  try:
+    for run in range(args.runs):
+      state_dir = os.path.join(directory, "state-%d" % (run))
+      # The first start has nothing cached, and the second one does.
+      cold.append(_start_once(args.daemon, state_dir, directory, env,
+                              args.timeout))
+      warm.append(_start_once(args.daemon, state_dir, directory, env,
+                              args.timeout))
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+  results = {"time": time.time(), "config": vars(args),
+             "cold": _summarize(cold), "warm": _summarize(warm),
+             "runs": {"cold": cold, "warm": warm}}
+
+  for mode in ("cold", "warm"):
+    summary = results[mode]
+    print("%-5s listening %.3f s, accepting %.3f s, ready %.3f s (median)" % \
+          (mode, summary["listening"]["median"],
+           summary["accepting"]["median"], summary["ready"]["median"]))
+
+  if args.output:
+    with open(args.output, "w") as output_file:
+      json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+  main()
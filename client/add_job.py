@@ -1,37 +1,202 @@
 #!/usr/bin/python3
 
 
-from urllib.request import Request, urlopen
-from urllib.parse import quote_plus, urlencode
 import argparse
+import http.client
+import json
 import os
+import socket
+import sys
 
 
-def _add_job(job_directory):
-  """ Adds the job via the REST API.
+# Where the daemon's REST API lives by default.
+_SERVER = "127.0.0.1:5000"
+# Where the daemon's unix socket lives by default.
+_SOCKET = "/tmp/stoplight.sock"
+
+
+class _SocketConnection:
+  """ A connection to the daemon's unix socket. Many commands can be sent
+  before reading any of the replies. """
+
+  def __init__(self, path):
+    """
+    Args:
+      path: The path to the socket. """
+    self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.__socket.connect(path)
+    self.__file = self.__socket.makefile("rwb")
+    self.__next_id = 0
+
+  def send(self, command):
+    """ Sends a command.
+    Args:
+      command: The command, without an ID.
+    Returns:
+      The ID of the command. """
+    command["id"] = self.__next_id
+    self.__next_id += 1
+    self.__file.write((json.dumps(command) + "\n").encode("utf-8"))
+    return command["id"]
+
+  def get_reply(self):
+    """ Waits for the next reply.
+    Returns:
+      The ID of the command, and its result. """
+    self.__file.flush()
+    line = self.__file.readline()
+    if not line:
+      raise RuntimeError("The daemon closed the connection.")
+    reply = json.loads(line.decode("utf-8"))
+    if "error" in reply:
+      raise RuntimeError("Command failed: %s" % (reply["error"]))
+    return reply["id"], reply["result"]
+
+  def close(self):
+    """ Closes the connection. """
+    self.__file.close()
+    self.__socket.close()
+
+
+def _make_body(job_directories, globs=None, priority=None):
+  """ Makes the arguments for adding a batch of jobs.
+  Args:
+    job_directories: The job directories.
+    globs: Patterns matching job directories, which are expanded by the daemon.
+    priority: Optional priority for the jobs, which overrides the ones in their
+    job.yaml files.
+  Returns:
+    The arguments, as a dictionary. """
+  # The daemon works out who the jobs belong to itself.
+  body = {"job_dirs": [os.path.abspath(job_dir) \
+                       for job_dir in job_directories],
+          "globs": [os.path.abspath(pattern) for pattern in (globs or [])]}
+  if priority is not None:
+    body["priority"] = priority
+  return body
+
+def _add_jobs(connection, body):
+  """ Adds a batch of jobs via the REST API.
   Args:
-    job_directory: The job directory. """
-  job_directory = os.path.abspath(job_directory)
-  job_directory = quote_plus(job_directory)
+    connection: The HTTPConnection to send the request on.
+    body: The arguments, from _make_body().
+  Returns:
+    The parsed response, which contains lists of accepted and rejected jobs,
+    and the IDs of the accepted ones. """
+  connection.request("POST", "/add_jobs", json.dumps(body),
+                     {"Content-Type": "application/json"})
+  response = connection.getresponse()
+  data = response.read()
+  if response.status != 200:
+    raise RuntimeError("Request failed with status %d." % (response.status))
 
-  # Perform the request.
-  url = "http://127.0.0.1:5000/add_job"
-  values = {"job_dir": job_directory}
+  return json.loads(data.decode("utf-8"))
 
-  data = urlencode(values)
-  data = data.encode("ascii")
-  request = Request(url, data)
-  response = urlopen(request)
+def _add_jobs_over_socket(path, bodies):
+  """ Adds batches of jobs via the daemon's unix socket. All the batches are
+  sent before waiting for any replies, so the daemon can load them at the
+  same time.
+  Args:
+    path: The path to the socket.
+    bodies: The arguments for each batch, from _make_body().
+  Returns:
+    The results for each batch, in the same order, in the same form as from
+    _add_jobs(). """
+  connection = _SocketConnection(path)
+  try:
+    for body in bodies:
+      body["type"] = "add_jobs"
+      connection.send(body)
+
+    results = [None] * len(bodies)
+    for _ in bodies:
+      command_id, result = connection.get_reply()
+      results[command_id] = result
+  finally:
+    connection.close()
+
+  return results
+
+def _chunks(items, size):
+  """ Splits a list into chunks.
+  Args:
+    items: The list to split.
+    size: The maximum size of each chunk.
+  Returns:
+    A generator of chunks. """
+  for i in range(0, len(items), size):
+    yield items[i:i + size]
 
 def main():
   # Parse arguments.
   parser = argparse.ArgumentParser( \
-      description="Add a new job to the Stoplight queue.")
-  parser.add_argument("job_directory", help="The path to the job directory.")
+      description="Add new jobs to the Stoplight queue.")
+  parser.add_argument("job_directories", nargs="*",
+                      help="The paths to the job directories. Use - to read" \
+                           " them from stdin, one per line.")
+  parser.add_argument("-g", "--glob", action="append", default=[],
+                      help="Add all job directories matching this pattern." \
+                           " Can be given more than once.")
+  parser.add_argument("-p", "--priority", type=int,
+                      help="Priority for the jobs. Jobs with higher" \
+                           " priorities are started first. Overrides the" \
+                           " Priority in job.yaml.")
+  parser.add_argument("-s", "--server", metavar="HOST:PORT",
+                      help="The daemon, or cluster coordinator, to add the" \
+                           " jobs to over HTTP. Defaults to %s, unless the" \
+                           " local daemon's socket exists." % (_SERVER))
+  parser.add_argument("--socket", default=_SOCKET,
+                      help="The local daemon's unix socket, which is used" \
+                           " instead of HTTP if it exists.")
+  parser.add_argument("-v", "--verbose", action="store_true",
+                      help="Print the IDs of the jobs that were added.")
+  parser.add_argument("--chunk-size", type=int, default=500,
+                      help="Maximum number of jobs to send in one request.")
 
   args = parser.parse_args()
 
-  _add_job(args.job_directory)
+  job_directories = []
+  for job_directory in args.job_directories:
+    if job_directory == "-":
+      job_directories.extend([line.strip() for line in sys.stdin \
+                              if line.strip()])
+    else:
+      job_directories.append(job_directory)
+
+  if not job_directories and not args.glob:
+    parser.error("No job directories specified.")
+
+  bodies = [_make_body(chunk, priority=args.priority) \
+            for chunk in _chunks(job_directories, args.chunk_size)]
+  if args.glob:
+    bodies.append(_make_body([], args.glob, priority=args.priority))
+
+  if args.server is None and os.path.exists(args.socket):
+    results = _add_jobs_over_socket(args.socket, bodies)
+  else:
+    # All the chunks share a single connection.
+    host, _, port = (args.server or _SERVER).rpartition(":")
+    connection = http.client.HTTPConnection(host, int(port))
+    results = [_add_jobs(connection, body) for body in bodies]
+    connection.close()
+
+  accepted = 0
+  rejected = 0
+  for result in results:
+    accepted += len(result["accepted"])
+    if args.verbose:
+      # The coordinator doesn't assign IDs.
+      for job_dir, job_ids in zip(result["accepted"],
+                                  result.get("job_ids", [])):
+        ids = ", ".join(str(job_id) for job_id in job_ids)
+        print("Added %s with job IDs %s." % (job_dir, ids))
+    rejected += len(result["rejected"])
+    for rejection in result["rejected"]:
+      print("Rejected %s: %s" % (rejection["job_dir"], rejection["reason"]))
+
+  print("Added %d jobs, rejected %d." % (accepted, rejected))
+  if rejected:
+    sys.exit(1)
 
 
 if __name__ == "__main__":
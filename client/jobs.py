@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+
+
+import argparse
+import datetime
+import http.client
+import json
+import sys
+import urllib.parse
+
+
+# Where the daemon's REST API lives by default.
+_SERVER = "127.0.0.1:5000"
+# How long to wait for changes in each request, in seconds.
+_POLL_TIMEOUT = 25
+
+
+def _get(connection, path, params=None):
+  """ Makes a GET request to the REST API.
+  Args:
+    connection: The HTTPConnection to send the request on.
+    path: The path to request.
+    params: Optional dictionary of query parameters. Ones that are None are
+    left out.
+  Returns:
+    The parsed response, or None if the server returned 404. """
+  if params:
+    params = {key: value for key, value in params.items() if value is not None}
+    path += "?" + urllib.parse.urlencode(params)
+
+  connection.request("GET", path)
+  response = connection.getresponse()
+  data = response.read()
+  if response.status == 404:
+    return None
+  if response.status != 200:
+    raise RuntimeError("Request failed with status %d." % (response.status))
+
+  return json.loads(data.decode("utf-8"))
+
+def _format_time(timestamp):
+  """ Formats a time for printing.
+  Args:
+    timestamp: The time, in seconds since the epoch, or None.
+  Returns:
+    The formatted time. """
+  if timestamp is None:
+    return "-"
+  return datetime.datetime.fromtimestamp(timestamp).strftime("%m-%d %H:%M:%S")
+
+def _print_job(job):
+  """ Prints a line about a job.
+  Args:
+    job: The job, as returned by the REST API. """
+  name = job["name"]
+  if job["task"] is not None:
+    name = "%s[%d]" % (name, job["task"])
+  print("%8d  %-9s  %-12s  %-14s  %-14s  %s" % \
+        (job["id"], job["state"], job["owner"], _format_time(job["started"]),
+         _format_time(job["finished"]), name))
+
+def _follow(connection):
+  """ Prints changes to jobs as they happen, until interrupted.
+  Args:
+    connection: The HTTPConnection to send the requests on. """
+  cursor = _get(connection, "/changes")["cursor"]
+  while True:
+    result = _get(connection, "/changes", {"since": cursor,
+                                           "timeout": _POLL_TIMEOUT})
+    if result["missed"]:
+      print("Some changes were missed.")
+    for change in result["changes"]:
+      print("%s  %8d  %s" % (_format_time(change["time"]), change["id"],
+                             change["state"]))
+    cursor = result["cursor"]
+
+def _print_output(connection, job_id, stream, follow, pattern):
+  """ Prints the output of a job.
+  Args:
+    connection: The HTTPConnection to send the request on.
+    job_id: The ID of the job.
+    stream: Either "out" or "err".
+    follow: Whether to keep printing new output until the job is done.
+    pattern: Optional string. Only lines that contain it are printed.
+  Returns:
+    False if the job doesn't exist. """
+  params = {"stream": stream, "follow": int(follow)}
+  if pattern is not None:
+    params["grep"] = pattern
+  connection.request("GET", "/jobs/%d/output?%s" % \
+                     (job_id, urllib.parse.urlencode(params)))
+  response = connection.getresponse()
+  if response.status == 404:
+    response.read()
+    return False
+  if response.status == 403:
+    response.read()
+    raise RuntimeError("The output of job %d isn't readable by everyone." % \
+                       (job_id))
+  if response.status != 200:
+    raise RuntimeError("Request failed with status %d." % (response.status))
+
+  while True:
+    data = response.read1(64 * 1024)
+    if not data:
+      break
+    sys.stdout.buffer.write(data)
+    sys.stdout.buffer.flush()
+  return True
+
+def main():
+  # Parse arguments.
+  parser = argparse.ArgumentParser( \
+      description="Show jobs in the Stoplight queue.")
+  parser.add_argument("job_ids", nargs="*", type=int,
+                      help="Only show these jobs.")
+  parser.add_argument("--state",
+                      help="Only show jobs in this state, such as pending," \
+                           " running or failed.")
+  parser.add_argument("--owner", help="Only show jobs with this owner.")
+  parser.add_argument("--name", help="Only show jobs with this name.")
+  parser.add_argument("-f", "--follow", action="store_true",
+                      help="Print changes to jobs as they happen, or, with" \
+                           " --output, the output of the job until it is" \
+                           " done.")
+  parser.add_argument("-o", "--output", choices=("out", "err"),
+                      help="Print the stdout or stderr of a job instead.")
+  parser.add_argument("--grep", metavar="TEXT",
+                      help="With --output, only print lines that contain" \
+                           " this.")
+  parser.add_argument("-s", "--server", default=_SERVER, metavar="HOST:PORT",
+                      help="The daemon to query.")
+  args = parser.parse_args()
+
+  host, _, port = args.server.rpartition(":")
+  connection = http.client.HTTPConnection(host, int(port),
+                                          timeout=_POLL_TIMEOUT + 30)
+
+  if args.output:
+    if len(args.job_ids) != 1:
+      parser.error("--output needs exactly one job ID.")
+    try:
+      found = _print_output(connection, args.job_ids[0], args.output,
+                            args.follow, args.grep)
+    except KeyboardInterrupt:
+      found = True
+    if not found:
+      print("Unknown job %d." % (args.job_ids[0]), file=sys.stderr)
+      sys.exit(1)
+    return
+
+  if args.follow:
+    try:
+      _follow(connection)
+    except KeyboardInterrupt:
+      pass
+    return
+
+  print("%8s  %-9s  %-12s  %-14s  %-14s  %s" % \
+        ("ID", "STATE", "OWNER", "STARTED", "FINISHED", "NAME"))
+  missing = False
+  for job_id in args.job_ids:
+    job = _get(connection, "/jobs/%d" % (job_id))
+    if job is None:
+      print("%8d  unknown" % (job_id))
+      missing = True
+    else:
+      _print_job(job)
+
+  if not args.job_ids:
+    # Go through all the pages.
+    after = None
+    while True:
+      result = _get(connection, "/jobs", {"state": args.state,
+                                          "owner": args.owner,
+                                          "name": args.name, "after": after,
+                                          "limit": 1000})
+      for job in result["jobs"]:
+        _print_job(job)
+      after = result["next"]
+      if after is None:
+        break
+
+  connection.close()
+  if missing:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,168 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import os
+import threading
+
+from job import JobConfig
+from util import ConfigurationError
+
+
+""" Reads and validates new jobs in a pool of worker threads, so that adding a
+lot of jobs at once doesn't hold up scheduling. """
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigCache:
+  """ Caches parsed job configurations. Entries are looked up first by path,
+  modification time and size, in which case the file doesn't even have to be
+  read, and then by a hash of the file contents, so that identical job.yaml
+  files in different directories are only parsed once. """
+
+  def __init__(self, max_size=10000):
+    """
+    Args:
+      max_size: The maximum number of entries to keep in each cache. """
+    self.__max_size = max_size
+
+    # Maps (path, mtime, size) to content hashes.
+    self.__by_stat = OrderedDict()
+    # Maps content hashes to JobConfigs.
+    self.__by_hash = OrderedDict()
+    self.__lock = threading.Lock()
+
+  def __remember(self, cache, key, value):
+    """ Adds an entry to one of the caches, evicting the least recently used
+    entry if it is full.
+    Args:
+      cache: The cache to add to.
+      key: The key to add.
+      value: The value to add. """
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > self.__max_size:
+      cache.popitem(last=False)
+
+  def __lookup(self, cache, key):
+    """ Looks up an entry in one of the caches.
+    Args:
+      cache: The cache to look in.
+      key: The key to look up.
+    Returns:
+      The value, or None if it wasn't found. """
+    value = cache.get(key)
+    if value is not None:
+      cache.move_to_end(key)
+    return value
+
+  def load(self, config_path):
+    """ Loads a job configuration, using the cache if possible.
+    Args:
+      config_path: The path to the job.yaml file.
+    Returns:
+      The JobConfig. """
+    info = os.stat(config_path)
+    stat_key = (config_path, info.st_mtime_ns, info.st_size)
+
+    with self.__lock:
+      content_hash = self.__lookup(self.__by_stat, stat_key)
+      if content_hash is not None:
+        config = self.__lookup(self.__by_hash, content_hash)
+        if config is not None:
+          return config
+
+    with open(config_path, "rb") as config_file:
+      config_text = config_file.read()
+    content_hash = hashlib.sha1(config_text).digest()
+
+    with self.__lock:
+      self.__remember(self.__by_stat, stat_key, content_hash)
+      config = self.__lookup(self.__by_hash, content_hash)
+    if config is not None:
+      return config
+
+    config = JobConfig.parse(config_text)
+    with self.__lock:
+      self.__remember(self.__by_hash, content_hash, config)
+
+    return config
+
+
+class AdmissionPipeline:
+  """ Reads and validates the configurations for new jobs in the background. """
+
+  def __init__(self, workers=4, cache=None):
+    """
+    Args:
+      workers: The number of worker threads to use.
+      cache: The ConfigCache to use. A new one will be created if not
+      specified. """
+    self.__executor = ThreadPoolExecutor(max_workers=workers)
+    self.__cache = cache or ConfigCache()
+    self.__workers = workers
+
+  def __load_job(self, job_directory):
+    """ Loads and validates a single job.
+    Args:
+      job_directory: The directory containing the job.
+    Returns:
+      The JobConfig for the job, or a message saying why it is invalid. """
+    if not os.path.isdir(job_directory):
+      return "Not a directory."
+
+    config_path = os.path.join(job_directory, "job.yaml")
+    if not os.path.exists(config_path):
+      return "Could not find job.yaml file in %s!" % (job_directory)
+    if not os.path.exists(os.path.join(job_directory, "run_job.sh")):
+      return "Could not find run_job.sh file in %s!" % (job_directory)
+
+    try:
+      return self.__cache.load(config_path)
+    except (ConfigurationError, OSError) as error:
+      return str(error)
+
+  def __load_chunk(self, job_directories):
+    """ Loads a chunk of jobs.
+    Args:
+      job_directories: The directories containing the jobs.
+    Returns:
+      A list of results, one for each job. """
+    return [self.__load_job(job_directory) \
+            for job_directory in job_directories]
+
+  def __load_batch(self, job_directories, callback):
+    """ Loads a batch of jobs, and calls the callback with the results.
+    Args:
+      job_directories: The directories containing the jobs.
+      callback: The function to call with the results. """
+    # Split the batch between the workers.
+    chunk_size = max(1, -(-len(job_directories) // self.__workers))
+    chunks = [job_directories[i:i + chunk_size] \
+              for i in range(0, len(job_directories), chunk_size)]
+    futures = [self.__executor.submit(self.__load_chunk, chunk) \
+               for chunk in chunks]
+
+    results = []
+    for future in futures:
+      results.extend(future.result())
+
+    callback(list(zip(job_directories, results)))
+
+  def submit(self, job_directories, callback):
+    """ Loads a batch of jobs in the background.
+    Args:
+      job_directories: The directories containing the jobs.
+      callback: Function that will be called with a list of
+      (job directory, result) pairs once all the jobs are loaded, where each
+      result is a JobConfig, or a message saying why the job is invalid. This
+      is called from a different thread. """
+    logger.debug("Loading batch of %d jobs." % (len(job_directories)))
+
+    # Waiting for all the chunks would tie up a worker, so do it in a separate
+    # thread.
+    thread = threading.Thread(target=self.__load_batch,
+                              args=(job_directories, callback), daemon=True)
+    thread.start()
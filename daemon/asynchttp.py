@@ -0,0 +1,326 @@
+import asyncio
+import functools
+import http
+import json
+import logging
+import os
+import urllib.parse
+
+
+""" A small HTTP/1.1 server on top of asyncio streams, for the daemon's REST
+API. It only does what the API needs: keep-alive connections, request bodies
+with a Content-Length, responses that are streamed as they are generated, and
+sending files with sendfile(). """
+
+
+logger = logging.getLogger(__name__)
+
+
+# The longest request line or header that is accepted, in bytes.
+_MAX_LINE = 64 * 1024
+# The most headers that a request can have.
+_MAX_HEADERS = 100
+# The biggest request body that is accepted, in bytes.
+_MAX_BODY = 64 * 1024 * 1024
+
+
+class HttpError(Exception):
+  """ Raised by handlers to send an error response. """
+
+  def __init__(self, status, message=None):
+    """
+    Args:
+      status: The HTTP status code.
+      message: Optional explanation for the client. Defaults to the standard
+      reason phrase for the status. """
+    self.status = status
+    self.message = message or http.HTTPStatus(status).phrase
+    super().__init__(self.message)
+
+
+class Request:
+  """ A parsed HTTP request. """
+
+  def __init__(self, method, target, version, headers, body):
+    """
+    Args:
+      method: The request method, such as GET.
+      target: The request target, with the path and query string.
+      version: The HTTP version, such as HTTP/1.1.
+      headers: Dictionary of headers, with lowercase names.
+      body: The request body, as bytes. """
+    self.method = method
+    self.version = version
+    self.headers = headers
+    self.body = body
+
+    parts = urllib.parse.urlsplit(target)
+    self.path = urllib.parse.unquote(parts.path)
+    # Only the first value of each query parameter is kept.
+    self.args = {name: values[0] for name, values in \
+                 urllib.parse.parse_qs(parts.query).items()}
+
+  def get_json(self):
+    """
+    Returns:
+      The body parsed as JSON, or None if it isn't valid JSON. """
+    try:
+      return json.loads(self.body.decode("utf-8"))
+    except ValueError:
+      return None
+
+  def get_form(self):
+    """
+    Returns:
+      The body parsed as a URL-encoded form, as a dictionary with the first
+      value of each field. """
+    form = urllib.parse.parse_qs(self.body.decode("utf-8", "replace"))
+    return {name: values[0] for name, values in form.items()}
+
+  def keep_alive(self):
+    """
+    Returns:
+      Whether the client wants to keep the connection open after the
+      response. """
+    connection = self.headers.get("connection", "").lower()
+    if self.version == "HTTP/1.1":
+      return connection != "close"
+    return connection == "keep-alive"
+
+
+class Response:
+  """ Sends the response to a single request. A response is either sent all
+  at once with send(), sent as a stream with start(), write() and end(), or
+  sent from a file with send_file(). """
+
+  def __init__(self, writer, request):
+    """
+    Args:
+      writer: The StreamWriter for the connection.
+      request: The Request that this responds to. """
+    self.__writer = writer
+    self.keep_alive = request.keep_alive()
+    # HTTP/1.0 clients don't understand chunked responses, so streams to them
+    # end by closing the connection.
+    self.__chunked = request.version == "HTTP/1.1"
+    # Whether the status line has been sent.
+    self.started = False
+
+  def __write_head(self, status, headers):
+    """ Writes the status line and headers.
+    Args:
+      status: The HTTP status code.
+      headers: Dictionary of headers. """
+    if not self.keep_alive:
+      headers["Connection"] = "close"
+    elif not self.__chunked:
+      # HTTP/1.0 connections are closed after each response unless we say
+      # otherwise.
+      headers["Connection"] = "keep-alive"
+
+    lines = ["HTTP/1.1 %d %s" % (status, http.HTTPStatus(status).phrase)]
+    lines.extend(["%s: %s" % (name, value) for name, value in headers.items()])
+    self.__writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    self.started = True
+
+  async def send(self, status, body, content_type, headers=None):
+    """ Sends a complete response.
+    Args:
+      status: The HTTP status code.
+      body: The body, as bytes or a string.
+      content_type: The Content-Type of the body.
+      headers: Optional dictionary of extra headers. """
+    if isinstance(body, str):
+      body = body.encode("utf-8")
+    headers = dict(headers or {})
+    headers["Content-Type"] = content_type
+    headers["Content-Length"] = str(len(body))
+    self.__write_head(status, headers)
+    self.__writer.write(body)
+    await self.__writer.drain()
+
+  async def send_json(self, data, status=200, headers=None):
+    """ Sends a complete JSON response.
+    Args:
+      data: The data to send.
+      status: The HTTP status code.
+      headers: Optional dictionary of extra headers. """
+    await self.send(status, json.dumps(data), "application/json", headers)
+
+  async def start(self, status, content_type, headers=None):
+    """ Starts a response whose body is sent with write().
+    Args:
+      status: The HTTP status code.
+      content_type: The Content-Type of the body.
+      headers: Optional dictionary of extra headers. """
+    headers = dict(headers or {})
+    headers["Content-Type"] = content_type
+    if self.__chunked:
+      headers["Transfer-Encoding"] = "chunked"
+    else:
+      self.keep_alive = False
+    self.__write_head(status, headers)
+    await self.__writer.drain()
+
+  async def write(self, data):
+    """ Sends part of the body of a response that was started with start().
+    This waits until the client has caught up, so that slow clients don't
+    make us buffer an unbounded amount of data.
+    Args:
+      data: The data, as bytes or a string. """
+    if isinstance(data, str):
+      data = data.encode("utf-8")
+    if not data:
+      return
+
+    if self.__chunked:
+      self.__writer.write(b"%x\r\n" % (len(data)))
+      self.__writer.write(data)
+      self.__writer.write(b"\r\n")
+    else:
+      self.__writer.write(data)
+    await self.__writer.drain()
+
+  async def end(self):
+    """ Finishes a response that was started with start(). """
+    if self.__chunked:
+      self.__writer.write(b"0\r\n\r\n")
+      await self.__writer.drain()
+
+  async def send_file(self, status, file_object, offset, content_type,
+                      headers=None):
+    """ Sends part of a file as the response. This uses sendfile(), so the
+    data doesn't have to be copied through Python.
+    Args:
+      status: The HTTP status code.
+      file_object: The file, opened in binary mode.
+      offset: Where to start sending from.
+      content_type: The Content-Type of the body.
+      headers: Optional dictionary of extra headers. """
+    count = max(os.fstat(file_object.fileno()).st_size - offset, 0)
+    headers = dict(headers or {})
+    headers["Content-Type"] = content_type
+    headers["Content-Length"] = str(count)
+    self.__write_head(status, headers)
+    await self.__writer.drain()
+    if count:
+      loop = asyncio.get_running_loop()
+      await loop.sendfile(self.__writer.transport, file_object, offset, count)
+
+
+async def _read_request(reader):
+  """ Reads a request from a connection.
+  Args:
+    reader: The StreamReader for the connection.
+  Returns:
+    The Request, or None if the connection was closed before a new request
+    started. """
+  line = await reader.readline()
+  if not line:
+    return None
+  if line in (b"\r\n", b"\n"):
+    # Some clients send an extra blank line after a request body.
+    line = await reader.readline()
+    if not line:
+      return None
+
+  try:
+    method, target, version = line.decode("latin-1").split()
+  except ValueError:
+    raise HttpError(400, "Invalid request line.")
+  if version not in ("HTTP/1.0", "HTTP/1.1"):
+    raise HttpError(505)
+
+  headers = {}
+  while True:
+    line = await reader.readline()
+    if line in (b"\r\n", b"\n", b""):
+      break
+    if len(headers) >= _MAX_HEADERS:
+      raise HttpError(431)
+    name, colon, value = line.decode("latin-1").partition(":")
+    if not colon:
+      raise HttpError(400, "Invalid header.")
+    headers[name.strip().lower()] = value.strip()
+
+  if "transfer-encoding" in headers:
+    raise HttpError(411)
+  try:
+    length = int(headers.get("content-length", 0))
+  except ValueError:
+    raise HttpError(400, "Invalid Content-Length.")
+  if length < 0:
+    raise HttpError(400, "Invalid Content-Length.")
+  if length > _MAX_BODY:
+    raise HttpError(413)
+  body = await reader.readexactly(length) if length else b""
+
+  return Request(method, target, version, headers, body)
+
+async def _handle_connection(handler, reader, writer):
+  """ Handles the requests on a single connection, one after another.
+  Args:
+    handler: The coroutine function to handle each request with. It is called
+    with the Request and the Response.
+    reader: The StreamReader for the connection.
+    writer: The StreamWriter for the connection. """
+  try:
+    while True:
+      try:
+        request = await _read_request(reader)
+      except HttpError as error:
+        # We can't tell where the next request starts, so give up on the
+        # connection.
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Length: 0\r\n" \
+                      "Connection: close\r\n\r\n" % \
+                      (error.status, http.HTTPStatus(error.status).phrase)) \
+                     .encode("latin-1"))
+        await writer.drain()
+        break
+      except ValueError:
+        # A line was longer than the limit.
+        break
+      if request is None:
+        break
+
+      response = Response(writer, request)
+      try:
+        await handler(request, response)
+      except HttpError as error:
+        if response.started:
+          break
+        await response.send_json({"error": error.message},
+                                 status=error.status)
+      except ConnectionError:
+        raise
+      except Exception:
+        logger.exception("Failed to handle %s %s." % (request.method,
+                                                       request.path))
+        if response.started:
+          break
+        await response.send_json({"error": "Internal error."}, status=500)
+
+      if not response.keep_alive:
+        break
+
+  except (ConnectionError, asyncio.IncompleteReadError):
+    # The client went away.
+    pass
+  finally:
+    writer.close()
+
+async def serve(handler, host, port, backlog=1024):
+  """ Starts serving HTTP.
+  Args:
+    handler: The coroutine function to handle each request with. It is called
+    with the Request and a Response to send the response with. It can raise
+    HttpError to send an error response instead.
+    host: The address to listen on.
+    port: The port to listen on.
+    backlog: The most connections that can wait to be accepted.
+  Returns:
+    The asyncio Server. """
+  return await asyncio.start_server(functools.partial(_handle_connection,
+                                                      handler),
+                                    host, port, limit=_MAX_LINE,
+                                    backlog=backlog)
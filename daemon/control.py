@@ -0,0 +1,609 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import re
+import socket
+import stat
+import struct
+import urllib.parse
+
+from asynchttp import HttpError
+import asynchttp
+import jobindex
+import logtail
+import metrics
+import output
+import util
+
+
+""" The control plane of the daemon. It runs in the event loop of the daemon,
+so requests are answered straight from the state of the manager, without
+going through another process. It serves the REST API over HTTP, and the same
+requests as JSON lines over a unix domain socket, which is cheaper for local
+clients. """
+
+
+logger = logging.getLogger(__name__)
+
+
+# Where local clients can connect to the daemon by default.
+DEFAULT_SOCKET = "/tmp/stoplight.sock"
+
+# The longest that a request for changes can wait for one, in seconds.
+_MAX_CHANGES_TIMEOUT = 30
+# The most jobs that a query can return at once.
+_MAX_QUERY_LIMIT = 1000
+# The longest command that is accepted on the unix socket, in bytes.
+_MAX_COMMAND = 64 * 1024 * 1024
+
+
+def _get_int(args, name, default=None, minimum=0, maximum=None):
+  """ Gets an integer argument of a request.
+  Args:
+    args: Dictionary of arguments. These are the query parameters of HTTP
+    requests, which are strings, or the fields of commands on the unix socket,
+    which are already integers.
+    name: The name of the argument.
+    default: The value to use if it is missing.
+    minimum: The smallest allowed value, or None for no limit.
+    maximum: The largest allowed value. Bigger values are clamped to this.
+  Returns:
+    The value of the argument. """
+  value = args.get(name)
+  if value is None:
+    return default
+
+  if isinstance(value, bool) or not isinstance(value, (int, str)):
+    raise HttpError(400, "Invalid %s: %s" % (name, value))
+  try:
+    value = int(value)
+  except ValueError:
+    raise HttpError(400, "Invalid %s: %s" % (name, value))
+  if minimum is not None and value < minimum:
+    raise HttpError(400, "Invalid %s: %d" % (name, value))
+  if maximum is not None:
+    value = min(value, maximum)
+  return value
+
+def _get_strings(args, name):
+  """ Gets an argument of a request that is a list of strings.
+  Args:
+    args: Dictionary of arguments.
+    name: The name of the argument.
+  Returns:
+    The list, which is empty if the argument is missing. """
+  values = args.get(name) or []
+  if not isinstance(values, list) or \
+     not all([isinstance(value, str) for value in values]):
+    raise HttpError(400, "Invalid %s." % (name))
+  return values
+
+def _expand_globs(patterns):
+  """ Finds the directories matching some patterns.
+  Args:
+    patterns: The patterns.
+  Returns:
+    A list with the sorted matches for each pattern. """
+  return [sorted(glob.glob(pattern)) for pattern in patterns]
+
+def _get_peer_uid(writer):
+  """ Finds out which user is on the other end of a unix socket connection.
+  Args:
+    writer: The StreamWriter for the connection.
+  Returns:
+    The ID of the user, or None if we can't tell. """
+  peer = writer.get_extra_info("socket")
+  if peer is None or not hasattr(socket, "SO_PEERCRED"):
+    return None
+  credentials = peer.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                struct.calcsize("3i"))
+  _, uid, _ = struct.unpack("3i", credentials)
+  return uid
+
+def _is_public(path):
+  """ Checks whether every user can read a file, which they can't if the file
+  isn't readable by others, or a directory above it isn't searchable by them.
+  Files that don't exist yet are judged by their directories.
+  Args:
+    path: The path to the file.
+  Returns:
+    True if the file can be read by anyone. """
+  path = os.path.abspath(path)
+  try:
+    if not os.stat(path).st_mode & stat.S_IROTH:
+      return False
+  except FileNotFoundError:
+    pass
+
+  directory = os.path.dirname(path)
+  while True:
+    try:
+      if not os.stat(directory).st_mode & stat.S_IXOTH:
+        return False
+    except FileNotFoundError:
+      return False
+    parent = os.path.dirname(directory)
+    if parent == directory:
+      return True
+    directory = parent
+
+def _remove_stale_socket(path):
+  """ Removes a unix domain socket that was left behind by a daemon that is no
+  longer running.
+  Args:
+    path: The path to the socket. """
+  try:
+    mode = os.stat(path).st_mode
+  except FileNotFoundError:
+    return
+  if not stat.S_ISSOCK(mode):
+    raise RuntimeError("'%s' exists, and is not a socket." % (path))
+
+  probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    probe.connect(path)
+  except (ConnectionRefusedError, FileNotFoundError):
+    logger.info("Removing stale socket '%s'." % (path))
+    os.remove(path)
+    return
+  finally:
+    probe.close()
+
+  raise RuntimeError("Another daemon is listening on '%s'." % (path))
+
+
+class ControlPlane:
+  """ Serves requests from clients. Every request runs as its own task in the
+  event loop, so a slow one, like a request that waits for jobs to change,
+  doesn't hold up any others. On the unix socket, a client can send many
+  commands without waiting for the replies, which come back tagged with the
+  "id" of their command, in whatever order they finish. """
+
+  def __init__(self, daemon, host="127.0.0.1", port=5000, socket_path=None,
+               trust_owner=False):
+    """
+    Args:
+      daemon: The Daemon to serve requests for.
+      host: The address to serve HTTP on.
+      port: The port to serve HTTP on.
+      socket_path: Optional path to serve the unix domain socket at.
+      trust_owner: Whether to believe the owner that HTTP clients say jobs
+      belong to. Otherwise, jobs that are added over HTTP belong to the owners
+      of their directories. On the unix socket, jobs always belong to the
+      user that connected, unless that is root. """
+    self.__daemon = daemon
+    self.__host = host
+    self.__port = port
+    self.__socket_path = socket_path
+    self.__trust_owner = trust_owner
+
+    # Follows job output files for clients.
+    self.__tailer = logtail.Tailer(self.__is_job_finished)
+    # The HTTP routes, as (method, path pattern, handler) tuples. Handlers are
+    # called with the Request, the Response, and the groups from the
+    # pattern.
+    self.__routes = [
+        ("POST", re.compile(r"/add_job$"), self.__http_add_job),
+        ("POST", re.compile(r"/add_jobs$"), self.__http_add_jobs),
+        ("GET", re.compile(r"/jobs$"), self.__http_query_jobs),
+        ("GET", re.compile(r"/jobs/(\d+)$"), self.__http_get_job),
+        ("GET", re.compile(r"/jobs/(\d+)/output$"), self.__http_get_output),
+        ("GET", re.compile(r"/changes$"), self.__http_get_changes),
+        ("GET", re.compile(r"/events$"), self.__http_get_events),
+        ("GET", re.compile(r"/metrics$"), self.__http_get_metrics)]
+    # Maps the types of commands on the unix socket to their handlers.
+    self.__commands = {"add_jobs": self.__add_jobs,
+                       "get_job": self.__get_job,
+                       "query_jobs": self.__query_jobs,
+                       "get_changes": self.__get_changes,
+                       "get_metrics": self.__get_metrics}
+
+    self.__servers = []
+
+  async def start(self):
+    """ Starts serving requests. Must be called from the event loop of the
+    daemon. """
+    self.__servers.append(await asynchttp.serve(self.__handle_http,
+                                                self.__host, self.__port))
+
+    if self.__socket_path:
+      _remove_stale_socket(self.__socket_path)
+      self.__servers.append( \
+          await asyncio.start_unix_server(self.__handle_unix,
+                                          self.__socket_path,
+                                          limit=_MAX_COMMAND, backlog=1024))
+      # Any local user can add jobs. They belong to whoever connected.
+      os.chmod(self.__socket_path, 0o666)
+      logger.info("Listening on '%s'." % (self.__socket_path))
+
+  def __get_index(self):
+    """
+    Returns:
+      The JobIndex of the daemon.
+    Raises:
+      HttpError if the daemon is still starting, so it doesn't have one
+      yet. """
+    index = self.__daemon.get_index()
+    if index is None:
+      raise HttpError(503, "The daemon is starting.")
+    return index
+
+  def __is_job_finished(self, job_id):
+    """ Checks whether a job is done, for the tailer.
+    Args:
+      job_id: The ID of the job.
+    Returns:
+      True if the job is done, or no longer known. """
+    job = self.__get_index().get(job_id)
+    return job is None or job["state"] in jobindex.FINISHED_STATES
+
+  async def __add_jobs(self, args):
+    """ Adds a batch of jobs. The arguments can have a "job_dirs" list of job
+    directories, and/or a "globs" list of patterns matching job directories.
+    They can also have an "owner" for the jobs, which the caller has to have
+    checked, and a "priority" that overrides the ones in their job.yaml
+    files.
+    Args:
+      args: Dictionary of arguments.
+    Returns:
+      Lists of which directories were accepted, and the IDs of the jobs that
+      were added from each of them, as well as which were rejected and
+      why. """
+    job_dirs = list(_get_strings(args, "job_dirs"))
+    globs = _get_strings(args, "globs")
+    owner = args.get("owner")
+    if owner is not None and not isinstance(owner, str):
+      raise HttpError(400, "Invalid owner: %s" % (owner))
+    priority = args.get("priority")
+    if priority is not None and \
+       (isinstance(priority, bool) or not isinstance(priority, int)):
+      raise HttpError(400, "Invalid priority: %s" % (priority))
+
+    rejected = []
+    if globs:
+      # This touches the filesystem, so it is done in a thread.
+      loop = asyncio.get_running_loop()
+      matches = await loop.run_in_executor(None, _expand_globs, globs)
+      for pattern, pattern_matches in zip(globs, matches):
+        if not pattern_matches:
+          rejected.append({"job_dir": pattern,
+                           "reason": "No directories matched."})
+        job_dirs.extend(pattern_matches)
+
+    accepted = []
+    job_ids = []
+    if job_dirs:
+      # The daemon adds the whole batch at once, and tells us what went wrong
+      # with each job.
+      results = await self.__daemon.add_jobs(job_dirs, owner=owner,
+                                             priority=priority)
+      for job_dir, result in zip(job_dirs, results):
+        if isinstance(result, str):
+          rejected.append({"job_dir": job_dir, "reason": result})
+        else:
+          accepted.append(job_dir)
+          job_ids.append(result)
+
+    return {"accepted": accepted, "job_ids": job_ids, "rejected": rejected}
+
+  async def __get_job(self, args):
+    """ Gets the state of the job with the "job_id" argument. Finished jobs are
+    only kept for a while.
+    Args:
+      args: Dictionary of arguments.
+    Returns:
+      The job, or None if it isn't known. """
+    job_id = _get_int(args, "job_id")
+    if job_id is None:
+      raise HttpError(400, "Missing job_id.")
+    return self.__get_index().get(job_id)
+
+  async def __query_jobs(self, args):
+    """ Finds jobs, in order of ID. The "state", "owner" and "name" arguments
+    only return jobs that match, and "limit" sets the number of jobs to
+    return.
+    Args:
+      args: Dictionary of arguments.
+    Returns:
+      The jobs that were found. If there are more, "next" is set to a value
+      that can be passed as the "after" argument to get the next page. """
+    state = args.get("state")
+    if state is not None and state not in jobindex.STATES:
+      raise HttpError(400, "Invalid state: %s" % (state))
+
+    jobs, next_page = self.__get_index().query( \
+        state=state, owner=args.get("owner"), name=args.get("name"),
+        after=_get_int(args, "after", minimum=-1),
+        limit=_get_int(args, "limit", default=100, minimum=1,
+                       maximum=_MAX_QUERY_LIMIT))
+    return {"jobs": jobs, "next": next_page}
+
+  async def __get_changes(self, args):
+    """ Gets the changes to the states of jobs after the "since" argument,
+    which should be the "cursor" from the previous response. If nothing has
+    changed, this waits for up to "timeout" seconds for something to. Without
+    "since", it just returns the current cursor.
+    Args:
+      args: Dictionary of arguments.
+    Returns:
+      The changes, and the cursor to pass next time. If the client has fallen
+      so far behind that some changes were dropped, "missed" is set, and it
+      should query the jobs again. """
+    index = self.__get_index()
+    since = _get_int(args, "since")
+    if since is None:
+      since = index.get_cursor()
+    else:
+      await self.__daemon.wait_for_changes( \
+          since, _get_int(args, "timeout", default=0,
+                          maximum=_MAX_CHANGES_TIMEOUT))
+
+    changes, cursor, missed = index.get_changes(since)
+    return {"changes": changes, "cursor": cursor, "missed": missed}
+
+  async def __get_metrics(self, args):
+    """
+    Args:
+      args: Dictionary of arguments, which are ignored.
+    Returns:
+      The metrics, in the Prometheus text format. """
+    if self.__daemon.is_starting():
+      raise HttpError(503, "The daemon is starting.")
+    return metrics.format_text(self.__daemon.collect_metrics() or [])
+
+  async def __handle_http(self, request, response):
+    """ Handles an HTTP request.
+    Args:
+      request: The asynchttp.Request.
+      response: The asynchttp.Response to send the response with. """
+    logger.debug("Got HTTP request: %s %s" % (request.method, request.path))
+
+    found = False
+    for method, pattern, handler in self.__routes:
+      match = pattern.match(request.path)
+      if match is None:
+        continue
+      found = True
+      if request.method == method:
+        await handler(request, response, *match.groups())
+        return
+
+    raise HttpError(405 if found else 404)
+
+  async def __http_add_job(self, request, response):
+    """ Adds a new job. The "job_dir" form field is the job directory. """
+    job_dir = request.get_form().get("job_dir")
+    if not job_dir:
+      raise HttpError(400, "Missing job_dir.")
+
+    job_dir = urllib.parse.unquote_plus(job_dir)
+    # Job arrays get an ID for each task.
+    result = (await self.__daemon.add_jobs([job_dir]))[0]
+    if isinstance(result, str):
+      await response.send_json({"reason": result}, status=400)
+      return
+
+    await response.send_json({"job_ids": result})
+
+  async def __http_add_jobs(self, request, response):
+    """ Adds a batch of jobs. The request body should be a JSON object with
+    the arguments for __add_jobs(). """
+    body = request.get_json()
+    if not isinstance(body, dict):
+      raise HttpError(400, "Missing JSON body.")
+    if not self.__trust_owner:
+      # Anyone can claim to be anyone over HTTP.
+      body.pop("owner", None)
+    await response.send_json(await self.__add_jobs(body))
+
+  async def __http_get_job(self, request, response, job_id):
+    """ Gets the state of a job. """
+    job = await self.__get_job({"job_id": job_id})
+    if job is None:
+      raise HttpError(404)
+    await response.send_json(job)
+
+  async def __http_query_jobs(self, request, response):
+    """ Finds jobs, with the query parameters as the arguments for
+    __query_jobs(). """
+    await response.send_json(await self.__query_jobs(request.args))
+
+  async def __http_get_changes(self, request, response):
+    """ Gets the changes to jobs, with the query parameters as the arguments
+    for __get_changes(). """
+    await response.send_json(await self.__get_changes(request.args))
+
+  async def __http_get_events(self, request, response):
+    """ Streams changes to the states of jobs as Server-Sent Events. Each event
+    has the sequence number of the change as its ID, so clients that reconnect
+    pick up where they left off. A "missed" event is sent if some changes were
+    dropped before the client could get them. """
+    index = self.__get_index()
+    cursor = _get_int({"since": request.headers.get("last-event-id") or \
+                                request.args.get("since")}, "since")
+    if cursor is None:
+      cursor = index.get_cursor()
+
+    await response.start(200, "text/event-stream",
+                         {"Cache-Control": "no-cache"})
+    while True:
+      await self.__daemon.wait_for_changes(cursor, _MAX_CHANGES_TIMEOUT)
+      changes, cursor, missed = index.get_changes(cursor)
+
+      if missed:
+        await response.write("event: missed\ndata: {}\n\n")
+      events = ["id: %d\ndata: %s\n\n" % (change["seq"], json.dumps(change)) \
+                for change in changes]
+      # Make sure that the connection is still there.
+      await response.write("".join(events) or ": keepalive\n\n")
+
+  async def __http_get_metrics(self, request, response):
+    """ Gets metrics, in the Prometheus text format. """
+    await response.send(200, await self.__get_metrics(request.args),
+                        "text/plain; version=0.0.4; charset=utf-8")
+
+  async def __http_get_output(self, request, response, job_id):
+    """ Gets the output of a job. The "stream" parameter is "out" (the default)
+    or "err", and "offset" is the byte offset to start at, or, if negative,
+    the number of bytes before the end to start at. With "follow", the
+    response keeps going until the job is done. "grep" is a string, and only
+    lines that contain it are sent. The output is sent as
+    it is, unless "format" is "sse", or the client accepts text/event-stream,
+    in which case each line is sent as a Server-Sent Event, with the offset
+    after the line as its ID, so clients that reconnect pick up where they
+    left off. """
+    job_id = int(job_id)
+    stream = request.args.get("stream", "out")
+    if stream not in ("out", "err"):
+      raise HttpError(400, "Invalid stream: %s" % (stream))
+    follow = request.args.get("follow", "0").lower() in ("1", "true", "yes")
+    accept = request.headers.get("accept", "")
+    use_sse = request.args.get("format") == "sse" or \
+              accept.split(",")[0].split(";")[0].strip() == "text/event-stream"
+
+    text = request.args.get("grep")
+    if text is not None:
+      text = text.encode("utf-8")
+
+    offset = _get_int(request.args, "offset", default=0, minimum=None)
+    if use_sse and request.headers.get("last-event-id"):
+      offset = _get_int(request.headers, "last-event-id")
+
+    job = self.__get_index().get(job_id)
+    if job is None:
+      raise HttpError(404)
+    path = output.get_output_path(job["dir"], job["task"], stream)
+    if not _is_public(path):
+      # Anyone can connect over HTTP, so they only get to see what any local
+      # user could.
+      raise HttpError(403, "The output of job %d isn't readable by" \
+                           " everyone." % (job_id))
+
+    if offset < 0:
+      try:
+        offset = max(os.stat(path).st_size + offset, 0)
+      except FileNotFoundError:
+        offset = 0
+    headers = {"X-Output-Offset": str(offset)}
+
+    if not (follow or use_sse or text):
+      # The file is sent by the kernel, without copying it through Python.
+      try:
+        output_file = open(path, "rb")
+      except FileNotFoundError:
+        await response.send(200, b"", "application/octet-stream", headers)
+        return
+      with output_file:
+        await response.send_file(200, output_file, offset,
+                                 "application/octet-stream", headers)
+      return
+
+    if follow:
+      chunks = self.__tailer.follow(path, job_id, offset)
+    else:
+      chunks = logtail.read(path, offset)
+
+    try:
+      if use_sse:
+        headers["Cache-Control"] = "no-cache"
+        await response.start(200, "text/event-stream", headers)
+        async for line_end, line in logtail.filter_lines(chunks, text):
+          if line is None:
+            await response.write("event: truncated\ndata: \n\n")
+          else:
+            await response.write("id: %d\ndata: %s\n\n" % \
+                (line_end, line.rstrip(b"\r").decode("utf-8", "replace")))
+
+      elif text:
+        await response.start(200, "application/octet-stream", headers)
+        async for _, line in logtail.filter_lines(chunks, text):
+          if line is not None:
+            await response.write(line + b"\n")
+
+      else:
+        await response.start(200, "application/octet-stream", headers)
+        async for _, data in chunks:
+          await response.write(data)
+
+      await response.end()
+    finally:
+      # Stop following the file right away if the client went away.
+      await chunks.aclose()
+
+  async def __handle_unix(self, reader, writer):
+    """ Handles a connection on the unix socket. Each line from the client is
+    a JSON object with the "type" of the command, an "id" to tag the reply
+    with, and the arguments of the command. Each reply is a line with a JSON
+    object with the "id", and either the "result" or an "error".
+    Args:
+      reader: The StreamReader for the connection.
+      writer: The StreamWriter for the connection. """
+    # Replies can finish in any order, so they take turns to write.
+    lock = asyncio.Lock()
+    tasks = set()
+    uid = _get_peer_uid(writer)
+    try:
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+
+        task = asyncio.create_task(self.__handle_command(line, writer, lock,
+                                                         uid))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+      # Finish replying to the commands that are still going.
+      if tasks:
+        await asyncio.wait(tasks)
+    except (ConnectionError, ValueError) as error:
+      # The client went away, or sent a command that was too long.
+      logger.debug("Closing unix socket connection: %s" % (error))
+      for task in tasks:
+        task.cancel()
+    finally:
+      writer.close()
+
+  async def __handle_command(self, line, writer, lock, uid):
+    """ Handles a single command from the unix socket, and replies to it.
+    Args:
+      line: The line with the command.
+      writer: The StreamWriter to reply on.
+      lock: The lock to hold while replying.
+      uid: The ID of the user that sent the command, or None if we don't
+      know. """
+    reply = {"id": None}
+    try:
+      try:
+        command = json.loads(line.decode("utf-8"))
+      except ValueError:
+        raise HttpError(400, "Invalid JSON.")
+      if not isinstance(command, dict):
+        raise HttpError(400, "Commands must be JSON objects.")
+
+      reply["id"] = command.get("id")
+      if uid is None:
+        command.pop("owner", None)
+      elif uid != 0 or command.get("owner") is None:
+        # Only root can add jobs for other users.
+        command["owner"] = util.get_user_name(uid)
+      handler = self.__commands.get(command.get("type"))
+      if handler is None:
+        raise HttpError(400, "Unknown command: %s" % (command.get("type")))
+      reply["result"] = await handler(command)
+    except HttpError as error:
+      reply["error"] = error.message
+    except Exception:
+      logger.exception("Failed to handle command.")
+      reply["error"] = "Internal error."
+
+    data = (json.dumps(reply) + "\n").encode("utf-8")
+    try:
+      async with lock:
+        writer.write(data)
+        await writer.drain()
+    except ConnectionError:
+      # The client went away.
+      pass
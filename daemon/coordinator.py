@@ -0,0 +1,641 @@
+#!/usr/bin/python3
+
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import glob
+import http.client
+import itertools
+import json
+import logging
+import threading
+import time
+
+from flask import abort, Flask, jsonify, request
+from werkzeug.serving import WSGIRequestHandler
+
+from admission import AdmissionPipeline
+from scheduler import choose_gpus, PendingQueue
+
+
+""" Coordinates a cluster of stoplight daemons. Jobs are submitted here, using
+the same API as a single daemon, and each one is sent to the worker that it
+fits on best. Workers tell us how much of their machines are in use through
+heartbeats. Job directories have to be on storage that every worker can see.
+"""
+
+
+logger = logging.getLogger(__name__)
+
+
+# Flask app.
+_app = Flask(__name__)
+# The coordinator that the app uses.
+_coordinator = None
+# Loads the configurations for new jobs.
+_pipeline = None
+# Whether to believe the owner that clients send with jobs.
+_trust_owner = False
+
+# How long to wait for jobs to be loaded, in seconds.
+_LOAD_TIMEOUT = 60
+
+
+def _get_requirements(config):
+  """ Gets the requirement vector for a job. Workers have different amounts of
+  CPU and RAM, so unlike the manager, these are kept in absolute units.
+  Args:
+    config: The JobConfig for the job.
+  Returns:
+    A tuple of the CPU and RAM requirements, the number of GPUs, and the GPU
+    and VRAM requirements for each GPU. """
+  usage = config.get_resource_usage()
+  return usage.Cpu, usage.Ram, usage.GpuCount, usage.Gpu, usage.Vram
+
+
+class _Worker:
+  """ What we know about a single worker. """
+
+  def __init__(self, name, url):
+    """
+    Args:
+      name: The name of the worker.
+      url: The address of the worker's server, as "host:port". """
+    self.name = name
+    self.url = url
+    # The last state that the worker reported.
+    self.state = {}
+    # When we last heard from the worker.
+    self.last_seen = time.monotonic()
+    # Whether the worker is considered to be up.
+    self.alive = True
+
+    # Maps the directories of jobs that were sent to the worker, but haven't
+    # started yet, to the GPUs we expect them to use. The worker doesn't count
+    # these in its usage yet, so we have to.
+    self.dispatched = {}
+    # The directories of jobs that are running on the worker.
+    self.running = set()
+    # The directories of jobs that the worker should cancel, because they
+    # were sent somewhere else while we couldn't reach it. These are sent
+    # with every reply, until the worker says that the jobs are finished.
+    self.cancelling = set()
+
+  def get_usage(self, jobs):
+    """ Gets the usage of the worker, including the jobs that are on their way
+    to it.
+    Args:
+      jobs: Maps job directories to their _Job entries.
+    Returns:
+      The CPU and RAM usage percentages, and lists of the usage percentage and
+      VRAM usage of each GPU. """
+    state = self.state
+    num_gpus = state["gpus"]
+    cpu = state["cpu"]
+    ram = state["ram"]
+    gpu_usage = [state["gpu.%d" % (i)] for i in range(num_gpus)]
+    vram_usage = [state["vram.%d" % (i)] for i in range(num_gpus)]
+
+    for job_dir, gpus in self.dispatched.items():
+      needed_cpu, needed_ram, _, needed_gpu, needed_vram = \
+          jobs[job_dir].requirements
+      cpu += needed_cpu / state["cores"]
+      ram += needed_ram / state["total_ram"] * 100
+      for gpu_id in gpus:
+        gpu_usage[gpu_id] += needed_gpu
+        vram_usage[gpu_id] += needed_vram
+
+    return cpu, ram, gpu_usage, vram_usage
+
+  def get_total_vram(self):
+    """
+    Returns:
+      The total VRAM of each GPU on the worker. """
+    return [self.state["total_vram.%d" % (i)] \
+            for i in range(self.state["gpus"])]
+
+  def is_ready(self):
+    """
+    Returns:
+      True if jobs can be sent to the worker. """
+    return self.alive and "cores" in self.state
+
+
+class _Job:
+  """ A job that was submitted to the cluster. """
+
+  def __init__(self, job_dir, requirements, image, owner, priority, sequence):
+    """
+    Args:
+      job_dir: The directory of the job.
+      requirements: The requirement vector for the job.
+      image: The image that the job runs in.
+      owner: The owner of the job.
+      priority: The priority of the job.
+      sequence: The position of the job in the queue. """
+    self.job_dir = job_dir
+    self.requirements = requirements
+    self.image = image
+    self.owner = owner
+    self.priority = priority
+    self.sequence = sequence
+
+
+class Coordinator:
+  """ Keeps a queue of pending jobs, and sends them to workers. Each job goes to
+  the worker that it leaves the least room on, so that we keep larger holes
+  available for larger jobs, the same as GPUs are chosen within a machine.
+  Workers that stop sending heartbeats are assumed to be gone, and their jobs
+  are put back into the queue in their original places. If the worker was only
+  cut off from us, and not actually down, it tells us which jobs it still has
+  when it comes back. Those are taken back out of the queue, and wherever a job
+  ended up twice, the copy that hasn't started yet is cancelled. Only jobs that
+  started in both places run twice. """
+
+  def __init__(self, worker_timeout=10.0, dispatch_threads=8):
+    """
+    Args:
+      worker_timeout: How long a worker can go without a heartbeat, in
+      seconds, before its jobs are requeued.
+      dispatch_threads: The number of threads to send jobs to workers with. """
+    self.__worker_timeout = worker_timeout
+
+    # Protects all the state below, which is used from the server threads.
+    self.__lock = threading.Lock()
+    # Maps worker names to _Workers.
+    self.__workers = {}
+    # Maps the directories of all the jobs we know about to _Jobs.
+    self.__jobs = {}
+    # Jobs that haven't been sent to a worker yet, by directory.
+    self.__pending = PendingQueue()
+    # Gives jobs their positions in the queue.
+    self.__sequence = itertools.count()
+
+    # Set when there might be something new to schedule.
+    self.__wake_event = threading.Event()
+    self.__executor = ThreadPoolExecutor(max_workers=dispatch_threads)
+
+  def start(self):
+    """ Starts scheduling jobs in the background. """
+    thread = threading.Thread(target=self.__run, daemon=True)
+    thread.start()
+
+  def add_jobs(self, loaded_jobs, owner=None, priority=None):
+    """ Adds a batch of jobs to the queue.
+    Args:
+      loaded_jobs: A list of (job directory, result) pairs, where each result
+      is a JobConfig, or a message saying why the job is invalid.
+      owner: Optional owner of the jobs.
+      priority: Optional priority for the jobs, which overrides the ones in
+      their configurations.
+    Returns:
+      A list with None for each job that was added, or a message saying why it
+      wasn't. """
+    errors = []
+    with self.__lock:
+      for job_dir, config in loaded_jobs:
+        if isinstance(config, str):
+          errors.append(config)
+          continue
+        if job_dir in self.__jobs:
+          errors.append("Job is already queued.")
+          continue
+        if config.get_array():
+          # Workers expand arrays themselves, so the whole array would have to
+          # fit on one of them.
+          errors.append("Job arrays can't be spread across a cluster. Submit" \
+                        " them to a worker directly.")
+          continue
+        if config.get_dependencies():
+          # Workers only know about their own jobs.
+          errors.append("Jobs with dependencies can't be spread across a" \
+                        " cluster. Submit them to a worker directly.")
+          continue
+
+        job_priority = priority
+        if job_priority is None:
+          job_priority = config.get_priority()
+        job = _Job(job_dir, _get_requirements(config),
+                   config.get_container_name(), owner, job_priority,
+                   next(self.__sequence))
+        self.__jobs[job_dir] = job
+        self.__enqueue(job)
+        errors.append(None)
+
+    logger.info("Added %d jobs." % (errors.count(None)))
+    self.__wake_event.set()
+    return errors
+
+  def __enqueue(self, job):
+    """ Puts a job in the pending queue. Must be called with the lock held.
+    Args:
+      job: The job to add. """
+    self.__pending.add(job.job_dir, job.requirements, image=job.image,
+                       owner=job.owner, priority=job.priority,
+                       sequence=job.sequence)
+
+  def __unqueue(self, job):
+    """ Takes a job back out of the pending queue. Must be called with the lock
+    held.
+    Args:
+      job: The job. """
+    self.__pending.remove(job.job_dir, job.requirements, image=job.image,
+                          owner=job.owner, priority=job.priority)
+
+  def __find_worker(self, job_dir):
+    """ Finds the worker that a job was sent to. Must be called with the lock
+    held.
+    Args:
+      job_dir: The directory of the job.
+    Returns:
+      The worker, or None if the job is in the queue. """
+    for worker in self.__workers.values():
+      if job_dir in worker.dispatched or job_dir in worker.running:
+        return worker
+    return None
+
+  def __resync(self, worker, running, pending):
+    """ Reconciles the jobs that a worker says it has with where we think they
+    are. This matters when we gave up on the worker, and it comes back. Must be
+    called with the lock held.
+    Args:
+      worker: The worker.
+      running: The directories of the jobs that are running on it.
+      pending: The directories of the jobs that are queued on it, which haven't
+      started yet. """
+    for job_dir, started in [(job_dir, True) for job_dir in running] + \
+                            [(job_dir, False) for job_dir in pending]:
+      job = self.__jobs.get(job_dir)
+      if job is None:
+        # It was submitted to the worker directly.
+        continue
+
+      holder = self.__find_worker(job_dir)
+      if holder is worker:
+        if started and worker.dispatched.pop(job_dir, None) is not None:
+          worker.running.add(job_dir)
+        continue
+
+      if holder is None:
+        # We requeued it, but it never left.
+        logger.info("%s still has %s." % (worker.name, job_dir))
+        self.__unqueue(job)
+      elif started and job_dir in holder.dispatched:
+        # We sent it somewhere else too, but it hasn't started there.
+        logger.warning("Cancelling %s on %s, since it is running on %s." % \
+                       (job_dir, holder.name, worker.name))
+        del holder.dispatched[job_dir]
+        holder.cancelling.add(job_dir)
+      elif not started:
+        logger.warning("Cancelling %s on %s, since it is on %s." % \
+                       (job_dir, worker.name, holder.name))
+        worker.cancelling.add(job_dir)
+        continue
+      else:
+        logger.error("%s is running on both %s and %s." % \
+                     (job_dir, worker.name, holder.name))
+        continue
+
+      if started:
+        worker.running.add(job_dir)
+      else:
+        # We don't know which GPUs it will get, so only its CPU and RAM count
+        # until it starts.
+        worker.dispatched[job_dir] = ()
+
+  def __finish(self, worker, job_dir):
+    """ Forgets about a job that finished on a worker. Must be called with the
+    lock held.
+    Args:
+      worker: The worker that it finished on.
+      job_dir: The directory of the job. """
+    worker.cancelling.discard(job_dir)
+    job = self.__jobs.get(job_dir)
+    if job is None:
+      return
+
+    if worker.dispatched.pop(job_dir, None) is None and \
+       job_dir not in worker.running:
+      # We gave up on the worker while the job was running there.
+      holder = self.__find_worker(job_dir)
+      if holder is None:
+        self.__unqueue(job)
+      elif job_dir in holder.dispatched:
+        del holder.dispatched[job_dir]
+        holder.cancelling.add(job_dir)
+      else:
+        # It is running somewhere else too, so that copy finishes it.
+        return
+
+    worker.running.discard(job_dir)
+    del self.__jobs[job_dir]
+
+  def __requeue_worker(self, worker):
+    """ Puts all the jobs from a worker back into the queue. Must be called with
+    the lock held.
+    Args:
+      worker: The worker. """
+    job_dirs = list(worker.dispatched) + list(worker.running)
+    for job_dir in job_dirs:
+      self.__enqueue(self.__jobs[job_dir])
+    worker.dispatched.clear()
+    worker.running.clear()
+
+    if job_dirs:
+      logger.warning("Requeued %d jobs from %s." % (len(job_dirs),
+                                                    worker.name))
+      self.__wake_event.set()
+
+  def __mark_dead(self, worker):
+    """ Marks a worker as down, and requeues its jobs. Must be called with the
+    lock held.
+    Args:
+      worker: The worker. """
+    if not worker.alive:
+      return
+
+    logger.error("Lost worker %s." % (worker.name))
+    worker.alive = False
+    self.__requeue_worker(worker)
+
+  def heartbeat(self, beat):
+    """ Handles a heartbeat from a worker.
+    Args:
+      beat: The heartbeat, from worker.Reporter.
+    Returns:
+      The reply to send to the worker. """
+    name = beat["worker"]
+    with self.__lock:
+      worker = self.__workers.get(name)
+      if not beat["full"] and (worker is None or not worker.alive):
+        # We don't know what state the worker is in, either because we were
+        # restarted, or because we already gave up on it.
+        return {"resync": True}
+
+      if worker is None:
+        logger.info("New worker %s at %s." % (name, beat["url"]))
+        worker = _Worker(name, beat["url"])
+        self.__workers[name] = worker
+      elif not worker.alive:
+        logger.info("Worker %s is back." % (name))
+
+      worker.url = beat["url"]
+      worker.alive = True
+      worker.last_seen = time.monotonic()
+      if beat["full"]:
+        worker.state = dict(beat["changes"])
+        self.__resync(worker, beat.get("running", []),
+                      beat.get("pending", []))
+      else:
+        worker.state.update(beat["changes"])
+
+      for job_dir in beat["started"]:
+        if worker.dispatched.pop(job_dir, None) is not None:
+          worker.running.add(job_dir)
+      for job_dir in beat["finished"]:
+        self.__finish(worker, job_dir)
+
+      reply = {}
+      if worker.cancelling:
+        reply["cancel"] = sorted(worker.cancelling)
+
+    if beat["full"] or beat["changes"] or beat["started"] or \
+       beat["finished"]:
+      # Something might fit now.
+      self.__wake_event.set()
+    return reply
+
+  def __check_workers(self):
+    """ Requeues the jobs from workers that we haven't heard from in too long.
+    Must be called with the lock held. """
+    now = time.monotonic()
+    for worker in self.__workers.values():
+      if worker.alive and now - worker.last_seen > self.__worker_timeout:
+        self.__mark_dead(worker)
+
+  def __place(self, job_dir, requirements):
+    """ Chooses a worker for a job, and reserves the resources for it there.
+    Args:
+      job_dir: The directory of the job.
+      requirements: The requirement vector for the job.
+    Returns:
+      The worker, or None if the job doesn't fit anywhere. """
+    needed_cpu, needed_ram, count, needed_gpu, needed_vram = requirements
+
+    best = None
+    for worker in self.__workers.values():
+      if not worker.is_ready():
+        continue
+
+      cpu, ram, gpu_usage, vram_usage = worker.get_usage(self.__jobs)
+      cpu_left = 100 - cpu - needed_cpu / worker.state["cores"]
+      ram_left = 100 - ram - needed_ram / worker.state["total_ram"] * 100
+      if cpu_left < 0 or ram_left < 0:
+        continue
+      total_vram = worker.get_total_vram()
+      gpus = choose_gpus(count, needed_gpu, needed_vram, gpu_usage, vram_usage,
+                         total_vram)
+      if gpus is None:
+        continue
+
+      # Weight all resources equally, like choose_gpus() does.
+      slack = cpu_left / 100 + ram_left / 100
+      for gpu_id in gpus:
+        slack += (100 - gpu_usage[gpu_id] - needed_gpu) / 100
+        slack += (total_vram[gpu_id] - vram_usage[gpu_id] - needed_vram) / \
+                 total_vram[gpu_id]
+      if best is None or (slack, worker.name) < best[:2]:
+        best = (slack, worker.name, worker, gpus)
+
+    if best is None:
+      return None
+
+    _, _, worker, gpus = best
+    worker.dispatched[job_dir] = gpus
+    return worker
+
+  def __send(self, worker, job_dirs, owner, priority):
+    """ Sends jobs to a worker. Meant to be run in a separate thread.
+    Args:
+      worker: The worker to send the jobs to.
+      job_dirs: The directories of the jobs.
+      owner: The owner of the jobs.
+      priority: The priority of the jobs. """
+    host, port = worker.url.rsplit(":", 1)
+    body = {"job_dirs": job_dirs, "owner": owner, "priority": priority}
+    try:
+      connection = http.client.HTTPConnection(host, int(port), timeout=60)
+      connection.request("POST", "/add_jobs", json.dumps(body),
+                         {"Content-Type": "application/json"})
+      response = connection.getresponse()
+      data = response.read()
+      connection.close()
+      if response.status != 200:
+        raise http.client.HTTPException("Worker returned %d." % \
+                                         (response.status))
+      rejected = json.loads(data)["rejected"]
+    except (OSError, ValueError, KeyError, http.client.HTTPException) as error:
+      logger.error("Failed to send %d jobs to %s: %s" % \
+                   (len(job_dirs), worker.name, error))
+      with self.__lock:
+        self.__mark_dead(worker)
+      return
+
+    logger.debug("Sent %d jobs to %s.", len(job_dirs), worker.name)
+    if not rejected:
+      return
+    with self.__lock:
+      for rejection in rejected:
+        job_dir = rejection["job_dir"]
+        logger.error("%s rejected %s: %s" % (worker.name, job_dir,
+                                             rejection["reason"]))
+        if worker.dispatched.pop(job_dir, None) is not None:
+          del self.__jobs[job_dir]
+    # That freed up some room.
+    self.__wake_event.set()
+
+  def __dispatch(self):
+    """ Sends every pending job that fits somewhere to a worker. """
+    with self.__lock:
+      self.__check_workers()
+      runnable = self.__pending.pop_runnable(self.__place)
+
+      # Send jobs to each worker in batches.
+      batches = {}
+      for job_dir, _, worker in runnable:
+        job = self.__jobs[job_dir]
+        key = (worker.name, job.owner, job.priority)
+        batches.setdefault(key, (worker, []))[1].append(job_dir)
+
+    for (_, owner, priority), (worker, job_dirs) in batches.items():
+      self.__executor.submit(self.__send, worker, job_dirs, owner, priority)
+
+  def __run(self):
+    """ Schedules jobs forever. """
+    while True:
+      # Wake up regularly to notice workers that went away.
+      self.__wake_event.wait(min(1.0, self.__worker_timeout / 2))
+      self.__wake_event.clear()
+
+      self.__dispatch()
+
+  def get_status(self):
+    """
+    Returns:
+      A dictionary describing the workers and the queue. """
+    with self.__lock:
+      workers = {}
+      for name, worker in self.__workers.items():
+        workers[name] = {"url": worker.url, "alive": worker.alive,
+                         "dispatched": len(worker.dispatched),
+                         "running": len(worker.running),
+                         "cancelling": len(worker.cancelling),
+                         "state": worker.state}
+      return {"pending": len(self.__pending), "workers": workers}
+
+
+@_app.route("/add_jobs", methods=["POST"])
+def _add_jobs():
+  """ Adds a batch of jobs to the cluster. This takes the same request as the
+  daemon's /add_jobs. """
+  body = request.get_json(silent=True)
+  if not isinstance(body, dict):
+    logger.error("Invalid request with no JSON body.")
+    abort(400)
+
+  job_dirs = list(body.get("job_dirs", []))
+  priority = body.get("priority")
+  if priority is not None and not isinstance(priority, int):
+    logger.error("Invalid priority: %s" % (priority))
+    abort(400)
+
+  rejected = []
+  for pattern in body.get("globs", []):
+    matches = sorted(glob.glob(pattern))
+    if not matches:
+      rejected.append({"job_dir": pattern,
+                       "reason": "No directories matched."})
+    job_dirs.extend(matches)
+
+  accepted = []
+  if job_dirs:
+    # Load the jobs here too, since we need their requirements to place them.
+    loaded = [threading.Event(), None]
+    def on_loaded(loaded_jobs):
+      loaded[1] = loaded_jobs
+      loaded[0].set()
+
+    _pipeline.submit(job_dirs, on_loaded)
+    if not loaded[0].wait(_LOAD_TIMEOUT):
+      logger.error("Timed out loading jobs.")
+      abort(504)
+
+    # Without an owner, the workers use the owners of the job directories.
+    owner = body.get("owner") if _trust_owner else None
+    errors = _coordinator.add_jobs(loaded[1], owner=owner, priority=priority)
+    for job_dir, error in zip(job_dirs, errors):
+      if error:
+        rejected.append({"job_dir": job_dir, "reason": error})
+      else:
+        accepted.append(job_dir)
+
+  return jsonify(accepted=accepted, rejected=rejected)
+
+@_app.route("/heartbeat", methods=["POST"])
+def _heartbeat():
+  """ Handles a heartbeat from a worker. """
+  beat = request.get_json(silent=True)
+  if not isinstance(beat, dict) or "worker" not in beat:
+    logger.error("Invalid heartbeat.")
+    abort(400)
+
+  return jsonify(_coordinator.heartbeat(beat))
+
+@_app.route("/workers", methods=["GET"])
+def _workers():
+  """ Shows the state of the workers and the queue. """
+  return jsonify(_coordinator.get_status())
+
+
+def main():
+  global _coordinator
+  global _pipeline
+  global _trust_owner
+
+  parser = argparse.ArgumentParser( \
+      description="Coordinates a cluster of stoplight daemons.")
+  parser.add_argument("--host", default="127.0.0.1",
+                      help="Address to listen on.")
+  parser.add_argument("--port", type=int, default=5100,
+                      help="Port to listen on.")
+  parser.add_argument("--worker-timeout", type=float, default=10.0,
+                      help="Seconds without a heartbeat before a worker is" \
+                           " considered down, and its jobs are requeued.")
+  parser.add_argument("--admission-workers", type=int, default=4,
+                      help="Number of threads to load new jobs with.")
+  parser.add_argument("--trust-owner", action="store_true",
+                      help="Believe the owner that clients send with jobs." \
+                           " Only use this if the coordinator can only be" \
+                           " reached by trusted clients. The workers need" \
+                           " --trust-owner too.")
+  parser.add_argument("--log-level", default="info",
+                      choices=("debug", "info", "warning", "error"),
+                      help="Minimum level of messages to log.")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=getattr(logging, args.log_level.upper()),
+                      format="%(name)s@%(asctime)s: [%(levelname)s]" \
+                             " %(message)s")
+
+  _trust_owner = args.trust_owner
+  _coordinator = Coordinator(worker_timeout=args.worker_timeout)
+  _coordinator.start()
+  _pipeline = AdmissionPipeline(workers=args.admission_workers)
+
+  # Allow workers to keep their connections open between heartbeats.
+  WSGIRequestHandler.protocol_version = "HTTP/1.1"
+  _app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+  main()
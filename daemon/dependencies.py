@@ -0,0 +1,171 @@
+from collections import deque, OrderedDict
+
+
+""" Tracks dependencies between jobs, so that pipelines can be submitted all at
+once, with each step waiting for the ones before it. """
+
+
+# The dependency is satisfied once the other job succeeds. If it fails, the
+# dependent job is cancelled.
+AFTER_SUCCESS = "success"
+# The dependency is satisfied once the other job finishes in any way.
+AFTER_ANY = "any"
+CONDITIONS = (AFTER_SUCCESS, AFTER_ANY)
+
+# What add() can decide about a new job.
+READY = "ready"
+BLOCKED = "blocked"
+CANCELLED = "cancelled"
+
+
+class DependencyGraph:
+  """ A DAG of jobs and the job directories that they depend on. A directory
+  counts as finished once every job from it has finished, which lets a job
+  depend on a whole job array, and it succeeded if all of those jobs did.
+  Each blocked job keeps a count of its unmet dependencies, and each
+  directory keeps a list of the jobs waiting on it, so finishing a job only
+  touches the jobs that directly depend on it. Failures are propagated the
+  same way, one level at a time. Dependencies have to be submitted before the
+  jobs that depend on them, which means that there can't be any cycles. """
+
+  def __init__(self, max_outcomes=10000, on_outcome=None):
+    """
+    Args:
+      max_outcomes: The number of finished directories to remember the
+      outcomes of, so that new jobs can depend on them.
+      on_outcome: Optional function that is called with a directory and
+      whether it succeeded, whenever all the jobs from it have finished. """
+    self.__max_outcomes = max_outcomes
+    self.__on_outcome = on_outcome
+
+    # Maps directories with jobs that haven't finished to
+    # [number of unfinished jobs, whether any failed] lists.
+    self.__live = {}
+    # Maps directories to lists of (job, condition) pairs for the blocked jobs
+    # that are waiting on them.
+    self.__waiting = {}
+    # Maps blocked jobs to the number of dependencies they are waiting on.
+    self.__unmet = {}
+    # Maps finished directories to whether they succeeded, oldest first.
+    self.__outcomes = OrderedDict()
+
+  def __len__(self):
+    """
+    Returns:
+      The number of blocked jobs. """
+    return len(self.__unmet)
+
+  def load_outcomes(self, outcomes):
+    """ Restores the outcomes of directories that finished before a restart.
+    Args:
+      outcomes: A list of (directory, succeeded) pairs, oldest first. """
+    for directory, succeeded in outcomes:
+      self.__remember(directory, succeeded)
+
+  def __remember(self, directory, succeeded):
+    """ Records the outcome of a finished directory.
+    Args:
+      directory: The directory.
+      succeeded: Whether all its jobs succeeded. """
+    self.__outcomes[directory] = succeeded
+    self.__outcomes.move_to_end(directory)
+    if len(self.__outcomes) > self.__max_outcomes:
+      self.__outcomes.popitem(last=False)
+
+  def check(self, directory, dependencies):
+    """ Checks whether a new job's dependencies can be met.
+    Args:
+      directory: The directory of the new job.
+      dependencies: A list of (directory, condition) pairs.
+    Returns:
+      None if they can, or a message saying why not. """
+    for dependency, condition in dependencies:
+      if dependency == directory:
+        return "Job can't depend on itself."
+      if dependency in self.__live:
+        continue
+
+      succeeded = self.__outcomes.get(dependency)
+      if succeeded is None:
+        return "Dependency %s isn't queued, and hasn't finished recently." % \
+               (dependency)
+      if not succeeded and condition == AFTER_SUCCESS:
+        return "Dependency %s failed." % (dependency)
+
+    return None
+
+  def add(self, job, dependencies):
+    """ Adds a new job. Its directory counts as unfinished until it finishes.
+    Args:
+      job: The job.
+      dependencies: A list of (directory, condition) pairs. Directories that
+      are neither queued nor remembered are assumed to have succeeded.
+    Returns:
+      READY if the job can run now, BLOCKED if it has to wait, or CANCELLED if
+      one of its dependencies already failed. A cancelled job still has to be
+      passed to finish(). """
+    state = self.__live.setdefault(job.get_directory(), [0, False])
+    state[0] += 1
+
+    unmet = 0
+    for dependency, condition in dependencies:
+      if dependency == job.get_directory():
+        # This would never be met.
+        continue
+      if dependency in self.__live:
+        self.__waiting.setdefault(dependency, []).append((job, condition))
+        unmet += 1
+      elif self.__outcomes.get(dependency) is False and \
+           condition == AFTER_SUCCESS:
+        return CANCELLED
+
+    if not unmet:
+      return READY
+    self.__unmet[job] = unmet
+    return BLOCKED
+
+  def finish(self, job, succeeded):
+    """ Records that a job finished, and updates the jobs that depend on it.
+    Args:
+      job: The job.
+      succeeded: Whether the job succeeded.
+    Returns:
+      A list of the blocked jobs that can now run, and a list of the blocked
+      jobs that were cancelled because a dependency failed. Cancelled jobs
+      have already been finished. """
+    ready = []
+    cancelled = []
+    # (directory, succeeded) pairs for jobs that finished.
+    finished = deque([(job.get_directory(), succeeded)])
+    while finished:
+      directory, succeeded = finished.popleft()
+      state = self.__live[directory]
+      state[0] -= 1
+      state[1] = state[1] or not succeeded
+      if state[0]:
+        # Other jobs from the directory are still going.
+        continue
+
+      del self.__live[directory]
+      succeeded = not state[1]
+      self.__remember(directory, succeeded)
+      if self.__on_outcome:
+        self.__on_outcome(directory, succeeded)
+
+      for dependent, condition in self.__waiting.pop(directory, ()):
+        if dependent not in self.__unmet:
+          # It was already cancelled.
+          continue
+
+        if succeeded or condition == AFTER_ANY:
+          self.__unmet[dependent] -= 1
+          if not self.__unmet[dependent]:
+            del self.__unmet[dependent]
+            ready.append(dependent)
+        else:
+          # Cancelling a job finishes it, which can cancel more jobs.
+          del self.__unmet[dependent]
+          cancelled.append(dependent)
+          finished.append((dependent.get_directory(), False))
+
+    return ready, cancelled
@@ -1,120 +1,681 @@
-from fcntl import fcntl, F_GETFL, F_SETFL
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import json
 import logging
 import os
-import subprocess
-import sys
+import socket
+import struct
+import threading
+import urllib.parse
 
 import util
 
 
-""" A simple wrapper that makes interacting with docker less ugly. """
+""" A simple wrapper that makes interacting with docker less ugly. This talks
+to the Docker Engine API directly over its unix socket, instead of running the
+docker command line tool. """
 
 
 logger = logging.getLogger(__name__)
 
 
+# Label that we put on all the containers we start.
+_LABEL = "stoplight"
+# Version of the Docker Engine API that we use. This is the first one that
+# supports device requests.
+_API_VERSION = "v1.40"
+# Default location of the docker socket.
+_DEFAULT_SOCKET = "/var/run/docker.sock"
+# How much to read from an output stream at once.
+_READ_SIZE = 256 * 1024
+
+# Threads that signals are sent to containers from, so that a slow docker
+# daemon doesn't hold up the scheduling loop.
+_signal_executor = ThreadPoolExecutor(max_workers=2)
+
+
+class DockerError(Exception):
+  """ Raised when the Docker Engine API returns an error. """
+
+  def __init__(self, status, message):
+    """
+    Args:
+      status: The HTTP status code.
+      message: The error message. """
+    super().__init__("Docker error %d: %s" % (status, message))
+    self.status = status
+
+
+class _UnixConnection(http.client.HTTPConnection):
+  """ An HTTP connection over a unix socket. """
+
+  def __init__(self, socket_path):
+    """
+    Args:
+      socket_path: The path to the socket. """
+    super().__init__("localhost")
+    self.__socket_path = socket_path
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.connect(self.__socket_path)
+
+
+class Client:
+  """ A client for the Docker Engine API. Connections are kept open and reused
+  between requests. """
+
+  def __init__(self, socket_path=None):
+    """
+    Args:
+      socket_path: The path to the docker socket. By default, this is taken
+      from DOCKER_HOST, if it is a unix socket, or the standard location. """
+    if socket_path is None:
+      socket_path = _DEFAULT_SOCKET
+      docker_host = os.environ.get("DOCKER_HOST", "")
+      if docker_host.startswith("unix://"):
+        socket_path = docker_host[len("unix://"):]
+    self.__socket_path = socket_path
+
+    # Idle connections that can be reused.
+    self.__connections = []
+    self.__lock = threading.Lock()
+
+  def __get_connection(self):
+    """
+    Returns:
+      An idle connection, or a new one if there are none. """
+    with self.__lock:
+      if self.__connections:
+        return self.__connections.pop()
+    return _UnixConnection(self.__socket_path)
+
+  def __release_connection(self, connection):
+    """ Returns a connection to the pool.
+    Args:
+      connection: The connection to return. """
+    with self.__lock:
+      self.__connections.append(connection)
+
+  def __make_path(self, path, query=None):
+    """ Makes the full path for a request.
+    Args:
+      path: The path of the endpoint, without the API version.
+      query: Optional dictionary of query parameters.
+    Returns:
+      The full path. """
+    path = "/%s%s" % (_API_VERSION, path)
+    if query:
+      path += "?" + urllib.parse.urlencode(query)
+    return path
+
+  def request(self, method, path, query=None, body=None):
+    """ Performs a request.
+    Args:
+      method: The HTTP method.
+      path: The path of the endpoint, without the API version.
+      query: Optional dictionary of query parameters.
+      body: Optional object to send as JSON.
+    Returns:
+      The decoded JSON response, or None if there was no content. """
+    full_path = self.__make_path(path, query)
+    headers = {}
+    if body is not None:
+      body = json.dumps(body)
+      headers["Content-Type"] = "application/json"
+
+    # If the connection was idle, the server might have closed it, in which
+    # case we try again with a new one.
+    for attempt in range(2):
+      connection = self.__get_connection()
+      try:
+        connection.request(method, full_path, body=body, headers=headers)
+        response = connection.getresponse()
+        data = response.read()
+        break
+      except (http.client.RemoteDisconnected, ConnectionError):
+        connection.close()
+        if attempt:
+          raise
+
+    if response.will_close:
+      connection.close()
+    else:
+      self.__release_connection(connection)
+
+    if response.status >= 400:
+      message = data.decode("utf-8", "replace")
+      try:
+        message = json.loads(message)["message"]
+      except (ValueError, KeyError, TypeError):
+        pass
+      raise DockerError(response.status, message)
+
+    if not data:
+      return None
+    try:
+      return json.loads(data.decode("utf-8"))
+    except ValueError:
+      # Some endpoints, like image pulls, stream multiple JSON objects.
+      return data
+
+  def attach(self, container_id):
+    """ Attaches to the output of a container.
+    Args:
+      container_id: The ID or name of the container.
+    Returns:
+      A socket that the multiplexed output can be read from, and any output
+      data that was already received with the response headers. """
+    path = self.__make_path("/containers/%s/attach" % (container_id),
+                            {"stream": 1, "stdout": 1, "stderr": 1})
+    request = "POST %s HTTP/1.1\r\nHost: localhost\r\n" \
+              "Connection: Upgrade\r\nUpgrade: tcp\r\n" \
+              "Content-Length: 0\r\n\r\n" % (path)
+
+    # The connection gets hijacked for the stream, so we can't use a normal
+    # HTTP connection.
+    stream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stream.connect(self.__socket_path)
+    stream.sendall(request.encode("utf-8"))
+
+    response = b""
+    while b"\r\n\r\n" not in response:
+      data = stream.recv(4096)
+      if not data:
+        stream.close()
+        raise DockerError(0, "Connection closed while attaching.")
+      response += data
+
+    headers, _, leftover = response.partition(b"\r\n\r\n")
+    status = int(headers.split(b" ", 2)[1])
+    if status not in (101, 200):
+      stream.close()
+      raise DockerError(status, "Failed to attach to %s." % (container_id))
+
+    return stream, leftover
+
+
+# Client shared by all containers. It is created the first time it's needed.
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+  """
+  Returns:
+    The shared Docker Engine API client. """
+  global _client
+  with _client_lock:
+    if _client is None:
+      _client = Client()
+  return _client
+
+def list_containers():
+  """ Lists the containers started by stoplight that still exist.
+  Returns:
+    A dictionary mapping the names of the containers to their states, such as
+    "running" or "exited". """
+  filters = json.dumps({"label": [_LABEL]})
+  containers = get_client().request("GET", "/containers/json",
+                                    {"all": 1, "filters": filters})
+
+  states = {}
+  for container in containers:
+    for name in container["Names"]:
+      states[name.lstrip("/")] = container["State"]
+  return states
+
+def _split_image(image):
+  """ Splits an image name into the repository and the tag.
+  Args:
+    image: The name of the image.
+  Returns:
+    The repository and the tag. For images that are referenced by digest,
+    such as "ubuntu@sha256:...", the repository includes the digest, and the
+    tag is None. """
+  name, _, digest = image.partition("@")
+  if digest:
+    # The digest picks the image, so any tag is ignored, like docker does.
+    repository, _, tag = name.rpartition(":")
+    if repository and "/" not in tag:
+      name = repository
+    return "%s@%s" % (name, digest), None
+
+  name, _, tag = image.rpartition(":")
+  if not name or "/" in tag:
+    # No tag, or the colon was part of a registry address.
+    name, tag = image, "latest"
+  return name, tag
+
+def normalize_image(image):
+  """ Normalizes an image name, so that it matches the tags or digests that
+  docker reports for local images.
+  Args:
+    image: The name of the image.
+  Returns:
+    The normalized name, which always includes a tag or a digest. """
+  name, tag = _split_image(image)
+  if tag is None:
+    return name
+  return "%s:%s" % (name, tag)
+
+def _check_progress(progress):
+  """ Checks the progress messages that docker streams back while pulling an
+  image. A pull that fails partway through still returns a successful status,
+  with the error in the last message.
+  Args:
+    progress: The response to the pull request.
+  Raises:
+    DockerError if the pull failed. """
+  if isinstance(progress, dict):
+    messages = [progress]
+  else:
+    messages = []
+    decoder = json.JSONDecoder()
+    text = (progress or b"").decode("utf-8", "replace")
+    offset = 0
+    while True:
+      # Skip the whitespace between messages.
+      while offset < len(text) and text[offset].isspace():
+        offset += 1
+      if offset >= len(text):
+        break
+      try:
+        message, offset = decoder.raw_decode(text, offset)
+      except ValueError:
+        raise DockerError(0, "Bad progress message from image pull.")
+      messages.append(message)
+
+  for message in messages:
+    if isinstance(message, dict) and message.get("error"):
+      raise DockerError(0, message["error"])
+
+def pull_image(image):
+  """ Pulls an image. This blocks until the pull is finished.
+  Args:
+    image: The name of the image. """
+  logger.info("Pulling image '%s'." % (image))
+
+  name, tag = _split_image(image)
+  query = {"fromImage": name}
+  if tag is not None:
+    query["tag"] = tag
+  progress = get_client().request("POST", "/images/create", query)
+  _check_progress(progress)
+
+def list_images():
+  """ Lists the images that are present locally.
+  Returns:
+    A dictionary mapping the tags and digests of the images, in the same form
+    as normalize_image() produces, to their sizes, in bytes. """
+  images = {}
+  for image in get_client().request("GET", "/images/json"):
+    for name in (image.get("RepoTags") or []) + \
+                (image.get("RepoDigests") or []):
+      images[name] = image["Size"]
+  return images
+
+def get_image_size(image):
+  """
+  Args:
+    image: The name of the image.
+  Returns:
+    The size of the image, in bytes. """
+  info = get_client().request("GET", "/images/%s/json" % (image))
+  return info["Size"]
+
+def remove_image(image):
+  """ Removes a local image.
+  Args:
+    image: The name of the image. """
+  logger.info("Removing image '%s'." % (image))
+  get_client().request("DELETE", "/images/%s" % (image))
+
+def get_container_pid(name):
+  """
+  Args:
+    name: The name of the container.
+  Returns:
+    The process ID of the main process in the container, on the host, or None
+    if it isn't running. """
+  info = get_client().request("GET", "/containers/%s/json" % (name))
+  return info["State"].get("Pid") or None
+
+def wait_container(name):
+  """ Waits for a container to exit. This blocks until it does, or returns
+  right away if it already has.
+  Args:
+    name: The name of the container.
+  Returns:
+    The exit code of the container. """
+  result = get_client().request("POST", "/containers/%s/wait" % (name))
+  return result["StatusCode"]
+
+def remove_container(name, force=False):
+  """ Removes a container.
+  Args:
+    name: The name of the container.
+    force: Whether to kill the container first if it is still running.
+    Otherwise, removing a running container fails. """
+  query = None
+  if force:
+    query = {"force": 1}
+  get_client().request("DELETE", "/containers/%s" % (name), query)
+
+
+class _Demultiplexer:
+  """ Splits the multiplexed output stream from a container into stdout and
+  stderr. The stream consists of frames, each of which has an 8-byte header
+  specifying which stream it belongs to and how long it is. """
+
+  def __init__(self, stdout, stderr):
+    """
+    Args:
+      stdout: File to write the standard output to.
+      stderr: File to write the standard error to. """
+    self.__fds = {1: stdout.fileno(), 2: stderr.fileno()}
+    self.__buffer = bytearray()
+
+  def feed(self, data):
+    """ Processes new data from the stream.
+    Args:
+      data: The new data. """
+    self.__buffer += data
+
+    offset = 0
+    while len(self.__buffer) - offset >= 8:
+      stream, size = struct.unpack_from(">BxxxL", self.__buffer, offset)
+      if len(self.__buffer) - offset - 8 < size:
+        # We don't have the whole frame yet.
+        break
+
+      fd = self.__fds.get(stream)
+      if fd is not None:
+        with memoryview(self.__buffer) as view:
+          frame = view[offset + 8:offset + 8 + size]
+          while frame:
+            written = os.write(fd, frame)
+            frame = frame[written:]
+          frame.release()
+
+      offset += 8 + size
+
+    del self.__buffer[:offset]
+
+
 class Container:
   """ Represents a running container. """
 
-  def __init__(self, container, job_dir, nvidia=True):
+  def __init__(self, container, job_dir, name):
     """
     Args:
       container: The container to run.
       job_dir: The directory that will be mounted under /job_files in the
       container.
-      nvidia: If true, it will use nvidia-docker instead of normal docker. """
+      name: The name to give the container, which can be used to find it again
+      if the daemon restarts. """
     self.__container = container
     self.__job_dir = os.path.abspath(job_dir)
+    self.__name = name
+
+    # The stream that we read the output from.
+    self.__stream = None
+    self.__demultiplexer = None
+    # The read end of a pipe that is closed once the container exits. The
+    # output stream usually ends when the container exits, but the container
+    # can also close its output early, so we only know that it exited once
+    # waiting for it returns.
+    self.__wait_pipe = None
+    # The exit code of the container, or the error that we got waiting for it.
+    # This is set from the thread that waits for the container.
+    self.__exit_status = None
+    # Whether the container exited, and was removed.
+    self.__exited = False
+    # Whether we killed the container.
+    self.__killed = False
 
-    self.__process = None
+  def __del__(self):
+    self.__close_stream()
+    if self.__wait_pipe is not None:
+      os.close(self.__wait_pipe)
+      self.__wait_pipe = None
+
+  def __close_stream(self):
+    """ Closes the output stream. """
+    if self.__stream:
+      self.__stream.close()
+      self.__stream = None
 
-    if nvidia:
-      self.__docker = util.get_path("nvidia-docker")
+  def __wait(self, write_fd):
+    """ Waits for the container to exit, and removes it. Meant to be run in
+    its own thread, since a container that closed its output early can keep
+    running for as long as it likes.
+    Args:
+      write_fd: The write end of the wait pipe, which is closed once we are
+      done. """
+    try:
+      self.__exit_status = wait_container(self.__name)
+    except (DockerError, OSError) as error:
+      self.__exit_status = error
     else:
-      self.__docker = util.get_path("docker")
+      # Only remove the container once it has really exited.
+      try:
+        remove_container(self.__name)
+      except (DockerError, OSError) as error:
+        logger.warning("Failed to remove container '%s': %s" % \
+                       (self.__name, error))
 
-  def __del__(self):
-    # Stop the processes.
-    if (self.__process and not self.is_finished()):
-      logger.warning("Terminating job from '%s.'" % (self.__job_dir))
-      self.__process.terminate()
+    os.close(write_fd)
+
+  def __start_waiting(self):
+    """ Starts waiting for the container to exit in the background. """
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(read_fd, False)
+    self.__wait_pipe = read_fd
+    threading.Thread(target=self.__wait, args=(write_fd,), daemon=True).start()
+
+  def __attach(self, stdout, stderr):
+    """ Attaches to the output of the container.
+    Args:
+      stdout: File to write the standard output of the container to.
+      stderr: File to write the standard error of the container to. """
+    self.__stream, leftover = get_client().attach(self.__name)
+    self.__stream.setblocking(False)
+
+    self.__demultiplexer = _Demultiplexer(stdout, stderr)
+    self.__demultiplexer.feed(leftover)
 
-  def run_exe(self, exe):
+  def __create(self, config):
+    """ Creates the container, pulling the image if we don't have it.
+    Args:
+      config: The container configuration. """
+    client = get_client()
+    try:
+      client.request("POST", "/containers/create", {"name": self.__name},
+                     config)
+    except DockerError as error:
+      if error.status != 404:
+        raise
+      # We don't have the image.
+      pull_image(self.__container)
+      client.request("POST", "/containers/create", {"name": self.__name},
+                     config)
+
+  def run_exe(self, exe, stdout, stderr, environment=None, gpus=(), cpus=None,
+              memory=None, cpuset_cpus=None, cpuset_mems=None):
     """ Runs an executable in the container. The executable is run in the
     context of the root directory of the container.
     Args:
       exe: The name of the executable to run. It is asumed that this is located
-      in job_dir. """
+      in job_dir.
+      stdout: File to write the standard output of the executable to.
+      stderr: File to write the standard error of the executable to.
+      environment: Dictionary of extra environment variables to set in the
+      container.
+      gpus: The IDs of the GPUs to give the container access to.
+      cpus: Optional number of CPU cores that the container is limited to.
+      memory: Optional amount of memory, in bytes, that the container is
+      limited to. It is killed if it uses more.
+      cpuset_cpus: Optional list of CPUs that the container may run on, such
+      as "0-3".
+      cpuset_mems: Optional list of NUMA nodes that the container may allocate
+      memory on. """
     local_exe_path = os.path.join(self.__job_dir, exe)
     logger.debug("Running '%s' in container '%s'.", exe, self.__container)
     if not os.path.exists(local_exe_path):
       raise util.ConfigurationError("'%s' not found, or not executable." % \
                                     (local_exe_path))
 
-    # Make the docker command.
-    exe_path = os.path.join("job_files", exe)
-    command = [self.__docker, "run", "--rm", "--net=host", "-v",
-               "%s:/job_files" % (self.__job_dir), self.__container, exe_path]
-    logger.debug("Running command: %s" % (command))
-    # Run the command.
-    self.__process = subprocess.Popen(command, stdout=subprocess.PIPE,
-                                      stderr=subprocess.PIPE)
-    # Use non-blocking IO.
-    flags = fcntl(self.__process.stdout, F_GETFL)
-    fcntl(self.__process.stdout, F_SETFL, flags | os.O_NONBLOCK)
-    flags = fcntl(self.__process.stderr, F_GETFL)
-    fcntl(self.__process.stderr, F_SETFL, flags | os.O_NONBLOCK)
+    exe_path = os.path.join("/job_files", exe)
+    host_config = {"Binds": ["%s:/job_files" % (self.__job_dir)],
+                   "NetworkMode": "host"}
+    if gpus:
+      host_config["DeviceRequests"] = [{"Driver": "nvidia",
+                                        "DeviceIDs": [str(gpu) \
+                                                      for gpu in gpus],
+                                        "Capabilities": [["gpu"]]}]
+    if cpus:
+      host_config["NanoCpus"] = int(cpus * 1000000000)
+    if memory:
+      # Don't let it use swap to get around the limit.
+      host_config["Memory"] = int(memory)
+      host_config["MemorySwap"] = int(memory)
+    if cpuset_cpus:
+      host_config["CpusetCpus"] = cpuset_cpus
+    if cpuset_mems:
+      host_config["CpusetMems"] = cpuset_mems
+    config = {"Image": self.__container, "Cmd": [exe_path],
+              "Env": ["%s=%s" % (name, value) \
+                      for name, value in (environment or {}).items()],
+              "Labels": {_LABEL: ""},
+              "AttachStdout": True, "AttachStderr": True,
+              "HostConfig": host_config}
+    logger.debug("Creating container: %s", config)
 
-  def is_finished(self):
-    """
-    Returns:
-      True if the container is finished executing, False otherwise. """
-    retcode = self.__process.poll()
-    if retcode == None:
-      # Not done yet.
-      return False
+    try:
+      self.__create(config)
+      # Attach before starting, so we don't miss any output.
+      self.__attach(stdout, stderr)
+      get_client().request("POST", "/containers/%s/start" % (self.__name))
+    except (DockerError, OSError) as error:
+      self.__close_stream()
+      # Don't leave a container behind that was created, but never ran.
+      try:
+        remove_container(self.__name, force=True)
+      except (DockerError, OSError):
+        pass
+      raise util.ConfigurationError("Failed to start container: %s" % \
+                                    (error))
 
-    if retcode != 0:
-      raise RuntimeError("Internal process exited with status %d." \
-                         " Nice going, nerd!" % (retcode))
+  def reattach(self, stdout, stderr):
+    """ Reattaches to a container that was started by a previous instance of
+    the daemon. Output that was produced while the daemon was down is not
+    copied.
+    Args:
+      stdout: File to write the standard output of the container to.
+      stderr: File to write the standard error of the container to. """
+    logger.info("Reattaching to container '%s'." % (self.__name))
+    self.__attach(stdout, stderr)
 
-    logger.info("Job from %s finished successfully." % (self.__job_dir))
-    return True
+  def get_name(self):
+    """
+    Returns:
+      The name of the container. """
+    return self.__name
 
-  def get_output(self):
+  def get_output_fd(self):
     """
     Returns:
-      The most recent output from stdout. """
-    output = ""
+      The file descriptor that the output of the container is read from. Once
+      the output has ended, this is a different file descriptor, which becomes
+      readable when the container exits. None once it has exited. """
+    if self.__stream:
+      return self.__stream.fileno()
+    return self.__wait_pipe
 
-    while True:
-      read = self.__process.stdout.read(1024)
-      if not read:
+  def pump_output(self):
+    """ Copies any available output from the container to the output files.
+    This never blocks.
+    Returns:
+      True if the container has exited, False otherwise. """
+    while self.__stream:
+      try:
+        data = self.__stream.recv(_READ_SIZE)
+      except BlockingIOError:
+        # Nothing more for now.
+        return False
+
+      if not data:
+        # The output ended. Make the pipe first, so that it can't get the
+        # same file descriptor as the stream did.
+        self.__start_waiting()
+        self.__close_stream()
         break
+
+      self.__demultiplexer.feed(data)
+
+    if self.__wait_pipe is not None:
       try:
-        output += read.decode("utf-8")
-      except UnicodeDecodeError:
-        # Occasionally, we get things we can't understand, so we can just ignore
-        # that.
-        logger.warning("Job %s: got bad unicode." % (self.__job_dir))
+        os.read(self.__wait_pipe, 1)
+      except BlockingIOError:
+        # Still running.
+        return False
+
+      # The other end was closed, so we have the exit status.
+      os.close(self.__wait_pipe)
+      self.__wait_pipe = None
+      self.__exited = True
 
-    return output
+    return self.__exited
 
-  def get_error(self):
+  def signal(self, signal_name):
+    """ Sends a signal to the main process in the container. The signal is
+    sent in the background, so this never blocks.
+    Args:
+      signal_name: The name of the signal, such as "SIGTERM". """
+    if self.__exited:
+      return
+
+    _signal_executor.submit(self.__send_signal, signal_name)
+
+  def __send_signal(self, signal_name):
+    """ Sends a signal to the container. Meant to be run in the signal
+    executor.
+    Args:
+      signal_name: The name of the signal. """
+    try:
+      get_client().request("POST", "/containers/%s/kill" % (self.__name),
+                           {"signal": signal_name})
+    except (DockerError, OSError) as error:
+      # It probably exited already.
+      logger.warning("Failed to send %s to container '%s': %s" % \
+                     (signal_name, self.__name, error))
+
+  def kill(self, reason):
+    """ Kills the container. Doesn't do anything if it was already killed.
+    Args:
+      reason: Why the container is being killed, for the log. """
+    if self.__killed or self.__exited:
+      return
+
+    logger.warning("Killing container '%s': %s" % (self.__name, reason))
+    self.signal("SIGKILL")
+    self.__killed = True
+
+  def is_finished(self):
     """
     Returns:
-      The most recent output from stderr. """
-    output = ""
+      True if the container is finished executing, False otherwise. """
+    if not self.pump_output():
+      # Not done yet.
+      return False
 
-    while True:
-      read = self.__process.stderr.read(1024)
-      if not read:
-        break
-      try:
-        output += read.decode("utf-8")
-      except UnicodeDecodeError:
-        # Occasionally, we get things we can't understand, so we can just ignore
-        # that.
-        logger.warning("Job %s: got bad unicode." % (self.__job_dir))
+    retcode = self.__exit_status
+    if isinstance(retcode, Exception):
+      raise RuntimeError("Could not get exit status: %s" % (retcode))
+    if retcode != 0:
+      raise RuntimeError("Internal process exited with status %d." \
+                         " Nice going, nerd!" % (retcode))
 
-    return output
+    logger.info("Job from %s finished successfully." % (self.__job_dir))
+    return True
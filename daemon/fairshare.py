@@ -0,0 +1,125 @@
+import json
+import logging
+import math
+import os
+import time
+
+
+""" Keeps track of how much of the machine each user has been using, so that
+users who have used less recently get to go first. """
+
+
+logger = logging.getLogger(__name__)
+
+
+class FairShare:
+  """ Tracks the GPU usage of each owner, with older usage counting for less
+  and less over time. For each owner, we only store the decayed usage as of
+  the last time it changed, the number of GPUs they are using right now, and
+  when that was, so looking up an owner's usage takes constant time no matter
+  how many jobs they have run. """
+
+  def __init__(self, half_life=7 * 24 * 3600, weights=None, path=None):
+    """
+    Args:
+      half_life: How long it takes for usage to count for half as much, in
+      seconds.
+      weights: Optional dictionary mapping owners to the relative share of the
+      machine that they are entitled to. Owners that aren't listed get a weight
+      of 1.
+      path: Optional file to save the usage in, so that it survives
+      restarts. """
+    self.__decay_rate = math.log(2) / half_life
+    self.__weights = weights or {}
+    self.__path = path
+
+    # Maps owners to [usage in GPU-seconds, GPUs in use, time of last update].
+    self.__owners = {}
+    # Whether anything changed since we last saved.
+    self.__dirty = False
+
+    if self.__path and os.path.exists(self.__path):
+      self.__load()
+
+  def __load(self):
+    """ Loads the saved usage. """
+    try:
+      with open(self.__path) as usage_file:
+        saved = json.load(usage_file)
+    except (OSError, ValueError) as error:
+      logger.warning("Failed to load fair-share usage: %s" % (error))
+      return
+
+    for owner, (usage, last_update) in saved.items():
+      # Anything that is still running gets added back when it is reattached.
+      self.__owners[owner] = [usage, 0, last_update]
+
+  def __update(self, owner, now):
+    """ Brings the usage for an owner up to date.
+    Args:
+      owner: The owner.
+      now: The current time.
+    Returns:
+      The state for the owner. """
+    state = self.__owners.get(owner)
+    if state is None:
+      state = [0.0, 0, now]
+      self.__owners[owner] = state
+      return state
+
+    usage, gpus, last_update = state
+    # Decay the old usage, and add what was used since then, which also decays
+    # while it accumulates.
+    decay = math.exp(-self.__decay_rate * max(0, now - last_update))
+    state[0] = usage * decay + gpus / self.__decay_rate * (1 - decay)
+    state[2] = now
+    return state
+
+  def add_running(self, owner, gpus):
+    """ Records that an owner started or stopped using GPUs.
+    Args:
+      owner: The owner.
+      gpus: The number of GPUs that they started using, or minus the number
+      that they stopped using. These can be fractional. """
+    if not gpus:
+      return
+
+    state = self.__update(owner, time.time())
+    state[1] += gpus
+    self.__dirty = True
+
+  def get_usage(self, owner):
+    """
+    Args:
+      owner: The owner.
+    Returns:
+      The decayed usage of the owner, in GPU-hours. """
+    if owner not in self.__owners:
+      return 0.0
+    return self.__update(owner, time.time())[0] / 3600
+
+  def get_share(self, owner):
+    """ Gets how much an owner has used, relative to what they are entitled to.
+    Pending jobs from owners with lower values should be started first.
+    Args:
+      owner: The owner.
+    Returns:
+      The usage of the owner, divided by their weight. """
+    return self.get_usage(owner) / self.__weights.get(owner, 1)
+
+  def save(self):
+    """ Saves the usage, if anything changed. """
+    if not self.__path or not self.__dirty:
+      return
+
+    now = time.time()
+    saved = {}
+    for owner in self.__owners:
+      saved[owner] = [self.__update(owner, now)[0], now]
+
+    temp_path = self.__path + ".tmp"
+    with open(temp_path, "w") as usage_file:
+      usage_file.write(json.dumps(saved))
+    os.replace(temp_path, self.__path)
+
+    self.__dirty = False
@@ -0,0 +1,190 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+import docker
+
+
+""" Makes sure that the images for queued jobs are present before the jobs are
+started, so that jobs don't sit on reserved resources while their image is
+being downloaded. """
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImageCache:
+  """ Keeps track of which images are present locally, pulls the images that
+  pending jobs will need in the background, and removes the least recently used
+  images when they take up too much disk space. """
+
+  def __init__(self, max_pulls=2, lookahead=4, disk_budget=0):
+    """
+    Args:
+      max_pulls: The maximum number of images to pull at once.
+      lookahead: How many missing images, in the order that pending jobs need
+      them, to pull ahead of time. Images that are present, or already being
+      pulled, don't count towards this.
+      disk_budget: The maximum amount of space, in bytes, that images should
+      take up. Images that are in use are never removed, so this can be
+      exceeded. If this is zero, images are never removed. """
+    self.__max_pulls = max_pulls
+    self.__lookahead = lookahead
+    self.__disk_budget = disk_budget
+    # Pulls and removals both happen in here.
+    self.__executor = ThreadPoolExecutor(max_workers=max_pulls)
+
+    # Maps images that are present locally to their sizes, with the least
+    # recently used ones first. This is loaded the first time it's needed.
+    self.__images = None
+    # Images that are currently being pulled.
+    self.__pulling = set()
+    # Images that we failed to pull. Jobs that use them are allowed to start
+    # anyway, so that they fail with a useful error.
+    self.__failed = set()
+    # Whether any pulls finished since the last update.
+    self.__pulls_finished = False
+    # Function to call when a pull finishes.
+    self.__callback = None
+    self.__lock = threading.Lock()
+
+  def set_callback(self, callback):
+    """ Sets a function to call whenever a pull finishes. This is called from
+    a different thread.
+    Args:
+      callback: The function to call. """
+    self.__callback = callback
+
+  def __load(self):
+    """ Finds out which images are already present. """
+    try:
+      images = docker.list_images()
+    except (docker.DockerError, OSError) as error:
+      logger.warning("Failed to list images: %s" % (error))
+      images = {}
+
+    logger.info("Found %d local images." % (len(images)))
+    self.__images = OrderedDict(images)
+
+  def __pull(self, image):
+    """ Pulls an image. Meant to be run in the executor.
+    Args:
+      image: The image to pull. """
+    try:
+      docker.pull_image(image)
+      size = docker.get_image_size(image)
+    except (docker.DockerError, OSError) as error:
+      logger.error("Failed to pull image '%s': %s" % (image, error))
+      size = None
+
+    with self.__lock:
+      if size is None:
+        self.__failed.add(image)
+      else:
+        self.__images[image] = size
+      self.__pulling.discard(image)
+      self.__pulls_finished = True
+
+    if self.__callback:
+      self.__callback()
+
+  def __remove(self, image, size):
+    """ Removes an image. Meant to be run in the executor.
+    Args:
+      image: The image to remove.
+      size: The size of the image. """
+    try:
+      docker.remove_image(image)
+    except (docker.DockerError, OSError) as error:
+      # It's probably being used by something that we didn't start. Treat it
+      # as recently used, so that we try other images first next time.
+      logger.warning("Failed to remove image '%s': %s" % (image, error))
+      with self.__lock:
+        self.__images[image] = size
+
+  def __evict(self, needed):
+    """ Removes the least recently used images until we are within the disk
+    budget.
+    Args:
+      needed: The set of images that must not be removed. """
+    total_size = sum(self.__images.values())
+    for image in list(self.__images):
+      if total_size <= self.__disk_budget:
+        break
+      if image in needed:
+        continue
+
+      size = self.__images.pop(image)
+      total_size -= size
+      self.__executor.submit(self.__remove, image, size)
+
+  def is_ready(self, image):
+    """ Checks whether a job using an image can be started without waiting for
+    the image to be downloaded.
+    Args:
+      image: The name of the image.
+    Returns:
+      True if the image is present, or we couldn't pull it. """
+    image = docker.normalize_image(image)
+    with self.__lock:
+      return image in self.__images or image in self.__failed
+
+  def touch(self, image):
+    """ Marks an image as used, because a job was just started with it.
+    Args:
+      image: The name of the image. """
+    image = docker.normalize_image(image)
+    with self.__lock:
+      if image in self.__images:
+        self.__images.move_to_end(image)
+      # If it failed before, it's worth trying again for later jobs.
+      self.__failed.discard(image)
+
+  def update(self, pending_images, running_images):
+    """ Starts pulling the images that will be needed soon, and removes images
+    if we are over the disk budget.
+    Args:
+      pending_images: The images used by pending jobs, in the order that they
+      are needed.
+      running_images: The images used by running jobs.
+    Returns:
+      True if any images were pulled since the last update. """
+    if self.__images is None:
+      self.__load()
+
+    # Images that pending jobs need, up to the last one that we looked at.
+    upcoming = set()
+    with self.__lock:
+      # Only images that still have to be pulled count towards the lookahead.
+      # Otherwise, a few images that are already present, or being pulled, at
+      # the front of the queue would keep the ones behind them from ever being
+      # pulled.
+      missing = 0
+      for image in pending_images:
+        if missing >= self.__lookahead:
+          break
+        image = docker.normalize_image(image)
+        upcoming.add(image)
+        if image in self.__images or image in self.__pulling or \
+           image in self.__failed:
+          continue
+
+        missing += 1
+        if len(self.__pulling) >= self.__max_pulls:
+          # It will get pulled once one of the others is done.
+          continue
+        logger.debug("Pulling image '%s' ahead of time." % (image))
+        self.__pulling.add(image)
+        self.__executor.submit(self.__pull, image)
+
+      if self.__disk_budget:
+        needed = upcoming
+        needed.update([docker.normalize_image(image) \
+                       for image in running_images])
+        self.__evict(needed)
+
+      pulls_finished = self.__pulls_finished
+      self.__pulls_finished = False
+
+    return pulls_finished
@@ -1,106 +1,201 @@
+import functools
 import logging
-import os
-
-import yaml
-try:
-  # Use libyaml, if available.
-  from yaml import CLoader as Loader
-except ImportError:
-  # Otherwise, fall back on Python version.
-  from yaml import Loader
+import re
+import time
 
+from dependencies import AFTER_SUCCESS, CONDITIONS
+from output import OutputFile, get_output_path
 from util import ConfigurationError
 import docker
+import topology
 
 
 logger = logging.getLogger(__name__)
 
 
-class Job:
-  """ Represents a single job. """
-
-  class ResourceUsage:
-    """ Stores and validates data about job resource requirements. """
-    def __init__(self, resource_data):
-      """
-      Args:
-        resource_data: The raw ResourceUsage section from the YAML file to
-        initialize with. """
-
-      """ CPU requirements. """
-      self.Cpu = None
-      """ RAM requirements. """
-      self.Ram = None
-      """ GPU requirements. """
-      self.Gpu = None
-      """ VRAM requirements. """
-      self.Vram = None
-
-      if not resource_data:
-        # No ResourceUsage section.
-        logger.warning("No ResourceUsage section found in job.yaml.")
-        return
-
-      # Otherwise, initialize from the data we have.
-      self.__initialize_from_data(resource_data)
+# Parameters of job arrays are passed as environment variables, so their names
+# have to be valid ones.
+_PARAMETER_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
 
-    def __initialize_from_data(self, resource_data):
-      """ Initialize the class based on an existing ResourceUsage section. """
-      for pair in resource_data:
-        if "CpuUsage" in pair:
-          self.Cpu = pair["CpuUsage"]
-        elif "RamUsage" in pair:
-          self.Ram = pair["RamUsage"]
-        elif "GpuUsage" in pair:
-          self.Gpu = pair["GpuUsage"]
-        elif "VramUsage" in pair:
-          self.Vram = pair["VramUsage"]
 
-        else:
-          logger.warning("Got unknown resource: '%s'." % (pair))
+@functools.lru_cache(maxsize=None)
+def _get_yaml_loader():
+  """ Gets the class to load YAML with. yaml is slow to import, and isn't needed
+  until the first job is added, so it is imported here instead of when the
+  daemon starts.
+  Returns:
+    The loader class. """
+  try:
+    # Use libyaml, if available.
+    from yaml import CLoader as Loader
+  except ImportError:
+    # Otherwise, fall back on Python version.
+    from yaml import Loader
 
-      if not self.Cpu:
-        # Assume insignificant CPU load.
-        logger.debug("Got no CpuUsage section, asuming 0.")
-        self.Cpu = 0
+  return Loader
 
-      if not self.Ram:
-        # Assume insignificant RAM usage.
-        logger.debug("Got no RamUsage section, asuming 0.")
-        self.Ram = 0
 
-      if not self.Gpu:
-        # Assume insignificant GPU usage.
-        logger.debug("Got no GpuUsage section, asuming 0.")
-        self.Gpu = 0
+class ResourceUsage:
+  """ Stores and validates data about job resource requirements. """
 
-      if not self.Vram:
-        # Assume insignificant VRAM usage.
-        logger.debug("Got no VramUsage section, asuming 0.")
-        self.Vram = 0
+  # Maps the names of resources in the ResourceUsage section to attributes.
+  _RESOURCES = {"CpuUsage": "Cpu", "RamUsage": "Ram", "GpuUsage": "Gpu",
+                "VramUsage": "Vram", "GpuCount": "GpuCount"}
 
+  def __init__(self, resource_data):
+    """
+    Args:
+      resource_data: The raw ResourceUsage section from the YAML file to
+      initialize with. """
+
+    """ CPU requirements. """
+    self.Cpu = 0
+    """ RAM requirements. """
+    self.Ram = 0
+    """ Number of GPUs required. """
+    self.GpuCount = None
+    """ GPU requirements, for each GPU. """
+    self.Gpu = 0
+    """ VRAM requirements, for each GPU. """
+    self.Vram = 0
+
+    if not resource_data:
+      # No ResourceUsage section.
+      logger.warning("No ResourceUsage section found in job.yaml.")
+    else:
+      # Otherwise, initialize from the data we have.
+      self.__initialize_from_data(resource_data)
 
-  def __init__(self, job_directory):
+    if self.GpuCount is None:
+      # Assume that a job that uses the GPU at all needs one of them.
+      self.GpuCount = 1 if (self.Gpu or self.Vram) else 0
+
+  def __initialize_from_data(self, resource_data):
+    """ Initialize the class based on an existing ResourceUsage section.
+    Anything that isn't specified is assumed to be insignificant. """
+    if not isinstance(resource_data, list):
+      raise ConfigurationError("Invalid job.yaml: ResourceUsage must be a" \
+                               " list.")
+
+    for pair in resource_data:
+      if not isinstance(pair, dict):
+        raise ConfigurationError("Invalid job.yaml: bad resource '%s'." % \
+                                 (pair))
+
+      for resource, value in pair.items():
+        attribute = ResourceUsage._RESOURCES.get(resource)
+        if attribute is None:
+          logger.warning("Got unknown resource: '%s'." % (resource))
+          continue
+
+        if not isinstance(value, (int, float)) or value < 0:
+          raise ConfigurationError("Invalid job.yaml: %s must be a" \
+                                   " non-negative number." % (resource))
+        setattr(self, attribute, value)
+
+
+class ArraySpec:
+  """ Stores and validates the Array section of a job.yaml file, which runs the
+  job once for each of a set of parameters. Tasks are numbered, and their
+  parameters are worked out from their numbers when they are needed, so a
+  large grid doesn't have to be expanded up front. """
+
+  def __init__(self, array_data):
     """
     Args:
-      job_directory: The path to the job directory. """
-    self.__job_directory = job_directory
+      array_data: The raw Array section from the YAML file. """
+    if not isinstance(array_data, dict):
+      raise ConfigurationError("Invalid job.yaml: Array must be a mapping.")
+    for key in array_data:
+      if key not in ("Grid", "Tasks"):
+        raise ConfigurationError("Invalid job.yaml: unknown Array key '%s'." \
+                                 % (key))
+
+    # The sets of parameters to run.
+    self.__tasks = [{}]
+    tasks = array_data.get("Tasks")
+    if tasks is not None:
+      if not isinstance(tasks, list) or not tasks:
+        raise ConfigurationError("Invalid job.yaml: Array Tasks must be a" \
+                                 " non-empty list.")
+      for parameters in tasks:
+        if not isinstance(parameters, dict):
+          raise ConfigurationError("Invalid job.yaml: Array Tasks must" \
+                                   " contain mappings.")
+        for name, value in parameters.items():
+          self.__check_parameter(name, value)
+      self.__tasks = tasks
+
+    # List of (name, values) pairs for the grid, in the order given.
+    self.__grid = []
+    grid = array_data.get("Grid")
+    if grid is not None:
+      if not isinstance(grid, dict) or not grid:
+        raise ConfigurationError("Invalid job.yaml: Array Grid must be a" \
+                                 " non-empty mapping.")
+      for name, values in grid.items():
+        if not isinstance(values, list) or not values:
+          raise ConfigurationError("Invalid job.yaml: Array Grid values for" \
+                                   " '%s' must be a non-empty list." % (name))
+        for value in values:
+          self.__check_parameter(name, value)
+        self.__grid.append((name, values))
+
+    if tasks is None and grid is None:
+      raise ConfigurationError("Invalid job.yaml: Array needs Grid or Tasks.")
+
+    self.__grid_size = 1
+    for _, values in self.__grid:
+      self.__grid_size *= len(values)
+
+  @staticmethod
+  def __check_parameter(name, value):
+    """ Checks that a parameter can be passed as an environment variable.
+    Args:
+      name: The name of the parameter.
+      value: The value of the parameter. """
+    if not isinstance(name, str) or not _PARAMETER_NAME.match(name):
+      raise ConfigurationError("Invalid job.yaml: bad Array parameter name" \
+                               " '%s'." % (name))
+    if not isinstance(value, (str, int, float, bool)):
+      raise ConfigurationError("Invalid job.yaml: Array parameter '%s' must" \
+                               " be a string or a number." % (name))
+
+  def get_num_tasks(self):
+    """
+    Returns:
+      The number of tasks in the array. """
+    return len(self.__tasks) * self.__grid_size
 
-    # Open files for output.
-    out_file_path = os.path.join(self.__job_directory, "job.out")
-    err_file_path = os.path.join(self.__job_directory, "job.err")
-    self.__out_file = open(out_file_path, "a")
-    self.__err_file = open(err_file_path, "a")
+  def get_parameters(self, task):
+    """ Gets the parameters for a task. Every entry in Tasks is combined with
+    every point in the Grid, with the last grid parameter changing fastest.
+    Args:
+      task: The number of the task.
+    Returns:
+      A dictionary mapping parameter names to values. """
+    task_index, grid_index = divmod(task, self.__grid_size)
+    parameters = dict(self.__tasks[task_index])
 
-    # Interpret the job configuration.
-    self.__interpret_configuration()
+    value_indices = []
+    for _, values in reversed(self.__grid):
+      grid_index, value_index = divmod(grid_index, len(values))
+      value_indices.append(value_index)
+    for (name, values), value_index in zip(self.__grid,
+                                           reversed(value_indices)):
+      parameters[name] = values[value_index]
 
-  def __del__(self):
-    # Close output files.
-    self.__out_file.close()
-    self.__err_file.close()
+    return parameters
 
-  def __interpret_configuration(self):
+
+class JobConfig:
+  """ The validated contents of a job.yaml file. These are never modified, so
+  jobs with identical job.yaml files can share a single instance. """
+
+  def __init__(self, config_data):
+    """
+    Args:
+      config_data: The parsed contents of the job.yaml file. """
     def missing_param(name):
       """ Small helper function to raise a missing parameter exception.
       Args:
@@ -108,15 +203,9 @@ class Job:
       raise ConfigurationError( \
           "Invalid job.yaml: '%s' parameter is required." % (name))
 
-    # Read the configuration file.
-    config_path = os.path.join(self.__job_directory, "job.yaml")
-    if not os.path.exists(config_path):
-      raise ConfigurationError("Could not find job.yaml file in %s!" % \
-                               (self.__job_directory))
-
-    config_data = None
-    with open(config_path) as config_file:
-      config_data = yaml.load(config_file, Loader=Loader)
+    if not isinstance(config_data, dict):
+      raise ConfigurationError("Invalid job.yaml: expected a mapping.")
+    self.__data = config_data
 
     # Set the proper attributes from the config file.
     self.__name = config_data.get("Name")
@@ -132,17 +221,281 @@ class Job:
       missing_param("Container")
 
     # Handle the ResourceUsage section.
-    self.__resource_usage = Job.ResourceUsage(config_data.get("ResourceUsage"))
+    self.__resource_usage = ResourceUsage(config_data.get("ResourceUsage"))
+
+    # Jobs with higher priorities are started first.
+    self.__priority = config_data.get("Priority", 0)
+    if not isinstance(self.__priority, int):
+      raise ConfigurationError("Invalid job.yaml: Priority must be an" \
+                               " integer.")
+
+    # The maximum amount of time the job is allowed to run, in seconds.
+    self.__max_runtime = config_data.get("MaxRuntime")
+    if self.__max_runtime is not None and \
+       (not isinstance(self.__max_runtime, (int, float)) or \
+        self.__max_runtime <= 0):
+      raise ConfigurationError("Invalid job.yaml: MaxRuntime must be a" \
+                               " positive number.")
+
+    # Jobs with an Array section are run once for each set of parameters.
+    self.__array = None
+    if config_data.get("Array") is not None:
+      self.__array = ArraySpec(config_data["Array"])
+
+    # Jobs that have to finish first, as (path, condition) pairs.
+    self.__dependencies = []
+    depends_on = config_data.get("DependsOn", [])
+    if not isinstance(depends_on, list):
+      raise ConfigurationError("Invalid job.yaml: DependsOn must be a list.")
+    for dependency in depends_on:
+      if isinstance(dependency, str):
+        # Just the path, with the default condition.
+        dependency = {"Job": dependency}
+      if not isinstance(dependency, dict) or \
+         not isinstance(dependency.get("Job"), str):
+        raise ConfigurationError("Invalid job.yaml: bad dependency '%s'." % \
+                                 (dependency))
+      condition = dependency.get("Condition", AFTER_SUCCESS)
+      if condition not in CONDITIONS:
+        raise ConfigurationError("Invalid job.yaml: dependency Condition must" \
+                                 " be one of %s." % (", ".join(CONDITIONS)))
+      self.__dependencies.append((dependency["Job"], condition))
+
+  @classmethod
+  def parse(cls, config_text):
+    """ Parses and validates the contents of a job.yaml file.
+    Args:
+      config_text: The contents of the file.
+    Returns:
+      The JobConfig. """
+    import yaml
+
+    try:
+      config_data = yaml.load(config_text, Loader=_get_yaml_loader())
+    except yaml.YAMLError as error:
+      raise ConfigurationError("Invalid job.yaml: %s" % (error))
+
+    return cls(config_data)
+
+  def get_data(self):
+    """
+    Returns:
+      The raw parsed contents of the job.yaml file. """
+    return self.__data
+
+  def get_name(self):
+    """
+    Returns:
+      The name of the job. """
+    return self.__name
+
+  def get_description(self):
+    """
+    Returns:
+      The description of the job. """
+    return self.__description
+
+  def get_container_name(self):
+    """
+    Returns:
+      The name of the container to run the job in. """
+    return self.__container_name
+
+  def get_resource_usage(self):
+    """
+    Returns:
+      The resource usage for the job. """
+    return self.__resource_usage
+
+  def get_priority(self):
+    """
+    Returns:
+      The priority of the job. """
+    return self.__priority
+
+  def get_max_runtime(self):
+    """
+    Returns:
+      The maximum amount of time the job is allowed to run, in seconds, or None
+      if it wasn't specified. """
+    return self.__max_runtime
+
+  def get_array(self):
+    """
+    Returns:
+      The ArraySpec for the job, or None if it isn't a job array. """
+    return self.__array
+
+  def get_dependencies(self):
+    """
+    Returns:
+      A list of (path, condition) pairs for the jobs that have to finish before
+      this one can start. Relative paths are relative to the job directory. """
+    return self.__dependencies
+
+
+class Job:
+  """ Represents a single job, or a single task of a job array. Queued jobs are
+  kept small, since there can be a lot of them. The config is shared with the
+  other jobs loaded from the same job.yaml, and nothing is opened until the
+  job starts. """
 
-  def start(self):
-    """ Starts the job running. """
-    logger.info("Starting job: %s (%s)", self.__name, self.__description)
+  __slots__ = ("__job_directory", "__job_id", "__config", "__owner",
+               "__priority", "__task", "__rotation", "__container_class",
+               "__container", "__out_file", "__err_file")
+
+  def __init__(self, job_directory, job_id, config, rotation=None, owner=None,
+               priority=None, container_class=None, task=None):
+    """
+    Args:
+      job_directory: The path to the job directory.
+      job_id: A unique numerical ID for the job.
+      config: The JobConfig for the job.
+      rotation: Optional output.Rotation object specifying how to rotate the
+      output files.
+      owner: The user that the job belongs to.
+      priority: The priority of the job. If not specified, the priority from
+      the job.yaml file is used.
+      container_class: Optional class to run the job with, which has the same
+      interface as docker.Container. This is mostly useful for testing.
+      task: The number of the task, if this is part of a job array. """
+    self.__job_directory = job_directory
+    self.__job_id = job_id
+    self.__config = config
+    self.__owner = owner
+    self.__priority = priority
+    if self.__priority is None:
+      self.__priority = config.get_priority()
+    self.__task = task
+    self.__rotation = rotation
+    self.__container_class = container_class or docker.Container
+    self.__container = None
+
+    # Output files are only opened once the job starts, so that queued jobs
+    # don't use up file descriptors.
+    self.__out_file = None
+    self.__err_file = None
+
+  def __del__(self):
+    self.close_output()
+
+  def __open_output(self):
+    """ Opens the files that the job output is written to. Each task of a job
+    array gets its own. """
+    out_file_path = get_output_path(self.__job_directory, self.__task, "out")
+    err_file_path = get_output_path(self.__job_directory, self.__task, "err")
+    self.__out_file = OutputFile(out_file_path, rotation=self.__rotation)
+    self.__err_file = OutputFile(err_file_path, rotation=self.__rotation)
+
+  def close_output(self):
+    """ Closes the output files. Should be called once the job is finished. """
+    if self.__out_file:
+      self.__out_file.close()
+      self.__out_file = None
+    if self.__err_file:
+      self.__err_file.close()
+      self.__err_file = None
+
+  def make_container_name(self):
+    """ Makes a name for a new container for the job. The name has to be
+    unique, even if the daemon is restarted without its saved state.
+    Returns:
+      The name. """
+    return "stoplight-%d-%d" % (self.__job_id, int(time.time()))
+
+  def start(self, gpus, limits=None, cpuset=None, name=None):
+    """ Starts the job running.
+    Args:
+      gpus: The IDs of the GPUs that the job is allowed to use.
+      limits: Optional pair of the CPU, in percent of a core, and the RAM, in
+      bytes, to limit the container to.
+      cpuset: Optional pair of lists of the IDs of the CPUs that the job is
+      pinned to, and of the NUMA nodes that it allocates memory on.
+      name: The name to give the container. By default, a new one is
+      made. """
+    logger.info("Starting job: %s (%s) on GPUs %s", self.get_name(),
+                self.__config.get_description(), gpus)
+
+    # Only expose the GPUs that we allocated to the job. Docker does this based
+    # on the device request, but images that set this variable themselves
+    # could override that on older setups.
+    if gpus:
+      visible_devices = ",".join([str(gpu) for gpu in gpus])
+    else:
+      visible_devices = "none"
+    environment = {}
+    if self.__task is not None:
+      # Tasks get their parameters through the environment.
+      array = self.__config.get_array()
+      for name, value in array.get_parameters(self.__task).items():
+        environment[name] = str(value)
+      environment["STOPLIGHT_TASK_ID"] = str(self.__task)
+      environment["STOPLIGHT_NUM_TASKS"] = str(array.get_num_tasks())
+    # Parameters can't override this.
+    environment["NVIDIA_VISIBLE_DEVICES"] = visible_devices
 
     # First, create the docker container to run inside.
-    self.__container = docker.Container(self.__container_name,
-                                        self.__job_directory)
+    if name is None:
+      name = self.make_container_name()
+    self.__container = self.__container_class( \
+        self.__config.get_container_name(), self.__job_directory, name)
     # Run the script to start the job.
-    self.__container.run_exe("run_job.sh")
+    cpus = None
+    memory = None
+    if limits:
+      cpu, memory = limits
+      # The CPU is in percent of a core.
+      cpus = cpu / 100
+    cpuset_cpus = None
+    cpuset_mems = None
+    if cpuset:
+      cpuset_cpus = topology.format_cpu_list(cpuset[0])
+      cpuset_mems = topology.format_cpu_list(cpuset[1])
+    self.__open_output()
+    self.__container.run_exe("run_job.sh", self.__out_file, self.__err_file,
+                             environment=environment, gpus=gpus, cpus=cpus,
+                             memory=memory, cpuset_cpus=cpuset_cpus,
+                             cpuset_mems=cpuset_mems)
+
+  def reattach(self, name):
+    """ Reattaches to the container for this job, after the daemon was
+    restarted.
+    Args:
+      name: The name of the container. """
+    self.__container = self.__container_class( \
+        self.__config.get_container_name(), self.__job_directory, name)
+    self.__open_output()
+    self.__container.reattach(self.__out_file, self.__err_file)
+
+  def get_container_name(self):
+    """
+    Returns:
+      The name of the container the job is running in. """
+    return self.__container.get_name()
+
+  def get_output_fd(self):
+    """
+    Returns:
+      The file descriptor that new output from the job shows up on, which
+      also becomes readable when the job exits, or None once it has. """
+    return self.__container.get_output_fd()
+
+  def pump_output(self):
+    """ Writes any new output from the job to the job.out and job.err files in
+    the job directory. This never blocks. """
+    self.__container.pump_output()
+
+  def signal(self, signal_name):
+    """ Sends a signal to the job.
+    Args:
+      signal_name: The name of the signal, such as "SIGTERM". """
+    self.__container.signal(signal_name)
+
+  def kill(self, reason):
+    """ Kills the job. It will show up as finished once its container exits.
+    Args:
+      reason: Why the job is being killed, for the log. """
+    self.__container.kill(reason)
 
   def is_finished(self):
     """
@@ -150,29 +503,68 @@ class Job:
       True if the job is finished running, False otherwise. """
     return self.__container.is_finished()
 
+  def get_id(self):
+    """
+    Returns:
+      The unique ID of the job. """
+    return self.__job_id
+
+  def get_directory(self):
+    """
+    Returns:
+      The job directory. """
+    return self.__job_directory
+
+  def get_config(self):
+    """
+    Returns:
+      The JobConfig for the job. """
+    return self.__config
+
   def get_name(self):
     """
     Returns:
-      The name of the job. """
-    return self.__name
+      The name of the job. Tasks of job arrays have their number appended. """
+    if self.__task is not None:
+      return "%s[%d]" % (self.__config.get_name(), self.__task)
+    return self.__config.get_name()
 
-  def get_resource_usage(self):
+  def get_task(self):
     """
     Returns:
-      The resource usage for this job. """
-    return self.__resource_usage
+      The number of the task within its job array, or None if the job isn't
+      part of one. """
+    return self.__task
 
-  def write_job_output(self):
-    """ Writes the stdout and stderr streams from the job to files in the job
-    directory called job.out and job.err respectively. """
-    new_output = self.__container.get_output()
-    new_errors = self.__container.get_error()
+  def get_owner(self):
+    """
+    Returns:
+      The user that the job belongs to. """
+    return self.__owner
 
-    if new_output:
-      self.__out_file.write(new_output)
-      # Flush so we can tail -f it in realtime.
-      self.__out_file.flush()
+  def get_priority(self):
+    """
+    Returns:
+      The priority of the job. """
+    return self.__priority
 
-    if new_errors:
-      self.__err_file.write(new_errors)
-      self.__err_file.flush()
+  def get_image(self):
+    """
+    Returns:
+      The image that the job runs in. """
+    return self.__config.get_container_name()
+
+  def get_resource_usage(self):
+    """
+    Returns:
+      The resource usage for this job. """
+    return self.__config.get_resource_usage()
+
+  def rotate_output(self):
+    """ Rotates the job.out and job.err files in the job directory if they have
+    gotten too big. The daemon writes to these, as it copies the output of
+    the container from the attach stream in pump_output(), so this has to be
+    called from the same thread. """
+    if self.__out_file:
+      self.__out_file.maybe_rotate()
+      self.__err_file.maybe_rotate()
@@ -0,0 +1,275 @@
+from collections import deque
+import bisect
+import time
+
+
+""" Keeps track of the state of every job, so that clients can look jobs up
+and follow what happens to them. """
+
+
+# The states that a job can be in.
+PENDING = "pending"
+BLOCKED = "blocked"
+# Resources have been reserved for the job, and its container is being started.
+STARTING = "starting"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+STATES = (PENDING, BLOCKED, STARTING, RUNNING, SUCCEEDED, FAILED, CANCELLED)
+# States that a job never leaves.
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class _Record:
+  """ What we know about a single job. """
+
+  __slots__ = ("job_id", "name", "directory", "owner", "task", "priority",
+               "state", "submitted", "started", "finished", "launch_time")
+
+  def __init__(self, job, state, submitted):
+    """
+    Args:
+      job: The job.
+      state: The state that the job starts in.
+      submitted: When the job was submitted. """
+    self.job_id = job.get_id()
+    # Tasks of job arrays are indexed under the name of the array.
+    self.name = job.get_config().get_name()
+    self.directory = job.get_directory()
+    self.owner = job.get_owner()
+    self.task = job.get_task()
+    self.priority = job.get_priority()
+    self.state = state
+    self.submitted = submitted
+    self.started = None
+    self.finished = None
+    # How long it took to start the container of the job, in seconds.
+    self.launch_time = None
+
+  def to_dict(self):
+    """
+    Returns:
+      The record as a dictionary that can be encoded as JSON. """
+    return {"id": self.job_id, "name": self.name, "dir": self.directory,
+            "owner": self.owner, "task": self.task, "priority": self.priority,
+            "state": self.state, "submitted": self.submitted,
+            "started": self.started, "finished": self.finished,
+            "launch_time": self.launch_time}
+
+
+class JobIndex:
+  """ Indexes jobs by ID, state, owner and name. Each index is a sorted list of
+  job IDs, which is updated whenever a job changes state, so queries only
+  look at the jobs that match one of their filters, and pages can be found by
+  bisecting. Finished jobs are kept for a while, so that clients can find out
+  what happened to them. Every change is also added to a feed, which clients
+  can read from where they left off. """
+
+  def __init__(self, max_finished=10000, max_changes=10000):
+    """
+    Args:
+      max_finished: The number of finished jobs to keep.
+      max_changes: The number of changes to keep in the feed. Clients that
+      fall further behind than this have to start over. """
+    self.__max_finished = max_finished
+
+    # Maps job IDs to _Records.
+    self.__records = {}
+    # Sorted list of all the job IDs.
+    self.__ids = []
+    # Maps states, owners and names to sorted lists of job IDs.
+    self.__by_state = {}
+    self.__by_owner = {}
+    self.__by_name = {}
+    # IDs of finished jobs, in the order that they finished.
+    self.__finished = deque()
+
+    # Recent changes, as (sequence number, job ID, state, time) tuples.
+    self.__changes = deque(maxlen=max_changes)
+    # Sequence number of the last change.
+    self.__cursor = 0
+
+  def __len__(self):
+    return len(self.__records)
+
+  @staticmethod
+  def __insert(index, key, job_id):
+    """ Adds a job to an index.
+    Args:
+      index: The index.
+      key: The key to add the job under.
+      job_id: The ID of the job. """
+    ids = index.get(key)
+    if ids is None:
+      index[key] = [job_id]
+    elif ids[-1] < job_id:
+      # New jobs have the highest IDs, so this is the common case.
+      ids.append(job_id)
+    else:
+      bisect.insort(ids, job_id)
+
+  @staticmethod
+  def __remove(index, key, job_id):
+    """ Removes a job from an index.
+    Args:
+      index: The index.
+      key: The key that the job is under.
+      job_id: The ID of the job. """
+    ids = index[key]
+    del ids[bisect.bisect_left(ids, job_id)]
+    if not ids:
+      del index[key]
+
+  def __record_change(self, record):
+    """ Adds the current state of a job to the feed.
+    Args:
+      record: The record for the job. """
+    self.__cursor += 1
+    self.__changes.append((self.__cursor, record.job_id, record.state,
+                           time.time()))
+
+  def add(self, job, state, started=None):
+    """ Adds a new job.
+    Args:
+      job: The job.
+      state: The state that the job is in.
+      started: When the job started, if it is already running. """
+    record = _Record(job, state, time.time())
+    record.started = started
+    self.__records[record.job_id] = record
+
+    if self.__ids and self.__ids[-1] > record.job_id:
+      bisect.insort(self.__ids, record.job_id)
+    else:
+      self.__ids.append(record.job_id)
+    self.__insert(self.__by_state, state, record.job_id)
+    self.__insert(self.__by_owner, record.owner, record.job_id)
+    self.__insert(self.__by_name, record.name, record.job_id)
+    self.__record_change(record)
+
+  def set_state(self, job_id, state, launch_time=None):
+    """ Records that a job changed state.
+    Args:
+      job_id: The ID of the job.
+      state: The new state.
+      launch_time: How long it took to start the container of the job, in
+      seconds, if it just started running. """
+    record = self.__records[job_id]
+    if launch_time is not None:
+      record.launch_time = launch_time
+    if record.state == state:
+      return
+
+    self.__remove(self.__by_state, record.state, job_id)
+    self.__insert(self.__by_state, state, job_id)
+    record.state = state
+
+    now = time.time()
+    if state == RUNNING:
+      record.started = now
+    elif state == PENDING:
+      # It was requeued.
+      record.started = None
+    elif state in FINISHED_STATES:
+      record.finished = now
+      self.__finished.append(job_id)
+    self.__record_change(record)
+
+    while len(self.__finished) > self.__max_finished:
+      self.__forget(self.__finished.popleft())
+
+  def __forget(self, job_id):
+    """ Removes a finished job from the indexes.
+    Args:
+      job_id: The ID of the job. """
+    record = self.__records.pop(job_id)
+    del self.__ids[bisect.bisect_left(self.__ids, job_id)]
+    self.__remove(self.__by_state, record.state, job_id)
+    self.__remove(self.__by_owner, record.owner, job_id)
+    self.__remove(self.__by_name, record.name, job_id)
+
+  def get(self, job_id):
+    """ Looks up a job.
+    Args:
+      job_id: The ID of the job.
+    Returns:
+      The record for the job, as a dictionary, or None if we don't know about
+      it. """
+    record = self.__records.get(job_id)
+    if record is None:
+      return None
+    return record.to_dict()
+
+  def query(self, state=None, owner=None, name=None, after=None, limit=100):
+    """ Finds jobs, in order of ID.
+    Args:
+      state: Only find jobs in this state.
+      owner: Only find jobs with this owner.
+      name: Only find jobs with this name.
+      after: Only find jobs with IDs greater than this, to get the next page.
+      limit: The maximum number of jobs to return.
+    Returns:
+      A list of records for the jobs, as dictionaries, and the value to pass
+      as after to get the next page, or None if this is the last one. """
+    filters = []
+    for index, key in ((self.__by_state, state), (self.__by_owner, owner),
+                       (self.__by_name, name)):
+      if key is not None:
+        filters.append(index.get(key, []))
+    if filters:
+      # Go through the smallest index, and check the rest against the records.
+      ids = min(filters, key=len)
+    else:
+      ids = self.__ids
+
+    start = 0
+    if after is not None:
+      start = bisect.bisect_right(ids, after)
+
+    jobs = []
+    for position in range(start, len(ids)):
+      record = self.__records[ids[position]]
+      if (state is not None and record.state != state) or \
+         (owner is not None and record.owner != owner) or \
+         (name is not None and record.name != name):
+        continue
+
+      if len(jobs) == limit:
+        # There is at least one more.
+        return jobs, jobs[-1]["id"]
+      jobs.append(record.to_dict())
+
+    return jobs, None
+
+  def get_cursor(self):
+    """
+    Returns:
+      The sequence number of the last change. """
+    return self.__cursor
+
+  def get_changes(self, since):
+    """ Gets the changes after a point in the feed.
+    Args:
+      since: The sequence number of the last change that the client has seen.
+    Returns:
+      A list of changes, as dictionaries, the sequence number of the last one,
+      and whether some changes were dropped because the client fell too far
+      behind. """
+    if since >= self.__cursor:
+      return [], self.__cursor, False
+
+    missed = False
+    first = self.__changes[0][0]
+    if since < first - 1:
+      # Some changes have already been dropped.
+      missed = True
+      since = first - 1
+
+    changes = []
+    # Changes are numbered consecutively, so the position can be worked out.
+    for position in range(since - first + 1, len(self.__changes)):
+      sequence, job_id, state, change_time = self.__changes[position]
+      changes.append({"seq": sequence, "id": job_id, "state": state,
+                      "time": change_time})
+    return changes, self.__cursor, missed
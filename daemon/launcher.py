@@ -0,0 +1,90 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+from util import ConfigurationError
+
+
+""" Starts the containers for jobs in the background, so that slow launches
+don't hold up scheduling, copying output, or reaping jobs that exited. """
+
+
+logger = logging.getLogger(__name__)
+
+
+class Launcher:
+  """ Starts jobs in a pool of threads, with a limit on how many are started at
+  once. The manager reserves resources for a job before handing it over, and
+  collects the jobs that finished launching on its next update. """
+
+  def __init__(self, workers=4):
+    """
+    Args:
+      workers: The maximum number of jobs to start at once. """
+    self.__executor = ThreadPoolExecutor(max_workers=workers)
+
+    # Jobs that finished launching, as (job, error, latency) tuples, in the
+    # order that they finished. Appending and popping from a deque is safe
+    # between threads.
+    self.__launched = deque()
+    # Function to call when a launch finishes.
+    self.__callback = None
+
+  def set_callback(self, callback):
+    """ Sets a function to call whenever a launch finishes. This is called from
+    a different thread.
+    Args:
+      callback: The function to call. """
+    self.__callback = callback
+
+  def __launch(self, job, gpus, limits, cpuset, name, submit_time):
+    """ Starts a job. Meant to be run in the executor.
+    Args:
+      job: The job.
+      gpus: The IDs of the GPUs that the job is allowed to use.
+      limits: The CPU and RAM to limit the container to, or None.
+      cpuset: The CPUs and NUMA nodes to pin the job to, or None.
+      name: The name to give the container, or None.
+      submit_time: When the launch was requested. """
+    error = None
+    try:
+      job.start(gpus, limits=limits, cpuset=cpuset, name=name)
+    except (ConfigurationError, OSError) as launch_error:
+      error = launch_error
+    except Exception as launch_error:
+      # This would otherwise disappear into the executor, and the job would
+      # never leave the launching state.
+      logger.exception("Unexpected error starting job %s." % \
+                       (job.get_name()))
+      error = launch_error
+
+    self.__launched.append((job, error, time.monotonic() - submit_time))
+    if self.__callback:
+      self.__callback()
+
+  def launch(self, job, gpus, limits=None, cpuset=None, name=None):
+    """ Starts a job in the background.
+    Args:
+      job: The job.
+      gpus: The IDs of the GPUs that the job is allowed to use.
+      limits: Optional pair of the CPU, in percent of a core, and the RAM, in
+      bytes, to limit the container to.
+      cpuset: Optional pair of lists of the CPUs that the job is pinned to,
+      and of the NUMA nodes that it allocates memory on.
+      name: The name to give the container. By default, the job makes a new
+      one. """
+    self.__executor.submit(self.__launch, job, gpus, limits, cpuset, name,
+                           time.monotonic())
+
+  def get_launched(self):
+    """ Gets the jobs that finished launching since the last call.
+    Returns:
+      A list of (job, error, latency) tuples, where error is the exception
+      that the launch failed with, or None if the job is running, and latency
+      is the time from when the launch was requested until it finished, in
+      seconds. """
+    launched = []
+    while self.__launched:
+      launched.append(self.__launched.popleft())
+    return launched
@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import os
+
+
+""" Reads and follows the output files of jobs, so that clients can watch jobs
+without having access to the job directories. Files are read in bounded
+chunks from an offset, so even very large ones are never loaded all at
+once. """
+
+
+logger = logging.getLogger(__name__)
+
+
+# The most that is read from a file at once, in bytes.
+_CHUNK_SIZE = 1024 * 1024
+
+
+def read_chunks(fd, offset, end):
+  """ Reads part of a file.
+  Args:
+    fd: The file descriptor to read from.
+    offset: Where to start reading.
+    end: Where to stop reading.
+  Returns:
+    A generator of (offset, data) pairs. """
+  while offset < end:
+    data = os.pread(fd, min(_CHUNK_SIZE, end - offset), offset)
+    if not data:
+      # The file was truncated.
+      return
+    yield offset, data
+    offset += len(data)
+
+async def read(path, offset):
+  """ Reads a file from an offset up to its current end.
+  Args:
+    path: The path to the file.
+    offset: Where to start reading.
+  Returns:
+    An async generator of (offset, data) pairs, which is empty if the file
+    doesn't exist. """
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except FileNotFoundError:
+    return
+
+  try:
+    for chunk in read_chunks(fd, offset, os.fstat(fd).st_size):
+      yield chunk
+  finally:
+    os.close(fd)
+
+async def filter_lines(chunks, text=None):
+  """ Splits chunks of a file into lines.
+  Args:
+    chunks: An async generator of (offset, data) pairs, as produced by read()
+    or Tailer.follow(). An offset before the end of the previous chunk means
+    that the file was truncated.
+    text: Optional bytes to look for. Only lines that contain them are kept.
+    This runs on the event loop, so it is a plain substring search, which
+    takes time proportional to the length of the line, whatever the client
+    asks for.
+  Returns:
+    An async generator of (offset, line) pairs, where the offset is just after
+    the end of the line, so that reading can be resumed from there. Lines
+    don't include the newline. If the file was truncated, a (0, None) pair is
+    generated. A partial line at the end is only generated once the chunks run
+    out. """
+  # The start of an incomplete line from the previous chunk.
+  partial = b""
+  expected = None
+  async for offset, data in chunks:
+    if expected is not None and offset < expected:
+      partial = b""
+      yield 0, None
+    expected = offset + len(data)
+
+    lines = data.split(b"\n")
+    lines[0] = partial + lines[0]
+    partial = lines.pop()
+    end = expected - len(partial)
+    # Work backwards from the end of the last complete line.
+    ends = []
+    for line in reversed(lines):
+      ends.append(end)
+      end -= len(line) + 1
+    for line, line_end in zip(lines, reversed(ends)):
+      if text is None or text in line:
+        yield line_end, line
+
+  if partial and (text is None or text in partial):
+    yield expected, partial
+
+
+class _WatchedFile:
+  """ A file that clients are following. """
+
+  def __init__(self, path, job_id):
+    """
+    Args:
+      path: The path to the file.
+      job_id: The ID of the job that writes to it. """
+    self.path = path
+    self.job_id = job_id
+    # Notified whenever anything below changes.
+    self.condition = asyncio.Condition()
+
+    self.size = 0
+    self.inode = None
+    # Number of times that the file was truncated or replaced.
+    self.truncations = 0
+    # Whether the job is done, so the file won't grow anymore.
+    self.finished = False
+    # Number of clients following the file.
+    self.followers = 0
+
+
+class Tailer:
+  """ Follows output files on behalf of any number of clients. A single task
+  checks the size of each file that is being followed, and wakes up the
+  clients following it when it grows. Each client then only reads the new
+  data, so adding clients doesn't add any more checks of the file, and the
+  new data is normally still in the page cache. This runs in the event loop
+  of the daemon, so following a file doesn't take up a thread. """
+
+  def __init__(self, is_finished, interval=0.5):
+    """
+    Args:
+      is_finished: Function that is called with a job ID, and returns whether
+      that job is done.
+      interval: How often to check the files, in seconds. """
+    self.__is_finished = is_finished
+    self.__interval = interval
+
+    # Maps paths to the _WatchedFiles for them.
+    self.__files = {}
+    self.__task = None
+
+  async def __check(self, watched):
+    """ Checks whether a file has changed, and wakes up the clients following it
+    if it did.
+    Args:
+      watched: The _WatchedFile. """
+    # This is checked first, so that all the output from the job is in the
+    # file by the time that we see that it is done.
+    finished = watched.finished or self.__is_finished(watched.job_id)
+    try:
+      stat = os.stat(watched.path)
+      size, inode = stat.st_size, stat.st_ino
+    except FileNotFoundError:
+      # The job hasn't started yet.
+      size, inode = 0, None
+
+    changed = size != watched.size or finished != watched.finished
+    if size < watched.size or \
+       (watched.inode is not None and inode != watched.inode):
+      # It was rotated.
+      watched.truncations += 1
+      changed = True
+
+    watched.size = size
+    watched.inode = inode
+    watched.finished = finished
+    if changed:
+      async with watched.condition:
+        watched.condition.notify_all()
+
+  async def __run(self):
+    """ Checks the files that are being followed, until nobody is following
+    any. """
+    while self.__files:
+      await asyncio.sleep(self.__interval)
+
+      for watched in list(self.__files.values()):
+        try:
+          await self.__check(watched)
+        except Exception:
+          logger.exception("Failed to check '%s'." % (watched.path))
+
+    self.__task = None
+
+  async def follow(self, path, job_id, offset):
+    """ Reads a file from an offset, and keeps reading it as it grows, until
+    the job that writes to it is done.
+    Args:
+      path: The path to the file.
+      job_id: The ID of the job.
+      offset: Where to start reading.
+    Returns:
+      An async generator of (offset, data) pairs. If the file is rotated, it
+      starts again from the beginning of the new file, with an offset of 0. """
+    watched = self.__files.get(path)
+    is_new = watched is None
+    if is_new:
+      watched = _WatchedFile(path, job_id)
+      self.__files[path] = watched
+      if self.__task is None:
+        self.__task = asyncio.create_task(self.__run())
+    watched.followers += 1
+
+    fd = None
+    fd_inode = None
+    try:
+      if is_new:
+        await self.__check(watched)
+      truncations = watched.truncations
+      while True:
+        async with watched.condition:
+          await watched.condition.wait_for( \
+              lambda: watched.size > offset or watched.finished or \
+                      watched.truncations != truncations)
+
+        size = watched.size
+        finished = watched.finished
+        inode = watched.inode
+        if watched.truncations != truncations:
+          truncations = watched.truncations
+          offset = 0
+
+        if size > offset:
+          if fd is None or fd_inode != inode:
+            if fd is not None:
+              os.close(fd)
+              fd = None
+            try:
+              fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+              # It is being replaced.
+              await asyncio.sleep(self.__interval)
+              continue
+            fd_inode = inode
+
+          for chunk_offset, data in read_chunks(fd, offset, size):
+            yield chunk_offset, data
+            offset = chunk_offset + len(data)
+          if offset < size:
+            # It was truncated while we were reading. Wait until that is
+            # noticed.
+            offset = size
+          continue
+
+        if finished:
+          return
+
+    finally:
+      if fd is not None:
+        os.close(fd)
+      watched.followers -= 1
+      if not watched.followers:
+        del self.__files[path]
@@ -1,12 +1,18 @@
-from collections import deque
 from multiprocessing import cpu_count
+import functools
 import logging
+import math
 import os
+import time
 
-import psutil
-
-from job import ConfigurationError, Job
+from dependencies import BLOCKED, READY, DependencyGraph
+from job import ConfigurationError, Job, JobConfig
+from scheduler import RESERVATIONS, PendingQueue, Planner, choose_gpus
+import docker
+import jobindex
+import metrics
 import nvidia
+import util
 
 
 """ Manages a set of jobs, and determines how to best use the resources of a
@@ -16,181 +22,1273 @@ machine. """
 logger = logging.getLogger(__name__)
 
 
+def _get_directory_owner(path):
+  """
+  Args:
+    path: The path to a directory.
+  Returns:
+    The name of the user that owns the directory, or None if it doesn't
+    exist. """
+  try:
+    return util.get_user_name(os.stat(path).st_uid)
+  except OSError:
+    return None
+
+
+def _resolve_dependencies(job_directory, config):
+  """ Gets the dependencies of a job, with absolute paths.
+  Args:
+    job_directory: The directory of the job.
+    config: The JobConfig for the job.
+  Returns:
+    A list of (directory, condition) pairs. """
+  return [(os.path.normpath(os.path.join(job_directory, path)), condition) \
+          for path, condition in config.get_dependencies()]
+
+
 class Manager:
-  def __init__(self):
+  def __init__(self, telemetry=None, warmup=30, rotation=None, store=None,
+               images=None, policy="greedy", runtimes=None, fair_share=None,
+               preempt_signal=None, preempt_grace=60, gpus=None,
+               make_job=None, metrics=None, reporter=None,
+               container_telemetry=None, overcommit=None,
+               enforce_limits=False, launcher=None, max_launch_attempts=3,
+               cpu_allocator=None, default_cpu=100, default_ram=2 ** 30):
+    """
+    Args:
+      telemetry: Optional GpuTelemetry instance. If provided, we use the
+      measured GPU usage instead of the declared usage of running jobs when
+      deciding whether new jobs fit.
+      warmup: How long, in seconds, after a job starts before we trust that its
+      usage shows up in the measurements, for both the GPUs and containers.
+      rotation: Optional output.Rotation object specifying how to rotate job
+      output files.
+      store: Optional persistence.StateStore to save our state in. If
+      provided, any state saved by a previous instance will be restored.
+      images: Optional images.ImageCache. If provided, images are pulled before
+      jobs need them, and jobs are only started once their image is present.
+      policy: The scheduling policy. This can be "greedy", which starts any job
+      that fits, or "easy" or "conservative" for backfill scheduling, which
+      starts jobs out of order only if that won't delay the jobs that are
+      waiting for resources.
+      runtimes: Optional runtimes.RuntimeEstimates to learn how long jobs take
+      from. This is used for backfill scheduling, for jobs that don't declare
+      a MaxRuntime.
+      fair_share: Optional fairshare.FairShare to track the usage of each owner
+      with. If provided, pending jobs from owners who have used less are
+      started first.
+      preempt_signal: If specified, running jobs can be preempted to make room
+      for pending jobs with a higher priority. They are sent this signal, so
+      that they can save a checkpoint in their job directory, and are then put
+      back in the queue.
+      preempt_grace: How long, in seconds, preempted jobs have to exit before
+      they are killed.
+      gpus: Optional list of nvidia.Gpu objects to schedule jobs on. By
+      default, we find the GPUs in the system.
+      make_job: Optional callable that takes the same arguments as Job, and
+      returns a new job. This lets jobs be run with a different backend, such
+      as a fake one for benchmarking.
+      metrics: Optional metrics.Metrics to record what the manager is doing
+      in.
+      reporter: Optional worker.Reporter to tell a coordinator about our free
+      resources, and the jobs that started and finished, after each
+      update.
+      container_telemetry: Optional telemetry.ContainerTelemetry to measure
+      the CPU and RAM usage of running jobs with.
+      overcommit: Optional overcommit.Overcommit. If provided, new jobs are
+      placed against the measured CPU and RAM usage of the running jobs, so
+      more jobs can run than their declarations would allow.
+      enforce_limits: Whether to limit the containers of jobs to the CPU and
+      RAM that they declared, which is what makes overcommitting safe. See
+      default_cpu and default_ram for jobs that don't declare them.
+      launcher: Optional launcher.Launcher to start the containers of jobs
+      with in the background. By default, jobs are started during the update,
+      one at a time.
+      max_launch_attempts: How many times to try starting a job whose
+      container fails to start before giving up on it. Jobs that fail to
+      start before that go back in the queue.
+      cpu_allocator: Optional topology.CpuAllocator. If provided, each job is
+      pinned to its own contiguous set of CPU cores, on the NUMA node of its
+      GPUs if there is room there. Jobs are still placed by their CPU
+      percentage, so if no node has enough free cores in a row, the job runs
+      unpinned. Jobs that don't use any CPU aren't pinned either. Jobs that
+      aren't pinned can run on any core, including the pinned ones.
+      default_cpu: The CPU, in percent of a core, that jobs which don't
+      declare a CpuUsage count as using when overcommitting or enforcing
+      limits. Their containers are limited to this. Otherwise, they would be
+      placed for free, and never be limited.
+      default_ram: The same for jobs that don't declare a RamUsage, in
+      bytes. """
+    self.__telemetry = telemetry
+    self.__warmup = warmup
+    self.__rotation = rotation
+    self.__store = store
+    self.__images = images
+    self.__policy = policy
+    self.__runtimes = runtimes
+    self.__fair_share = fair_share
+    self.__preempt_signal = preempt_signal
+    self.__preempt_grace = preempt_grace
+    self.__make_job = make_job or Job
+    self.__metrics = metrics
+    self.__reporter = reporter
+    self.__container_telemetry = container_telemetry
+    self.__overcommit = overcommit
+    self.__enforce_limits = enforce_limits
+    self.__launcher = launcher
+    self.__max_launch_attempts = max_launch_attempts
+    self.__cpu_allocator = cpu_allocator
+    self.__default_cpu = default_cpu
+    self.__default_ram = default_ram
+    # The next job ID to use, if we don't have a store to get them from.
+    self.__next_id = 0
+
     # This is the queue that keeps track of our pending jobs.
-    self.__pending_jobs = deque()
-    # This is the set that keeps track of our running jobs.
-    self.__running_jobs = set()
-    # Jobs that might currently be runnable.
-    self.__maybe_runnable = deque()
-    # Jobs that were started from maybe_runnable. This is so we can easily
-    # remove them from pending_jobs the next time we go through the queue.
-    self.__already_started = set()
-
-    # TODO(danielp): Support for multiple GPUs.
-    self.__gpu = nvidia.Gpu(0)
-
-    # Current usage percentages for each of the resources.
+    self.__pending_jobs = PendingQueue()
+    # This maps running jobs to the requirements that they were started with,
+    # the GPUs that they are running on, and when they were started.
+    self.__running_jobs = {}
+    # Maps jobs whose containers are being started to their requirements, the
+    # GPUs that were reserved for them, and when they were queued. Their
+    # resources are reserved the same as for running jobs.
+    self.__launching = {}
+    # Maps jobs that failed to start to how many times they failed.
+    self.__launch_attempts = {}
+    # Maps starting and running jobs that are pinned to the CPUs they are
+    # pinned to.
+    self.__pinned_cpus = {}
+    # Whether anything happened that might allow more jobs to run.
+    self.__may_start_jobs = False
+    # Maps running jobs that are being preempted to when they will be killed,
+    # if they haven't exited by themselves.
+    self.__preempting = {}
+    # Whether we already looked for jobs to preempt during this scheduling
+    # pass.
+    self.__checked_preemption = False
+    # Maps pending jobs to when they were added to the queue.
+    self.__queued_times = {}
+    # Directories of jobs that started and finished since the last report.
+    self.__started_dirs = []
+    self.__finished_dirs = []
+    # The pending job and its requirements that jobs are being preempted for.
+    # The resources that they free up are held for it until it starts, so that
+    # nothing else takes them first.
+    self.__preemptor = None
+    # Dependencies between jobs. Jobs only go into the pending queue once the
+    # jobs they depend on are done.
+    self.__dependencies = DependencyGraph( \
+        on_outcome=self.__store.record_outcome if self.__store else None)
+    # Maps jobs that are waiting on other jobs to their requirements.
+    self.__blocked_jobs = {}
+    # The state of every job, which clients can query.
+    self.__index = jobindex.JobIndex()
+
+    self.__gpus = gpus
+    if self.__gpus is None:
+      self.__gpus = nvidia.enumerate_gpus()
+
+    # Current usage percentages for the CPU and RAM.
     self.__cpu_usage = 0
     self.__ram_usage = 0
-    self.__gpu_usage = 0
-    self.__vram_usage = 0
+    # Current usage percentages and VRAM usage, in bytes, for each GPU.
+    self.__gpu_usage = [0] * len(self.__gpus)
+    self.__vram_usage = [0] * len(self.__gpus)
+    # The GPU and VRAM usage that we use for placing jobs. These are the same
+    # as the above unless we are using measured usage.
+    self.__effective_gpu_usage = self.__gpu_usage
+    self.__effective_vram_usage = self.__vram_usage
+    # The CPU and RAM usage percentages that we use for placing jobs. These are
+    # lower than the declared usage if we are overcommitting.
+    self.__effective_cpu_usage = 0
+    self.__effective_ram_usage = 0
 
     self.__get_available_resources()
+    if self.__metrics:
+      self.__add_metrics()
+
+    if self.__store:
+      self.__recover()
+
+  def __add_metrics(self):
+    """ Adds the metrics that the manager records. """
+    self.__metrics.add_histogram("stoplight_update_phase_seconds",
+                                 "Time spent in each phase of an update.",
+                                 metrics.PHASE_BUCKETS)
+    self.__metrics.add_histogram("stoplight_queue_wait_seconds",
+                                 "Time from when jobs are queued until they" \
+                                 " start.", metrics.LATENCY_BUCKETS)
+    self.__metrics.add_histogram("stoplight_launch_seconds",
+                                 "Time from when jobs are placed until their" \
+                                 " containers are running.",
+                                 metrics.LATENCY_BUCKETS)
+    self.__metrics.add_counter("stoplight_jobs_started_total",
+                               "Jobs that were started.")
+    self.__metrics.add_counter("stoplight_launch_failures_total",
+                               "Times that the container for a job failed" \
+                               " to start.")
+    self.__metrics.add_counter("stoplight_jobs_finished_total",
+                               "Jobs that finished, or failed.")
+    self.__metrics.add_counter("stoplight_jobs_requeued_total",
+                               "Preempted jobs that were put back in the" \
+                               " queue.")
+    self.__metrics.add_counter("stoplight_jobs_cancelled_total",
+                               "Jobs that were cancelled because a job they" \
+                               " depend on failed.")
+    self.__metrics.add_gauge("stoplight_pending_jobs",
+                             "Jobs waiting in the queue.")
+    self.__metrics.add_gauge("stoplight_pending_buckets",
+                             "Groups of identical pending jobs.")
+    self.__metrics.add_gauge("stoplight_blocked_jobs",
+                             "Jobs waiting for the jobs they depend on.")
+    self.__metrics.add_gauge("stoplight_starting_jobs",
+                             "Jobs whose containers are being started.")
+    self.__metrics.add_gauge("stoplight_running_jobs", "Jobs that are running.")
+    self.__metrics.add_gauge("stoplight_preempting_jobs",
+                             "Running jobs that are being preempted.")
+    self.__metrics.add_gauge("stoplight_reserved_cpu_percent",
+                             "CPU reserved by running jobs.")
+    self.__metrics.add_gauge("stoplight_reserved_ram_percent",
+                             "RAM reserved by running jobs.")
+    self.__metrics.add_gauge("stoplight_reserved_gpu_percent",
+                             "GPU usage reserved by running jobs.")
+    self.__metrics.add_gauge("stoplight_reserved_vram_bytes",
+                             "VRAM reserved by running jobs.")
+    self.__metrics.add_gauge("stoplight_effective_cpu_percent",
+                             "CPU usage that new jobs are placed against.")
+    self.__metrics.add_gauge("stoplight_effective_ram_percent",
+                             "RAM usage that new jobs are placed against.")
+    self.__metrics.add_gauge("stoplight_measured_gpu_percent",
+                             "Measured GPU usage.")
+    self.__metrics.add_gauge("stoplight_measured_vram_bytes",
+                             "Measured VRAM usage.")
+
+  def __observe_phase(self, phase, seconds):
+    """ Records how long part of an update took.
+    Args:
+      phase: The name of the phase.
+      seconds: How long it took. """
+    if self.__metrics:
+      self.__metrics.observe("stoplight_update_phase_seconds", seconds,
+                             labels=(("phase", phase),))
+
+  def collect_metrics(self):
+    """ Updates the gauges, and gets all the metrics.
+    Returns:
+      A snapshot from metrics.Metrics.snapshot(), or None if we don't have
+      any metrics. """
+    if not self.__metrics:
+      return None
+
+    self.__metrics.set("stoplight_pending_jobs", len(self.__pending_jobs))
+    self.__metrics.set("stoplight_pending_buckets",
+                       self.__pending_jobs.get_num_buckets())
+    self.__metrics.set("stoplight_blocked_jobs", len(self.__blocked_jobs))
+    self.__metrics.set("stoplight_starting_jobs", len(self.__launching))
+    self.__metrics.set("stoplight_running_jobs", len(self.__running_jobs))
+    self.__metrics.set("stoplight_preempting_jobs", len(self.__preempting))
+    self.__metrics.set("stoplight_reserved_cpu_percent", self.__cpu_usage)
+    self.__metrics.set("stoplight_reserved_ram_percent", self.__ram_usage)
+    self.__metrics.set("stoplight_effective_cpu_percent",
+                       self.__effective_cpu_usage)
+    self.__metrics.set("stoplight_effective_ram_percent",
+                       self.__effective_ram_usage)
+    for gpu_id in range(len(self.__gpus)):
+      labels = (("gpu", str(gpu_id)),)
+      self.__metrics.set("stoplight_reserved_gpu_percent",
+                         self.__gpu_usage[gpu_id], labels=labels)
+      self.__metrics.set("stoplight_reserved_vram_bytes",
+                         self.__vram_usage[gpu_id], labels=labels)
+
+      measured = None
+      if self.__telemetry:
+        measured = self.__telemetry.get_usage(gpu_id)
+      if measured is not None:
+        utilization, memory = measured
+        self.__metrics.set("stoplight_measured_gpu_percent", utilization,
+                           labels=labels)
+        self.__metrics.set("stoplight_measured_vram_bytes", memory,
+                           labels=labels)
+
+    return self.__metrics.snapshot()
+
+  def __recover(self):
+    """ Restores the pending and running jobs that were saved by a previous
+    instance of the daemon. Running jobs are reattached to their containers,
+    if they are still running. So are jobs that were being started, if their
+    containers got going, and otherwise they go back in the queue. Any other
+    containers of ours are removed. """
+    containers = None
+
+    # Jobs that were loaded from the same job.yaml share their configuration,
+    # so it only has to be validated once. This maps the IDs of the saved
+    # configurations to JobConfigs, or the errors from validating them.
+    configs = {}
+    # Maps JobConfigs to their requirements.
+    requirements_cache = {}
+    records = self.__store.load()
+    self.__dependencies.load_outcomes(self.__store.get_outcomes())
+    for job_id, record in records:
+      config = configs.get(id(record["config"]))
+      if config is None:
+        try:
+          config = JobConfig(record["config"])
+        except ConfigurationError as error:
+          config = str(error)
+        configs[id(record["config"])] = config
+      if isinstance(config, str):
+        logger.error("Failed to restore job %d: %s" % (job_id, config))
+        self.__store.record_finish(job_id)
+        continue
+
+      job = self.__make_job(record["dir"], job_id, config,
+                            rotation=self.__rotation,
+                            owner=record.get("owner"),
+                            priority=record.get("priority"),
+                            task=record.get("task"))
+      requirements = requirements_cache.get(config)
+      if requirements is None:
+        requirements = self.__calculate_resource_requirements(job)
+        requirements_cache[config] = requirements
+      name = record.get("container")
+      if name is None and "launching" in record:
+        # The daemon stopped while the job was being started.
+        if containers is None:
+          containers = docker.list_containers()
+        name = record["launching"]
+        if containers.get(name) in (None, "created"):
+          # It never started running, so it is started again.
+          logger.info("Requeueing job %s, which was being started." % \
+                      (job.get_name()))
+          if name in containers:
+            self.__remove_orphan(name)
+          self.__store.record_requeue(job_id)
+          name = None
+
+      if name is None:
+        # The job is still pending. Jobs are restored in the order they were
+        # added, so anything it depends on has already been restored.
+        self.__admit(job, requirements,
+                     _resolve_dependencies(record["dir"], config))
+        continue
+
+      # Whatever it depended on must have been done.
+      self.__dependencies.add(job, [])
+      self.__index.add(job, jobindex.RUNNING, started=record.get("time"))
+
+      # The job was running.
+      if containers is None:
+        containers = docker.list_containers()
+      state = containers.get(name)
+      if state != "running":
+        logger.warning("Job %s ended while the daemon was down." % \
+                       (job.get_name()))
+        exit_code = None
+        if state is not None:
+          exit_code = self.__clean_up_container(name)
+        self.__finish(job, exit_code == 0)
+        continue
+
+      gpus = tuple(record["gpus"])
+      self.__reserve(job, requirements, gpus, 1)
+      if self.__cpu_allocator and record.get("cpus"):
+        self.__cpu_allocator.reserve(record["cpus"])
+        self.__pinned_cpus[job] = record["cpus"]
+      job.reattach(name)
+      if "container" not in record:
+        # It started after all.
+        logger.info("Adopting container %s of job %s." % \
+                    (name, job.get_name()))
+        self.__store.record_start(job, gpus, record.get("cpus"))
+      if self.__container_telemetry:
+        self.__container_telemetry.add(name)
+      # Convert the start time to the monotonic clock.
+      running_time = time.time() - (record.get("time") or time.time())
+      self.__running_jobs[job] = (requirements, gpus,
+                                  time.monotonic() - running_time)
+
+    self.__remove_orphans(records, containers)
+    self.__may_start_jobs = True
+    self.__store.flush()
+
+  def __remove_orphans(self, records, containers):
+    """ Removes the containers of ours that no saved job knows about. These
+    can be left over from jobs that failed to restore, or from state that was
+    lost.
+    Args:
+      records: The (job ID, record) pairs of the saved jobs.
+      containers: The containers from docker.list_containers(), or None if
+      they haven't been listed yet. """
+    if containers is None:
+      try:
+        containers = docker.list_containers()
+      except (docker.DockerError, OSError) as error:
+        logger.warning("Failed to look for orphaned containers: %s" % \
+                       (error))
+        return
+
+    known = set()
+    for _, record in records:
+      known.add(record.get("container"))
+      known.add(record.get("launching"))
+    for name in containers:
+      if name not in known:
+        self.__remove_orphan(name)
+
+  def __remove_orphan(self, name):
+    """ Removes a container that no job is using, even if it is running.
+    Args:
+      name: The name of the container. """
+    logger.warning("Removing orphaned container %s." % (name))
+    try:
+      docker.remove_container(name, force=True)
+    except (docker.DockerError, OSError) as error:
+      logger.error("Failed to remove container %s: %s" % (name, error))
+
+  def __clean_up_container(self, name):
+    """ Removes a container that finished while the daemon was down.
+    Args:
+      name: The name of the container.
+    Returns:
+      The exit code of the container, or None if it couldn't be removed. """
+    try:
+      exit_code = docker.wait_container(name)
+      docker.remove_container(name)
+      logger.info("Container %s exited with status %d." % (name, exit_code))
+      return exit_code
+    except docker.DockerError as error:
+      logger.error("Failed to remove container %s: %s" % (name, error))
+      return None
+
+  def __allocate_id(self):
+    """
+    Returns:
+      A new, unique job ID. """
+    if self.__store:
+      return self.__store.allocate_id()
+
+    job_id = self.__next_id
+    self.__next_id += 1
+    return job_id
 
   def __get_available_resources(self):
     """ Gets the available amount of certain system resources. """
     self.__cpu_cores = cpu_count()
-    self.__total_ram = psutil.virtual_memory().total
-    self.__total_vram = self.__gpu.get_total_vram()
+    if self.__cpu_allocator:
+      # Jobs can only be pinned to the CPUs that are online.
+      self.__cpu_cores = self.__cpu_allocator.get_num_cpus()
+    self.__total_ram = os.sysconf("SC_PAGE_SIZE") * \
+                       os.sysconf("SC_PHYS_PAGES")
 
     logger.info("Running with %d CPU cores, and %d bytes of RAM." % \
                 (self.__cpu_cores, self.__total_ram))
-    logger.info("Got GPU with %d bytes of VRAM." % (self.__total_vram))
+    for gpu in self.__gpus:
+      logger.info("Got GPU %d with %d bytes of VRAM." % \
+                  (gpu.get_id(), gpu.get_total_vram()))
+
+  def __get_cpu_and_ram(self, job):
+    """ Gets the CPU and RAM that a job counts as using, which is what it
+    declared, unless it didn't declare them and we are overcommitting or
+    enforcing limits.
+    Args:
+      job: The job.
+    Returns:
+      The CPU, in percent of a core, and the RAM, in bytes. """
+    usage = job.get_resource_usage()
+    if not (self.__overcommit or self.__enforce_limits):
+      return usage.Cpu, usage.Ram
+    return usage.Cpu or self.__default_cpu, usage.Ram or self.__default_ram
 
   def __calculate_resource_requirements(self, job):
-    """ Calculates the percentage resource requirements for running a particular
-    job.
+    """ Calculates the resource requirements for running a particular job.
     Returns:
-      A tuple containing the requirements for CPU, RAM, GPU, and VRAM. """
+      A tuple containing the percentage requirements for CPU and RAM, the number
+      of GPUs, and the percentage GPU and VRAM (in bytes) requirements for each
+      GPU. """
     usage = job.get_resource_usage()
+    job_cpu, job_ram = self.__get_cpu_and_ram(job)
 
     # CPU requirements will be in percentages, so we just need to divide this by
     # the number of cores.
-    cpu = usage.Cpu / self.__cpu_cores
+    cpu = job_cpu / self.__cpu_cores
     # RAM is in bytes, so we can just calculate the fraction.
-    ram = usage.Ram / self.__total_ram * 100
+    ram = job_ram / self.__total_ram * 100
     # GPU requirement will be in percentage form already.
     gpu = usage.Gpu
-    # VRAM is in bytes, so we can calculate the fraction again.
-    vram = usage.Vram / self.__total_vram * 100
+    # GPUs can have different amounts of VRAM, so we keep this in bytes.
+    vram = usage.Vram
 
-    return cpu, ram, gpu, vram
+    return cpu, ram, usage.GpuCount, gpu, vram
 
-  def add_job(self, job_directory):
-    """ Adds a new job to the queue.
+  def __estimate_runtime(self, job):
+    """ Estimates how long a job will run for.
     Args:
-      job_directory: The directory containing the job. """
-    logger.info("Adding new job from '%s'." % (job_directory))
+      job: The job.
+    Returns:
+      The estimated runtime, in seconds, or None if we have no idea. """
+    max_runtime = job.get_config().get_max_runtime()
+    if max_runtime:
+      # If the job declared a limit, it will be killed once it reaches it.
+      return max_runtime
+    if self.__runtimes:
+      # Tasks of a job array share their estimates.
+      return self.__runtimes.estimate(job.get_config().get_name(),
+                                      job.get_image())
+    return None
 
-    try:
-      new_job = Job(job_directory)
-    except ConfigurationError as error:
-      # Bad configuration. Don't add the job.
-      logger.error("Failed to add job: %s" % str(error))
+  def __make_planner(self):
+    """ Makes a planner for the next scheduling pass.
+    Returns:
+      The scheduler.Planner. """
+    now = time.monotonic()
+    running = []
+    for job, (requirements, gpus, start_time) in self.__running_jobs.items():
+      runtime = self.__estimate_runtime(job)
+      end_time = float("inf") if runtime is None else start_time + runtime
+      running.append((end_time, requirements, gpus))
+    for job, (requirements, gpus, _) in self.__launching.items():
+      # These are about to start running.
+      runtime = self.__estimate_runtime(job)
+      end_time = float("inf") if runtime is None else now + runtime
+      running.append((end_time, requirements, gpus))
+
+    usage = (self.__effective_cpu_usage, self.__effective_ram_usage,
+             self.__effective_gpu_usage, self.__effective_vram_usage)
+    total_vram = [gpu.get_total_vram() for gpu in self.__gpus]
+    planner = Planner(now, usage, total_vram, running,
+                      max_reservations=RESERVATIONS[self.__policy])
+
+    if self.__preemptor:
+      _, requirements = self.__preemptor
+      gpus = self.__fit_after(requirements, list(self.__preempting))
+      if gpus is not None:
+        planner.hold(requirements, gpus)
+
+    return planner
+
+  def __place(self, planner, job, requirements):
+    """ Finds a place for a job to run, and reserves the resources for it.
+    Args:
+      planner: The Planner for the current scheduling pass.
+      job: The job.
+      requirements: The requirement vector for the job.
+    Returns:
+      A tuple of the IDs of the GPUs to run the job on, or None if the job
+      shouldn't be started yet. """
+    held = self.__preemptor is not None and self.__preemptor[0] is job
+    gpus = planner.place(requirements, self.__estimate_runtime(job), held=held)
+    if gpus is None:
+      if self.__preempt_signal and not self.__checked_preemption:
+        # Only the first job that doesn't fit gets to preempt anything, since
+        # it will take up whatever is freed.
+        self.__checked_preemption = True
+        self.__preempt_for(planner, job, requirements)
+      return None
+
+    if held:
+      self.__preemptor = None
+
+    cpu, ram, _, gpu, vram = requirements
+    self.__reserve(job, requirements, gpus, 1)
+    # Until it shows up in the measurements, the job counts as using what it
+    # declared.
+    self.__effective_cpu_usage += cpu
+    self.__effective_ram_usage += ram
+    if self.__effective_gpu_usage is not self.__gpu_usage:
+      # The job we just placed won't show up in the measurements for a while.
+      for gpu_id in gpus:
+        self.__effective_gpu_usage[gpu_id] += gpu
+        self.__effective_vram_usage[gpu_id] += vram
+
+    return gpus
+
+  def __fit_after(self, requirements, released):
+    """ Checks whether a job would fit once some running jobs have exited.
+    Args:
+      requirements: The requirement vector for the job.
+      released: The running jobs to assume have exited.
+    Returns:
+      The GPUs that the job would run on, or None if it wouldn't fit. """
+    cpu = self.__cpu_usage
+    ram = self.__ram_usage
+    gpu_usage = list(self.__gpu_usage)
+    vram_usage = list(self.__vram_usage)
+    for job in released:
+      (job_cpu, job_ram, _, job_gpu, job_vram), gpus, _ = \
+          self.__running_jobs[job]
+      cpu -= job_cpu
+      ram -= job_ram
+      for gpu_id in gpus:
+        gpu_usage[gpu_id] -= job_gpu
+        vram_usage[gpu_id] -= job_vram
+
+    needed_cpu, needed_ram, count, needed_gpu, needed_vram = requirements
+    if needed_cpu > 100 - cpu or needed_ram > 100 - ram:
+      return None
+    total_vram = [gpu.get_total_vram() for gpu in self.__gpus]
+    return choose_gpus(count, needed_gpu, needed_vram, gpu_usage, vram_usage,
+                       total_vram)
+
+  def __preempt_for(self, planner, job, requirements):
+    """ Preempts running jobs with a lower priority, if that would make room
+    for a pending job.
+    Args:
+      planner: The Planner for the current scheduling pass.
+      job: The pending job.
+      requirements: The requirement vector for the pending job. """
+    released = list(self.__preempting)
+    gpus = self.__fit_after(requirements, released)
+    if gpus is not None:
+      # Enough is being freed up already.
+      self.__preemptor = (job, requirements)
+      planner.hold(requirements, gpus)
+      return
+
+    # Prefer preempting the lowest priority jobs, and of those, the ones that
+    # started most recently, since they lose the least work.
+    candidates = [(other.get_priority(), -start_time, other.get_id(), other) \
+                  for other, (_, _, start_time) in self.__running_jobs.items() \
+                  if other.get_priority() < job.get_priority() and \
+                     other not in self.__preempting]
+    candidates.sort()
+
+    victims = []
+    for _, _, _, other in candidates:
+      victims.append(other)
+      if self.__fit_after(requirements, released + victims) is not None:
+        break
+    else:
+      # Even preempting everything we could wouldn't help.
+      return
+
+    # Spare any of the victims that turned out not to be needed.
+    for other in reversed(list(victims)):
+      remaining = [victim for victim in victims if victim is not other]
+      if self.__fit_after(requirements, released + remaining) is not None:
+        victims = remaining
+
+    kill_time = time.monotonic() + self.__preempt_grace
+    for other in victims:
+      logger.info("Preempting job %s for higher priority job %s." % \
+                  (other.get_name(), job.get_name()))
+      other.signal(self.__preempt_signal)
+      self.__preempting[other] = kill_time
+
+    self.__preemptor = (job, requirements)
+    planner.hold(requirements,
+                 self.__fit_after(requirements, released + victims))
+
+  def __update_overcommit(self):
+    """ Updates the CPU and RAM usage used for placing jobs from the measured
+    usage of the running jobs. """
+    # Jobs that started recently might not show up in the measurements yet, so
+    # we count what they declared, the same as jobs that we have no
+    # measurements for.
+    measured_cpu = 0
+    measured_ram = 0
+    now = time.monotonic()
+    for job, (requirements, _, start_time) in self.__running_jobs.items():
+      measured = None
+      if self.__container_telemetry and now - start_time >= self.__warmup:
+        measured = self.__container_telemetry.get_usage( \
+            job.get_container_name())
+
+      if measured is None:
+        measured_cpu += requirements[0]
+        measured_ram += requirements[1]
+      else:
+        cpu, ram = measured
+        measured_cpu += cpu / self.__cpu_cores
+        measured_ram += ram / self.__total_ram * 100
+    for requirements, _, _ in self.__launching.values():
+      measured_cpu += requirements[0]
+      measured_ram += requirements[1]
+
+    self.__effective_cpu_usage = \
+        self.__overcommit.get_effective_usage(self.__cpu_usage, measured_cpu)
+    self.__effective_ram_usage = \
+        self.__overcommit.get_effective_usage(self.__ram_usage, measured_ram)
+
+  def __update_effective_usage(self):
+    """ Updates the usage used for placing jobs from the measured usage, if we
+    have it. """
+    if self.__overcommit:
+      self.__update_overcommit()
+    else:
+      self.__effective_cpu_usage = self.__cpu_usage
+      self.__effective_ram_usage = self.__ram_usage
+
+    if not self.__telemetry:
+      return
+
+    # Jobs that started recently might not show up in the measurements yet, so
+    # we count their declared usage on top of what we measure.
+    warming_gpu = [0] * len(self.__gpus)
+    warming_vram = [0] * len(self.__gpus)
+    now = time.monotonic()
+    for requirements, gpus, start_time in self.__running_jobs.values():
+      if now - start_time < self.__warmup:
+        for gpu_id in gpus:
+          warming_gpu[gpu_id] += requirements[3]
+          warming_vram[gpu_id] += requirements[4]
+    for requirements, gpus, _ in self.__launching.values():
+      for gpu_id in gpus:
+        warming_gpu[gpu_id] += requirements[3]
+        warming_vram[gpu_id] += requirements[4]
+
+    self.__effective_gpu_usage = list(self.__gpu_usage)
+    self.__effective_vram_usage = list(self.__vram_usage)
+    for gpu_id in range(len(self.__gpus)):
+      measured = self.__telemetry.get_usage(gpu_id)
+      if measured is None:
+        # No recent data, so fall back on the declared usage.
+        continue
+
+      utilization, memory = measured
+      self.__effective_gpu_usage[gpu_id] = utilization + warming_gpu[gpu_id]
+      self.__effective_vram_usage[gpu_id] = memory + warming_vram[gpu_id]
+
+  def __reserve(self, job, requirements, gpus, sign):
+    """ Updates the resource usage for a job.
+    Args:
+      job: The job.
+      requirements: The requirement vector for the job.
+      gpus: The IDs of the GPUs that the job runs on.
+      sign: 1 to reserve resources, -1 to release them. """
+    cpu, ram, _, gpu, vram = requirements
+    self.__cpu_usage += sign * cpu
+    self.__ram_usage += sign * ram
+    for gpu_id in gpus:
+      self.__gpu_usage[gpu_id] += sign * gpu
+      self.__vram_usage[gpu_id] += sign * vram
+
+    if self.__fair_share:
+      # Charge the owner for the fraction of each GPU that they reserved.
+      self.__fair_share.add_running(job.get_owner(),
+                                    sign * len(gpus) * gpu / 100)
+
+  def __enqueue(self, job, requirements):
+    """ Adds a job to the pending queue.
+    Args:
+      job: The job.
+      requirements: The requirement vector for the job. """
+    # Job IDs are assigned in order, so using them as the position means that
+    # requeued jobs go back to where they were.
+    self.__pending_jobs.add(job, requirements, image=job.get_image(),
+                            owner=job.get_owner(),
+                            priority=job.get_priority(),
+                            sequence=job.get_id())
+    self.__queued_times[job] = time.monotonic()
+
+  def __admit(self, job, requirements, dependencies):
+    """ Adds a pending job. It goes into the queue if nothing that it depends on
+    is still going, and waits otherwise.
+    Args:
+      job: The job.
+      requirements: The requirement vector for the job.
+      dependencies: A list of (directory, condition) pairs for the jobs that it
+      depends on. """
+    state = self.__dependencies.add(job, dependencies)
+    if state == READY:
+      self.__index.add(job, jobindex.PENDING)
+      self.__enqueue(job, requirements)
       return
 
-    self.__pending_jobs.appendleft(new_job)
+    self.__index.add(job, jobindex.BLOCKED)
+    if state == BLOCKED:
+      self.__blocked_jobs[job] = requirements
+    else:
+      self.__cancel(job, "since a job it depends on failed")
+      # Its directory only counts as done once it is finished.
+      self.__propagate(job, False)
+      self.__propagate(job, False)
+
+  def __cancel(self, job, reason):
+    """ Removes a job that will never run.
+    Args:
+      job: The job.
+      reason: Why it won't run. """
+    logger.warning("Cancelling job %s, %s." % (job.get_name(), reason))
+    self.__index.set_state(job.get_id(), jobindex.CANCELLED)
+    if self.__store:
+      self.__store.record_finish(job.get_id())
+    if self.__metrics:
+      self.__metrics.increment("stoplight_jobs_cancelled_total")
+    if self.__reporter:
+      self.__finished_dirs.append(job.get_directory())
+
+  def __propagate(self, job, succeeded):
+    """ Updates the jobs that depend on a job that is done.
+    Args:
+      job: The job.
+      succeeded: Whether the job succeeded. """
+    ready, cancelled = self.__dependencies.finish(job, succeeded)
+    for ready_job in ready:
+      logger.info("Job %s is no longer waiting on other jobs." % \
+                  (ready_job.get_name()))
+      self.__enqueue(ready_job, self.__blocked_jobs.pop(ready_job))
+      self.__index.set_state(ready_job.get_id(), jobindex.PENDING)
+      self.__may_start_jobs = True
+    for cancelled_job in cancelled:
+      del self.__blocked_jobs[cancelled_job]
+      self.__cancel(cancelled_job, "since a job it depends on failed")
 
-    # We haven't checked whether this job is runnable yet.
-    self.__maybe_runnable.appendleft(new_job)
+  def __finish(self, job, succeeded):
+    """ Records that a job finished, or failed to start.
+    Args:
+      job: The job.
+      succeeded: Whether the job succeeded. """
+    self.__index.set_state(job.get_id(),
+                           jobindex.SUCCEEDED if succeeded else jobindex.FAILED)
+    if self.__store:
+      self.__store.record_finish(job.get_id())
+    if self.__metrics:
+      self.__metrics.increment("stoplight_jobs_finished_total")
+    if self.__reporter:
+      self.__finished_dirs.append(job.get_directory())
+
+    self.__propagate(job, succeeded)
+
+  def admit_jobs(self, loaded_jobs, owner=None, priority=None):
+    """ Adds a batch of new jobs to the queue. They will all be considered for
+    scheduling together on the next update. Job arrays are expanded into one
+    job for each task, which all share the same configuration and requirement
+    vector. Jobs that depend on other jobs wait until those are done, so the
+    jobs they depend on have to be added first, either earlier in the same
+    batch or before it.
+    Args:
+      loaded_jobs: A list of (job directory, result) pairs, as produced by
+      the AdmissionPipeline, where each result is either a JobConfig, or a
+      message saying why the job is invalid.
+      owner: The user that submitted the jobs. If not specified, each job
+      belongs to the owner of its directory.
+      priority: Optional priority for the jobs, which overrides the priorities
+      in their job.yaml files.
+    Returns:
+      A list with an entry for each job directory, which is either a list of
+      the IDs of the jobs that were added from it, or a message saying why
+      none were. """
+    logger.info("Adding batch of %d jobs." % (len(loaded_jobs)))
+
+    results = []
+    # Maps JobConfigs to their requirements. We only need to calculate these
+    # once, since the amount of available resources doesn't change, and jobs
+    # with the same requirements then share a single tuple.
+    requirements_cache = {}
+    for job_directory, config in loaded_jobs:
+      if not isinstance(config, JobConfig):
+        # Bad configuration. Don't add the job.
+        logger.error("Failed to add job from '%s': %s" % (job_directory,
+                                                           config))
+        results.append(config)
+        continue
+
+      dependencies = _resolve_dependencies(job_directory, config)
+      error = self.__dependencies.check(job_directory, dependencies)
+      if error:
+        logger.error("Failed to add job from '%s': %s" % (job_directory,
+                                                           error))
+        results.append(error)
+        continue
+
+      tasks = (None,)
+      if config.get_array():
+        tasks = range(config.get_array().get_num_tasks())
+        logger.info("Adding job array %s with %d tasks." % \
+                    (config.get_name(), len(tasks)))
+
+      job_owner = owner or _get_directory_owner(job_directory)
+      job_ids = []
+      for task in tasks:
+        new_job = self.__make_job(job_directory, self.__allocate_id(), config,
+                                  rotation=self.__rotation, owner=job_owner,
+                                  priority=priority, task=task)
+        requirements = requirements_cache.get(config)
+        if requirements is None:
+          requirements = self.__calculate_resource_requirements(new_job)
+          requirements_cache[config] = requirements
+        if self.__store:
+          self.__store.record_add(new_job)
+        self.__admit(new_job, requirements, dependencies)
+        job_ids.append(new_job.get_id())
+
+      results.append(job_ids)
+
+    # We haven't checked whether these jobs are runnable yet.
+    self.__may_start_jobs = True
+    return results
+
+  def get_index(self):
+    """
+    Returns:
+      The JobIndex with the state of every job. """
+    return self.__index
+
+  def get_output_fds(self):
+    """
+    Returns:
+      A dictionary mapping the file descriptors that the output of running jobs
+      shows up on to the jobs. These also become readable when a job exits. """
+    fds = {}
+    for job in self.__running_jobs:
+      fd = job.get_output_fd()
+      if fd is not None:
+        fds[fd] = job
+
+    return fds
 
   def update(self):
     """ Updates the state of the manager. Should be called periodically. """
     # Remove any jobs that are now finished.
-    finished_job = False
+    now = time.monotonic()
     to_remove = []
-    for job in self.__running_jobs:
-      # Write any new output.
-      job.write_job_output()
+    phase_start = time.perf_counter()
+    output_time = 0.0
+    for job, (_, _, start_time) in self.__running_jobs.items():
+      # Write any new output, and keep it from getting too big.
+      output_start = time.perf_counter()
+      job.pump_output()
+      job.rotate_output()
+      output_time += time.perf_counter() - output_start
+
+      max_runtime = job.get_config().get_max_runtime()
+      if max_runtime and now - start_time > max_runtime:
+        job.kill("exceeded its MaxRuntime of %s seconds" % (max_runtime))
+      kill_time = self.__preempting.get(job)
+      if kill_time is not None and now > kill_time:
+        job.kill("did not exit within %s seconds of being preempted" % \
+                 (self.__preempt_grace))
 
       completed = False
+      succeeded = True
       try:
         completed = job.is_finished()
+        if completed and self.__runtimes and kill_time is None:
+          # Only successful runs tell us how long the job really takes.
+          self.__runtimes.record(job.get_config().get_name(), job.get_image(),
+                                 now - start_time)
       except RuntimeError:
-        # The job failed.
-        logger.error("Job %s execution failed!" % (job.get_name()))
+        if kill_time is None:
+          # The job failed.
+          logger.error("Job %s execution failed!" % (job.get_name()))
         completed = True
+        succeeded = False
 
       if completed:
-        # Remove the finished job.
-        to_remove.append(job)
-        finished_job = True
-
-        # Reclaim the resources used by the job.
-        cpu, ram, gpu, vram = self.__calculate_resource_requirements(job)
-        self.__cpu_usage -= cpu
-        self.__ram_usage -= ram
-        self.__gpu_usage -= gpu
-        self.__vram_usage -= vram
-
-    # We can't remove jobs from the set we're iterating through, so...
-    for job in to_remove:
-      logger.debug("Removing completed job: %s" % (job.get_name()))
-      self.__running_jobs.remove(job)
-
-    # Check to see if there are any new jobs that we can start running.
-    cpu_remaining = 100 - self.__cpu_usage
-    ram_remaining = 100 - self.__ram_usage
-    gpu_remaining = 100 - self.__gpu_usage
-    vram_remaining = 100 - self.__vram_usage
-
-    pending_queue = self.__pending_jobs
-    if not finished_job:
-      # If no jobs finished this cycle, then our resource usage profile didn't
-      # change, so we only have to look at new jobs that were added.
-      logger.debug("No jobs finished, using maybe_runnable queue.")
-      pending_queue = self.__maybe_runnable
-
-    # If we just finished a job, our current load changed, so we have to go
-    # through and check the entire pending queue.
-    seen_jobs = 0
-    while (cpu_remaining > 0 and ram_remaining > 0 and \
-           gpu_remaining > 0 and vram_remaining > 0):
-      if not len(pending_queue):
-        # We have no work to do.
-        logger.debug("No more jobs to run.")
-        break
-      if seen_jobs >= len(pending_queue):
-        # We have more jobs to run, but insufficient resources to run them.
-        logger.debug("Not enough resources to run more jobs.")
-        break;
-
-      # Get the next job to check.
-      job = pending_queue.pop()
-      if job in self.__already_started:
-        # We already started this job on a pass through maybe_runnable, so we
-        # can ignore it this time.
-        self.__already_started.remove(job)
-        continue
+        to_remove.append((job, succeeded))
 
-      cpu, ram, gpu, vram = self.__calculate_resource_requirements(job)
+    # We can't remove jobs from the dict we're iterating through, so...
+    for job, succeeded in to_remove:
+      logger.debug("Removing completed job: %s", job.get_name())
+      requirements, gpus, _ = self.__running_jobs.pop(job)
+      job.close_output()
+      if self.__container_telemetry:
+        self.__container_telemetry.remove(job.get_container_name())
 
-      if (cpu <= cpu_remaining and ram <= ram_remaining and \
-          gpu <= gpu_remaining and vram <= ram_remaining):
-        # Start the job.
-        logger.info("Starting new job: %s" % (job.get_name()))
-        job.start()
+      # Reclaim the resources used by the job.
+      self.__reserve(job, requirements, gpus, -1)
+      self.__unpin(job)
+      if self.__preempting.pop(job, None) is not None:
+        # It was preempted, so it goes back in the queue.
+        logger.info("Requeueing preempted job %s." % (job.get_name()))
+        self.__enqueue(job, requirements)
+        self.__index.set_state(job.get_id(), jobindex.PENDING)
+        if self.__store:
+          self.__store.record_requeue(job.get_id())
+        if self.__metrics:
+          self.__metrics.increment("stoplight_jobs_requeued_total")
+      else:
+        self.__finish(job, succeeded)
+      # Our resource usage profile changed, so more jobs might fit.
+      self.__may_start_jobs = True
 
-        cpu_remaining -= cpu
-        ram_remaining -= ram
-        gpu_remaining -= gpu
-        vram_remaining -= vram
+    self.__observe_phase("output", output_time)
+    self.__observe_phase("reap",
+                         time.perf_counter() - phase_start - output_time)
 
-        self.__running_jobs.add(job)
+    if self.__launcher:
+      for job, error, latency in self.__launcher.get_launched():
+        self.__on_launched(job, error, latency)
 
-        if pending_queue == self.__maybe_runnable:
-          # Indicate that we've already started this job, so we should ignore
-          # the copy in pending_jobs.
-          self.__already_started.add(job)
+    if self.__reporter:
+      cancelled = self.__reporter.take_cancelled()
+      if cancelled:
+        self.__cancel_duplicates(cancelled)
 
-      else:
-        # If we don't have enough resources, add it back to the queue.
-        pending_queue.appendleft(job)
+    if self.__images:
+      phase_start = time.perf_counter()
+      # Images of jobs that are starting are in use too.
+      running_images = set([job.get_image() for job in self.__running_jobs])
+      running_images.update([job.get_image() for job in self.__launching])
+      if self.__images.update(self.__pending_jobs.get_images(),
+                              running_images):
+        # Jobs that were waiting for their images can now run.
+        self.__may_start_jobs = True
+      self.__observe_phase("images", time.perf_counter() - phase_start)
+
+    if self.__may_start_jobs or self.__telemetry or \
+       self.__container_telemetry:
+      # Something changed since the last time we checked the pending queue. (If
+      # we are using measured usage, it can change at any time.)
+      self.__may_start_jobs = False
+      self.__start_jobs()
+
+    phase_start = time.perf_counter()
+    if self.__store:
+      self.__store.flush()
+    if self.__runtimes:
+      self.__runtimes.save()
+    if self.__fair_share:
+      self.__fair_share.save()
+    self.__observe_phase("save", time.perf_counter() - phase_start)
+
+    if self.__reporter:
+      jobs = None
+      if self.__reporter.needs_jobs():
+        jobs = self.__get_report_jobs()
+      self.__reporter.report(self.__get_report_state(), self.__started_dirs,
+                             self.__finished_dirs, jobs=jobs)
+      self.__started_dirs = []
+      self.__finished_dirs = []
+
+  def __get_report_state(self):
+    """ Gets the state that we report to the coordinator. This is flat, so that
+    only the values that changed have to be sent.
+    Returns:
+      A dictionary with the size of the machine, and how much of it is in
+      use. """
+    # If we are overcommitting, the coordinator can send us more jobs than
+    # they declared room for.
+    state = {"cores": self.__cpu_cores, "total_ram": self.__total_ram,
+             "gpus": len(self.__gpus), "cpu": self.__effective_cpu_usage,
+             "ram": self.__effective_ram_usage,
+             "pending": len(self.__pending_jobs),
+             "blocked": len(self.__blocked_jobs),
+             "running": len(self.__running_jobs) + len(self.__launching)}
+    for gpu_id, gpu in enumerate(self.__gpus):
+      state["gpu.%d" % (gpu_id)] = self.__effective_gpu_usage[gpu_id]
+      state["vram.%d" % (gpu_id)] = self.__effective_vram_usage[gpu_id]
+      state["total_vram.%d" % (gpu_id)] = gpu.get_total_vram()
+
+    return state
+
+  def __get_report_jobs(self):
+    """ Lists our jobs for the coordinator. This looks at every job, so it is
+    only done when the coordinator needs to find out where its jobs are.
+    Returns:
+      Sorted lists of the directories of the running jobs, and of the pending
+      ones. Jobs that are being started count as running, since it is too late
+      to cancel them. """
+    running = set([job.get_directory() for job in self.__running_jobs])
+    running.update([job.get_directory() for job in self.__launching])
+    pending = set([job.get_directory() for job in self.__queued_times])
+    pending.update([job.get_directory() for job in self.__blocked_jobs])
+    return sorted(running), sorted(pending - running)
+
+  def __cancel_duplicates(self, job_dirs):
+    """ Cancels pending jobs that the coordinator also sent to another worker,
+    while it couldn't reach us.
+    Args:
+      job_dirs: The directories of the jobs. """
+    for job in [job for job in self.__queued_times \
+                if job.get_directory() in job_dirs]:
+      # The requirements only depend on the job and the machine, so they are
+      # the same as when it was queued.
+      self.__pending_jobs.remove(job,
+                                 self.__calculate_resource_requirements(job),
+                                 image=job.get_image(), owner=job.get_owner(),
+                                 priority=job.get_priority())
+      del self.__queued_times[job]
+      self.__cancel(job, "since the coordinator sent it to another worker")
+      self.__propagate(job, False)
+
+  def __pin(self, job, gpus):
+    """ Picks the CPUs to pin a job to.
+    Args:
+      job: The job.
+      gpus: The IDs of the GPUs that the job runs on.
+    Returns:
+      The IDs of the CPUs and of the NUMA node to pin the job to, or None if
+      it isn't pinned. """
+    if not self.__cpu_allocator:
+      return None
+
+    # The CPU is in percent of a core. Jobs that use less than a core still
+    # get one to themselves, but jobs that use none aren't pinned, so that
+    # they don't take up a core that placement thinks is free.
+    cpu, _ = self.__get_cpu_and_ram(job)
+    if not cpu:
+      return None
+    count = max(1, math.ceil(cpu / 100))
+    cpuset = self.__cpu_allocator.allocate(count, gpus)
+    if cpuset is None:
+      logger.info("No room to pin job %s to %d cores on one NUMA node." % \
+                  (job.get_name(), count))
+      return None
+
+    cpus, nodes = cpuset
+    logger.debug("Pinning job %s to CPUs %s on NUMA node %s.", job.get_name(),
+                 cpus, nodes)
+    self.__pinned_cpus[job] = cpus
+    return cpuset
+
+  def __unpin(self, job):
+    """ Frees the CPUs that a job was pinned to, if it was.
+    Args:
+      job: The job. """
+    cpus = self.__pinned_cpus.pop(job, None)
+    if cpus is not None:
+      self.__cpu_allocator.release(cpus)
+
+  def __launch(self, job, requirements, gpus):
+    """ Gets a job that resources were just reserved for ready to start.
+    Args:
+      job: The job.
+      requirements: The requirement vector for the job.
+      gpus: The IDs of the GPUs that were reserved for the job.
+    Returns:
+      The name to give its container, and the CPUs and NUMA nodes to pin it
+      to, or None. """
+    logger.info("Starting new job: %s" % (job.get_name()))
+    self.__launching[job] = (requirements, gpus,
+                             self.__queued_times.pop(job, None))
+    self.__index.set_state(job.get_id(), jobindex.STARTING)
+    cpuset = self.__pin(job, gpus)
+    name = job.make_container_name()
+    if self.__store:
+      self.__store.record_launch(job, name, gpus, self.__pinned_cpus.get(job))
+    return name, cpuset
+
+  def __start(self, job, gpus, name, cpuset):
+    """ Starts the container of a job.
+    Args:
+      job: The job.
+      gpus: The IDs of the GPUs that were reserved for the job.
+      name: The name to give the container.
+      cpuset: The CPUs and NUMA nodes to pin the job to, or None. """
+    limits = None
+    if self.__enforce_limits:
+      limits = self.__get_cpu_and_ram(job)
+    if self.__launcher:
+      self.__launcher.launch(job, gpus, limits=limits, cpuset=cpuset,
+                             name=name)
+      return
+
+    launch_start = time.monotonic()
+    error = None
+    try:
+      job.start(gpus, limits=limits, cpuset=cpuset, name=name)
+    except (ConfigurationError, OSError) as launch_error:
+      error = launch_error
+    self.__on_launched(job, error, time.monotonic() - launch_start)
+
+  def __on_launched(self, job, error, latency):
+    """ Moves a job to the running jobs once its container has started, or
+    puts it back in the queue if that failed.
+    Args:
+      job: The job.
+      error: The exception that starting the job failed with, or None if it
+      started.
+      latency: How long starting the job took, in seconds. """
+    requirements, gpus, queued_time = self.__launching.pop(job)
+    if self.__metrics:
+      self.__metrics.observe("stoplight_launch_seconds", latency)
+    if error is not None:
+      self.__on_launch_failed(job, requirements, gpus, error)
+      return
+
+    logger.debug("Started job %s in %.3f seconds.", job.get_name(), latency)
+    self.__launch_attempts.pop(job, None)
+    # The container is ready by now, so this is when the job really started.
+    self.__running_jobs[job] = (requirements, gpus, time.monotonic())
+    self.__index.set_state(job.get_id(), jobindex.RUNNING,
+                           launch_time=latency)
+    if self.__container_telemetry:
+      self.__container_telemetry.add(job.get_container_name())
+    if self.__images:
+      self.__images.touch(job.get_image())
+    if self.__store:
+      self.__store.record_start(job, gpus, self.__pinned_cpus.get(job))
+    if self.__reporter:
+      self.__started_dirs.append(job.get_directory())
+    if self.__metrics:
+      self.__metrics.increment("stoplight_jobs_started_total")
+      if queued_time is not None:
+        self.__metrics.observe("stoplight_queue_wait_seconds",
+                               time.monotonic() - queued_time)
+
+  def __on_launch_failed(self, job, requirements, gpus, error):
+    """ Releases the resources of a job that failed to start, and puts it back
+    in the queue, unless it failed too many times already.
+    Args:
+      job: The job.
+      requirements: The requirement vector for the job.
+      gpus: The IDs of the GPUs that were reserved for the job.
+      error: The exception that starting the job failed with. """
+    logger.error("Failed to start job %s: %s" % (job.get_name(), str(error)))
+    job.close_output()
+    self.__reserve(job, requirements, gpus, -1)
+    self.__unpin(job)
+    # Something else might fit in the space we freed up.
+    self.__may_start_jobs = True
+    if self.__metrics:
+      self.__metrics.increment("stoplight_launch_failures_total")
+
+    attempts = self.__launch_attempts.pop(job, 0) + 1
+    if attempts >= self.__max_launch_attempts:
+      self.__finish(job, False)
+      return
+
+    logger.info("Requeueing job %s after %d failed attempts to start it." % \
+                (job.get_name(), attempts))
+    self.__launch_attempts[job] = attempts
+    self.__enqueue(job, requirements)
+    self.__index.set_state(job.get_id(), jobindex.PENDING)
+    if self.__store:
+      self.__store.record_requeue(job.get_id())
+
+  def __start_jobs(self):
+    """ Starts any pending jobs that we have the resources for. """
+    self.__update_effective_usage()
+
+    # Check to see if there are any new jobs that we can start running. This
+    # reserves the resources for them as it goes. Jobs with images that are
+    # already present get to go first. Jobs whose images are still being pulled
+    # only get what is left after that, so that they don't hold on to resources
+    # that ready jobs could use while they wait.
+    phase_start = time.perf_counter()
+    is_ready = None
+    if self.__images:
+      is_ready = self.__images.is_ready
+    self.__checked_preemption = False
+    planner = self.__make_planner()
+    place = functools.partial(self.__place, planner)
+    get_share = None
+    if self.__fair_share:
+      get_share = self.__fair_share.get_share
 
-      seen_jobs += 1
+    def has_room(smallest):
+      if self.__preempt_signal and not self.__checked_preemption:
+        # The first job that doesn't fit still gets to preempt others.
+        return True
+      return planner.has_room(smallest)
 
-    # Since everything in this queue is also in the pending queue, we've processed
-    # it already.
-    self.__maybe_runnable.clear()
+    runnable = self.__pending_jobs.pop_runnable(place, is_ready, get_share,
+                                                has_room)
+    self.__observe_phase("scan", time.perf_counter() - phase_start)
 
-    # Update resource usage.
-    self.__cpu_usage = 100 - cpu_remaining
-    self.__ram_usage = 100 - ram_remaining
-    self.__gpu_usage = 100 - gpu_remaining
-    self.__vram_usage = 100 - vram_remaining
+    phase_start = time.perf_counter()
+    launches = []
+    for job, requirements, gpus in runnable:
+      launches.append((job, gpus) + self.__launch(job, requirements, gpus))
+    if self.__store and launches:
+      # The names of the containers have to be saved before they exist, so
+      # that they can be found again if the daemon stops while starting them.
+      self.__store.flush()
+    for job, gpus, name, cpuset in launches:
+      self.__start(job, gpus, name, cpuset)
 
-    logger.debug("Resource usage: CPU: %d, RAM: %d, GPU: %d, VRAM: %d" % \
-                 (self.__cpu_usage, self.__ram_usage, self.__gpu_usage,
-                  self.__vram_usage))
+    self.__observe_phase("launch", time.perf_counter() - phase_start)
+    # The arguments are only formatted if debug logging is enabled.
+    logger.debug("Resource usage: CPU: %d, RAM: %d, GPU: %s, VRAM: %s",
+                 self.__cpu_usage, self.__ram_usage, self.__gpu_usage,
+                 self.__vram_usage)
@@ -0,0 +1,224 @@
+import bisect
+import logging
+import threading
+import time
+
+
+""" Collects metrics about the daemon, and formats them for Prometheus. """
+
+
+# Buckets for timing the parts of an update, in seconds.
+PHASE_BUCKETS = (0.00001, 0.00003, 0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03,
+                 0.1, 0.3, 1.0, 3.0)
+# Buckets for how long jobs wait in the queue, in seconds.
+LATENCY_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, 4 * 3600, 12 * 3600,
+                   24 * 3600, 72 * 3600)
+
+
+class Histogram:
+  """ Counts how many observations fall into each of a set of buckets. """
+
+  def __init__(self, buckets):
+    """
+    Args:
+      buckets: The upper bounds of the buckets, in increasing order. There is
+      also an implicit bucket for everything bigger. """
+    self.__buckets = tuple(buckets)
+    self.__counts = [0] * (len(self.__buckets) + 1)
+    self.__sum = 0.0
+
+  def observe(self, value):
+    """ Records an observation.
+    Args:
+      value: The observed value. """
+    self.__counts[bisect.bisect_left(self.__buckets, value)] += 1
+    self.__sum += value
+
+  def get_state(self):
+    """
+    Returns:
+      The bucket bounds, the count in each bucket, and the sum of all the
+      observations. """
+    return self.__buckets, list(self.__counts), self.__sum
+
+
+class Metrics:
+  """ A set of counters, gauges and histograms. They can be updated from any
+  thread. When they are scraped, a snapshot made of plain tuples is taken
+  under the lock, and formatted afterwards, so updates are never held up by
+  formatting. """
+
+  def __init__(self):
+    # Maps metric names to [type, help, buckets, {labels: value}] lists, where
+    # labels are tuples of (name, value) pairs.
+    self.__metrics = {}
+    # Metrics can be updated from logging in any thread.
+    self.__lock = threading.Lock()
+
+  def __add(self, name, metric_type, help_text, buckets=None):
+    """ Adds a new metric, if it doesn't already exist. """
+    with self.__lock:
+      self.__metrics.setdefault(name, [metric_type, help_text, buckets, {}])
+
+  def add_counter(self, name, help_text):
+    """ Adds a counter, which only ever goes up.
+    Args:
+      name: The name of the counter.
+      help_text: A description of the counter. """
+    self.__add(name, "counter", help_text)
+
+  def add_gauge(self, name, help_text):
+    """ Adds a gauge, which is set to the current value of something.
+    Args:
+      name: The name of the gauge.
+      help_text: A description of the gauge. """
+    self.__add(name, "gauge", help_text)
+
+  def add_histogram(self, name, help_text, buckets):
+    """ Adds a histogram.
+    Args:
+      name: The name of the histogram.
+      help_text: A description of the histogram.
+      buckets: The upper bounds of the buckets. """
+    self.__add(name, "histogram", help_text, buckets)
+
+  def increment(self, name, amount=1, labels=()):
+    """ Increments a counter.
+    Args:
+      name: The name of the counter.
+      amount: How much to add.
+      labels: Tuple of (name, value) label pairs. """
+    with self.__lock:
+      values = self.__metrics[name][3]
+      values[labels] = values.get(labels, 0) + amount
+
+  def set(self, name, value, labels=()):
+    """ Sets a gauge.
+    Args:
+      name: The name of the gauge.
+      value: The new value.
+      labels: Tuple of (name, value) label pairs. """
+    with self.__lock:
+      self.__metrics[name][3][labels] = value
+
+  def observe(self, name, value, labels=()):
+    """ Adds an observation to a histogram.
+    Args:
+      name: The name of the histogram.
+      value: The observed value.
+      labels: Tuple of (name, value) label pairs. """
+    with self.__lock:
+      _, _, buckets, values = self.__metrics[name]
+      histogram = values.get(labels)
+      if histogram is None:
+        histogram = Histogram(buckets)
+        values[labels] = histogram
+      histogram.observe(value)
+
+  def snapshot(self):
+    """
+    Returns:
+      A list of (name, type, help, samples) tuples, where samples is a list of
+      (labels, value) pairs. For histograms, the values are the states of the
+      histograms. This can be pickled. """
+    snapshot = []
+    with self.__lock:
+      for name, (metric_type, help_text, _, values) in \
+          sorted(self.__metrics.items()):
+        samples = []
+        for labels, value in values.items():
+          if metric_type == "histogram":
+            value = value.get_state()
+          samples.append((labels, value))
+        snapshot.append((name, metric_type, help_text, samples))
+
+    return snapshot
+
+
+class TimedHandler(logging.Handler):
+  """ Wraps a logging handler, and records how many records it handles, and
+  how long it takes to format and write them. """
+
+  def __init__(self, handler, metrics):
+    """
+    Args:
+      handler: The handler to wrap.
+      metrics: The Metrics to record in. """
+    super().__init__(handler.level)
+    self.__handler = handler
+    self.__metrics = metrics
+
+    self.__metrics.add_counter("stoplight_log_records_total",
+                               "Log records written, by level.")
+    self.__metrics.add_counter("stoplight_log_seconds_total",
+                               "Time spent formatting and writing log" \
+                               " records.")
+
+  def handle(self, record):
+    start_time = time.perf_counter()
+    handled = self.__handler.handle(record)
+    elapsed = time.perf_counter() - start_time
+
+    self.__metrics.increment("stoplight_log_records_total",
+                             labels=(("level", record.levelname),))
+    self.__metrics.increment("stoplight_log_seconds_total", elapsed)
+    return handled
+
+
+def _format_labels(labels):
+  """
+  Args:
+    labels: Tuple of (name, value) label pairs.
+  Returns:
+    The labels in the Prometheus text format. """
+  if not labels:
+    return ""
+
+  pairs = []
+  for name, value in labels:
+    value = str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+    value = value.replace("\n", "\\n")
+    pairs.append("%s=\"%s\"" % (name, value))
+  return "{%s}" % (",".join(pairs))
+
+def _format_value(value):
+  """
+  Args:
+    value: A sample value.
+  Returns:
+    The value in the Prometheus text format. """
+  if value == float("inf"):
+    return "+Inf"
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+def format_text(snapshot):
+  """ Formats metrics in the Prometheus text exposition format.
+  Args:
+    snapshot: A snapshot from Metrics.snapshot().
+  Returns:
+    The formatted metrics. """
+  lines = []
+  for name, metric_type, help_text, samples in snapshot:
+    lines.append("# HELP %s %s" % (name, help_text))
+    lines.append("# TYPE %s %s" % (name, metric_type))
+
+    for labels, value in sorted(samples, key=lambda sample: sample[0]):
+      if metric_type != "histogram":
+        lines.append("%s%s %s" % (name, _format_labels(labels),
+                                  _format_value(value)))
+        continue
+
+      buckets, counts, total = value
+      cumulative = 0
+      for bound, count in zip(buckets + (float("inf"),), counts):
+        cumulative += count
+        bucket_labels = labels + (("le", _format_value(bound)),)
+        lines.append("%s_bucket%s %d" % (name, _format_labels(bucket_labels),
+                                         cumulative))
+      lines.append("%s_sum%s %s" % (name, _format_labels(labels),
+                                    _format_value(total)))
+      lines.append("%s_count%s %d" % (name, _format_labels(labels),
+                                      cumulative))
+
+  lines.append("")
+  return "\n".join(lines)
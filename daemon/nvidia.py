@@ -1,41 +1,148 @@
+import json
+import logging
+import os
 import subprocess
-import xml.etree.ElementTree as et
 
 import util
 
 
-""" Gets information about an NVIDIA GPU. """
+""" Gets information about NVIDIA GPUs. """
+
+
+logger = logging.getLogger(__name__)
+
+
+# Changes whenever the format of the cached GPU information changes.
+_CACHE_VERSION = 2
+
+
+def parse_vram(memory):
+  """ Parses a VRAM amount from nvidia-smi.
+  Args:
+    memory: The memory string, which should look like "12345 MiB", or just
+    "12345".
+  Returns:
+    The amount of memory, in bytes. """
+  return int(memory.split()[0]) * 1000000
 
 
 class Gpu:
   """ Represents a single GPU in the system. """
 
-  def __init__(self, gpu_id):
+  def __init__(self, gpu_id, uuid, total_vram, bus_id=None):
     """
     Args:
-      gpu_id: The numerical ID of the GPU, as listed by nvidia-smi -L. """
+      gpu_id: The numerical ID of the GPU, as listed by nvidia-smi -L.
+      uuid: The UUID of the GPU.
+      total_vram: The total amount of VRAM on the GPU, in bytes.
+      bus_id: The PCI bus ID of the GPU, such as "00000000:3B:00.0", if we
+      know it. """
     self.__gpu_id = gpu_id
+    self.__uuid = uuid
+    self.__total_vram = total_vram
+    self.__bus_id = bus_id
 
-    self.__nvidia_smi = util.get_path("nvidia-smi")
-
-    self.__gather_global_data()
-
-  def __gather_global_data(self):
-    """ Gathers data about a GPU which doesn't change. """
-    # Find the total amount of VRAM.
-    command = [self.__nvidia_smi, "-i", str(self.__gpu_id), "-q", "-x"]
-    output = subprocess.check_output(command)
-    # Parse XML output.
-    tree = et.fromstring(output)
+  def get_id(self):
+    """
+    Returns:
+      The numerical ID of the GPU. """
+    return self.__gpu_id
 
-    gpu = tree.find("gpu")
-    memory = gpu.find("fb_memory_usage")
-    vram = memory.find("total").text
-    # Convert to bytes.
-    self.__total_vram = int(vram.split()[0]) * 1000000
+  def get_uuid(self):
+    """
+    Returns:
+      The UUID of the GPU. """
+    return self.__uuid
 
   def get_total_vram(self):
     """
     Returns:
-      The total amount of VRAM that the system has. """
+      The total amount of VRAM that the GPU has. """
     return self.__total_vram
+
+  def get_bus_id(self):
+    """
+    Returns:
+      The PCI bus ID of the GPU, or None if we don't know it. """
+    return self.__bus_id
+
+
+def _probe_gpus(nvidia_smi):
+  """ Finds all the GPUs in the system, using a single nvidia-smi call. We only
+  ask for the fields that we need, which is much faster than a full query.
+  Args:
+    nvidia_smi: The path to nvidia-smi.
+  Returns:
+    A list of (ID, UUID, total VRAM, PCI bus ID) tuples, ordered by ID. """
+  command = [nvidia_smi, "--query-gpu=index,uuid,memory.total,pci.bus_id",
+             "--format=csv,noheader,nounits"]
+  output = subprocess.check_output(command, universal_newlines=True)
+
+  gpus = []
+  for line in output.splitlines():
+    if not line.strip():
+      continue
+    gpu_id, uuid, total_vram, bus_id = [field.strip() \
+                                        for field in line.split(",")]
+    gpus.append((int(gpu_id), uuid, parse_vram(total_vram), bus_id))
+
+  gpus.sort()
+  return gpus
+
+def _get_cache_key(nvidia_smi):
+  """ Gets a key that changes whenever the set of GPUs might have changed. The
+  GPUs can't change without a reboot, and the driver can't be upgraded without
+  replacing nvidia-smi.
+  Args:
+    nvidia_smi: The path to nvidia-smi.
+  Returns:
+    The key, as a JSON-compatible dictionary. """
+  try:
+    with open("/proc/sys/kernel/random/boot_id") as boot_id_file:
+      boot_id = boot_id_file.read().strip()
+  except OSError:
+    # Without this, we can't tell when the machine rebooted.
+    boot_id = None
+
+  stat = os.stat(nvidia_smi)
+  return {"version": _CACHE_VERSION, "boot_id": boot_id,
+          "nvidia_smi": nvidia_smi, "mtime": stat.st_mtime,
+          "size": stat.st_size}
+
+def enumerate_gpus(cache_path=None):
+  """ Finds all the GPUs in the system. This gathers data about them which
+  doesn't change.
+  Args:
+    cache_path: Optional file to cache the results in. If it was written since
+    the last reboot, and the driver hasn't changed, we use what's in it
+    instead of running nvidia-smi.
+  Returns:
+    A list of Gpu objects, ordered by their IDs. """
+  nvidia_smi = util.get_path("nvidia-smi")
+  key = _get_cache_key(nvidia_smi)
+
+  probed = None
+  if cache_path:
+    try:
+      with open(cache_path) as cache_file:
+        cached = json.load(cache_file)
+      if cached["key"] == key:
+        probed = cached["gpus"]
+    except (OSError, ValueError, KeyError, TypeError):
+      # No usable cache.
+      pass
+
+  if probed is None:
+    probed = _probe_gpus(nvidia_smi)
+
+    if cache_path:
+      temp_path = cache_path + ".tmp"
+      try:
+        with open(temp_path, "w") as cache_file:
+          cache_file.write(json.dumps({"key": key, "gpus": probed}))
+        os.replace(temp_path, cache_path)
+      except OSError as error:
+        logger.warning("Failed to cache GPU information: %s" % (error))
+
+  return [Gpu(gpu_id, uuid, total_vram, bus_id) \
+          for gpu_id, uuid, total_vram, bus_id in probed]
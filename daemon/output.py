@@ -0,0 +1,166 @@
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import logging
+import os
+import shutil
+import threading
+
+
+""" Handles the files that job output gets written to. """
+
+
+logger = logging.getLogger(__name__)
+
+
+# Thread that we compress old output files in, so that compressing large files
+# doesn't stall the daemon.
+_rotation_executor = None
+_rotation_executor_lock = threading.Lock()
+
+
+def _get_rotation_executor():
+  """
+  Returns:
+    The executor to do rotation in. It is created the first time this is
+    called. """
+  global _rotation_executor
+  with _rotation_executor_lock:
+    if _rotation_executor is None:
+      _rotation_executor = ThreadPoolExecutor(max_workers=1)
+
+  return _rotation_executor
+
+
+def get_output_path(job_directory, task, stream):
+  """ Gets the path of a file that job output is written to.
+  Args:
+    job_directory: The job directory.
+    task: The number of the task, for tasks of job arrays, or None.
+    stream: Either "out" or "err".
+  Returns:
+    The path to the file. """
+  prefix = "job"
+  if task is not None:
+    prefix = "job.%d" % (task)
+  return os.path.join(job_directory, "%s.%s" % (prefix, stream))
+
+
+class Rotation:
+  """ Settings for rotating output files. """
+
+  def __init__(self, max_size, backups=3, compress=False):
+    """
+    Args:
+      max_size: The size, in bytes, at which we rotate an output file.
+      backups: The number of old output files to keep.
+      compress: Whether to gzip old output files. """
+    self.max_size = max_size
+    self.backups = backups
+    self.compress = compress
+
+
+class OutputFile:
+  """ A file that a job writes its output to. The daemon is the only writer: it
+  copies the output of the container from the attach stream, on the event loop.
+  The file can therefore be rotated on the loop too, between two writes, without
+  losing anything. """
+
+  def __init__(self, path, rotation=None):
+    """
+    Args:
+      path: The path to the file. It will be appended to if it exists.
+      rotation: Optional Rotation object that specifies how to rotate the file
+      when it gets too big. """
+    self.__path = path
+    self.__rotation = rotation
+
+    self.__fd = self.__open()
+    # Whether an old output file is still being compressed.
+    self.__compressing = False
+
+  def __open(self):
+    """
+    Returns:
+      A new file descriptor for the file. """
+    return os.open(self.__path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+  def fileno(self):
+    """
+    Returns:
+      The underlying file descriptor. This stays the same when the file is
+      rotated. """
+    return self.__fd
+
+  def close(self):
+    """ Closes the file. """
+    if self.__fd is not None:
+      os.close(self.__fd)
+      self.__fd = None
+
+  def __get_backup_path(self, number):
+    """ Gets the path to an old output file.
+    Args:
+      number: The number of the backup, where 1 is the most recent.
+    Returns:
+      The path to the backup. """
+    path = "%s.%d" % (self.__path, number)
+    if self.__rotation.compress:
+      path += ".gz"
+    return path
+
+  def __rotate(self):
+    """ Actually rotates the file. """
+    # Make room for the new backup.
+    for number in range(self.__rotation.backups - 1, 0, -1):
+      path = self.__get_backup_path(number)
+      if os.path.exists(path):
+        os.replace(path, self.__get_backup_path(number + 1))
+
+    # Move the file out of the way, and start a new one. The new file takes
+    # over the old descriptor, so that whatever was handed it keeps writing to
+    # the right place.
+    old_path = "%s.1" % (self.__path)
+    os.replace(self.__path, old_path)
+    new_fd = self.__open()
+    try:
+      os.dup2(new_fd, self.__fd)
+    finally:
+      os.close(new_fd)
+
+    if self.__rotation.compress:
+      self.__compressing = True
+      _get_rotation_executor().submit(self.__compress, old_path)
+
+  def __compress(self, old_path):
+    """ Compresses the most recent old output file. Nothing writes to it any
+    more, so this is done in the background.
+    Args:
+      old_path: The path to the file. """
+    try:
+      with open(old_path, "rb") as source:
+        with gzip.open(self.__get_backup_path(1), "wb") as dest:
+          shutil.copyfileobj(source, dest, 1024 * 1024)
+      os.remove(old_path)
+
+    except OSError as error:
+      logger.error("Failed to compress '%s': %s" % (old_path, error))
+
+    finally:
+      self.__compressing = False
+
+  def maybe_rotate(self):
+    """ Rotates the file if it is too large. This is cheap to call if it doesn't
+    need to be rotated. """
+    if not self.__rotation or not self.__rotation.max_size:
+      return
+    if self.__compressing or self.__fd is None:
+      return
+
+    if os.fstat(self.__fd).st_size < self.__rotation.max_size:
+      return
+
+    logger.info("Rotating output file '%s'." % (self.__path))
+    try:
+      self.__rotate()
+    except OSError as error:
+      logger.error("Failed to rotate '%s': %s" % (self.__path, error))
@@ -0,0 +1,38 @@
+""" Decides how far the CPU and RAM of a machine can be overcommitted, based on
+how much running jobs actually use. """
+
+
+class Overcommit:
+  """ Lets jobs be placed based on the measured usage of the running jobs,
+  instead of what they declared, since jobs tend to ask for more than they
+  need. Two limits keep this safe. Some headroom is always left on top of the
+  measured usage, for spikes and for everything else on the machine. And the
+  declared usage can only exceed the machine by a fixed ratio, so that if
+  every job suddenly uses all that it declared, which its container limits
+  allow, the machine is only ever oversubscribed by a bounded amount. """
+
+  def __init__(self, max_ratio=1.5, headroom=10.0):
+    """
+    Args:
+      max_ratio: The most that the total declared usage can be, as a multiple
+      of what the machine has.
+      headroom: The percentage of the machine to always leave free on top of
+      the measured usage. """
+    self.__max_ratio = max_ratio
+    self.__headroom = headroom
+
+  def get_effective_usage(self, declared, measured):
+    """ Works out the usage to place new jobs against. New jobs fit if their
+    declared usage is no more than 100 minus this.
+    Args:
+      declared: The total declared usage of the running jobs, as a percentage
+      of the machine.
+      measured: The total measured usage of the running jobs, as a percentage
+      of the machine. Jobs that don't have measurements yet should be counted
+      with their declared usage.
+    Returns:
+      The effective usage, as a percentage of the machine. This can be less
+      than the declared usage, but never more. """
+    effective = max(measured + self.__headroom,
+                    declared - (self.__max_ratio - 1) * 100)
+    return min(effective, declared)
@@ -0,0 +1,302 @@
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import time
+import weakref
+
+
+""" Saves the state of the manager to disk, so that it survives restarts. The
+state is stored as an append-only journal of changes, plus a snapshot of the
+live state that is taken periodically. Loading the state only requires reading
+the snapshot and the journal entries since then, so it takes time proportional
+to the number of live jobs, and not to the full history. """
+
+
+logger = logging.getLogger(__name__)
+
+
+def _get_config_key(config_data):
+  """ Gets the key that a job configuration is stored under.
+  Args:
+    config_data: The parsed contents of the job.yaml file.
+  Returns:
+    A key that is the same for identical configurations. """
+  encoded = json.dumps(config_data, sort_keys=True, default=str)
+  return hashlib.sha1(encoded.encode("utf-8")).hexdigest()[:16]
+
+
+class StateStore:
+  """ Persists the set of pending and running jobs. """
+
+  def __init__(self, state_dir, snapshot_interval=10000, max_outcomes=10000):
+    """
+    Args:
+      state_dir: The directory to store the state in.
+      snapshot_interval: How many journal entries to write before taking a
+      new snapshot.
+      max_outcomes: The number of finished job directories to remember the
+      outcomes of. """
+    self.__snapshot_path = os.path.join(state_dir, "snapshot.json")
+    self.__journal_path = os.path.join(state_dir, "journal.jsonl")
+    self.__snapshot_interval = snapshot_interval
+    self.__max_outcomes = max_outcomes
+
+    os.makedirs(state_dir, exist_ok=True)
+
+    # Mirror of the live state, which maps job IDs to their records. Each record
+    # has the job directory, the key of the job configuration, the owner and
+    # the priority, and the task number for tasks of job arrays. Running jobs
+    # also have their GPUs, container name, and start time. Jobs that are
+    # being started have their GPUs, and the name that their container gets
+    # under "launching". This is kept in order of job ID, which is also the
+    # order that they were added in.
+    self.__jobs = {}
+    # Maps keys to job configurations. Each configuration is only stored once,
+    # no matter how many jobs use it, which matters for large job arrays.
+    self.__configs = {}
+    # Maps JobConfigs to their keys, so they only have to be computed once.
+    self.__config_keys = weakref.WeakKeyDictionary()
+    # Maps finished job directories to whether they succeeded, oldest first, so
+    # that jobs can depend on them after a restart.
+    self.__outcomes = OrderedDict()
+    # The next ID to assign to a job.
+    self.__next_id = 0
+
+    self.__journal = None
+    # Number of entries in the journal.
+    self.__journal_length = 0
+
+  def __apply(self, entry):
+    """ Applies a journal entry to the live state. This is idempotent, so that
+    it is harmless to replay entries that are already in the snapshot.
+    Args:
+      entry: The entry to apply. """
+    op = entry["op"]
+    if op == "config":
+      self.__configs[entry["key"]] = entry["config"]
+      return
+    if op == "outcome":
+      self.__outcomes[entry["dir"]] = entry["succeeded"]
+      self.__outcomes.move_to_end(entry["dir"])
+      if len(self.__outcomes) > self.__max_outcomes:
+        self.__outcomes.popitem(last=False)
+      return
+
+    job_id = entry["id"]
+    if op == "add":
+      record = {"dir": entry["dir"], "config": self.__intern(entry["config"]),
+                "owner": entry.get("owner"), "priority": entry.get("priority")}
+      if entry.get("task") is not None:
+        record["task"] = entry["task"]
+      self.__jobs.setdefault(job_id, record)
+      self.__next_id = max(self.__next_id, job_id + 1)
+    elif op == "launch":
+      record = self.__jobs.get(job_id)
+      if record is not None:
+        record["gpus"] = entry["gpus"]
+        record["launching"] = entry["container"]
+        if entry.get("cpus"):
+          record["cpus"] = entry["cpus"]
+    elif op == "start":
+      record = self.__jobs.get(job_id)
+      if record is not None:
+        record.pop("launching", None)
+        record["gpus"] = entry["gpus"]
+        record["container"] = entry["container"]
+        record["time"] = entry.get("time")
+        if entry.get("cpus"):
+          record["cpus"] = entry["cpus"]
+    elif op == "requeue":
+      record = self.__jobs.get(job_id)
+      if record is not None:
+        for key in ("gpus", "container", "launching", "time", "cpus"):
+          record.pop(key, None)
+    elif op == "finish":
+      self.__jobs.pop(job_id, None)
+    else:
+      logger.warning("Unknown journal entry: '%s'." % (op))
+
+  def __intern(self, config):
+    """ Makes sure that a job configuration is stored.
+    Args:
+      config: The key of a stored configuration, or, for state saved by older
+      versions, the configuration itself.
+    Returns:
+      The key of the configuration. """
+    if not isinstance(config, dict):
+      return config
+
+    key = _get_config_key(config)
+    self.__configs.setdefault(key, config)
+    return key
+
+  def load(self):
+    """ Loads the saved state, and starts a new journal.
+    Returns:
+      A list of (job ID, record) pairs for all the pending and running jobs,
+      in the order they were added. """
+    if os.path.exists(self.__snapshot_path):
+      with open(self.__snapshot_path) as snapshot_file:
+        snapshot = json.load(snapshot_file)
+
+      self.__next_id = snapshot["next_id"]
+      self.__configs.update(snapshot.get("configs", {}))
+      self.__outcomes.update(snapshot.get("outcomes", []))
+      for record in snapshot["jobs"]:
+        record["config"] = self.__intern(record["config"])
+        self.__jobs[record.pop("id")] = record
+
+    if os.path.exists(self.__journal_path):
+      with open(self.__journal_path) as journal_file:
+        for line in journal_file:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            # The daemon probably died while writing this.
+            logger.warning("Ignoring corrupt journal entry.")
+            continue
+
+          self.__apply(entry)
+
+    logger.info("Loaded %d jobs from saved state." % (len(self.__jobs)))
+
+    # Compact everything we just loaded.
+    self.snapshot()
+
+    # Jobs with the same configuration share a single copy of it.
+    return [(job_id, dict(record, config=self.__configs[record["config"]])) \
+            for job_id, record in sorted(self.__jobs.items())]
+
+  def get_outcomes(self):
+    """
+    Returns:
+      A list of (job directory, succeeded) pairs for the directories whose jobs
+      have all finished, oldest first. """
+    return list(self.__outcomes.items())
+
+  def __write(self, entry):
+    """ Writes a new journal entry, and applies it to the live state.
+    Args:
+      entry: The entry to write. """
+    self.__apply(entry)
+
+    self.__journal.write(json.dumps(entry, default=str))
+    self.__journal.write("\n")
+    self.__journal_length += 1
+
+  def allocate_id(self):
+    """
+    Returns:
+      A new, unique job ID. """
+    job_id = self.__next_id
+    self.__next_id += 1
+    return job_id
+
+  def record_add(self, job):
+    """ Records that a job was added.
+    Args:
+      job: The job that was added. """
+    config = job.get_config()
+    key = self.__config_keys.get(config)
+    if key is None:
+      key = _get_config_key(config.get_data())
+      self.__config_keys[config] = key
+    if key not in self.__configs:
+      self.__write({"op": "config", "key": key, "config": config.get_data()})
+
+    entry = {"op": "add", "id": job.get_id(), "dir": job.get_directory(),
+             "config": key, "owner": job.get_owner(),
+             "priority": job.get_priority()}
+    if job.get_task() is not None:
+      entry["task"] = job.get_task()
+    self.__write(entry)
+
+  def record_launch(self, job, name, gpus, cpus=None):
+    """ Records that a job is about to be started. This has to be flushed
+    before the container is created, so that the container can be found
+    again if the daemon stops while it is being started.
+    Args:
+      job: The job.
+      name: The name that its container will have.
+      gpus: The GPUs that the job will run on.
+      cpus: The CPUs that the job will be pinned to, if it is. """
+    entry = {"op": "launch", "id": job.get_id(), "container": name,
+             "gpus": list(gpus)}
+    if cpus:
+      entry["cpus"] = list(cpus)
+    self.__write(entry)
+
+  def record_start(self, job, gpus, cpus=None):
+    """ Records that a job was started.
+    Args:
+      job: The job that was started.
+      gpus: The GPUs that the job was started on.
+      cpus: The CPUs that the job is pinned to, if it is. """
+    entry = {"op": "start", "id": job.get_id(), "gpus": list(gpus),
+             "container": job.get_container_name(), "time": time.time()}
+    if cpus:
+      entry["cpus"] = list(cpus)
+    self.__write(entry)
+
+  def record_requeue(self, job_id):
+    """ Records that a running or starting job was put back in the pending
+    queue.
+    Args:
+      job_id: The ID of the job. """
+    self.__write({"op": "requeue", "id": job_id})
+
+  def record_finish(self, job_id):
+    """ Records that a job finished, or was otherwise removed.
+    Args:
+      job_id: The ID of the job. """
+    self.__write({"op": "finish", "id": job_id})
+
+  def record_outcome(self, job_dir, succeeded):
+    """ Records that all the jobs from a directory finished.
+    Args:
+      job_dir: The job directory.
+      succeeded: Whether all the jobs succeeded. """
+    self.__write({"op": "outcome", "dir": job_dir, "succeeded": succeeded})
+
+  def flush(self):
+    """ Makes sure that everything written so far will survive the daemon
+    crashing, and takes a new snapshot if the journal has gotten long. """
+    if self.__journal_length >= self.__snapshot_interval:
+      self.snapshot()
+    else:
+      self.__journal.flush()
+
+  def snapshot(self):
+    """ Writes out a snapshot of the live state, and starts a new journal. """
+    jobs = []
+    configs = {}
+    for job_id, record in self.__jobs.items():
+      record = dict(record)
+      record["id"] = job_id
+      jobs.append(record)
+      configs[record["config"]] = self.__configs[record["config"]]
+    # Forget the configurations that no jobs use anymore.
+    self.__configs = configs
+
+    # Write to a temporary file first, so we always have a complete snapshot.
+    temp_path = self.__snapshot_path + ".tmp"
+    with open(temp_path, "w") as snapshot_file:
+      # Encoding everything at once is a lot faster than json.dump().
+      snapshot_file.write(json.dumps({"next_id": self.__next_id,
+                                      "configs": configs, "jobs": jobs,
+                                      "outcomes": list(self.__outcomes.items())},
+                                     default=str))
+      snapshot_file.flush()
+      os.fsync(snapshot_file.fileno())
+    os.replace(temp_path, self.__snapshot_path)
+
+    # Everything in the journal is now in the snapshot. If we crash before
+    # truncating it, replaying it again is harmless.
+    if self.__journal:
+      self.__journal.close()
+    self.__journal = open(self.__journal_path, "w")
+    self.__journal_length = 0
+
+    logger.debug("Wrote snapshot with %d jobs." % (len(jobs)))
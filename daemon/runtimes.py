@@ -0,0 +1,90 @@
+from collections import deque
+import json
+import logging
+import os
+
+
+""" Learns how long jobs take to run, so that the scheduler can plan ahead. """
+
+
+logger = logging.getLogger(__name__)
+
+
+class RuntimeEstimates:
+  """ Keeps track of how long past jobs took to run. Jobs with the same name
+  and image are assumed to take about as long as each other. """
+
+  def __init__(self, path=None, history=10):
+    """
+    Args:
+      path: Optional file to save the recorded runtimes in, so that they
+      survive restarts.
+      history: How many of the most recent runtimes to remember for each kind
+      of job. """
+    self.__path = path
+    self.__history = history
+
+    # Maps (name, image) pairs to the most recent runtimes, in seconds.
+    self.__runtimes = {}
+    # Whether anything changed since we last saved.
+    self.__dirty = False
+
+    if self.__path and os.path.exists(self.__path):
+      self.__load()
+
+  def __load(self):
+    """ Loads the saved runtimes. """
+    try:
+      with open(self.__path) as runtimes_file:
+        saved = json.load(runtimes_file)
+    except (OSError, ValueError) as error:
+      logger.warning("Failed to load job runtimes: %s" % (error))
+      return
+
+    for name, image, runtimes in saved:
+      self.__runtimes[(name, image)] = deque(runtimes, maxlen=self.__history)
+
+    logger.info("Loaded runtimes for %d kinds of job." % (len(saved)))
+
+  def record(self, name, image, runtime):
+    """ Records how long a job took to run.
+    Args:
+      name: The name of the job.
+      image: The image that the job ran in.
+      runtime: How long the job ran for, in seconds. """
+    key = (name, image)
+    runtimes = self.__runtimes.get(key)
+    if runtimes is None:
+      runtimes = deque(maxlen=self.__history)
+      self.__runtimes[key] = runtimes
+
+    runtimes.append(runtime)
+    self.__dirty = True
+
+  def estimate(self, name, image):
+    """ Estimates how long a job will take to run. This errs on the side of
+    caution, and uses the longest recent runtime.
+    Args:
+      name: The name of the job.
+      image: The image that the job runs in.
+    Returns:
+      The estimated runtime, in seconds, or None if we have never seen this kind
+      of job before. """
+    runtimes = self.__runtimes.get((name, image))
+    if not runtimes:
+      return None
+    return max(runtimes)
+
+  def save(self):
+    """ Saves the recorded runtimes, if anything changed. """
+    if not self.__path or not self.__dirty:
+      return
+
+    saved = [[name, image, list(runtimes)] \
+             for (name, image), runtimes in self.__runtimes.items()]
+    temp_path = self.__path + ".tmp"
+    with open(temp_path, "w") as runtimes_file:
+      runtimes_file.write(json.dumps(saved))
+    os.replace(temp_path, self.__path)
+
+    self.__dirty = False
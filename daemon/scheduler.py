@@ -0,0 +1,559 @@
+from collections import deque
+import heapq
+
+
+""" Data structures for quickly finding pending jobs that can be run. """
+
+
+def fits(requirements, remaining):
+  """ Checks whether a set of requirements fits in the remaining resources.
+  Args:
+    requirements: The requirement vector to check.
+    remaining: The vector of remaining resources.
+  Returns:
+    True if every requirement is no larger than what is remaining. """
+  for needed, available in zip(requirements, remaining):
+    if needed > available:
+      return False
+
+  return True
+
+
+def choose_gpus(count, gpu, vram, gpu_usage, vram_usage, total_vram):
+  """ Chooses GPUs for a job, using best-fit bin packing. Of the GPUs that the
+  job fits on, we choose the ones that it leaves the least room on, so that
+  we keep larger holes available for larger jobs.
+  Args:
+    count: The number of GPUs that the job needs.
+    gpu: The percentage of each GPU that the job needs.
+    vram: The amount of VRAM on each GPU that the job needs.
+    gpu_usage: The current usage percentage of each GPU.
+    vram_usage: The current VRAM usage of each GPU, in bytes.
+    total_vram: The total VRAM of each GPU, in bytes.
+  Returns:
+    A tuple of the IDs of the chosen GPUs, or None if the job doesn't fit. """
+  if not count:
+    return ()
+
+  fitting = []
+  for gpu_id, device_vram in enumerate(total_vram):
+    gpu_left = 100 - gpu_usage[gpu_id] - gpu
+    vram_left = device_vram - vram_usage[gpu_id] - vram
+    if gpu_left < 0 or vram_left < 0:
+      continue
+
+    # Weight both resources equally.
+    slack = gpu_left / 100 + vram_left / device_vram
+    fitting.append((slack, gpu_id))
+
+  if len(fitting) < count:
+    return None
+
+  fitting.sort()
+  return tuple(sorted([gpu_id for _, gpu_id in fitting[:count]]))
+
+
+# Maps the names of scheduling policies to how many blocked jobs get a reserved
+# start time in each scheduling pass. Conservative backfill would give every
+# blocked job a reservation, but that gets expensive with many distinct kinds
+# of job in the queue, so it is capped.
+RESERVATIONS = {"greedy": 0, "easy": 1, "conservative": 32}
+
+
+class Planner:
+  """ Decides where pending jobs can be started during a single scheduling
+  pass. With the greedy policy, any job that fits is started. Otherwise, the
+  first jobs that don't fit get a reserved start time, based on when running
+  jobs are expected to finish, and later jobs are only started if they don't
+  delay any of those reservations. This is backfill scheduling, and it keeps
+  a stream of small jobs from starving large ones. """
+
+  def __init__(self, now, usage, total_vram, running, max_reservations=0):
+    """
+    Args:
+      now: The current time.
+      usage: The current usage, as a tuple of the CPU and RAM usage
+      percentages, and lists of the usage percentage and VRAM usage of each
+      GPU.
+      total_vram: The total VRAM of each GPU, in bytes.
+      running: A list of (end time, requirements, GPUs) tuples for the running
+      jobs, where the end time is when the job is expected to finish, or
+      infinity if we don't know.
+      max_reservations: The maximum number of jobs to reserve start times for.
+      If this is zero, scheduling is greedy. """
+    self.__now = now
+    cpu, ram, gpu_usage, vram_usage = usage
+    self.__usage = (cpu, ram, list(gpu_usage), list(vram_usage))
+    self.__total_vram = total_vram
+    # Jobs that are running, including ones that were started during this
+    # pass. Jobs that are past their expected end time are assumed to be about
+    # to finish.
+    self.__running = [(max(end, now), requirements, gpus) \
+                      for end, requirements, gpus in running]
+    self.__max_reservations = max_reservations
+    # Reserved (start time, end time, requirements, GPUs) tuples.
+    self.__reservations = []
+    # The (requirements, GPUs) being held for a particular job, if any.
+    self.__held = None
+    # Incremented whenever the current usage changes, so that has_room() can
+    # remember its answer until then.
+    self.__version = 0
+    # The (version, smallest requirements, answer) of the last has_room() call.
+    self.__room = None
+
+  def __get_usage_at(self, time):
+    """ Predicts the resource usage at some point in the future.
+    Args:
+      time: The time to predict the usage at.
+    Returns:
+      The predicted usage, in the same format as the current usage. """
+    cpu, ram, gpu_usage, vram_usage = self.__usage
+    if time <= self.__now:
+      return self.__usage
+
+    gpu_usage = list(gpu_usage)
+    vram_usage = list(vram_usage)
+    changes = [(requirements, gpus, -1) \
+               for end, requirements, gpus in self.__running if end <= time]
+    changes.extend([(requirements, gpus, 1) \
+                    for start, end, requirements, gpus in self.__reservations \
+                    if start <= time < end])
+    for (job_cpu, job_ram, _, job_gpu, job_vram), gpus, sign in changes:
+      cpu += sign * job_cpu
+      ram += sign * job_ram
+      for gpu_id in gpus:
+        gpu_usage[gpu_id] += sign * job_gpu
+        vram_usage[gpu_id] += sign * job_vram
+
+    return cpu, ram, gpu_usage, vram_usage
+
+  def __fit(self, requirements, start, duration):
+    """ Finds GPUs that a job can run on for a period of time.
+    Args:
+      requirements: The requirement vector for the job.
+      start: When the job would start.
+      duration: How long the job would run for.
+    Returns:
+      A tuple of the IDs of the GPUs, or None if the job doesn't fit. """
+    job_cpu, job_ram, count, job_gpu, job_vram = requirements
+
+    # Usage only ever goes up when a reservation starts, so those are the only
+    # points after the start that we have to check.
+    times = [start]
+    times.extend([other_start \
+                  for other_start, _, _, _ in self.__reservations \
+                  if start < other_start < start + duration])
+
+    cpu, ram, gpu_usage, vram_usage = self.__get_usage_at(times[0])
+    for time in times[1:]:
+      # Take the highest usage over the whole period.
+      next_cpu, next_ram, next_gpu, next_vram = self.__get_usage_at(time)
+      cpu = max(cpu, next_cpu)
+      ram = max(ram, next_ram)
+      gpu_usage = [max(a, b) for a, b in zip(gpu_usage, next_gpu)]
+      vram_usage = [max(a, b) for a, b in zip(vram_usage, next_vram)]
+
+    if job_cpu > 100 - cpu or job_ram > 100 - ram:
+      return None
+    return choose_gpus(count, job_gpu, job_vram, gpu_usage, vram_usage,
+                       self.__total_vram)
+
+  def __reserve(self, requirements, duration):
+    """ Reserves the earliest possible start time for a job that can't start
+    now.
+    Args:
+      requirements: The requirement vector for the job.
+      duration: How long the job is expected to run for. """
+    # A job can only start once something else has finished.
+    ends = set([end for end, _, _ in self.__running])
+    ends.update([end for _, end, _, _ in self.__reservations])
+    for start in sorted(ends):
+      if start <= self.__now:
+        # We already know it doesn't fit now.
+        continue
+      if start == float("inf"):
+        # We don't know when there will be room for the job, so there's no
+        # point in holding anything back for it.
+        break
+
+      gpus = self.__fit(requirements, start, duration)
+      if gpus is not None:
+        self.__reservations.append((start, start + duration, requirements,
+                                    gpus))
+        break
+
+  def __add_usage(self, requirements, gpus, sign):
+    """ Adds to or removes from the current usage.
+    Args:
+      requirements: The requirement vector for a job.
+      gpus: The GPUs that the job runs on.
+      sign: 1 to add the usage of the job, or -1 to remove it. """
+    job_cpu, job_ram, _, job_gpu, job_vram = requirements
+    cpu, ram, gpu_usage, vram_usage = self.__usage
+    for gpu_id in gpus:
+      gpu_usage[gpu_id] += sign * job_gpu
+      vram_usage[gpu_id] += sign * job_vram
+    self.__usage = (cpu + sign * job_cpu, ram + sign * job_ram, gpu_usage,
+                    vram_usage)
+    self.__version += 1
+
+  def has_room(self, smallest):
+    """ Checks whether a job could still be placed now. Reservations only ever
+    take away room, so if the current usage doesn't leave enough for even the
+    smallest job, nothing else can be placed during this pass. This is cheap
+    to call again until the usage changes.
+    Args:
+      smallest: The smallest value of each requirement over the pending jobs.
+    Returns:
+      False if no job that needs at least that much can fit. """
+    if self.__room is not None and self.__room[:2] == (self.__version,
+                                                        smallest):
+      return self.__room[2]
+
+    cpu, ram, gpu_usage, vram_usage = self.__usage
+    gpu_usage = list(gpu_usage)
+    vram_usage = list(vram_usage)
+    if self.__held is not None:
+      # These go to the job that they are held for, once it is placed.
+      (held_cpu, held_ram, _, held_gpu, held_vram), held_gpus = self.__held
+      cpu -= held_cpu
+      ram -= held_ram
+      for gpu_id in held_gpus:
+        gpu_usage[gpu_id] -= held_gpu
+        vram_usage[gpu_id] -= held_vram
+
+    min_cpu, min_ram, min_count, min_gpu, min_vram = smallest
+    room = min_cpu <= 100 - cpu and min_ram <= 100 - ram
+    if room and min_count:
+      free = [gpu_id for gpu_id, device_vram in enumerate(self.__total_vram) \
+              if min_gpu <= 100 - gpu_usage[gpu_id] and \
+                 min_vram <= device_vram - vram_usage[gpu_id]]
+      room = len(free) >= min_count
+
+    self.__room = (self.__version, smallest, room)
+    return room
+
+  def hold(self, requirements, gpus):
+    """ Holds resources for a job that can't start yet, for instance because
+    it is waiting for preempted jobs to exit, so that no other job can take
+    them in the meantime. They are released when that job is placed with
+    held=True.
+    Args:
+      requirements: The requirement vector for the job.
+      gpus: The GPUs to hold for the job. """
+    if self.__held is not None:
+      self.__release_held()
+
+    self.__held = (requirements, gpus)
+    self.__add_usage(requirements, gpus, 1)
+    self.__running.append((float("inf"), requirements, gpus))
+
+  def __release_held(self):
+    """ Releases the held resources. """
+    requirements, gpus = self.__held
+    self.__held = None
+    self.__add_usage(requirements, gpus, -1)
+    self.__running.remove((float("inf"), requirements, gpus))
+
+  def place(self, requirements, duration=None, held=False):
+    """ Decides whether a job can be started now.
+    Args:
+      requirements: The requirement vector for the job.
+      duration: How long the job is expected to run for, or None if we don't
+      know.
+      held: Whether this is the job that resources are being held for.
+    Returns:
+      A tuple of the IDs of the GPUs to start the job on, or None if it
+      shouldn't be started yet. """
+    if duration is None:
+      duration = float("inf")
+
+    held = held and self.__held is not None
+    if held:
+      held_requirements, held_gpus = self.__held
+      self.__release_held()
+
+    gpus = self.__fit(requirements, self.__now, duration)
+    if gpus is None:
+      if held:
+        # Keep holding on to them until the job does fit.
+        self.hold(held_requirements, held_gpus)
+      elif len(self.__reservations) < self.__max_reservations:
+        self.__reserve(requirements, duration)
+      return None
+
+    self.__add_usage(requirements, gpus, 1)
+    self.__running.append((self.__now + duration, requirements, gpus))
+
+    return gpus
+
+
+class PendingQueue:
+  """ A queue of pending jobs, ordered by priority, then by how much of the
+  machine their owner has been using, then by when they were added. Jobs with
+  the same owner, priority, requirement vector and image share a FIFO bucket,
+  so finding runnable jobs costs time proportional to the number of distinct
+  buckets, and not to the number of queued jobs. Parameter sweeps, where
+  thousands of jobs are identical, therefore only cost a single check. The
+  order of the buckets is kept in a heap between passes, so a pass that stops
+  early, because the machine is full, only looks at a few of them. """
+
+  def __init__(self):
+    # Maps (owner, priority, requirement vector, image) tuples to FIFO buckets
+    # of (sequence, job) pairs.
+    self.__buckets = {}
+    # Sequence number to assign to the next job. This is what lets us maintain
+    # FIFO order across buckets.
+    self.__next_sequence = 0
+    # Total number of jobs in all buckets.
+    self.__size = 0
+    # Maps owners to how many buckets they have.
+    self.__owners = {}
+
+    # Heap of (negative priority, share, sequence, key) tuples, with an entry
+    # for the first job of each bucket. Entries for jobs that are no longer
+    # first in their bucket are dropped when they come up.
+    self.__heap = []
+    # The shares that the heap is ordered by.
+    self.__heap_shares = {}
+
+    # The smallest value of each requirement over the buckets, or None if it
+    # hasn't been worked out. Buckets that were removed since it was worked
+    # out are still counted, so it can be too small, but never too big.
+    self.__smallest = None
+    # The number of buckets that were removed since then.
+    self.__removed = 0
+
+  def __len__(self):
+    return self.__size
+
+  def add(self, job, requirements, image=None, owner=None, priority=0,
+          sequence=None):
+    """ Adds a new job to the queue.
+    Args:
+      job: The job to add.
+      requirements: The requirement vector for the job. This must be hashable,
+      and is computed once, when the job is added.
+      image: The image that the job runs in.
+      owner: The owner of the job.
+      priority: The priority of the job. Jobs with higher priorities are
+      started first.
+      sequence: Optional number giving the position of the job in the queue.
+      This allows a job that was taken out of the queue to be put back in its
+      original place. By default, the job goes at the back. """
+    key = (owner, priority, requirements, image)
+    bucket = self.__buckets.get(key)
+    if bucket is None:
+      bucket = deque()
+      self.__buckets[key] = bucket
+      self.__owners[owner] = self.__owners.get(owner, 0) + 1
+      if self.__smallest is not None:
+        self.__smallest = tuple([min(values) for values in \
+                                 zip(self.__smallest, requirements)])
+
+    if sequence is None:
+      sequence = self.__next_sequence
+    self.__next_sequence = max(self.__next_sequence, sequence + 1)
+
+    if not bucket or bucket[-1][0] < sequence:
+      bucket.append((sequence, job))
+    else:
+      # This is rare, so a linear search is fine.
+      position = 0
+      while bucket[position][0] < sequence:
+        position += 1
+      bucket.insert(position, (sequence, job))
+    self.__size += 1
+
+    if bucket[0][0] == sequence:
+      # It is the new first job of the bucket.
+      heapq.heappush(self.__heap, (-priority,
+                                   self.__heap_shares.get(owner, 0),
+                                   sequence, key))
+
+  def remove(self, job, requirements, image=None, owner=None, priority=0):
+    """ Takes a job out of the queue without running it. This is rare, so it
+    takes time proportional to the number of jobs in its bucket.
+    Args:
+      job: The job to remove.
+      requirements: The requirement vector that the job was added with.
+      image: The image that the job was added with.
+      owner: The owner that the job was added with.
+      priority: The priority that the job was added with.
+    Returns:
+      True if the job was in the queue. """
+    key = (owner, priority, requirements, image)
+    bucket = self.__buckets.get(key)
+    if bucket is None:
+      return False
+    for position, (_, queued_job) in enumerate(bucket):
+      if queued_job == job:
+        break
+    else:
+      return False
+
+    del bucket[position]
+    self.__size -= 1
+    if not bucket:
+      self.__remove_bucket(key)
+    elif position == 0:
+      # The entry for it in the heap is dropped when it comes up, so the new
+      # first job needs one.
+      heapq.heappush(self.__heap, (-priority,
+                                   self.__heap_shares.get(owner, 0),
+                                   bucket[0][0], key))
+    return True
+
+  def __remove_bucket(self, key):
+    """ Removes an empty bucket.
+    Args:
+      key: The key of the bucket. """
+    del self.__buckets[key]
+    owner = key[0]
+    self.__owners[owner] -= 1
+    if not self.__owners[owner]:
+      del self.__owners[owner]
+    self.__removed += 1
+
+  def get_num_buckets(self):
+    """
+    Returns:
+      The number of distinct buckets in the queue. """
+    return len(self.__buckets)
+
+  def get_images(self):
+    """
+    Returns:
+      A list of the distinct images used by pending jobs, ordered by the
+      highest priority, oldest job that uses each one. """
+    first = {}
+    for (_, priority, _, image), bucket in self.__buckets.items():
+      order = (-priority, bucket[0][0])
+      if image not in first or order < first[image]:
+        first[image] = order
+
+    return sorted(first, key=first.get)
+
+  def __get_smallest(self):
+    """
+    Returns:
+      The smallest value of each requirement over the buckets, or a value that
+      is smaller. """
+    if self.__smallest is None or self.__removed * 2 > len(self.__buckets):
+      # Too many of the buckets that it came from are gone for it to be
+      # useful.
+      self.__smallest = tuple([min(values) for values in \
+                               zip(*[key[2] for key in self.__buckets])])
+      self.__removed = 0
+    return self.__smallest
+
+  def pop_runnable(self, place, is_ready=None, get_share=None,
+                   has_room=None):
+    """ Removes all the jobs that can be run with the remaining resources. Jobs
+    are considered in order, and a job that doesn't fit is skipped over,
+    allowing later jobs that do fit to run.
+    Args:
+      place: Function that is called with the first job in a bucket and its
+      requirement vector. If the job can be started, it should reserve the
+      resources for it and return where it was placed. Otherwise, it should
+      return None, and the rest of the bucket is skipped. Remaining resources
+      must only go down while this method runs.
+      is_ready: Optional function that is called with an image, and returns
+      whether jobs using that image can be started yet. Jobs that can't are
+      only placed once every job that can has been tried, so that they use
+      resources that would otherwise be left idle.
+      get_share: Optional function that is called with an owner, and returns
+      how much of the machine they have been using relative to their fair
+      share. Jobs from owners with lower values are considered first, among
+      jobs with the same priority.
+      has_room: Optional function that is called with the smallest value of
+      each requirement over the queued jobs, before each job is placed. If it
+      returns False, no queued job can fit anymore, so we stop early instead
+      of trying every bucket once the machine is full. It should be cheap to
+      call until the remaining resources change.
+    Returns:
+      A list of (job, requirements, placement) tuples for the jobs that were
+      removed, in the order they should be started. """
+    if not self.__buckets:
+      return []
+
+    # Look up every owner once, so that the order stays the same during this
+    # pass.
+    shares = {}
+    if get_share:
+      for owner in self.__owners:
+        shares[owner] = get_share(owner)
+    if shares != self.__heap_shares:
+      # The order changed, so the heap has to be rebuilt. Sequence numbers are
+      # unique, so the keys never get compared.
+      self.__heap = [(-key[1], shares.get(key[0], 0), bucket[0][0], key) \
+                     for key, bucket in self.__buckets.items()]
+      heapq.heapify(self.__heap)
+      self.__heap_shares = shares
+
+    smallest = None
+    if has_room:
+      smallest = self.__get_smallest()
+
+    # Entries for buckets that were looked at, but that we didn't take a job
+    # from. They go back in the heap for the next pass.
+    skipped = []
+    # Entries for buckets whose images aren't ready yet.
+    waiting = []
+    runnable = []
+
+    def take(candidates, is_ready):
+      """ Places jobs, in order, until there are no more candidates.
+      Args:
+        candidates: The heap of buckets to take jobs from.
+        is_ready: The function to check images with, or None to start jobs
+        whatever their images.
+      Returns:
+        False if it stopped early because nothing else fits. """
+      while candidates:
+        if smallest is not None and not has_room(smallest):
+          return False
+
+        entry = heapq.heappop(candidates)
+        neg_priority, share, sequence, key = entry
+        bucket = self.__buckets.get(key)
+        if bucket is None or bucket[0][0] != sequence:
+          # This job isn't first in its bucket anymore.
+          continue
+
+        _, _, requirements, image = key
+        if is_ready and not is_ready(image):
+          waiting.append(entry)
+          continue
+
+        placement = place(bucket[0][1], requirements)
+        # Remaining resources only ever go down here, so once a bucket doesn't
+        # fit, it won't fit again until the next call.
+        if placement is None:
+          skipped.append(entry)
+          continue
+
+        _, job = bucket.popleft()
+        self.__size -= 1
+        runnable.append((job, requirements, placement))
+
+        if bucket:
+          heapq.heappush(candidates,
+                         (neg_priority, share, bucket[0][0], key))
+        else:
+          self.__remove_bucket(key)
+
+      return True
+
+    if take(self.__heap, is_ready) and waiting:
+      # None of the jobs with images that are ready can use what is left.
+      # Rather than leaving it idle, jobs that are waiting for their images get
+      # to start, in order, and their containers pull the images when they are
+      # created.
+      heapq.heapify(waiting)
+      take(waiting, None)
+
+    for entry in skipped + waiting:
+      heapq.heappush(self.__heap, entry)
+
+    return runnable
@@ -1,63 +1,515 @@
 #!/usr/bin/python3
 
 
-from multiprocessing import Queue
-from queue import Empty
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import functools
 import logging
-import time
+import os
+import resource
+import socket
 
 
+from admission import AdmissionPipeline
+from control import ControlPlane, DEFAULT_SOCKET
+from fairshare import FairShare
+from images import ImageCache
+from launcher import Launcher
 from manager import Manager
-
-import server
+from metrics import Metrics, TimedHandler
+from overcommit import Overcommit
+from persistence import StateStore
+from runtimes import RuntimeEstimates
+from scheduler import RESERVATIONS
+from telemetry import ContainerTelemetry, GpuTelemetry
+from topology import CpuAllocator, read_topology
+from worker import Reporter
+import nvidia
+import output
 
 
 """ Main file for the stoplight daemon. """
 
 
-def init_logging(logfile):
+logger = logging.getLogger(__name__)
+
+
+class Daemon:
+  """ Runs the manager whenever something interesting happens, instead of on a
+  fixed timer. The manager is woken up when jobs are added, when a job exits,
+  when an image finishes downloading, or when a job finishes starting. Job
+  output is copied as soon as it arrives. A timer is only used as a
+  fallback. """
+
+  def __init__(self, manager, pipeline, poll_interval):
+    """
+    Args:
+      manager: The manager to run, or None if it is made once the daemon is
+      running. See run().
+      pipeline: The AdmissionPipeline to load new jobs with.
+      poll_interval: The maximum amount of time, in seconds, to wait between
+      updates if nothing happens. """
+    self.__manager = manager
+    self.__pipeline = pipeline
+    self.__poll_interval = poll_interval
+
+    # Batches of jobs that have been loaded, but not yet added to the manager.
+    # Each is a (future, owner, priority, loaded jobs) tuple, where the future
+    # gets the results.
+    self.__loaded_batches = deque()
+    # Maps the output file descriptors that we are watching to their jobs.
+    self.__watched_fds = {}
+    # Resolved the next time that a job changes, if anyone is waiting for that.
+    self.__changed = None
+    # The cursor of the job index the last time that we checked it.
+    self.__cursor = None
+
+    self.__loop = None
+    self.__wake_event = None
+
+  def __on_batch_loaded(self, future, owner, priority, loaded_jobs):
+    """ Called from a pipeline thread when a batch of jobs has been loaded.
+    Args:
+      future: The future to set to the results.
+      owner: The owner of the jobs.
+      priority: The priority of the jobs, or None.
+      loaded_jobs: The results from the pipeline. """
+    self.__loaded_batches.append((future, owner, priority, loaded_jobs))
+    self.wake()
+
+  def add_jobs(self, job_dirs, owner=None, priority=None):
+    """ Adds a batch of jobs. They are loaded in the background, and then added
+    to the manager all at once.
+    Args:
+      job_dirs: The directories of the jobs.
+      owner: Optional owner of the jobs.
+      priority: Optional priority for the jobs, which overrides the ones in
+      their job.yaml files.
+    Returns:
+      A future, which is set to a list with an entry for each job directory,
+      in the same order. Each entry is either a list of the IDs of the jobs
+      that were added from it, or the reason that it was rejected. """
+    future = self.__loop.create_future()
+    self.__pipeline.submit(job_dirs,
+                           functools.partial(self.__on_batch_loaded, future,
+                                             owner, priority))
+    return future
+
+  def is_starting(self):
+    """
+    Returns:
+      True if the manager is still being made. Jobs can already be added, but
+      nothing can be queried yet. """
+    return self.__manager is None
+
+  def get_index(self):
+    """
+    Returns:
+      The JobIndex with the states of jobs, or None if the daemon is still
+      starting. """
+    if self.__manager is None:
+      return None
+    return self.__manager.get_index()
+
+  def collect_metrics(self):
+    """
+    Returns:
+      A snapshot of the metrics, as returned by Manager.collect_metrics(), or
+      None if the daemon is still starting. """
+    if self.__manager is None:
+      return None
+    return self.__manager.collect_metrics()
+
+  async def wait_for_changes(self, since, timeout):
+    """ Waits until there are changes to jobs after a point in the feed of the
+    job index.
+    Args:
+      since: The cursor of the point in the feed.
+      timeout: The longest to wait, in seconds. """
+    index = self.__manager.get_index()
+    deadline = self.__loop.time() + timeout
+    while index.get_cursor() <= since:
+      remaining = deadline - self.__loop.time()
+      if remaining <= 0:
+        return
+
+      if self.__changed is None:
+        self.__changed = self.__loop.create_future()
+      try:
+        # This is shared by all the waiters, so it can't be cancelled by any
+        # of them timing out.
+        await asyncio.wait_for(asyncio.shield(self.__changed), remaining)
+      except asyncio.TimeoutError:
+        return
+
+  def __notify_changes(self):
+    """ Wakes up everything waiting for jobs to change, if any did. """
+    cursor = self.__manager.get_index().get_cursor()
+    if cursor == self.__cursor:
+      return
+
+    self.__cursor = cursor
+    if self.__changed is not None:
+      self.__changed.set_result(None)
+      self.__changed = None
+
+  def __admit_loaded_batches(self):
+    """ Adds any jobs that have finished loading to the manager. """
+    while self.__loaded_batches:
+      future, owner, priority, loaded_jobs = self.__loaded_batches.popleft()
+
+      results = self.__manager.admit_jobs(loaded_jobs, owner=owner,
+                                          priority=priority)
+      if not future.done():
+        future.set_result(results)
+
+  def __on_output(self, job):
+    """ Called when there is new output from a job.
+    Args:
+      job: The job. """
+    fd = job.get_output_fd()
+    job.pump_output()
+
+    if job.get_output_fd() != fd:
+      # The output ended, so there is a new file descriptor to watch for the
+      # job exiting, or the job exited.
+      self.__wake_event.set()
+
+  def __update_watched_fds(self):
+    """ Makes sure that we are watching exactly the output file descriptors of
+    the currently running jobs. """
+    fds = self.__manager.get_output_fds()
+
+    for fd, job in self.__watched_fds.items():
+      if fds.get(fd) is not job:
+        # This also covers the case where a file descriptor was closed, and the
+        # number was reused for a different job.
+        self.__loop.remove_reader(fd)
+    for fd, job in fds.items():
+      if self.__watched_fds.get(fd) is not job:
+        self.__loop.add_reader(fd, self.__on_output, job)
+
+    self.__watched_fds = fds
+
+  def wake(self):
+    """ Makes the daemon update the manager as soon as possible. This can be
+    called from any thread. """
+    if self.__loop:
+      self.__loop.call_soon_threadsafe(self.__wake_event.set)
+
+  async def __wait_for_event(self):
+    """ Waits until something happens, or until the poll interval elapses. """
+    try:
+      await asyncio.wait_for(self.__wake_event.wait(), self.__poll_interval)
+    except asyncio.TimeoutError:
+      pass
+
+    self.__wake_event.clear()
+
+  async def __run(self, on_start, make_manager):
+    """ Runs the main loop.
+    Args:
+      on_start: Optional coroutine function to await before the first
+      update.
+      make_manager: Optional function to make the manager with, in a
+      thread. """
+    self.__loop = asyncio.get_running_loop()
+    self.__wake_event = asyncio.Event()
+    if on_start:
+      await on_start()
+    if make_manager:
+      # Requests are answered while this runs, and jobs that are added in the
+      # meantime are queued up until the manager is ready.
+      self.__manager = await self.__loop.run_in_executor(None, make_manager)
+      logger.info("The daemon is ready.")
+
+    while True:
+      self.__admit_loaded_batches()
+      self.__manager.update()
+      self.__update_watched_fds()
+      self.__notify_changes()
+
+      await self.__wait_for_event()
+
+  def run(self, on_start=None, make_manager=None):
+    """ Runs the daemon forever.
+    Args:
+      on_start: Optional coroutine function that is awaited in the event loop
+      before the first update, to start anything else that runs in it, such
+      as the control plane.
+      make_manager: Function that makes the manager, if the daemon was made
+      without one. It is called in a thread once on_start is done, since
+      finding the GPUs and recovering the saved jobs can take a while, and
+      the control plane can already answer requests in the meantime. """
+    asyncio.run(self.__run(on_start, make_manager))
+
+
+def _raise_file_limit():
+  """ Raises the limit on open files as far as we are allowed to, since every
+  client connection takes up a file descriptor. """
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  if soft != hard:
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def init_logging(logfile, level=logging.DEBUG, metrics=None):
   """ Initializes logging.
   Args:
-    logfile: File that stuff will be logged to. """
+    logfile: File that stuff will be logged to.
+    level: The minimum level of messages to log. Messages below this level are
+    dropped before they are formatted.
+    metrics: Optional metrics.Metrics to record the cost of logging in. """
   root = logging.getLogger()
-  root.setLevel(logging.DEBUG)
+  root.setLevel(level)
 
   file_handler = logging.FileHandler(logfile)
-  file_handler.setLevel(logging.DEBUG)
+  file_handler.setLevel(level)
   stream_handler = logging.StreamHandler()
-  stream_handler.setLevel(logging.DEBUG)
+  stream_handler.setLevel(level)
 
   formatter = logging.Formatter("%(name)s@%(asctime)s: " +
       "[%(levelname)s] %(message)s")
   file_handler.setFormatter(formatter)
   stream_handler.setFormatter(formatter)
 
-  root.addHandler(file_handler)
-  root.addHandler(stream_handler)
+  for handler in (file_handler, stream_handler):
+    if metrics:
+      handler = TimedHandler(handler, metrics)
+    root.addHandler(handler)
 
 def main():
+  # Parse arguments.
+  parser = argparse.ArgumentParser(description="The stoplight daemon.")
+  parser.add_argument("--log-level", default="debug",
+                      choices=("debug", "info", "warning", "error"),
+                      help="Minimum level of messages to log.")
+  parser.add_argument("--host", default="127.0.0.1",
+                      help="Address for the server to listen on.")
+  parser.add_argument("--port", type=int, default=5000,
+                      help="Port for the server to listen on.")
+  parser.add_argument("--socket", default=DEFAULT_SOCKET,
+                      help="Unix domain socket for local clients to connect" \
+                           " to. Empty to disable.")
+  parser.add_argument("--trust-owner", action="store_true",
+                      help="Believe the owner that clients send with jobs" \
+                           " over HTTP. Only use this if the server can only" \
+                           " be reached by trusted clients, such as a" \
+                           " coordinator. Otherwise, jobs added over HTTP" \
+                           " belong to the owners of their directories.")
+  parser.add_argument("--poll-interval", type=float, default=5.0,
+                      help="Maximum number of seconds to wait between" \
+                           " updates when nothing happens.")
+  parser.add_argument("--measure-gpu-usage", action="store_true",
+                      help="Place jobs based on the measured GPU usage" \
+                           " instead of what running jobs declared.")
+  parser.add_argument("--telemetry-interval", type=float, default=1.0,
+                      help="Seconds between GPU and container usage samples.")
+  parser.add_argument("--overcommit", type=float, metavar="RATIO",
+                      help="Place jobs based on the measured CPU and RAM usage" \
+                           " of running jobs, letting what they declared add" \
+                           " up to this multiple of the machine, such as 1.5." \
+                           " Implies --enforce-limits.")
+  parser.add_argument("--overcommit-headroom", type=float, default=10.0,
+                      help="Percentage of the CPU and RAM to keep free on top" \
+                           " of the measured usage when overcommitting.")
+  parser.add_argument("--enforce-limits", action="store_true",
+                      help="Limit the containers of jobs to the CPU and RAM" \
+                           " that they declared.")
+  parser.add_argument("--default-cpu-usage", type=float, default=100,
+                      help="CPU, in percent of a core, that jobs which don't" \
+                           " declare a CpuUsage are counted as using and" \
+                           " limited to, when overcommitting or enforcing" \
+                           " limits.")
+  parser.add_argument("--default-ram-usage", type=int, default=2 ** 30,
+                      help="RAM, in bytes, that jobs which don't declare a" \
+                           " RamUsage are counted as using and limited to," \
+                           " when overcommitting or enforcing limits.")
+  parser.add_argument("--pin-cpus", action="store_true",
+                      help="Pin each job to its own contiguous set of CPU" \
+                           " cores, and its memory to their NUMA node," \
+                           " preferring the node that its GPUs are attached" \
+                           " to.")
+  parser.add_argument("--max-output-size", type=int, default=0,
+                      help="Rotate job.out and job.err when they get bigger" \
+                           " than this many bytes. 0 means never.")
+  parser.add_argument("--output-backups", type=int, default=3,
+                      help="Number of rotated output files to keep.")
+  parser.add_argument("--compress-output", action="store_true",
+                      help="Compress rotated output files.")
+  parser.add_argument("--admission-workers", type=int, default=4,
+                      help="Number of threads to load new jobs with.")
+  parser.add_argument("--launch-workers", type=int, default=4,
+                      help="Maximum number of job containers to start at once," \
+                           " in the background. 0 means containers are" \
+                           " started one at a time, in the scheduling loop.")
+  parser.add_argument("--state-dir", default="stoplight_state",
+                      help="Directory to save the job queue in, so that it" \
+                           " survives restarts. Empty to disable.")
+  parser.add_argument("--policy", choices=sorted(RESERVATIONS),
+                      default="greedy",
+                      help="Scheduling policy. greedy starts any job that" \
+                           " fits. easy and conservative use backfill, which" \
+                           " only starts jobs out of order if that doesn't" \
+                           " delay jobs that are waiting for resources.")
+  parser.add_argument("--preempt-signal", metavar="SIGNAL",
+                      help="Allow jobs to be preempted by pending jobs with a" \
+                           " higher priority. Preempted jobs are sent this" \
+                           " signal, such as SIGTERM or SIGUSR1, so they can" \
+                           " checkpoint, and are then requeued.")
+  parser.add_argument("--preempt-grace", type=float, default=60.0,
+                      help="Seconds that preempted jobs have to exit before" \
+                           " they are killed.")
+  parser.add_argument("--fair-share-half-life", type=float, default=168.0,
+                      help="How long it takes, in hours, for past GPU usage" \
+                           " to count half as much towards fair-share.")
+  parser.add_argument("--share", action="append", default=[],
+                      metavar="OWNER=WEIGHT",
+                      help="Give a user a bigger or smaller share of the" \
+                           " machine. Users that aren't listed have a" \
+                           " weight of 1. Can be given more than once.")
+  parser.add_argument("--image-pulls", type=int, default=2,
+                      help="Maximum number of images to pull ahead of time" \
+                           " at once. 0 means images are only pulled when" \
+                           " jobs start.")
+  parser.add_argument("--image-lookahead", type=int, default=4,
+                      help="Number of missing images, nearest the front of" \
+                           " the queue, to pull ahead of time.")
+  parser.add_argument("--image-disk-budget", type=int, default=0,
+                      help="Remove least recently used images when they take" \
+                           " up more than this many bytes. 0 means never.")
+  parser.add_argument("--coordinator", metavar="HOST:PORT",
+                      help="Run as a worker in a cluster, taking jobs from" \
+                           " the coordinator at this address.")
+  parser.add_argument("--worker-name", default=socket.gethostname(),
+                      help="Name of this worker, which must be unique in the" \
+                           " cluster.")
+  parser.add_argument("--advertise", metavar="HOST:PORT",
+                      help="Address that the coordinator can reach the" \
+                           " server at. Defaults to the address that it" \
+                           " listens on.")
+  parser.add_argument("--heartbeat-interval", type=float, default=2.0,
+                      help="Maximum number of seconds between heartbeats to" \
+                           " the coordinator.")
+  args = parser.parse_args()
+
+  weights = {}
+  for share in args.share:
+    owner, _, weight = share.partition("=")
+    try:
+      weights[owner] = float(weight)
+    except ValueError:
+      parser.error("Invalid share: '%s'." % (share))
+
+  metrics = Metrics()
+
   # Initialize logging.
-  init_logging("stoplightd.log")
+  init_logging("stoplightd.log", level=getattr(logging, args.log_level.upper()),
+               metrics=metrics)
 
-  # Start the server.
-  server_queue = Queue()
-  server.start(server_queue)
+  # Find the GPUs while everything else starts up. They don't change until the
+  # machine reboots, so they are cached in the state directory.
+  gpu_cache_path = None
+  if args.state_dir:
+    os.makedirs(args.state_dir, exist_ok=True)
+    gpu_cache_path = os.path.join(args.state_dir, "gpus.json")
+  probe_executor = ThreadPoolExecutor(max_workers=1)
+  gpu_probe = probe_executor.submit(nvidia.enumerate_gpus, gpu_cache_path)
+  probe_executor.shutdown(wait=False)
 
-  # Create and run the manager.
-  manager = Manager()
-  while True:
-    # Check for new jobs and add them.
-    try:
-      command = server_queue.get(block=False)
-      if command["type"] == "add_job":
-        # Add the job.
-        manager.add_job(command["job_dir"])
+  telemetry = None
+  if args.measure_gpu_usage:
+    telemetry = GpuTelemetry(interval=args.telemetry_interval)
+    telemetry.start()
 
-    except Empty:
-      pass
+  container_telemetry = None
+  overcommit = None
+  if args.overcommit:
+    if args.overcommit < 1:
+      parser.error("--overcommit must be at least 1.")
+    container_telemetry = ContainerTelemetry(interval=args.telemetry_interval)
+    container_telemetry.start()
+    overcommit = Overcommit(max_ratio=args.overcommit,
+                            headroom=args.overcommit_headroom)
+
+  rotation = output.Rotation(args.max_output_size,
+                             backups=args.output_backups,
+                             compress=args.compress_output)
+
+  store = None
+  runtimes_path = None
+  fair_share_path = None
+  if args.state_dir:
+    store = StateStore(args.state_dir)
+    runtimes_path = os.path.join(args.state_dir, "runtimes.json")
+    fair_share_path = os.path.join(args.state_dir, "fairshare.json")
+  runtimes = RuntimeEstimates(runtimes_path)
+  fair_share = FairShare(half_life=args.fair_share_half_life * 3600,
+                         weights=weights, path=fair_share_path)
+
+  images = None
+  if args.image_pulls:
+    images = ImageCache(max_pulls=args.image_pulls,
+                        lookahead=args.image_lookahead,
+                        disk_budget=args.image_disk_budget)
+
+  launcher = None
+  if args.launch_workers:
+    launcher = Launcher(workers=args.launch_workers)
+
+  reporter = None
+  if args.coordinator:
+    advertise = args.advertise
+    if not advertise:
+      host = args.host
+      if host in ("0.0.0.0", "::", ""):
+        host = socket.getfqdn()
+      advertise = "%s:%d" % (host, args.port)
+    reporter = Reporter(args.coordinator, args.worker_name, advertise,
+                        interval=args.heartbeat_interval)
+    reporter.start()
+
+  def make_manager():
+    """ Makes the manager. This waits for the GPUs to be found, and recovers
+    the saved jobs, so it runs once the control plane is already listening.
+    Returns:
+      The Manager. """
+    gpus = gpu_probe.result()
+    cpu_allocator = None
+    if args.pin_cpus:
+      cpu_allocator = CpuAllocator(read_topology(gpus))
+
+    return Manager(telemetry=telemetry, rotation=rotation, store=store,
+                   images=images, policy=args.policy, runtimes=runtimes,
+                   fair_share=fair_share,
+                   preempt_signal=args.preempt_signal,
+                   preempt_grace=args.preempt_grace,
+                   gpus=gpus,
+                   metrics=metrics, reporter=reporter,
+                   container_telemetry=container_telemetry,
+                   overcommit=overcommit,
+                   enforce_limits=args.enforce_limits or bool(overcommit),
+                   launcher=launcher, cpu_allocator=cpu_allocator,
+                   default_cpu=args.default_cpu_usage,
+                   default_ram=args.default_ram_usage)
+
+  pipeline = AdmissionPipeline(workers=args.admission_workers)
+  daemon = Daemon(None, pipeline, args.poll_interval)
+  if images:
+    # Start jobs as soon as their images are ready.
+    images.set_callback(daemon.wake)
+  if launcher:
+    # Jobs that finished starting are moved to the running jobs right away.
+    launcher.set_callback(daemon.wake)
 
-    manager.update()
-    time.sleep(5)
+  # The control plane runs in the same event loop as the daemon, so it can
+  # answer requests straight from the state of the manager.
+  _raise_file_limit()
+  control_plane = ControlPlane(daemon, host=args.host, port=args.port,
+                               socket_path=args.socket or None,
+                               trust_owner=args.trust_owner)
+  logger.info("Starting control plane on %s:%d." % (args.host, args.port))
+  daemon.run(on_start=control_plane.start, make_manager=make_manager)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,391 @@
+from collections import deque
+import array
+import logging
+import os
+import subprocess
+import threading
+import time
+
+import docker
+import nvidia
+import util
+
+
+""" Samples the actual resource usage of the GPUs and of running containers in
+the background. """
+
+
+logger = logging.getLogger(__name__)
+
+
+# The longest to wait before restarting nvidia-smi, in seconds, when it keeps
+# failing.
+_MAX_RESTART_DELAY = 60.0
+
+
+class GpuTelemetry:
+  """ Keeps track of recent GPU utilization and memory usage. This uses a single
+  long-running nvidia-smi process that prints a new sample periodically, instead
+  of starting a new process for every sample. """
+
+  def __init__(self, interval=1.0, history=10):
+    """
+    Args:
+      interval: How often to take a sample, in seconds.
+      history: How many samples to keep for each GPU. """
+    self.__interval = interval
+    self.__history = history
+    self.__nvidia_smi = util.get_path("nvidia-smi")
+
+    # Maps GPU IDs to recent (utilization, memory) samples.
+    self.__samples = {}
+    # Maps GPU IDs to when we last got a sample for them.
+    self.__last_sample_times = {}
+    # Protects the samples, since they are written from a different thread.
+    self.__lock = threading.Lock()
+
+    self.__process = None
+    self.__thread = None
+
+  def start(self):
+    """ Starts sampling in the background. """
+    self.__thread = threading.Thread(target=self.__run, daemon=True)
+    self.__thread.start()
+
+  def __run(self):
+    """ Runs the sampling process, restarting it if it dies. While it keeps
+    failing without producing any samples, we wait longer and longer before
+    restarting it. """
+    delay = self.__interval
+    while True:
+      try:
+        sampled = self.__sample()
+      except OSError as error:
+        logger.error("Failed to run nvidia-smi: %s" % (error))
+        sampled = False
+      except Exception:
+        # This would otherwise end the thread, and the samples would just
+        # stop, without anything saying why.
+        logger.exception("Unexpected error reading from nvidia-smi.")
+        sampled = False
+      else:
+        logger.error("nvidia-smi exited unexpectedly.")
+
+      if sampled:
+        delay = self.__interval
+      logger.info("Restarting nvidia-smi in %.1f s." % (delay))
+      time.sleep(delay)
+      delay = min(delay * 2, _MAX_RESTART_DELAY)
+
+  def __sample(self):
+    """ Starts nvidia-smi, and reads samples from it until it exits.
+    Returns:
+      True if we got any valid samples. """
+    command = [self.__nvidia_smi,
+               "--query-gpu=index,utilization.gpu,memory.used",
+               "--format=csv,noheader,nounits",
+               "-lms", str(int(self.__interval * 1000))]
+    logger.debug("Running command: %s" % (command))
+    self.__process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL,
+                                      universal_newlines=True)
+
+    sampled = False
+    try:
+      # Each line is a single sample for a single GPU.
+      for line in self.__process.stdout:
+        if self.__add_sample(line):
+          sampled = True
+    finally:
+      # If we stopped reading early, don't leave it running.
+      if self.__process.poll() is None:
+        self.__process.kill()
+      self.__process.stdout.close()
+      self.__process.wait()
+
+    return sampled
+
+  def __add_sample(self, line):
+    """ Parses a single line of output from nvidia-smi.
+    Args:
+      line: The line to parse.
+    Returns:
+      True if it was a valid sample. """
+    try:
+      gpu_id, utilization, memory = [field.strip() \
+                                     for field in line.split(",")]
+      gpu_id = int(gpu_id)
+      utilization = int(utilization)
+      memory = nvidia.parse_vram(memory)
+    except ValueError:
+      # This can happen if the value isn't available, in which case
+      # nvidia-smi prints something like "[N/A]".
+      logger.warning("Could not parse nvidia-smi sample: '%s'" % \
+                     (line.rstrip()))
+      return False
+
+    with self.__lock:
+      samples = self.__samples.get(gpu_id)
+      if samples is None:
+        samples = deque(maxlen=self.__history)
+        self.__samples[gpu_id] = samples
+
+      samples.append((utilization, memory))
+      self.__last_sample_times[gpu_id] = time.monotonic()
+
+    return True
+
+  def get_usage(self, gpu_id):
+    """ Gets the recent peak usage of a GPU. We use the peak instead of the
+    average, so that a job that just finished a spike isn't undercounted.
+    Args:
+      gpu_id: The ID of the GPU.
+    Returns:
+      The peak utilization percentage and the peak memory usage, in bytes,
+      over the recorded history, or None if we haven't gotten a sample
+      recently. """
+    with self.__lock:
+      samples = self.__samples.get(gpu_id)
+      if not samples:
+        return None
+      # If we missed a few samples, nvidia-smi is probably broken.
+      age = time.monotonic() - self.__last_sample_times[gpu_id]
+      if age > self.__interval * 3:
+        return None
+
+      utilization = max([sample[0] for sample in samples])
+      memory = max([sample[1] for sample in samples])
+
+    return utilization, memory
+
+
+def _read_cgroup_paths(pid, root="/"):
+  """ Finds the cgroups that a process is in.
+  Args:
+    pid: The process ID.
+    root: The root of the filesystem that /proc and /sys are under.
+  Returns:
+    The directory to read the CPU usage from, and the directory to read the
+    memory usage from. These are the same with cgroup v2. """
+  cgroup_root = os.path.join(root, "sys", "fs", "cgroup")
+  cpu_path = None
+  memory_path = None
+  unified_path = None
+  with open(os.path.join(root, "proc", str(pid), "cgroup")) as cgroup_file:
+    for line in cgroup_file:
+      # Each line looks like "hierarchy-ID:controllers:path".
+      _, controllers, path = line.rstrip("\n").split(":", 2)
+      path = path.lstrip("/")
+      if not controllers:
+        # The cgroup v2 unified hierarchy.
+        unified_path = os.path.join(cgroup_root, path)
+        continue
+
+      controllers = controllers.split(",")
+      if "cpuacct" in controllers:
+        cpu_path = os.path.join(cgroup_root, ",".join(controllers), path)
+        if not os.path.isdir(cpu_path):
+          cpu_path = os.path.join(cgroup_root, "cpuacct", path)
+      elif "memory" in controllers:
+        memory_path = os.path.join(cgroup_root, "memory", path)
+
+  if cpu_path is None or memory_path is None:
+    # On hybrid systems, the v1 controllers take precedence.
+    return unified_path, unified_path
+  return cpu_path, memory_path
+
+def _read_stat(path, key):
+  """ Reads a value from a cgroup file with a "key value" pair on each line.
+  Args:
+    path: The path to the file.
+    key: The key to read.
+  Returns:
+    The value, or 0 if it isn't there. """
+  with open(path) as stat_file:
+    for line in stat_file:
+      name, _, value = line.partition(" ")
+      if name == key:
+        return int(value)
+  return 0
+
+def _read_file(path):
+  """
+  Args:
+    path: The path to a cgroup file with a single number in it.
+  Returns:
+    The number. """
+  with open(path) as number_file:
+    return int(number_file.read())
+
+def read_cgroup_usage(cpu_path, memory_path):
+  """ Reads the resource usage of a cgroup.
+  Args:
+    cpu_path: The directory to read the CPU usage from.
+    memory_path: The directory to read the memory usage from.
+  Returns:
+    The total CPU time used so far, in seconds, and the memory in use, in
+    bytes. Memory that the kernel can just drop, like inactive file pages, is
+    not counted, the same as in docker stats. """
+  if os.path.exists(os.path.join(cpu_path, "cpu.stat")):
+    # cgroup v2.
+    cpu_time = _read_stat(os.path.join(cpu_path, "cpu.stat"),
+                          "usage_usec") / 1000000
+    memory = _read_file(os.path.join(memory_path, "memory.current")) - \
+             _read_stat(os.path.join(memory_path, "memory.stat"),
+                        "inactive_file")
+  else:
+    cpu_time = _read_file(os.path.join(cpu_path, "cpuacct.usage")) / \
+               1000000000
+    memory = _read_file(os.path.join(memory_path,
+                                     "memory.usage_in_bytes")) - \
+             _read_stat(os.path.join(memory_path, "memory.stat"),
+                        "total_inactive_file")
+
+  return cpu_time, max(memory, 0)
+
+
+class _ContainerHistory:
+  """ Recent usage samples for a single container. Samples are kept in
+  fixed-size ring buffers of floats, so each container only takes a few
+  hundred bytes, no matter how long it runs. """
+
+  __slots__ = ("name", "cpu_path", "memory_path", "cpu", "memory", "next",
+               "count", "last_cpu_time", "last_time", "peak_cpu",
+               "peak_memory")
+
+  def __init__(self, name, history):
+    """
+    Args:
+      name: The name of the container.
+      history: The number of samples to keep. """
+    self.name = name
+    # The cgroup directories, once we have found them.
+    self.cpu_path = None
+    self.memory_path = None
+
+    # CPU usage, in percent of a core, and memory usage, in bytes.
+    self.cpu = array.array("f", [0.0] * history)
+    self.memory = array.array("f", [0.0] * history)
+    # Where the next sample goes, and how many samples there are.
+    self.next = 0
+    self.count = 0
+    # The total CPU time at the last sample, and when that was.
+    self.last_cpu_time = None
+    self.last_time = None
+    # The peaks over the history, which are updated with every sample.
+    self.peak_cpu = 0.0
+    self.peak_memory = 0.0
+
+  def add(self, cpu, memory):
+    """ Adds a sample.
+    Args:
+      cpu: The CPU usage, in percent of a core.
+      memory: The memory usage, in bytes. """
+    self.cpu[self.next] = cpu
+    self.memory[self.next] = memory
+    self.next = (self.next + 1) % len(self.cpu)
+    self.count = min(self.count + 1, len(self.cpu))
+
+    self.peak_cpu = max(self.cpu[:self.count])
+    self.peak_memory = max(self.memory[:self.count])
+
+
+class ContainerTelemetry:
+  """ Keeps track of the recent CPU and memory usage of each running container,
+  by reading the counters in their cgroups. This is much cheaper than asking
+  docker for stats, and works with both cgroup v1 and v2. """
+
+  def __init__(self, interval=1.0, history=60, root="/", find_pid=None):
+    """
+    Args:
+      interval: How often to take a sample, in seconds.
+      history: How many samples to keep for each container.
+      root: The root of the filesystem that /proc and /sys are under.
+      find_pid: Optional function that takes the name of a container, and
+      returns the process ID of its main process. By default, docker is
+      asked. """
+    self.__interval = interval
+    self.__history = history
+    self.__root = root
+    self.__find_pid = find_pid or docker.get_container_pid
+
+    # Maps container names to _ContainerHistories.
+    self.__containers = {}
+    # Protects the containers, since they are sampled in a different thread.
+    self.__lock = threading.Lock()
+    self.__thread = None
+
+  def start(self):
+    """ Starts sampling in the background. """
+    self.__thread = threading.Thread(target=self.__run, daemon=True)
+    self.__thread.start()
+
+  def add(self, name):
+    """ Starts sampling a container.
+    Args:
+      name: The name of the container. """
+    with self.__lock:
+      self.__containers[name] = _ContainerHistory(name, self.__history)
+
+  def remove(self, name):
+    """ Stops sampling a container.
+    Args:
+      name: The name of the container. """
+    with self.__lock:
+      self.__containers.pop(name, None)
+
+  def __run(self):
+    """ Samples the containers, forever. """
+    while True:
+      with self.__lock:
+        containers = list(self.__containers.values())
+      for container in containers:
+        try:
+          self.__sample(container)
+        except (OSError, ValueError, docker.DockerError) as error:
+          # It probably exited. If not, we'll try again.
+          logger.debug("Failed to sample container '%s': %s" % \
+                       (container.name, error))
+          container.cpu_path = None
+
+      time.sleep(self.__interval)
+
+  def __sample(self, container):
+    """ Takes a sample for a single container.
+    Args:
+      container: The _ContainerHistory. """
+    if container.cpu_path is None:
+      pid = self.__find_pid(container.name)
+      if pid is None:
+        return
+      container.cpu_path, container.memory_path = \
+          _read_cgroup_paths(pid, root=self.__root)
+      container.last_cpu_time = None
+
+    now = time.monotonic()
+    cpu_time, memory = read_cgroup_usage(container.cpu_path,
+                                         container.memory_path)
+    with self.__lock:
+      if container.last_cpu_time is not None:
+        cpu = (cpu_time - container.last_cpu_time) / \
+              (now - container.last_time) * 100
+        container.add(max(cpu, 0.0), memory)
+      container.last_cpu_time = cpu_time
+      container.last_time = now
+
+  def get_usage(self, name):
+    """ Gets the recent peak usage of a container.
+    Args:
+      name: The name of the container.
+    Returns:
+      The peak CPU usage, in percent of a core, and the peak memory usage, in
+      bytes, over the recorded history, or None if we don't have a recent
+      sample. """
+    with self.__lock:
+      container = self.__containers.get(name)
+      if container is None or not container.count:
+        return None
+      if time.monotonic() - container.last_time > self.__interval * 3:
+        return None
+
+      return container.peak_cpu, container.peak_memory
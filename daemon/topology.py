@@ -0,0 +1,261 @@
+import glob
+import logging
+import os
+
+
+""" Finds out which CPU cores belong to which NUMA node, and which node each GPU
+is attached to, from sysfs, and hands out sets of cores to jobs so that they
+run close to their GPUs. Everything is read relative to a root directory, so
+that the parsing can be tried against a copy of the sysfs tree of another
+machine. """
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cpu_list(text):
+  """ Parses a list of CPUs in the format that the kernel uses, such as
+  "0-3,8-11".
+  Args:
+    text: The list.
+  Returns:
+    A sorted list of the CPU IDs. """
+  cpus = set()
+  for part in text.strip().split(","):
+    if not part:
+      continue
+    first, _, last = part.partition("-")
+    cpus.update(range(int(first), int(last or first) + 1))
+  return sorted(cpus)
+
+def format_cpu_list(cpus):
+  """ Formats a list of CPUs the way that the kernel and docker expect.
+  Args:
+    cpus: The CPU IDs.
+  Returns:
+    The list, with consecutive IDs collapsed into ranges, such as "0-3,8". """
+  ranges = []
+  for cpu in sorted(cpus):
+    if ranges and ranges[-1][1] == cpu - 1:
+      ranges[-1][1] = cpu
+    else:
+      ranges.append([cpu, cpu])
+  return ",".join([str(first) if first == last else "%d-%d" % (first, last) \
+                   for first, last in ranges])
+
+def _read_file(path):
+  """
+  Args:
+    path: The path to a sysfs file.
+  Returns:
+    The contents of the file, stripped, or None if it can't be read. """
+  try:
+    with open(path) as sysfs_file:
+      return sysfs_file.read().strip()
+  except OSError:
+    return None
+
+def _get_pci_path(root, bus_id):
+  """ Finds the sysfs directory of a PCI device.
+  Args:
+    root: The root of the filesystem that /sys is under.
+    bus_id: The PCI bus ID, as reported by nvidia-smi, such as
+    "00000000:3B:00.0".
+  Returns:
+    The path to the directory of the device. """
+  parts = bus_id.lower().split(":")
+  domain = int(parts[-3], 16) if len(parts) > 2 else 0
+  # nvidia-smi uses an 8 digit domain, but sysfs only uses 4.
+  name = "%04x:%s:%s" % (domain, parts[-2], parts[-1])
+  return os.path.join(root, "sys", "bus", "pci", "devices", name)
+
+
+class Topology:
+  """ The NUMA nodes of the machine, the CPUs in each one, and which node each
+  GPU is attached to. """
+
+  def __init__(self, nodes, gpu_nodes):
+    """
+    Args:
+      nodes: Dictionary mapping the ID of each NUMA node to a sorted list of the
+      IDs of its CPUs.
+      gpu_nodes: Dictionary mapping the ID of each GPU to the ID of the node
+      that it is attached to, or None if we don't know. """
+    self.__nodes = nodes
+    self.__gpu_nodes = gpu_nodes
+
+  def get_nodes(self):
+    """
+    Returns:
+      The IDs of the NUMA nodes, in order. """
+    return sorted(self.__nodes)
+
+  def get_cpus(self, node):
+    """
+    Args:
+      node: The ID of a NUMA node.
+    Returns:
+      A sorted list of the IDs of the CPUs in the node. """
+    return self.__nodes[node]
+
+  def get_gpu_node(self, gpu_id):
+    """
+    Args:
+      gpu_id: The ID of a GPU.
+    Returns:
+      The ID of the NUMA node that the GPU is attached to, or None if we don't
+      know. """
+    return self.__gpu_nodes.get(gpu_id)
+
+  def get_num_cpus(self):
+    """
+    Returns:
+      The number of CPUs on all the nodes. """
+    return sum([len(cpus) for cpus in self.__nodes.values()])
+
+
+def read_topology(gpus, root="/"):
+  """ Reads the topology of the machine from sysfs. Machines without NUMA
+  support show up as having a single node with every online CPU.
+  Args:
+    gpus: The nvidia.Gpu objects of the GPUs on the machine.
+    root: The root of the filesystem that /sys is under.
+  Returns:
+    The Topology. """
+  online = _read_file(os.path.join(root, "sys", "devices", "system", "cpu",
+                                   "online"))
+  online = set(parse_cpu_list(online)) if online else None
+
+  nodes = {}
+  node_root = os.path.join(root, "sys", "devices", "system", "node")
+  for node_path in glob.glob(os.path.join(node_root, "node[0-9]*")):
+    cpu_list = _read_file(os.path.join(node_path, "cpulist"))
+    if not cpu_list:
+      # Nodes with only memory, such as CXL expanders, have no CPUs.
+      continue
+    cpus = parse_cpu_list(cpu_list)
+    if online is not None:
+      cpus = [cpu for cpu in cpus if cpu in online]
+    if cpus:
+      nodes[int(os.path.basename(node_path)[len("node"):])] = cpus
+
+  if not nodes:
+    if online is None:
+      online = range(os.cpu_count())
+    nodes = {0: sorted(online)}
+
+  gpu_nodes = {}
+  for gpu in gpus:
+    node = None
+    if gpu.get_bus_id():
+      numa_node = _read_file(os.path.join(_get_pci_path(root,
+                                                        gpu.get_bus_id()),
+                                          "numa_node"))
+      # The kernel reports -1 if the device isn't attached to a node.
+      if numa_node is not None and int(numa_node) in nodes:
+        node = int(numa_node)
+    if node is None and len(nodes) > 1:
+      logger.warning("Could not find the NUMA node of GPU %d." % \
+                     (gpu.get_id()))
+    elif node is None:
+      node = min(nodes)
+    gpu_nodes[gpu.get_id()] = node
+
+  for node, cpus in sorted(nodes.items()):
+    logger.info("NUMA node %d has CPUs %s, and GPUs %s." % \
+                (node, format_cpu_list(cpus),
+                 [gpu_id for gpu_id, gpu_node in sorted(gpu_nodes.items()) \
+                  if gpu_node == node]))
+  return Topology(nodes, gpu_nodes)
+
+
+class CpuAllocator:
+  """ Hands out CPU cores to jobs. Each job gets a contiguous run of cores on
+  a single NUMA node, preferably the one that its GPUs are attached to, so
+  that its memory and PCIe traffic stay local. Of the runs that are big
+  enough, the smallest one is used, so that big runs are kept for big jobs. """
+
+  def __init__(self, topology):
+    """
+    Args:
+      topology: The Topology of the machine. """
+    self.__topology = topology
+    # The CPUs that are in use.
+    self.__used = set()
+
+  def get_num_cpus(self):
+    """
+    Returns:
+      The number of CPUs that can be handed out. """
+    return self.__topology.get_num_cpus()
+
+  def __find_run(self, node, count):
+    """ Finds the best run of free CPUs on a node.
+    Args:
+      node: The ID of the node.
+      count: The number of CPUs needed.
+    Returns:
+      A list of the IDs of the CPUs, or None if there is no run that is long
+      enough. """
+    best = None
+    run = []
+    # The sentinel at the end closes the last run.
+    for cpu in self.__topology.get_cpus(node) + [None]:
+      if cpu is not None and cpu not in self.__used and \
+         (not run or run[-1] == cpu - 1):
+        run.append(cpu)
+        continue
+
+      if len(run) >= count and (best is None or len(run) < len(best)):
+        best = run
+      run = []
+      if cpu is not None and cpu not in self.__used:
+        run.append(cpu)
+
+    if best is None:
+      return None
+    return best[:count]
+
+  def allocate(self, count, gpus=()):
+    """ Reserves CPUs for a job.
+    Args:
+      count: The number of CPUs that the job needs.
+      gpus: The IDs of the GPUs that the job runs on.
+    Returns:
+      A sorted list of the IDs of the CPUs, and a list with the ID of the node
+      that they are on, or None if no node has enough free CPUs in a row. The
+      job then isn't pinned. """
+    # Prefer the node with most of the GPUs, and then the emptiest ones.
+    gpu_counts = {}
+    for gpu_id in gpus:
+      node = self.__topology.get_gpu_node(gpu_id)
+      if node is not None:
+        gpu_counts[node] = gpu_counts.get(node, 0) + 1
+
+    def get_free(node):
+      return len([cpu for cpu in self.__topology.get_cpus(node) \
+                  if cpu not in self.__used])
+
+    nodes = sorted(self.__topology.get_nodes(),
+                   key=lambda node: (-gpu_counts.get(node, 0),
+                                     -get_free(node), node))
+    for node in nodes:
+      cpus = self.__find_run(node, count)
+      if cpus is not None:
+        self.__used.update(cpus)
+        return cpus, [node]
+
+    return None
+
+  def reserve(self, cpus):
+    """ Marks CPUs as used, for jobs that were pinned before the daemon
+    restarted.
+    Args:
+      cpus: The IDs of the CPUs. """
+    self.__used.update(cpus)
+
+  def release(self, cpus):
+    """ Frees CPUs once the job using them is done.
+    Args:
+      cpus: The IDs of the CPUs. """
+    self.__used.difference_update(cpus)
@@ -1,5 +1,8 @@
+import functools
 import logging
-import subprocess
+import pwd
+import shutil
+import sys
 
 
 logger = logging.getLogger()
@@ -10,18 +13,31 @@ class ConfigurationError(Exception):
   pass
 
 
-def get_path(tool):
-    """ Gets the path of a particular tool.
-    Args:
-      tool: The tool to find the path of.
-    Returns:
-      The path to the tool. """
-    try:
-      path = subprocess.check_output(["/usr/bin/which", tool])
-    except subprocess.CalledProcessError:
-      logger.critical("You should have installed '%s' beforehand." \
-                      " Your mother and I are very disappointed in you." % (tool))
-      sys.exit(1)
-
-    return path.decode("utf-8").rstrip("\n")
+@functools.lru_cache(maxsize=None)
+def get_user_name(uid):
+  """
+  Args:
+    uid: A user ID.
+  Returns:
+    The name of the user, or the ID as a string if it has no name. """
+  try:
+    return pwd.getpwuid(uid).pw_name
+  except KeyError:
+    return str(uid)
 
+@functools.lru_cache(maxsize=None)
+def get_path(tool):
+  """ Gets the path of a particular tool. This is only looked up once for each
+  tool.
+  Args:
+    tool: The tool to find the path of.
+  Returns:
+    The path to the tool. """
+  path = shutil.which(tool)
+  if path is None:
+    logger.critical("You should have installed '%s' beforehand." \
+                    " Your mother and I are very disappointed in you." % \
+                    (tool))
+    sys.exit(1)
+
+  return path
@@ -0,0 +1,199 @@
+import http.client
+import json
+import logging
+import threading
+
+
+""" Reports the state of a daemon to a coordinator, so that it can be used as
+a worker in a cluster. """
+
+
+logger = logging.getLogger(__name__)
+
+
+def _diff(old, new):
+  """ Finds the values that changed between two flat states.
+  Args:
+    old: The old state.
+    new: The new state.
+  Returns:
+    A dictionary of the values in the new state that are different from, or
+    missing in, the old state. """
+  return {key: value for key, value in new.items() if old.get(key) != value}
+
+
+class Reporter:
+  """ Sends heartbeats to the coordinator from a background thread. Each one
+  only contains the parts of our state that changed since the last heartbeat
+  the coordinator acknowledged, along with the jobs that started and finished
+  since then. If a heartbeat fails, the same changes are sent again with the
+  next one, and if the coordinator has lost track of us, it asks for the whole
+  state again. That includes every job that we have, so that the coordinator
+  can tell whether it sent any of them somewhere else in the meantime, and
+  cancel the copies that haven't started. """
+
+  def __init__(self, coordinator, name, url, interval=2.0):
+    """
+    Args:
+      coordinator: The address of the coordinator, as "host:port".
+      name: The name of this worker. This must be unique in the cluster.
+      url: The address that the coordinator can reach our server at, as
+      "host:port".
+      interval: The maximum amount of time, in seconds, between heartbeats.
+      Heartbeats are sent sooner when jobs start or finish. """
+    self.__coordinator = coordinator
+    self.__name = name
+    self.__url = url
+    self.__interval = interval
+
+    # Protects everything below, which is shared with the manager.
+    self.__lock = threading.Lock()
+    # The latest state from the manager.
+    self.__state = {}
+    # The last state that the coordinator acknowledged, or None if it needs
+    # the whole thing.
+    self.__acked_state = None
+    # Directories of jobs that started and finished, which the coordinator
+    # hasn't acknowledged yet.
+    self.__started = []
+    self.__finished = []
+    # The directories of the jobs that we have, as lists of the running and the
+    # pending ones, to send with the next full heartbeat, or None if the
+    # manager hasn't given us them yet.
+    self.__jobs = None
+    # Directories of jobs that the coordinator asked us to cancel.
+    self.__cancel_requested = set()
+    # The ones that the manager hasn't been told about yet.
+    self.__to_cancel = set()
+    # Set to send a heartbeat right away.
+    self.__wake_event = threading.Event()
+
+    self.__connection = None
+
+  def start(self):
+    """ Starts sending heartbeats. """
+    logger.info("Reporting to coordinator at %s as %s." % \
+                (self.__coordinator, self.__name))
+
+    thread = threading.Thread(target=self.__run, daemon=True)
+    thread.start()
+
+  def needs_jobs(self):
+    """
+    Returns:
+      True if the next heartbeat has to include all of our jobs, and the
+      manager should pass them to the next report(). """
+    with self.__lock:
+      return self.__acked_state is None and self.__jobs is None
+
+  def report(self, state, started, finished, jobs=None):
+    """ Updates what we tell the coordinator. This never blocks on the
+    network.
+    Args:
+      state: Flat dictionary with the size of the machine and how much of it is
+      in use.
+      started: The directories of jobs that started since the last report.
+      finished: The directories of jobs that finished since the last report.
+      jobs: Optional pair of lists of the directories of the running and the
+      pending jobs, which is only needed when needs_jobs() says so. """
+    with self.__lock:
+      self.__state = dict(state)
+      self.__started.extend(started)
+      self.__finished.extend(finished)
+      if jobs is not None:
+        self.__jobs = jobs
+
+    if started or finished or jobs is not None:
+      # The coordinator will want to know about these soon.
+      self.__wake_event.set()
+
+  def __post(self, body):
+    """ Sends a heartbeat to the coordinator.
+    Args:
+      body: The heartbeat to send.
+    Returns:
+      The reply from the coordinator. """
+    if self.__connection is None:
+      host, port = self.__coordinator.rsplit(":", 1)
+      self.__connection = http.client.HTTPConnection(host, int(port),
+                                                     timeout=10)
+
+    try:
+      self.__connection.request("POST", "/heartbeat", json.dumps(body),
+                                {"Content-Type": "application/json"})
+      response = self.__connection.getresponse()
+      data = response.read()
+    except (OSError, http.client.HTTPException):
+      # Start with a fresh connection next time.
+      self.__connection.close()
+      self.__connection = None
+      raise
+
+    if response.status != 200:
+      raise http.client.HTTPException("Coordinator returned %d." % \
+                                       (response.status))
+    return json.loads(data)
+
+  def take_cancelled(self):
+    """ Gets the jobs that the coordinator wants cancelled, because they are
+    running on another worker. Each one is only returned once.
+    Returns:
+      The directories of the jobs. """
+    with self.__lock:
+      to_cancel = self.__to_cancel
+      self.__to_cancel = set()
+    return to_cancel
+
+  def __send_heartbeat(self):
+    """ Sends a single heartbeat with everything that changed. """
+    with self.__lock:
+      state = self.__state
+      full = self.__acked_state is None
+      if full:
+        if self.__jobs is None:
+          # Wait until the manager tells us what jobs we have.
+          return
+        changes = state
+      else:
+        changes = _diff(self.__acked_state, state)
+      started = list(self.__started)
+      finished = list(self.__finished)
+
+    body = {"worker": self.__name, "url": self.__url, "full": full,
+            "changes": changes, "started": started, "finished": finished}
+    if full:
+      # Anything that happened since the manager listed the jobs is in started
+      # and finished, which the coordinator looks at afterwards.
+      body["running"], body["pending"] = self.__jobs
+    try:
+      reply = self.__post(body)
+    except (OSError, ValueError, http.client.HTTPException) as error:
+      # Everything will be sent again next time.
+      logger.warning("Failed to send heartbeat: %s" % (error))
+      return
+
+    with self.__lock:
+      # The coordinator has dealt with these events, whether or not it wants
+      # the full state again.
+      del self.__started[:len(started)]
+      del self.__finished[:len(finished)]
+      cancel = set(reply.get("cancel", []))
+      self.__to_cancel.update(cancel - self.__cancel_requested)
+      self.__cancel_requested = cancel
+      # Jobs change, so a full heartbeat needs a new list every time.
+      self.__jobs = None
+      if reply.get("resync"):
+        logger.info("Coordinator asked for our full state.")
+        self.__acked_state = None
+      else:
+        self.__acked_state = state
+
+  def __run(self):
+    """ Sends heartbeats forever. """
+    while True:
+      # Clear this first, so that reports made while we are sending are picked
+      # up by the next heartbeat.
+      self.__wake_event.clear()
+      self.__send_heartbeat()
+
+      self.__wake_event.wait(self.__interval)
@@ -0,0 +1,100 @@
+import http.server
+import json
+import os
+import shutil
+import sys
+import threading
+
+import pytest
+
+_ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+for directory in ("daemon", "benchmarks", "tools"):
+  sys.path.insert(0, os.path.join(_ROOT, directory))
+
+import docker
+import fake_docker
+import util
+
+
+""" Shared fixtures. The daemon uses flat imports, so its directory, and those
+of the fakes that stand in for docker and the GPUs, go on the path. """
+
+
+@pytest.fixture
+def fake_nvidia_smi(tmp_path, monkeypatch):
+  """ Puts a copy of the fake nvidia-smi at the front of PATH.
+  Returns:
+    The path to the copy. """
+  bin_dir = tmp_path / "bin"
+  bin_dir.mkdir()
+  path = bin_dir / "nvidia-smi"
+  shutil.copy(os.path.join(_ROOT, "tools", "fake_gpu", "nvidia-smi"), path)
+
+  monkeypatch.setenv("PATH", "%s:%s" % (bin_dir, os.environ["PATH"]))
+  # Paths are only looked up once.
+  util.get_path.cache_clear()
+  yield str(path)
+  util.get_path.cache_clear()
+
+@pytest.fixture
+def fake_engine(tmp_path, monkeypatch):
+  """ Runs the fake Docker Engine API, and points the client at it.
+  Returns:
+    The state of the fake engine. """
+  socket_path = str(tmp_path / "docker.sock")
+  server = fake_docker._Server(socket_path, fake_docker._Handler)
+  server.state = fake_docker._State(0.0, 1000)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+
+  monkeypatch.setattr(docker, "_client", docker.Client(socket_path))
+  yield server.state
+
+  server.shutdown()
+  server.server_close()
+
+class _JsonHandler(http.server.BaseHTTPRequestHandler):
+  """ Answers POSTs with whatever the handle_post function of the server
+  returns. """
+
+  # Clients keep their connections open.
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    # Keep quiet.
+    pass
+
+  def do_POST(self):
+    length = int(self.headers.get("Content-Length", 0))
+    body = json.loads(self.rfile.read(length).decode("utf-8"))
+    status, reply = self.server.handle_post(self.path, body)
+
+    data = json.dumps(reply).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+@pytest.fixture
+def make_json_server():
+  """ Runs HTTP servers that stand in for the coordinator and its workers.
+  Returns:
+    A function that is called with a function to handle requests, and returns
+    the address of a new server, as "host:port". The handler is called with
+    the path and the decoded body of each request, and returns the status and
+    the reply to send. """
+  servers = []
+
+  def make_json_server(handle):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _JsonHandler)
+    server.daemon_threads = True
+    server.handle_post = handle
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    servers.append(server)
+    return "127.0.0.1:%d" % (server.server_address[1])
+
+  yield make_json_server
+  for server in servers:
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,48 @@
+import os
+import pathlib
+import tempfile
+
+import pytest
+
+import control
+
+
+@pytest.fixture
+def public_dir():
+  """ A temporary directory that everyone can get into. The usual one for
+  tests is inside one that only we can.
+  Returns:
+    The path to the directory. """
+  with tempfile.TemporaryDirectory() as directory:
+    os.chmod(directory, 0o755)
+    yield pathlib.Path(directory)
+
+
+def test_is_public(public_dir):
+  job_dir = public_dir / "job"
+  job_dir.mkdir()
+  os.chmod(job_dir, 0o755)
+  path = job_dir / "job.out"
+  # Output that doesn't exist yet is judged by the directory.
+  assert control._is_public(str(path))
+
+  path.write_bytes(b"output")
+  os.chmod(path, 0o644)
+  assert control._is_public(str(path))
+
+  os.chmod(path, 0o600)
+  assert not control._is_public(str(path))
+
+  os.chmod(path, 0o644)
+  os.chmod(job_dir, 0o750)
+  assert not control._is_public(str(path))
+
+def test_private_parent(tmp_path):
+  path = tmp_path / "job.out"
+  path.write_bytes(b"output")
+  os.chmod(path, 0o644)
+  os.chmod(tmp_path, 0o700)
+  assert not control._is_public(str(path))
+
+def test_missing_directory_isnt_public(public_dir):
+  assert not control._is_public(str(public_dir / "gone" / "job.out"))
@@ -0,0 +1,235 @@
+import threading
+import time
+
+from coordinator import Coordinator
+from job import JobConfig
+
+
+class _FakeWorker:
+  """ Stands in for a daemon that the coordinator sends jobs to. """
+
+  def __init__(self, make_json_server, name, reject=()):
+    """
+    Args:
+      make_json_server: The fixture to run the server with.
+      name: The name of the worker.
+      reject: The directories of the jobs to reject. """
+    self.name = name
+    self.reject = reject
+    self.received = []
+    self.lock = threading.Lock()
+    self.url = make_json_server(self.__handle)
+
+  def __handle(self, path, body):
+    rejected = []
+    with self.lock:
+      for job_dir in body["job_dirs"]:
+        if job_dir in self.reject:
+          rejected.append({"job_dir": job_dir, "reason": "Bad job."})
+        else:
+          self.received.append(job_dir)
+    return 200, {"rejected": rejected}
+
+  def beat(self, coordinator, full=True, cpu=0, started=(), finished=(),
+           running=(), pending=()):
+    """ Sends a heartbeat for a machine with 4 cores, and a single GPU.
+    Returns:
+      The reply. """
+    beat = {"worker": self.name, "url": self.url, "full": full,
+            "changes": {}, "started": list(started),
+            "finished": list(finished)}
+    if full:
+      beat["changes"] = {"cores": 4, "total_ram": 1000, "gpus": 1, "cpu": cpu,
+                         "ram": 0, "gpu.0": 0, "vram.0": 0,
+                         "total_vram.0": 1000}
+      beat["running"] = list(running)
+      beat["pending"] = list(pending)
+    return coordinator.heartbeat(beat)
+
+  def get_received(self):
+    with self.lock:
+      return list(self.received)
+
+def _config(cpu=100):
+  """
+  Returns:
+    The JobConfig for a job that uses some CPU, and no GPUs. """
+  return JobConfig({"Name": "test", "Description": "A test job.",
+                    "Container": "test:latest",
+                    "ResourceUsage": [{"CpuUsage": cpu}, {"GpuCount": 0}]})
+
+def _wait_for(condition, timeout=10.0):
+  """
+  Returns:
+    Whether the condition became true before the timeout. """
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    if condition():
+      return True
+    time.sleep(0.01)
+  return False
+
+def _get_worker(coordinator, name):
+  """
+  Returns:
+    The status of a worker. """
+  return coordinator.get_status()["workers"][name]
+
+def _lose(coordinator, worker):
+  """ Waits until the coordinator gives up on a worker. """
+  assert _wait_for(lambda: not _get_worker(coordinator, worker.name)["alive"])
+
+
+def test_jobs_go_to_best_fit(make_json_server):
+  coordinator = Coordinator(worker_timeout=60.0)
+  busy = _FakeWorker(make_json_server, "busy")
+  idle = _FakeWorker(make_json_server, "idle")
+  busy.beat(coordinator, cpu=50)
+  idle.beat(coordinator)
+  coordinator.start()
+
+  assert coordinator.add_jobs([("/jobs/a", _config(cpu=100))]) == [None]
+  # It leaves the least room on the busy worker.
+  assert _wait_for(lambda: busy.get_received() == ["/jobs/a"])
+  assert _get_worker(coordinator, "busy")["dispatched"] == 1
+
+  busy.beat(coordinator, full=False, started=["/jobs/a"])
+  assert _get_worker(coordinator, "busy")["running"] == 1
+  busy.beat(coordinator, full=False, finished=["/jobs/a"])
+  assert _get_worker(coordinator, "busy")["running"] == 0
+  # Once it is gone, it can be submitted again.
+  assert coordinator.add_jobs([("/jobs/a", _config())]) == [None]
+
+def test_jobs_that_dont_fit_wait(make_json_server):
+  coordinator = Coordinator(worker_timeout=60.0)
+  worker = _FakeWorker(make_json_server, "worker")
+  worker.beat(coordinator, cpu=90)
+  coordinator.start()
+
+  coordinator.add_jobs([("/jobs/a", _config(cpu=100))])
+  time.sleep(0.2)
+  assert worker.get_received() == []
+  assert coordinator.get_status()["pending"] == 1
+
+  worker.beat(coordinator, cpu=0)
+  assert _wait_for(lambda: worker.get_received() == ["/jobs/a"])
+
+def test_bad_jobs(make_json_server):
+  coordinator = Coordinator(worker_timeout=60.0)
+  errors = coordinator.add_jobs([
+      ("/jobs/a", "Invalid job.yaml."), ("/jobs/b", _config()),
+      ("/jobs/b", _config()),
+      ("/jobs/c", JobConfig({"Name": "c", "Description": "c",
+                             "Container": "c",
+                             "Array": {"Tasks": [{"A": 1}]}}))])
+  assert errors[0] == "Invalid job.yaml."
+  assert errors[1] is None
+  assert errors[2] == "Job is already queued."
+  assert "arrays" in errors[3]
+
+def test_rejected_jobs_are_forgotten(make_json_server):
+  coordinator = Coordinator(worker_timeout=60.0)
+  worker = _FakeWorker(make_json_server, "worker", reject=["/jobs/bad"])
+  worker.beat(coordinator)
+  coordinator.start()
+
+  coordinator.add_jobs([("/jobs/bad", _config()), ("/jobs/good", _config())])
+  assert _wait_for(lambda: worker.get_received() == ["/jobs/good"])
+  assert _wait_for(lambda: _get_worker(coordinator, "worker")["dispatched"] \
+                           == 1)
+  assert coordinator.get_status()["pending"] == 0
+  assert coordinator.add_jobs([("/jobs/bad", _config())]) == [None]
+
+def test_unknown_workers_are_asked_to_resync(make_json_server):
+  coordinator = Coordinator(worker_timeout=60.0)
+  worker = _FakeWorker(make_json_server, "worker")
+  assert worker.beat(coordinator, full=False) == {"resync": True}
+  assert worker.beat(coordinator) == {}
+
+def test_jobs_are_requeued_from_lost_workers(make_json_server):
+  coordinator = Coordinator(worker_timeout=0.3)
+  lost = _FakeWorker(make_json_server, "lost")
+  lost.beat(coordinator)
+  coordinator.start()
+  coordinator.add_jobs([("/jobs/a", _config())])
+  assert _wait_for(lambda: lost.get_received() == ["/jobs/a"])
+
+  other = _FakeWorker(make_json_server, "other")
+  # Only the other worker keeps sending heartbeats.
+  assert _wait_for(lambda: other.beat(coordinator) == {} and \
+                           other.get_received() == ["/jobs/a"])
+  assert not _get_worker(coordinator, "lost")["alive"]
+  assert lost.beat(coordinator, full=False) == {"resync": True}
+
+def test_resync_takes_back_requeued_jobs(make_json_server):
+  coordinator = Coordinator(worker_timeout=0.3)
+  worker = _FakeWorker(make_json_server, "worker")
+  worker.beat(coordinator)
+  coordinator.start()
+  coordinator.add_jobs([("/jobs/a", _config()), ("/jobs/b", _config())])
+  assert _wait_for(lambda: len(worker.get_received()) == 2)
+  worker.beat(coordinator, full=False, started=["/jobs/a"])
+
+  _lose(coordinator, worker)
+  assert coordinator.get_status()["pending"] == 2
+  # It was only cut off, so it still has both.
+  assert worker.beat(coordinator, running=["/jobs/a"],
+                     pending=["/jobs/b"]) == {}
+
+  status = coordinator.get_status()
+  assert status["pending"] == 0
+  assert status["workers"]["worker"]["running"] == 1
+  assert status["workers"]["worker"]["dispatched"] == 1
+  time.sleep(0.2)
+  # Nothing was sent again.
+  assert len(worker.get_received()) == 2
+
+def test_resync_cancels_copies_that_havent_started(make_json_server):
+  coordinator = Coordinator(worker_timeout=0.3)
+  first = _FakeWorker(make_json_server, "first")
+  first.beat(coordinator)
+  coordinator.start()
+  coordinator.add_jobs([("/jobs/a", _config()), ("/jobs/b", _config())])
+  assert _wait_for(lambda: len(first.get_received()) == 2)
+  first.beat(coordinator, full=False, started=["/jobs/a"])
+
+  second = _FakeWorker(make_json_server, "second")
+  assert _wait_for(lambda: second.beat(coordinator) == {} and \
+                           len(second.get_received()) == 2)
+  second.beat(coordinator, full=False, started=["/jobs/b"])
+
+  # The first worker comes back. It is running /jobs/a, which hasn't started
+  # on the second one, and /jobs/b, which has, is still queued on it.
+  assert first.beat(coordinator, running=["/jobs/a"],
+                    pending=["/jobs/b"]) == {"cancel": ["/jobs/b"]}
+  assert second.beat(coordinator, full=False) == {"cancel": ["/jobs/a"]}
+  assert _get_worker(coordinator, "first")["running"] == 1
+  assert _get_worker(coordinator, "second")["running"] == 1
+  assert _get_worker(coordinator, "second")["dispatched"] == 0
+
+  # They keep being asked until they say the copies are gone.
+  assert second.beat(coordinator, full=False,
+                     finished=["/jobs/a"]) == {}
+  assert first.beat(coordinator, full=False, finished=["/jobs/b"]) == {}
+  # The copies that ran are still there.
+  assert _get_worker(coordinator, "first")["running"] == 1
+  assert _get_worker(coordinator, "second")["running"] == 1
+  first.beat(coordinator, full=False, finished=["/jobs/a"])
+  second.beat(coordinator, full=False, finished=["/jobs/b"])
+  assert _get_worker(coordinator, "first")["running"] == 0
+  assert _get_worker(coordinator, "second")["running"] == 0
+
+def test_jobs_that_finished_while_cut_off(make_json_server):
+  coordinator = Coordinator(worker_timeout=0.3)
+  worker = _FakeWorker(make_json_server, "worker")
+  worker.beat(coordinator)
+  coordinator.start()
+  coordinator.add_jobs([("/jobs/a", _config())])
+  assert _wait_for(lambda: worker.get_received() == ["/jobs/a"])
+  worker.beat(coordinator, full=False, started=["/jobs/a"])
+
+  _lose(coordinator, worker)
+  assert coordinator.get_status()["pending"] == 1
+  worker.beat(coordinator, finished=["/jobs/a"])
+  assert coordinator.get_status()["pending"] == 0
+  assert coordinator.add_jobs([("/jobs/a", _config())]) == [None]
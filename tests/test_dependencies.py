@@ -0,0 +1,145 @@
+from dependencies import AFTER_ANY, AFTER_SUCCESS, BLOCKED, CANCELLED, \
+                         READY, DependencyGraph
+
+
+class _Job:
+  """ Stands in for a job, which only needs a directory. """
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def get_directory(self):
+    return self.directory
+
+  def __repr__(self):
+    return "_Job(%r)" % (self.directory)
+
+
+def test_independent_jobs_are_ready():
+  graph = DependencyGraph()
+  assert graph.add(_Job("/a"), []) == READY
+  # Directories that we never heard of are assumed to be done.
+  assert graph.add(_Job("/b"), [("/old", AFTER_SUCCESS)]) == READY
+  assert len(graph) == 0
+
+def test_after_success():
+  graph = DependencyGraph()
+  first = _Job("/first")
+  second = _Job("/second")
+  assert graph.add(first, []) == READY
+  assert graph.add(second, [("/first", AFTER_SUCCESS)]) == BLOCKED
+  assert len(graph) == 1
+
+  assert graph.finish(first, True) == ([second], [])
+  assert len(graph) == 0
+
+def test_after_any():
+  graph = DependencyGraph()
+  first = _Job("/first")
+  cleanup = _Job("/cleanup")
+  graph.add(first, [])
+  assert graph.add(cleanup, [("/first", AFTER_ANY)]) == BLOCKED
+
+  assert graph.finish(first, False) == ([cleanup], [])
+
+def test_waits_for_every_dependency():
+  graph = DependencyGraph()
+  first = _Job("/first")
+  second = _Job("/second")
+  last = _Job("/last")
+  graph.add(first, [])
+  graph.add(second, [])
+  graph.add(last, [("/first", AFTER_SUCCESS), ("/second", AFTER_ANY)])
+
+  assert graph.finish(second, False) == ([], [])
+  assert graph.finish(first, True) == ([last], [])
+
+def test_waits_for_whole_directory():
+  # The tasks of a job array share a directory.
+  graph = DependencyGraph()
+  tasks = [_Job("/array") for _ in range(3)]
+  for task in tasks:
+    graph.add(task, [])
+  after = _Job("/after")
+  graph.add(after, [("/array", AFTER_SUCCESS)])
+
+  assert graph.finish(tasks[0], True) == ([], [])
+  assert graph.finish(tasks[1], True) == ([], [])
+  assert graph.finish(tasks[2], True) == ([after], [])
+
+def test_one_failed_task_fails_directory():
+  graph = DependencyGraph()
+  tasks = [_Job("/array"), _Job("/array")]
+  for task in tasks:
+    graph.add(task, [])
+  after = _Job("/after")
+  graph.add(after, [("/array", AFTER_SUCCESS)])
+
+  assert graph.finish(tasks[0], False) == ([], [])
+  assert graph.finish(tasks[1], True) == ([], [after])
+
+def test_cancellation_cascades():
+  graph = DependencyGraph()
+  first = _Job("/first")
+  second = _Job("/second")
+  third = _Job("/third")
+  cleanup = _Job("/cleanup")
+  graph.add(first, [])
+  graph.add(second, [("/first", AFTER_SUCCESS)])
+  graph.add(third, [("/second", AFTER_SUCCESS)])
+  graph.add(cleanup, [("/third", AFTER_ANY)])
+
+  # The cleanup still runs once everything before it was cancelled.
+  assert graph.finish(first, False) == ([cleanup], [second, third])
+  assert len(graph) == 0
+
+def test_outcomes_are_remembered():
+  outcomes = []
+  graph = DependencyGraph(
+      on_outcome=lambda directory, succeeded: \
+          outcomes.append((directory, succeeded)))
+  good = _Job("/good")
+  bad = _Job("/bad")
+  graph.add(good, [])
+  graph.add(bad, [])
+  graph.finish(good, True)
+  graph.finish(bad, False)
+  assert outcomes == [("/good", True), ("/bad", False)]
+
+  assert graph.check("/new", [("/good", AFTER_SUCCESS)]) is None
+  assert graph.check("/new", [("/bad", AFTER_ANY)]) is None
+  assert graph.check("/new", [("/bad", AFTER_SUCCESS)]) == \
+      "Dependency /bad failed."
+  assert graph.add(_Job("/new"), [("/good", AFTER_SUCCESS)]) == READY
+  assert graph.add(_Job("/other"), [("/bad", AFTER_SUCCESS)]) == CANCELLED
+
+def test_old_outcomes_are_forgotten():
+  graph = DependencyGraph(max_outcomes=2)
+  graph.load_outcomes([("/a", True), ("/b", True), ("/c", False)])
+
+  assert "isn't queued" in graph.check("/new", [("/a", AFTER_ANY)])
+  assert graph.check("/new", [("/b", AFTER_SUCCESS)]) is None
+  assert graph.check("/new", [("/c", AFTER_ANY)]) is None
+
+def test_check():
+  graph = DependencyGraph()
+  graph.add(_Job("/queued"), [])
+  assert graph.check("/new", [("/queued", AFTER_SUCCESS)]) is None
+  assert graph.check("/new", [("/new", AFTER_ANY)]) == \
+      "Job can't depend on itself."
+  assert "isn't queued" in graph.check("/new", [("/unknown", AFTER_ANY)])
+
+def test_cancelled_jobs_still_finish():
+  graph = DependencyGraph()
+  bad = _Job("/bad")
+  graph.add(bad, [])
+  graph.finish(bad, False)
+
+  cancelled = _Job("/cancelled")
+  assert graph.add(cancelled, [("/bad", AFTER_SUCCESS)]) == CANCELLED
+  after = _Job("/after")
+  assert graph.add(after, [("/cancelled", AFTER_ANY)]) == BLOCKED
+  # Until it is finished, its directory counts as unfinished.
+  assert graph.finish(cancelled, False) == ([after], [])
+  assert graph.check("/new", [("/cancelled", AFTER_SUCCESS)]) == \
+      "Dependency /cancelled failed."
@@ -0,0 +1,194 @@
+import os
+import struct
+import time
+
+import pytest
+
+import docker
+import util
+
+
+def _frame(stream, data):
+  """
+  Returns:
+    A frame of the multiplexed output stream. """
+  return struct.pack(">BxxxL", stream, len(data)) + data
+
+@pytest.fixture
+def output_files(tmp_path):
+  """ Files for the standard output and error of a container.
+  Returns:
+    The open stdout and stderr files. """
+  with open(tmp_path / "job.out", "wb+") as stdout, \
+       open(tmp_path / "job.err", "wb+") as stderr:
+    yield stdout, stderr
+
+def _read(output_file):
+  output_file.seek(0)
+  return output_file.read()
+
+
+def test_demultiplexer_splits_streams(output_files):
+  stdout, stderr = output_files
+  demultiplexer = docker._Demultiplexer(stdout, stderr)
+  demultiplexer.feed(_frame(1, b"out 1\n") + _frame(2, b"err 1\n") + \
+                     _frame(1, b"out 2\n"))
+
+  assert _read(stdout) == b"out 1\nout 2\n"
+  assert _read(stderr) == b"err 1\n"
+
+def test_demultiplexer_partial_frames(output_files):
+  stdout, stderr = output_files
+  demultiplexer = docker._Demultiplexer(stdout, stderr)
+  data = _frame(1, b"hello, ") + _frame(2, b"oops") + _frame(1, b"world")
+  # Split everywhere, including inside the headers.
+  for i in range(len(data)):
+    demultiplexer.feed(data[i:i + 1])
+
+  assert _read(stdout) == b"hello, world"
+  assert _read(stderr) == b"oops"
+
+def test_demultiplexer_ignores_other_streams(output_files):
+  stdout, stderr = output_files
+  demultiplexer = docker._Demultiplexer(stdout, stderr)
+  # Stream 0 is stdin, which is never written to the files.
+  demultiplexer.feed(_frame(0, b"stdin") + _frame(1, b"") + \
+                     _frame(1, b"out"))
+
+  assert _read(stdout) == b"out"
+  assert _read(stderr) == b""
+
+def test_demultiplexer_large_frame(output_files):
+  stdout, stderr = output_files
+  demultiplexer = docker._Demultiplexer(stdout, stderr)
+  data = os.urandom(1 << 20)
+  frame = _frame(2, data)
+  demultiplexer.feed(frame[:1000])
+  assert _read(stderr) == b""
+  demultiplexer.feed(frame[1000:])
+
+  assert _read(stderr) == data
+
+
+def _run(tmp_path, output_files, script, name="stoplight-test"):
+  """ Runs a job script in a container.
+  Args:
+    tmp_path: The directory to use as the job directory.
+    output_files: The stdout and stderr files.
+    script: The body of the shell script to run.
+    name: The name of the container.
+  Returns:
+    The Container. """
+  exe_path = tmp_path / "run_job.sh"
+  exe_path.write_text("#!/bin/sh\n" + script)
+  os.chmod(exe_path, 0o755)
+
+  container = docker.Container("test:latest", str(tmp_path), name)
+  container.run_exe("run_job.sh", *output_files)
+  return container
+
+def _wait_until_finished(container, timeout=10.0):
+  """ Polls a container until it is finished.
+  Returns:
+    What is_finished() returned. """
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    if container.is_finished():
+      return True
+    time.sleep(0.01)
+  return False
+
+
+def test_successful_exit(fake_engine, tmp_path, output_files):
+  container = _run(tmp_path, output_files, "echo out; echo err >&2\n")
+
+  assert _wait_until_finished(container)
+  assert container.get_output_fd() is None
+  stdout, stderr = output_files
+  assert _read(stdout) == b"out\n"
+  assert _read(stderr) == b"err\n"
+  # It was removed once it exited.
+  assert not fake_engine.containers
+
+def test_failed_exit(fake_engine, tmp_path, output_files):
+  container = _run(tmp_path, output_files, "exit 3\n")
+
+  with pytest.raises(RuntimeError, match="status 3"):
+    _wait_until_finished(container)
+  assert not fake_engine.containers
+
+def test_output_closed_before_exit(fake_engine, tmp_path, output_files):
+  container = _run(tmp_path, output_files,
+                   "echo before\nexec >&- 2>&-\nsleep 0.5\nexit 4\n")
+
+  # The output ends long before the container exits.
+  deadline = time.monotonic() + 0.3
+  while time.monotonic() < deadline:
+    assert not container.is_finished()
+    time.sleep(0.01)
+  assert container.get_output_fd() is not None
+
+  with pytest.raises(RuntimeError, match="status 4"):
+    _wait_until_finished(container)
+  assert _read(output_files[0]) == b"before\n"
+  assert not fake_engine.containers
+
+def test_killed(fake_engine, tmp_path, output_files):
+  container = _run(tmp_path, output_files, "exec sleep 60\n")
+  assert not container.is_finished()
+
+  start_time = time.monotonic()
+  container.kill("test")
+  # Signals are sent in the background.
+  assert time.monotonic() - start_time < 0.5
+
+  with pytest.raises(RuntimeError, match="status -9"):
+    _wait_until_finished(container)
+  # Once it exited, there is nothing left to kill.
+  container.kill("again")
+
+def test_exit_status_unavailable(fake_engine, tmp_path, output_files):
+  container = _run(tmp_path, output_files, "exec sleep 60\n")
+  # Something else removes the container, so there is nothing to wait for.
+  docker.remove_container("stoplight-test", force=True)
+
+  with pytest.raises(RuntimeError, match="Could not get exit status"):
+    _wait_until_finished(container)
+
+def test_failed_start_removes_container(fake_engine, tmp_path, output_files,
+                                        monkeypatch):
+  def fail_attach(name):
+    raise docker.DockerError(500, "No attaching today.")
+  monkeypatch.setattr(docker._client, "attach", fail_attach)
+
+  with pytest.raises(util.ConfigurationError):
+    _run(tmp_path, output_files, "exit 0\n")
+  assert not fake_engine.containers
+
+def test_gpus_are_requested(fake_engine, tmp_path, output_files):
+  exe_path = tmp_path / "run_job.sh"
+  exe_path.write_text("#!/bin/sh\nexec sleep 60\n")
+  os.chmod(exe_path, 0o755)
+  container = docker.Container("test:latest", str(tmp_path), "stoplight-gpus")
+  container.run_exe("run_job.sh", *output_files, gpus=(1, 3),
+                    environment={"NVIDIA_VISIBLE_DEVICES": "1,3"})
+
+  config = fake_engine.containers["stoplight-gpus"].config
+  assert config["HostConfig"]["DeviceRequests"] == \
+      [{"Driver": "nvidia", "DeviceIDs": ["1", "3"],
+        "Capabilities": [["gpu"]]}]
+  assert "NVIDIA_VISIBLE_DEVICES=1,3" in config["Env"]
+
+  container.kill("test")
+  with pytest.raises(RuntimeError):
+    _wait_until_finished(container)
+
+def test_no_gpus_requested(fake_engine, tmp_path, output_files):
+  container = _run(tmp_path, output_files, "exec sleep 60\n")
+
+  config = fake_engine.containers["stoplight-test"].config
+  assert "DeviceRequests" not in config["HostConfig"]
+
+  container.kill("test")
+  with pytest.raises(RuntimeError):
+    _wait_until_finished(container)
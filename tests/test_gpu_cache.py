@@ -0,0 +1,97 @@
+import json
+import os
+
+import pytest
+
+import nvidia
+
+
+@pytest.fixture
+def probes(fake_nvidia_smi, monkeypatch):
+  """ Counts the times that nvidia-smi is run to find the GPUs.
+  Returns:
+    A list that gets a path appended to it for every run. """
+  calls = []
+  probe_gpus = nvidia._probe_gpus
+
+  def counting_probe(nvidia_smi):
+    calls.append(nvidia_smi)
+    return probe_gpus(nvidia_smi)
+
+  monkeypatch.setattr(nvidia, "_probe_gpus", counting_probe)
+  monkeypatch.setenv("FAKE_NVIDIA_SMI_GPUS", "2")
+  monkeypatch.setenv("FAKE_NVIDIA_SMI_VRAM", "16000")
+  return calls
+
+def _describe(gpus):
+  return [(gpu.get_id(), gpu.get_uuid(), gpu.get_total_vram(),
+           gpu.get_bus_id()) for gpu in gpus]
+
+
+def test_no_cache(probes):
+  nvidia.enumerate_gpus()
+  nvidia.enumerate_gpus()
+  assert len(probes) == 2
+
+def test_cache_hit(probes, tmp_path):
+  cache_path = str(tmp_path / "gpus.json")
+  first = nvidia.enumerate_gpus(cache_path=cache_path)
+  assert len(probes) == 1
+  assert os.path.exists(cache_path)
+
+  second = nvidia.enumerate_gpus(cache_path=cache_path)
+  assert len(probes) == 1
+  assert _describe(second) == _describe(first)
+
+def test_cache_invalidated_by_new_driver(probes, tmp_path, fake_nvidia_smi):
+  cache_path = str(tmp_path / "gpus.json")
+  nvidia.enumerate_gpus(cache_path=cache_path)
+
+  # Upgrading the driver replaces nvidia-smi.
+  stat = os.stat(fake_nvidia_smi)
+  os.utime(fake_nvidia_smi, (stat.st_atime, stat.st_mtime + 10))
+  nvidia.enumerate_gpus(cache_path=cache_path)
+  assert len(probes) == 2
+
+  nvidia.enumerate_gpus(cache_path=cache_path)
+  assert len(probes) == 2
+
+def test_cache_invalidated_by_reboot(probes, tmp_path):
+  cache_path = str(tmp_path / "gpus.json")
+  nvidia.enumerate_gpus(cache_path=cache_path)
+
+  with open(cache_path) as cache_file:
+    cached = json.load(cache_file)
+  cached["key"]["boot_id"] = "a-previous-boot"
+  with open(cache_path, "w") as cache_file:
+    json.dump(cached, cache_file)
+
+  nvidia.enumerate_gpus(cache_path=cache_path)
+  assert len(probes) == 2
+
+def test_cache_invalidated_by_version(probes, tmp_path, monkeypatch):
+  cache_path = str(tmp_path / "gpus.json")
+  nvidia.enumerate_gpus(cache_path=cache_path)
+
+  monkeypatch.setattr(nvidia, "_CACHE_VERSION", nvidia._CACHE_VERSION + 1)
+  nvidia.enumerate_gpus(cache_path=cache_path)
+  assert len(probes) == 2
+
+@pytest.mark.parametrize("contents", ["", "not json", "[]", "{\"key\": 1}"])
+def test_bad_cache_is_ignored(probes, tmp_path, contents):
+  cache_path = str(tmp_path / "gpus.json")
+  with open(cache_path, "w") as cache_file:
+    cache_file.write(contents)
+
+  gpus = nvidia.enumerate_gpus(cache_path=cache_path)
+  assert len(gpus) == 2
+  assert len(probes) == 1
+
+  # It gets rewritten.
+  nvidia.enumerate_gpus(cache_path=cache_path)
+  assert len(probes) == 1
+
+def test_unwritable_cache(probes, tmp_path):
+  cache_path = str(tmp_path / "missing" / "gpus.json")
+  assert len(nvidia.enumerate_gpus(cache_path=cache_path)) == 2
+  assert not os.path.exists(cache_path)
@@ -0,0 +1,85 @@
+import threading
+import time
+
+import docker
+import images
+
+
+def _make_cache(fake_engine, present, **kwargs):
+  """
+  Args:
+    fake_engine: The state of the fake engine.
+    present: The images that are already present.
+  Returns:
+    An ImageCache, and an Event that is set whenever a pull finishes. """
+  for image in present:
+    fake_engine.images[docker.normalize_image(image)] = 1000
+  cache = images.ImageCache(**kwargs)
+  pulled = threading.Event()
+  cache.set_callback(pulled.set)
+  return cache, pulled
+
+def _wait_until_ready(cache, image, timeout=10.0):
+  """
+  Returns:
+    Whether the image became ready before the timeout. """
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    if cache.is_ready(image):
+      return True
+    time.sleep(0.01)
+  return False
+
+
+def test_pulls_upcoming_images(fake_engine):
+  cache, pulled = _make_cache(fake_engine, ["present"])
+  assert not cache.update(["present", "missing"], [])
+  assert cache.is_ready("present")
+
+  assert pulled.wait(10.0)
+  assert cache.is_ready("missing")
+  assert cache.update(["present", "missing"], [])
+
+def test_present_images_dont_count_towards_lookahead(fake_engine):
+  # The jobs at the front of the queue can't run, but their images are
+  # already there, so they shouldn't keep the next image from being pulled.
+  big = ["big %d" % (i) for i in range(4)]
+  cache, pulled = _make_cache(fake_engine, big, lookahead=1)
+  cache.update(big + ["small"], [])
+
+  assert pulled.wait(10.0)
+  assert cache.is_ready("small")
+
+def test_pulling_images_dont_count_towards_lookahead(fake_engine):
+  fake_engine.pull_time = 0.3
+  cache, pulled = _make_cache(fake_engine, [], lookahead=1)
+  cache.update(["first", "second"], [])
+  # The first image is still being pulled, so the next one is looked at.
+  cache.update(["first", "second"], [])
+
+  assert _wait_until_ready(cache, "first")
+  assert _wait_until_ready(cache, "second")
+
+def test_max_pulls(fake_engine):
+  fake_engine.pull_time = 0.3
+  cache, pulled = _make_cache(fake_engine, [], max_pulls=1)
+  cache.update(["first", "second"], [])
+  assert pulled.wait(10.0)
+  assert cache.is_ready("first")
+  assert not cache.is_ready("second")
+
+  pulled.clear()
+  cache.update(["second"], [])
+  assert pulled.wait(10.0)
+  assert cache.is_ready("second")
+
+def test_failed_pulls_are_ready(fake_engine, monkeypatch):
+  def fail_pull(image):
+    raise docker.DockerError(404, "No such image.")
+  monkeypatch.setattr(docker, "pull_image", fail_pull)
+
+  cache, pulled = _make_cache(fake_engine, [])
+  cache.update(["missing"], [])
+  assert pulled.wait(10.0)
+  # Jobs that use it get to start, and fail with a useful error.
+  assert cache.is_ready("missing")
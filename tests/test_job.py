@@ -0,0 +1,125 @@
+import pytest
+
+from job import ArraySpec, Job, JobConfig
+from util import ConfigurationError
+
+
+class _RecordingContainer:
+  """ Stands in for docker.Container, and remembers how jobs were run. """
+
+  # The arguments that each container was run with.
+  runs = []
+
+  def __init__(self, image, job_directory, name):
+    pass
+
+  def run_exe(self, exe, stdout, stderr, **kwargs):
+    _RecordingContainer.runs.append(kwargs)
+
+def _make_config(**config):
+  """
+  Returns:
+    A JobConfig, with some extra settings in its job.yaml. """
+  config_data = {"Name": "test", "Description": "A test job.",
+                 "Container": "test:latest",
+                 "ResourceUsage": [{"GpuCount": 1}]}
+  config_data.update(config)
+  return JobConfig(config_data)
+
+def _start(tmp_path, gpus, config=None, task=None):
+  """ Starts a job.
+  Returns:
+    The arguments that its container was run with. """
+  _RecordingContainer.runs.clear()
+  job = Job(str(tmp_path), 1, config or _make_config(), task=task,
+            container_class=_RecordingContainer)
+  job.start(gpus)
+  job.close_output()
+  return _RecordingContainer.runs[0]
+
+
+def test_gpus_are_visible(tmp_path):
+  run_args = _start(tmp_path, (0, 2))
+  assert run_args["gpus"] == (0, 2)
+  assert run_args["environment"]["NVIDIA_VISIBLE_DEVICES"] == "0,2"
+
+def test_no_gpus_are_visible(tmp_path):
+  run_args = _start(tmp_path, ())
+  assert run_args["gpus"] == ()
+  assert run_args["environment"]["NVIDIA_VISIBLE_DEVICES"] == "none"
+
+def test_parameters_cant_pick_gpus(tmp_path):
+  config = _make_config(Array={"Tasks": [{"NVIDIA_VISIBLE_DEVICES": "all"}]})
+  run_args = _start(tmp_path, (1,), config=config, task=0)
+  assert run_args["environment"]["NVIDIA_VISIBLE_DEVICES"] == "1"
+  assert run_args["environment"]["STOPLIGHT_TASK_ID"] == "0"
+
+
+def test_array_tasks():
+  array = ArraySpec({"Tasks": [{"LR": 0.1}, {"LR": 0.01, "DEPTH": 4}]})
+  assert array.get_num_tasks() == 2
+  assert array.get_parameters(0) == {"LR": 0.1}
+  assert array.get_parameters(1) == {"LR": 0.01, "DEPTH": 4}
+
+def test_array_grid():
+  array = ArraySpec({"Grid": {"LR": [0.1, 0.01], "DEPTH": [2, 4, 8]}})
+  assert array.get_num_tasks() == 6
+  # The last parameter changes fastest.
+  assert [array.get_parameters(task) for task in range(6)] == \
+      [{"LR": 0.1, "DEPTH": 2}, {"LR": 0.1, "DEPTH": 4},
+       {"LR": 0.1, "DEPTH": 8}, {"LR": 0.01, "DEPTH": 2},
+       {"LR": 0.01, "DEPTH": 4}, {"LR": 0.01, "DEPTH": 8}]
+
+def test_array_tasks_and_grid():
+  array = ArraySpec({"Tasks": [{"MODEL": "a"}, {"MODEL": "b"}],
+                     "Grid": {"SEED": [1, 2]}})
+  assert array.get_num_tasks() == 4
+  assert [array.get_parameters(task) for task in range(4)] == \
+      [{"MODEL": "a", "SEED": 1}, {"MODEL": "a", "SEED": 2},
+       {"MODEL": "b", "SEED": 1}, {"MODEL": "b", "SEED": 2}]
+
+def test_large_grid_isnt_expanded():
+  array = ArraySpec({"Grid": {"A": list(range(1000)), "B": list(range(1000)),
+                              "C": list(range(1000))}})
+  assert array.get_num_tasks() == 10 ** 9
+  assert array.get_parameters(123456789) == {"A": 123, "B": 456, "C": 789}
+
+@pytest.mark.parametrize("array_data, message", [
+    ([1, 2], "must be a mapping"),
+    ({}, "needs Grid or Tasks"),
+    ({"Grid": {"A": [1]}, "Other": 1}, "unknown Array key 'Other'"),
+    ({"Tasks": []}, "non-empty list"),
+    ({"Tasks": [1]}, "must contain mappings"),
+    ({"Grid": {}}, "non-empty mapping"),
+    ({"Grid": {"A": []}}, "for 'A' must be a non-empty list"),
+    ({"Grid": {"A": 1}}, "for 'A' must be a non-empty list"),
+    ({"Grid": {"1A": [1]}}, "bad Array parameter name '1A'"),
+    ({"Tasks": [{"A-B": 1}]}, "bad Array parameter name 'A-B'"),
+    ({"Grid": {"A": [[1]]}}, "'A' must be a string or a number"),
+    ({"Tasks": [{"A": None}]}, "'A' must be a string or a number")])
+def test_invalid_arrays(array_data, message):
+  with pytest.raises(ConfigurationError, match=message):
+    ArraySpec(array_data)
+
+def test_array_from_job_yaml():
+  config = JobConfig.parse("Name: sweep\n"
+                           "Description: A sweep.\n"
+                           "Container: test:latest\n"
+                           "Array:\n"
+                           "  Grid:\n"
+                           "    LR: [0.1, 0.01]\n")
+  assert config.get_array().get_num_tasks() == 2
+  assert _make_config().get_array() is None
+
+def test_tasks_get_their_parameters(tmp_path):
+  config = _make_config(Array={"Grid": {"LR": [0.1, 0.01]},
+                               "Tasks": [{"NAME": "x"}]})
+  run_args = _start(tmp_path, (), config=config, task=1)
+  environment = run_args["environment"]
+  assert environment["LR"] == "0.01"
+  assert environment["NAME"] == "x"
+  assert environment["STOPLIGHT_TASK_ID"] == "1"
+  assert environment["STOPLIGHT_NUM_TASKS"] == "2"
+  # Each task gets its own output files.
+  assert (tmp_path / "job.1.out").exists()
+  assert (tmp_path / "job.1.err").exists()
@@ -0,0 +1,154 @@
+import pytest
+
+from job import Job, JobConfig
+import jobindex
+
+
+def _make_job(job_id, name="test", owner="alice", task=None):
+  """
+  Returns:
+    A Job, which is never started. """
+  config = JobConfig({"Name": name, "Description": "A test job.",
+                      "Container": "test:latest"})
+  return Job("/jobs/%s" % (name), job_id, config, owner=owner, task=task)
+
+def _ids(result):
+  """
+  Returns:
+    The IDs of the jobs from a query, and the value to get the next page
+    with. """
+  jobs, next_page = result
+  return [job["id"] for job in jobs], next_page
+
+
+def test_get():
+  index = jobindex.JobIndex()
+  index.add(_make_job(3, owner="bob", task=2), jobindex.PENDING)
+
+  job = index.get(3)
+  assert job["id"] == 3
+  assert job["name"] == "test"
+  assert job["dir"] == "/jobs/test"
+  assert job["owner"] == "bob"
+  assert job["task"] == 2
+  assert job["state"] == jobindex.PENDING
+  assert job["started"] is None
+  assert index.get(4) is None
+  assert len(index) == 1
+
+def test_state_changes():
+  index = jobindex.JobIndex()
+  index.add(_make_job(0), jobindex.PENDING)
+
+  index.set_state(0, jobindex.RUNNING, launch_time=1.5)
+  job = index.get(0)
+  assert job["state"] == jobindex.RUNNING
+  assert job["started"] is not None
+  assert job["launch_time"] == 1.5
+
+  # Requeued jobs haven't started.
+  index.set_state(0, jobindex.PENDING)
+  assert index.get(0)["started"] is None
+
+  index.set_state(0, jobindex.RUNNING)
+  index.set_state(0, jobindex.SUCCEEDED)
+  job = index.get(0)
+  assert job["finished"] >= job["started"]
+
+def test_query_filters():
+  index = jobindex.JobIndex()
+  index.add(_make_job(0, name="a", owner="alice"), jobindex.PENDING)
+  index.add(_make_job(1, name="b", owner="bob"), jobindex.PENDING)
+  index.add(_make_job(2, name="a", owner="bob"), jobindex.RUNNING)
+  index.add(_make_job(3, name="b", owner="alice"), jobindex.BLOCKED)
+
+  assert _ids(index.query()) == ([0, 1, 2, 3], None)
+  assert _ids(index.query(state=jobindex.PENDING)) == ([0, 1], None)
+  assert _ids(index.query(owner="bob")) == ([1, 2], None)
+  assert _ids(index.query(name="a")) == ([0, 2], None)
+  assert _ids(index.query(owner="alice", name="b")) == ([3], None)
+  assert _ids(index.query(state=jobindex.FAILED)) == ([], None)
+
+  index.set_state(1, jobindex.RUNNING)
+  assert _ids(index.query(state=jobindex.RUNNING)) == ([1, 2], None)
+  assert _ids(index.query(state=jobindex.PENDING)) == ([0], None)
+
+def test_query_pages():
+  index = jobindex.JobIndex()
+  for job_id in range(10):
+    index.add(_make_job(job_id), jobindex.PENDING)
+
+  assert _ids(index.query(limit=4)) == ([0, 1, 2, 3], 3)
+  assert _ids(index.query(after=3, limit=4)) == ([4, 5, 6, 7], 7)
+  assert _ids(index.query(after=7, limit=4)) == ([8, 9], None)
+  # A full last page doesn't point to an empty one.
+  assert _ids(index.query(after=5, limit=4)) == ([6, 7, 8, 9], None)
+
+def test_ids_out_of_order():
+  # Restored jobs can be added after newer ones.
+  index = jobindex.JobIndex()
+  index.add(_make_job(5), jobindex.PENDING)
+  index.add(_make_job(2), jobindex.RUNNING)
+  index.add(_make_job(7), jobindex.PENDING)
+
+  assert _ids(index.query()) == ([2, 5, 7], None)
+  assert _ids(index.query(owner="alice", after=2)) == ([5, 7], None)
+
+def test_finished_jobs_are_forgotten():
+  index = jobindex.JobIndex(max_finished=2)
+  for job_id in range(4):
+    index.add(_make_job(job_id), jobindex.RUNNING)
+  for job_id in (2, 0, 3):
+    index.set_state(job_id, jobindex.SUCCEEDED)
+
+  # The first one to finish goes first.
+  assert index.get(2) is None
+  assert _ids(index.query()) == ([0, 1, 3], None)
+  assert _ids(index.query(state=jobindex.SUCCEEDED)) == ([0, 3], None)
+  assert _ids(index.query(name="test")) == ([0, 1, 3], None)
+
+def test_change_feed():
+  index = jobindex.JobIndex()
+  start = index.get_cursor()
+  index.add(_make_job(0), jobindex.PENDING)
+  index.add(_make_job(1), jobindex.PENDING)
+  index.set_state(0, jobindex.RUNNING)
+  # Setting the same state again isn't a change.
+  index.set_state(0, jobindex.RUNNING)
+
+  changes, cursor, missed = index.get_changes(start)
+  assert [(change["id"], change["state"]) for change in changes] == \
+      [(0, jobindex.PENDING), (1, jobindex.PENDING), (0, jobindex.RUNNING)]
+  assert [change["seq"] for change in changes] == \
+      [start + 1, start + 2, start + 3]
+  assert cursor == start + 3
+  assert not missed
+
+  # Clients pick up where they left off.
+  assert index.get_changes(cursor) == ([], cursor, False)
+  index.set_state(1, jobindex.CANCELLED)
+  changes, cursor, _ = index.get_changes(cursor)
+  assert [(change["id"], change["state"]) for change in changes] == \
+      [(1, jobindex.CANCELLED)]
+
+def test_change_feed_overflow():
+  index = jobindex.JobIndex(max_changes=3)
+  for job_id in range(5):
+    index.add(_make_job(job_id), jobindex.PENDING)
+
+  changes, cursor, missed = index.get_changes(0)
+  assert missed
+  assert [change["id"] for change in changes] == [2, 3, 4]
+  assert cursor == 5
+
+  # Just keeping up isn't missing anything.
+  changes, _, missed = index.get_changes(2)
+  assert not missed
+  assert [change["id"] for change in changes] == [2, 3, 4]
+
+@pytest.mark.parametrize("state", jobindex.FINISHED_STATES)
+def test_every_finished_state_counts(state):
+  index = jobindex.JobIndex(max_finished=0)
+  index.add(_make_job(0), jobindex.PENDING)
+  index.set_state(0, state)
+  assert len(index) == 0
@@ -0,0 +1,48 @@
+import asyncio
+import os
+
+import logtail
+
+
+async def _chunks(*chunks):
+  for chunk in chunks:
+    yield chunk
+
+def _filter(chunks, text=None):
+  """
+  Returns:
+    What filter_lines() generates for some chunks. """
+  async def collect():
+    return [line async for line in logtail.filter_lines(_chunks(*chunks),
+                                                        text)]
+  return asyncio.run(collect())
+
+
+def test_lines_across_chunks():
+  assert _filter([(0, b"one\ntw"), (6, b"o\nthree\n"), (14, b"four")]) == \
+      [(4, b"one"), (8, b"two"), (14, b"three"), (18, b"four")]
+
+def test_truncation():
+  assert _filter([(0, b"old line\npart"), (0, b"new\n")]) == \
+      [(9, b"old line"), (0, None), (4, b"new")]
+
+def test_substring_filter():
+  assert _filter([(0, b"error: 1\nok\nan error\n")], b"error") == \
+      [(9, b"error: 1"), (21, b"an error")]
+
+def test_filter_is_literal():
+  # This would take forever as a regular expression.
+  line = b"a" * 100000 + b"!"
+  assert _filter([(0, line + b"\n")], b"(a+)+$") == []
+  assert _filter([(0, b"x (a+)+$ y\n")], b"(a+)+$") == [(11, b"x (a+)+$ y")]
+
+def test_read_chunks(tmp_path):
+  path = tmp_path / "job.out"
+  path.write_bytes(b"0123456789")
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    assert list(logtail.read_chunks(fd, 3, 8)) == [(3, b"34567")]
+    # The file is shorter than expected.
+    assert list(logtail.read_chunks(fd, 8, 20)) == [(8, b"89")]
+  finally:
+    os.close(fd)
@@ -0,0 +1,44 @@
+import pytest
+
+import nvidia
+
+
+@pytest.mark.parametrize("memory, size", [("12345 MiB", 12345000000),
+                                          ("80", 80000000),
+                                          (" 7 MiB", 7000000)])
+def test_parse_vram(memory, size):
+  assert nvidia.parse_vram(memory) == size
+
+def test_enumerate_every_gpu(fake_nvidia_smi, monkeypatch):
+  monkeypatch.setenv("FAKE_NVIDIA_SMI_GPUS", "4")
+  monkeypatch.setenv("FAKE_NVIDIA_SMI_VRAM", "16000")
+
+  gpus = nvidia.enumerate_gpus()
+  assert [gpu.get_id() for gpu in gpus] == [0, 1, 2, 3]
+  assert [gpu.get_uuid() for gpu in gpus] == \
+      ["GPU-00000000-0000-0000-0000-%012d" % (gpu_id) \
+       for gpu_id in range(4)]
+  assert [gpu.get_total_vram() for gpu in gpus] == [16000000000] * 4
+  assert [gpu.get_bus_id() for gpu in gpus] == \
+      ["00000000:%02X:00.0" % (gpu_id + 1) for gpu_id in range(4)]
+
+def test_enumerate_single_gpu(fake_nvidia_smi, monkeypatch):
+  monkeypatch.setenv("FAKE_NVIDIA_SMI_GPUS", "1")
+
+  gpus = nvidia.enumerate_gpus()
+  assert len(gpus) == 1
+  assert gpus[0].get_id() == 0
+  assert gpus[0].get_total_vram() == 12000000000
+
+def test_probe_is_sorted_by_id(tmp_path):
+  # nvidia-smi doesn't promise any order.
+  script = tmp_path / "nvidia-smi"
+  script.write_text("#!/bin/sh\n"
+                    "echo '1, GPU-b, 200, 00000000:02:00.0'\n"
+                    "echo ''\n"
+                    "echo '0, GPU-a, 100, 00000000:01:00.0'\n")
+  script.chmod(0o755)
+
+  assert nvidia._probe_gpus(str(script)) == \
+      [(0, "GPU-a", 100000000, "00000000:01:00.0"),
+       (1, "GPU-b", 200000000, "00000000:02:00.0")]
@@ -0,0 +1,76 @@
+import gzip
+import os
+
+import output
+
+
+def _write(output_file, data):
+  os.write(output_file.fileno(), data)
+
+def _wait_for_compression():
+  """ Waits until the old output files have been compressed. """
+  output._get_rotation_executor().submit(lambda: None).result()
+
+
+def test_output_path():
+  assert output.get_output_path("/jobs/a", None, "out") == "/jobs/a/job.out"
+  assert output.get_output_path("/jobs/a", 3, "err") == "/jobs/a/job.3.err"
+
+def test_small_files_arent_rotated(tmp_path):
+  path = str(tmp_path / "job.out")
+  output_file = output.OutputFile(path, rotation=output.Rotation(100))
+  _write(output_file, b"x" * 99)
+  output_file.maybe_rotate()
+  output_file.close()
+
+  assert os.listdir(tmp_path) == ["job.out"]
+
+def test_rotation_loses_nothing(tmp_path):
+  path = str(tmp_path / "job.out")
+  output_file = output.OutputFile(path, rotation=output.Rotation(10))
+  fd = output_file.fileno()
+  _write(output_file, b"first line\n")
+  output_file.maybe_rotate()
+  # Writes to the same descriptor go to the new file.
+  assert output_file.fileno() == fd
+  _write(output_file, b"second line\n")
+  output_file.close()
+
+  with open(path + ".1", "rb") as old_file:
+    assert old_file.read() == b"first line\n"
+  with open(path, "rb") as new_file:
+    assert new_file.read() == b"second line\n"
+
+def test_old_files_are_limited(tmp_path):
+  path = str(tmp_path / "job.err")
+  output_file = output.OutputFile(path, rotation=output.Rotation(1, backups=2))
+  for i in range(4):
+    _write(output_file, b"%d" % (i))
+    output_file.maybe_rotate()
+  output_file.close()
+
+  assert sorted(os.listdir(tmp_path)) == ["job.err", "job.err.1", "job.err.2"]
+  with open(path + ".1", "rb") as old_file:
+    assert old_file.read() == b"3"
+  with open(path + ".2", "rb") as old_file:
+    assert old_file.read() == b"2"
+
+def test_compressed_rotation(tmp_path):
+  path = str(tmp_path / "job.out")
+  rotation = output.Rotation(5, backups=2, compress=True)
+  output_file = output.OutputFile(path, rotation=rotation)
+  for i in range(3):
+    _write(output_file, b"output %d\n" % (i))
+    output_file.maybe_rotate()
+    _wait_for_compression()
+  _write(output_file, b"latest\n")
+  output_file.close()
+
+  assert sorted(os.listdir(tmp_path)) == \
+      ["job.out", "job.out.1.gz", "job.out.2.gz"]
+  with gzip.open(path + ".1.gz") as old_file:
+    assert old_file.read() == b"output 2\n"
+  with gzip.open(path + ".2.gz") as old_file:
+    assert old_file.read() == b"output 1\n"
+  with open(path, "rb") as new_file:
+    assert new_file.read() == b"latest\n"
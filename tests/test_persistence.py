@@ -0,0 +1,191 @@
+import json
+
+from job import JobConfig
+from persistence import StateStore
+
+
+class _Job:
+  """ Just enough of a Job to record. """
+
+  def __init__(self, job_id, config, task=None):
+    self.__id = job_id
+    self.__config = config
+    self.__task = task
+
+  def get_id(self):
+    return self.__id
+
+  def get_config(self):
+    return self.__config
+
+  def get_directory(self):
+    return "/jobs/%s" % (self.__config.get_name())
+
+  def get_owner(self):
+    return "alice"
+
+  def get_priority(self):
+    return 1
+
+  def get_task(self):
+    return self.__task
+
+  def get_container_name(self):
+    return "stoplight-job-%d" % (self.__id)
+
+def _make_config(name="test"):
+  """
+  Returns:
+    A JobConfig. """
+  return JobConfig({"Name": name, "Description": "A test job.",
+                    "Container": "test:latest"})
+
+def _reload(tmp_path, **kwargs):
+  """ Loads the state that was saved, the way the daemon does at startup.
+  Args:
+    tmp_path: The state directory.
+    kwargs: Options for the StateStore.
+  Returns:
+    The new StateStore, and what load() returned. """
+  store = StateStore(str(tmp_path), **kwargs)
+  return store, store.load()
+
+
+def test_empty(tmp_path):
+  store, jobs = _reload(tmp_path)
+  assert jobs == []
+  assert store.get_outcomes() == []
+  assert store.allocate_id() == 0
+
+def test_journal_replay(tmp_path):
+  store, _ = _reload(tmp_path)
+  config = _make_config()
+  jobs = [_Job(store.allocate_id(), config, task=task) for task in range(4)]
+  for job in jobs:
+    store.record_add(job)
+  store.record_start(jobs[1], [0, 2], cpus=[4, 5])
+  store.record_start(jobs[2], [1])
+  store.record_requeue(jobs[2].get_id())
+  store.record_finish(jobs[3].get_id())
+  store.record_outcome("/jobs/old", False)
+  store.flush()
+
+  # Nothing is in the snapshot yet, so all of this comes from the journal.
+  store, loaded = _reload(tmp_path)
+  assert [job_id for job_id, _ in loaded] == [0, 1, 2]
+  pending = loaded[0][1]
+  assert pending["dir"] == "/jobs/test"
+  assert pending["config"] == config.get_data()
+  assert pending["owner"] == "alice"
+  assert pending["priority"] == 1
+  assert pending["task"] == 0
+  assert "container" not in pending
+
+  running = loaded[1][1]
+  assert running["gpus"] == [0, 2]
+  assert running["cpus"] == [4, 5]
+  assert running["container"] == "stoplight-job-1"
+  assert running["time"] is not None
+  # Requeued jobs are pending again.
+  assert "gpus" not in loaded[2][1]
+
+  assert store.get_outcomes() == [("/jobs/old", False)]
+  # IDs aren't reused, even those of finished jobs.
+  assert store.allocate_id() == 4
+
+def test_launching_jobs(tmp_path):
+  store, _ = _reload(tmp_path)
+  job = _Job(store.allocate_id(), _make_config())
+  store.record_add(job)
+  store.record_launch(job, "stoplight-job-0", [1])
+  store.flush()
+
+  _, loaded = _reload(tmp_path)
+  record = loaded[0][1]
+  # The container can be looked for, even though it never started.
+  assert record["launching"] == "stoplight-job-0"
+  assert record["gpus"] == [1]
+
+def test_snapshot_replay(tmp_path):
+  store, _ = _reload(tmp_path, snapshot_interval=5)
+  config = _make_config()
+  jobs = [_Job(store.allocate_id(), config) for _ in range(6)]
+  for job in jobs:
+    store.record_add(job)
+  # The journal is long enough now.
+  store.flush()
+  assert (tmp_path / "journal.jsonl").read_text() == ""
+
+  store.record_finish(jobs[0].get_id())
+  store.record_start(jobs[1], [0])
+  store.flush()
+
+  # The snapshot and the journal since then are combined.
+  _, loaded = _reload(tmp_path)
+  assert [job_id for job_id, _ in loaded] == [1, 2, 3, 4, 5]
+  assert loaded[0][1]["container"] == "stoplight-job-1"
+
+def test_configs_are_shared(tmp_path):
+  store, _ = _reload(tmp_path)
+  config = _make_config()
+  for _ in range(3):
+    store.record_add(_Job(store.allocate_id(), config))
+  store.record_add(_Job(store.allocate_id(), _make_config("other")))
+  store.flush()
+
+  entries = [json.loads(line) for line in \
+             (tmp_path / "journal.jsonl").read_text().splitlines()]
+  assert [entry["op"] for entry in entries].count("config") == 2
+
+  store, loaded = _reload(tmp_path)
+  snapshot = json.loads((tmp_path / "snapshot.json").read_text())
+  assert len(snapshot["configs"]) == 2
+  assert [record["config"]["Name"] for _, record in loaded] == \
+      ["test", "test", "test", "other"]
+
+  # Configurations that no jobs use are forgotten.
+  for job_id, _ in loaded[:3]:
+    store.record_finish(job_id)
+  store.snapshot()
+  snapshot = json.loads((tmp_path / "snapshot.json").read_text())
+  assert len(snapshot["configs"]) == 1
+
+def test_replay_is_idempotent(tmp_path):
+  store, _ = _reload(tmp_path)
+  job = _Job(store.allocate_id(), _make_config())
+  store.record_add(job)
+  store.record_start(job, [0])
+  store.flush()
+  journal = (tmp_path / "journal.jsonl").read_text()
+
+  # The daemon died after taking a snapshot, but before truncating the
+  # journal.
+  _reload(tmp_path)
+  (tmp_path / "journal.jsonl").write_text(journal)
+  _, loaded = _reload(tmp_path)
+  assert len(loaded) == 1
+  assert loaded[0][1]["container"] == "stoplight-job-0"
+
+def test_corrupt_entries_are_skipped(tmp_path):
+  store, _ = _reload(tmp_path)
+  for _ in range(2):
+    store.record_add(_Job(store.allocate_id(), _make_config()))
+  store.flush()
+  # The daemon died in the middle of writing an entry.
+  with open(tmp_path / "journal.jsonl", "a") as journal_file:
+    journal_file.write('{"op": "finish", "i')
+
+  _, loaded = _reload(tmp_path)
+  assert [job_id for job_id, _ in loaded] == [0, 1]
+
+def test_outcomes_are_limited(tmp_path):
+  store, _ = _reload(tmp_path, max_outcomes=2)
+  for name in ("a", "b", "c"):
+    store.record_outcome("/jobs/%s" % (name), name != "b")
+  # Recording one again makes it the newest.
+  store.record_outcome("/jobs/b", True)
+  assert store.get_outcomes() == [("/jobs/c", True), ("/jobs/b", True)]
+  store.flush()
+
+  store, _ = _reload(tmp_path, max_outcomes=2)
+  assert store.get_outcomes() == [("/jobs/c", True), ("/jobs/b", True)]
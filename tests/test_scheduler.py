@@ -0,0 +1,188 @@
+from scheduler import PendingQueue, Planner, choose_gpus
+
+
+def _make_planner(gpus=2, max_reservations=0):
+  """
+  Returns:
+    A Planner for an empty machine with some 1000 byte GPUs. """
+  return Planner(0.0, (0, 0, [0] * gpus, [0] * gpus), [1000] * gpus, [],
+                 max_reservations=max_reservations)
+
+def _place_all(queue, planner, **kwargs):
+  """
+  Returns:
+    The jobs that pop_runnable() started, and how many times it tried to
+    place one. """
+  attempts = []
+
+  def place(job, requirements):
+    attempts.append(job)
+    return planner.place(requirements)
+
+  runnable = queue.pop_runnable(place, has_room=planner.has_room, **kwargs)
+  return [job for job, _, _ in runnable], len(attempts)
+
+
+def test_fifo_across_buckets():
+  queue = PendingQueue()
+  queue.add("a", (10, 10, 0, 0, 0))
+  queue.add("b", (20, 10, 0, 0, 0))
+  queue.add("c", (10, 10, 0, 0, 0))
+  queue.add("d", (10, 10, 0, 0, 0), priority=1)
+
+  started, _ = _place_all(queue, _make_planner())
+  assert started == ["d", "a", "b", "c"]
+  assert len(queue) == 0
+  assert queue.get_num_buckets() == 0
+
+def test_skips_jobs_that_dont_fit():
+  queue = PendingQueue()
+  queue.add("big", (80, 10, 0, 0, 0))
+  queue.add("bigger", (90, 10, 0, 0, 0))
+  queue.add("small", (20, 10, 0, 0, 0))
+
+  started, _ = _place_all(queue, _make_planner())
+  assert started == ["big", "small"]
+  assert len(queue) == 1
+
+def test_stops_once_full():
+  queue = PendingQueue()
+  for i in range(100):
+    queue.add("job %d" % (i), (30 + i % 50, 1, 0, 0, 0), owner=str(i))
+
+  started, attempts = _place_all(queue, _make_planner())
+  # Once 98% of the CPU is used, even the smallest job doesn't fit, so the
+  # rest of the buckets aren't tried.
+  assert started == ["job 0", "job 1", "job 2"]
+  assert attempts == 3
+
+def test_stops_once_gpus_are_full():
+  queue = PendingQueue()
+  queue.add("first", (1, 1, 2, 60, 100))
+  for i in range(50):
+    queue.add("job %d" % (i), (1, 1, 1, 50 + i, 100), owner=str(i))
+
+  started, attempts = _place_all(queue, _make_planner())
+  # No GPU has the 50% that the smallest job needs left.
+  assert started == ["first"]
+  assert attempts == 1
+
+def test_has_room_counts_held_resources():
+  planner = _make_planner(gpus=1)
+  planner.place((50, 50, 1, 100, 1000))
+  assert not planner.has_room((50, 50, 1, 100, 1000))
+
+  planner = _make_planner(gpus=1)
+  planner.hold((50, 50, 1, 100, 1000), (0,))
+  # The job that they are held for can still use them.
+  assert planner.has_room((50, 50, 1, 100, 1000))
+
+def test_skipped_buckets_are_kept():
+  queue = PendingQueue()
+  queue.add("big", (90, 10, 0, 0, 0))
+  queue.add("small", (50, 10, 0, 0, 0))
+
+  planner = _make_planner()
+  planner.place((60, 0, 0, 0, 0))
+  started, _ = _place_all(queue, planner)
+  assert started == []
+
+  # The next pass still sees both buckets, in order.
+  started, _ = _place_all(queue, _make_planner())
+  assert started == ["big"]
+  started, _ = _place_all(queue, _make_planner())
+  assert started == ["small"]
+
+def test_jobs_put_back_in_place():
+  queue = PendingQueue()
+  queue.add("a", (10, 10, 0, 0, 0))
+  queue.add("b", (10, 10, 0, 0, 0))
+  started, _ = _place_all(queue, _make_planner())
+  assert started == ["a", "b"]
+
+  queue.add("c", (10, 10, 0, 0, 0))
+  # Requeued jobs keep their original position.
+  queue.add("b", (10, 10, 0, 0, 0), sequence=1)
+  queue.add("a", (10, 10, 0, 0, 0), sequence=0)
+  started, _ = _place_all(queue, _make_planner())
+  assert started == ["a", "b", "c"]
+
+def test_fair_share_order():
+  queue = PendingQueue()
+  queue.add("alice 1", (10, 10, 0, 0, 0), owner="alice")
+  queue.add("alice 2", (20, 10, 0, 0, 0), owner="alice")
+  queue.add("bob 1", (10, 10, 0, 0, 0), owner="bob")
+
+  shares = {"alice": 2.0, "bob": 0.5}
+  started, _ = _place_all(queue, _make_planner(), get_share=shares.get)
+  assert started == ["bob 1", "alice 1", "alice 2"]
+
+def test_ready_images_go_first():
+  queue = PendingQueue()
+  queue.add("a", (60, 10, 0, 0, 0), image="pulling")
+  queue.add("b", (60, 10, 0, 0, 0), image="present")
+
+  started, _ = _place_all(queue, _make_planner(),
+                          is_ready=lambda image: image == "present")
+  assert started == ["b"]
+  assert queue.get_images() == ["pulling"]
+
+def test_images_that_arent_ready_use_idle_resources():
+  queue = PendingQueue()
+  queue.add("big", (90, 10, 0, 0, 0), image="present")
+  queue.add("small 1", (20, 10, 0, 0, 0), image="pulling")
+  queue.add("small 2", (20, 10, 0, 0, 0), image="pulling")
+  queue.add("small 3", (10, 10, 0, 0, 0), image="present")
+
+  planner = _make_planner()
+  planner.place((50, 0, 0, 0, 0))
+  started, _ = _place_all(queue, planner,
+                          is_ready=lambda image: image == "present")
+  # Nothing that is ready can use the rest, so it isn't left idle.
+  assert started == ["small 3", "small 1", "small 2"]
+  assert queue.get_images() == ["present"]
+
+def test_remove():
+  queue = PendingQueue()
+  queue.add("a", (10, 10, 0, 0, 0))
+  queue.add("b", (10, 10, 0, 0, 0))
+  queue.add("c", (20, 10, 0, 0, 0))
+
+  assert queue.remove("a", (10, 10, 0, 0, 0))
+  assert not queue.remove("a", (10, 10, 0, 0, 0))
+  assert not queue.remove("c", (10, 10, 0, 0, 0))
+  assert queue.remove("c", (20, 10, 0, 0, 0))
+  assert len(queue) == 1
+  assert queue.get_num_buckets() == 1
+
+  started, _ = _place_all(queue, _make_planner())
+  assert started == ["b"]
+
+
+def test_choose_gpus_no_gpus():
+  assert choose_gpus(0, 0, 0, [100], [1000], [1000]) == ()
+
+def test_choose_gpus_best_fit():
+  # GPU 1 is the one that the job leaves the least room on.
+  assert choose_gpus(1, 40, 100, [20, 50, 0], [0, 0, 0],
+                     [1000, 1000, 1000]) == (1,)
+  # VRAM counts as much as utilization.
+  assert choose_gpus(1, 10, 100, [0, 0], [800, 0], [1000, 1000]) == (0,)
+
+def test_choose_gpus_multiple():
+  gpus = choose_gpus(2, 50, 100, [50, 0, 60, 25], [0, 0, 0, 0],
+                     [1000] * 4)
+  # GPU 2 doesn't have room, and GPUs 0 and 3 are the tightest fits.
+  assert gpus == (0, 3)
+
+def test_choose_gpus_not_enough():
+  assert choose_gpus(2, 50, 100, [60, 0], [0, 0], [1000, 1000]) is None
+  assert choose_gpus(1, 10, 600, [0, 0], [500, 500], [1000, 1000]) is None
+  assert choose_gpus(3, 10, 10, [0, 0], [0, 0], [1000, 1000]) is None
+
+def test_choose_gpus_exact_fit():
+  assert choose_gpus(1, 50, 500, [50], [500], [1000]) == (0,)
+
+def test_choose_gpus_different_sizes():
+  # The job only fits on the bigger GPU.
+  assert choose_gpus(1, 10, 2000, [0, 0], [0, 0], [1000, 4000]) == (1,)
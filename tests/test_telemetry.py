@@ -0,0 +1,95 @@
+import os
+import time
+
+import pytest
+
+import telemetry
+
+
+def _write_script(path, output):
+  """ Replaces nvidia-smi with a script that prints some canned samples, and
+  then sleeps so that they don't go stale.
+  Args:
+    path: The path to nvidia-smi.
+    output: The lines to print. """
+  with open(path, "w") as script:
+    script.write("#!/bin/sh\n")
+    for line in output:
+      script.write("echo '%s'\n" % (line))
+    script.write("exec sleep 5\n")
+  os.chmod(path, 0o755)
+
+def _wait_for_usage(gpu_telemetry, gpu_id, timeout=10.0):
+  """
+  Returns:
+    The usage of a GPU, once there is one. """
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    usage = gpu_telemetry.get_usage(gpu_id)
+    if usage is not None:
+      return usage
+    time.sleep(0.01)
+  return None
+
+
+def test_samples_from_fake_nvidia_smi(fake_nvidia_smi, monkeypatch):
+  monkeypatch.setenv("FAKE_NVIDIA_SMI_GPUS", "2")
+  monkeypatch.setenv("FAKE_NVIDIA_SMI_UTIL", "37")
+  monkeypatch.setenv("FAKE_NVIDIA_SMI_USED", "1234")
+
+  gpu_telemetry = telemetry.GpuTelemetry(interval=0.05)
+  gpu_telemetry.start()
+  assert _wait_for_usage(gpu_telemetry, 0) == (37, 1234000000)
+  assert _wait_for_usage(gpu_telemetry, 1) == (37, 1234000000)
+  assert gpu_telemetry.get_usage(2) is None
+
+def test_peak_over_history(fake_nvidia_smi):
+  _write_script(fake_nvidia_smi, ["0, 10, 100", "0, 80, 50", "0, 20, 300"])
+
+  gpu_telemetry = telemetry.GpuTelemetry(interval=1.0)
+  gpu_telemetry.start()
+  assert _wait_for_usage(gpu_telemetry, 0) is not None
+  # All three lines are read at once.
+  time.sleep(0.2)
+  assert gpu_telemetry.get_usage(0) == (80, 300000000)
+
+def test_history_is_limited(fake_nvidia_smi):
+  _write_script(fake_nvidia_smi, ["0, 90, 900", "0, 10, 100", "0, 20, 200"])
+
+  gpu_telemetry = telemetry.GpuTelemetry(interval=1.0, history=2)
+  gpu_telemetry.start()
+  assert _wait_for_usage(gpu_telemetry, 0) is not None
+  time.sleep(0.2)
+  assert gpu_telemetry.get_usage(0) == (20, 200000000)
+
+@pytest.mark.parametrize("line", ["0, [N/A], 100", "0, 10", "junk",
+                                  "0, 10, 100, 7", "x, 10, 100"])
+def test_bad_samples_are_skipped(fake_nvidia_smi, line):
+  _write_script(fake_nvidia_smi, [line, "1, 5, 10"])
+
+  gpu_telemetry = telemetry.GpuTelemetry(interval=1.0)
+  gpu_telemetry.start()
+  assert _wait_for_usage(gpu_telemetry, 1) == (5, 10000000)
+  assert gpu_telemetry.get_usage(0) is None
+
+def test_stale_samples_are_ignored(fake_nvidia_smi):
+  _write_script(fake_nvidia_smi, ["0, 10, 100"])
+
+  gpu_telemetry = telemetry.GpuTelemetry(interval=0.05)
+  gpu_telemetry.start()
+  assert _wait_for_usage(gpu_telemetry, 0) == (10, 100000000)
+  # Nothing else gets printed.
+  time.sleep(0.3)
+  assert gpu_telemetry.get_usage(0) is None
+
+def test_restarts_when_nvidia_smi_is_missing(fake_nvidia_smi, monkeypatch):
+  monkeypatch.setenv("FAKE_NVIDIA_SMI_UTIL", "12")
+  gpu_telemetry = telemetry.GpuTelemetry(interval=0.05)
+  moved = fake_nvidia_smi + ".moved"
+  os.rename(fake_nvidia_smi, moved)
+  gpu_telemetry.start()
+  time.sleep(0.2)
+  assert gpu_telemetry.get_usage(0) is None
+
+  os.rename(moved, fake_nvidia_smi)
+  assert _wait_for_usage(gpu_telemetry, 0) == (12, 0)
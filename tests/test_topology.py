@@ -0,0 +1,129 @@
+import os
+
+import pytest
+
+from fake_backends import make_gpus, make_sysfs
+import topology
+
+
+@pytest.mark.parametrize("text, cpus", [
+    ("0", [0]),
+    ("0-3", [0, 1, 2, 3]),
+    ("0-3,8-11\n", [0, 1, 2, 3, 8, 9, 10, 11]),
+    ("5,1-2,", [1, 2, 5]),
+    ("0-1,1-2", [0, 1, 2]),
+    ("", [])])
+def test_parse_cpu_list(text, cpus):
+  assert topology.parse_cpu_list(text) == cpus
+
+@pytest.mark.parametrize("cpus, text", [
+    ([0], "0"),
+    ([0, 1, 2, 3], "0-3"),
+    ([8, 0, 1, 2, 3, 9], "0-3,8-9"),
+    ([1, 3, 5], "1,3,5"),
+    ([], "")])
+def test_format_cpu_list(cpus, text):
+  assert topology.format_cpu_list(cpus) == text
+
+def test_cpu_list_round_trip():
+  cpus = [0, 1, 2, 3, 7, 16, 17, 31]
+  assert topology.parse_cpu_list(topology.format_cpu_list(cpus)) == cpus
+
+
+def test_read_topology(tmp_path):
+  # Two sockets, with the second hardware thread of each core numbered after
+  # all the first ones, and a GPU that isn't attached to a node.
+  make_sysfs(str(tmp_path), ["0-3,8-11", "4-7,12-15"], [0, 1, 1, -1])
+  gpus = make_gpus(4)
+  machine = topology.read_topology(gpus, root=str(tmp_path))
+
+  assert machine.get_nodes() == [0, 1]
+  assert machine.get_cpus(0) == [0, 1, 2, 3, 8, 9, 10, 11]
+  assert machine.get_cpus(1) == [4, 5, 6, 7, 12, 13, 14, 15]
+  assert machine.get_num_cpus() == 16
+  assert [machine.get_gpu_node(gpu.get_id()) for gpu in gpus] == \
+      [0, 1, 1, None]
+
+def test_read_topology_offline_cpus(tmp_path):
+  make_sysfs(str(tmp_path), ["0-3", "4-7"], [])
+  online_path = tmp_path / "sys" / "devices" / "system" / "cpu" / "online"
+  online_path.write_text("0-2,4\n")
+  # Nodes with only memory have no CPUs.
+  memory_node = tmp_path / "sys" / "devices" / "system" / "node" / "node2"
+  memory_node.mkdir()
+  (memory_node / "cpulist").write_text("\n")
+
+  machine = topology.read_topology([], root=str(tmp_path))
+  assert machine.get_nodes() == [0, 1]
+  assert machine.get_cpus(0) == [0, 1, 2]
+  assert machine.get_cpus(1) == [4]
+
+def test_read_topology_without_numa(tmp_path):
+  make_sysfs(str(tmp_path), ["0-7"], [])
+  node_root = tmp_path / "sys" / "devices" / "system" / "node"
+  (node_root / "node0" / "cpulist").unlink()
+  os.rmdir(node_root / "node0")
+
+  machine = topology.read_topology(make_gpus(1), root=str(tmp_path))
+  assert machine.get_nodes() == [0]
+  assert machine.get_cpus(0) == list(range(8))
+  # With a single node, every GPU is on it.
+  assert machine.get_gpu_node(0) == 0
+
+
+def _make_allocator(nodes, gpu_nodes=None):
+  """
+  Args:
+    nodes: Dictionary mapping node IDs to their CPUs.
+    gpu_nodes: Dictionary mapping GPU IDs to their nodes.
+  Returns:
+    A CpuAllocator for the machine. """
+  return topology.CpuAllocator(topology.Topology(nodes, gpu_nodes or {}))
+
+def test_allocate_prefers_gpu_node():
+  allocator = _make_allocator({0: list(range(8)), 1: list(range(8, 16))},
+                              {0: 0, 1: 1})
+  assert allocator.allocate(2, gpus=(1,)) == ([8, 9], [1])
+  assert allocator.allocate(2, gpus=(0,)) == ([0, 1], [0])
+  assert allocator.allocate(2, gpus=(0,)) == ([2, 3], [0])
+  # Without GPUs, the emptiest node is used.
+  assert allocator.allocate(4) == ([10, 11, 12, 13], [1])
+
+def test_allocate_falls_back_to_other_node():
+  allocator = _make_allocator({0: list(range(4)), 1: list(range(4, 8))},
+                              {0: 0})
+  assert allocator.allocate(4, gpus=(0,)) == ([0, 1, 2, 3], [0])
+  assert allocator.allocate(2, gpus=(0,)) == ([4, 5], [1])
+
+def test_allocate_best_fit():
+  allocator = _make_allocator({0: list(range(12))})
+  allocator.reserve([0, 1, 6, 7, 8])
+  # The free runs are 2-5 and 9-11. The smaller one that fits is used, which
+  # keeps the bigger run free for bigger jobs.
+  assert allocator.allocate(3) == ([9, 10, 11], [0])
+  assert allocator.allocate(4) == ([2, 3, 4, 5], [0])
+  assert allocator.allocate(1) is None
+
+def test_allocate_contiguous_only():
+  allocator = _make_allocator({0: list(range(8))})
+  allocator.reserve([1, 3, 5, 7])
+  # There are 4 free CPUs, but no 2 of them are in a row.
+  assert allocator.allocate(2) is None
+  assert allocator.allocate(1) == ([0], [0])
+
+def test_runs_dont_span_gaps_in_numbering():
+  allocator = _make_allocator({0: [0, 1, 8, 9]})
+  assert allocator.allocate(3) is None
+  assert allocator.allocate(2) == ([0, 1], [0])
+
+def test_release():
+  allocator = _make_allocator({0: list(range(4))})
+  first, _ = allocator.allocate(2)
+  second, _ = allocator.allocate(2)
+  assert allocator.allocate(1) is None
+
+  allocator.release(first)
+  assert allocator.allocate(2) == (first, [0])
+  allocator.release(second)
+  allocator.release(first)
+  assert allocator.allocate(4) == ([0, 1, 2, 3], [0])
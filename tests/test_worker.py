@@ -0,0 +1,124 @@
+import queue
+import time
+
+import worker
+
+
+class _FakeCoordinator:
+  """ Records heartbeats, and answers them with canned replies. """
+
+  def __init__(self, make_json_server):
+    self.beats = queue.Queue()
+    # (status, reply) pairs to answer the next heartbeats with. After they run
+    # out, heartbeats are acknowledged.
+    self.replies = []
+    self.address = make_json_server(self.__handle)
+
+  def __handle(self, path, body):
+    self.beats.put(body)
+    if self.replies:
+      return self.replies.pop(0)
+    return 200, {}
+
+  def next_beat(self, timeout=10.0):
+    """
+    Returns:
+      The next heartbeat that was sent. """
+    return self.beats.get(timeout=timeout)
+
+def _start_reporter(coordinator):
+  """
+  Returns:
+    A running Reporter that sends heartbeats to the coordinator. """
+  reporter = worker.Reporter(coordinator.address, "worker-1", "worker:5000",
+                             interval=0.05)
+  reporter.start()
+  return reporter
+
+
+def test_diff():
+  assert worker._diff({"a": 1, "b": 2}, {"a": 1, "b": 3, "c": 4}) == \
+      {"b": 3, "c": 4}
+  assert worker._diff({"a": 1}, {"a": 1}) == {}
+
+def test_full_heartbeat_lists_jobs(make_json_server):
+  coordinator = _FakeCoordinator(make_json_server)
+  reporter = _start_reporter(coordinator)
+  # Nothing is sent until the manager lists our jobs.
+  time.sleep(0.2)
+  assert coordinator.beats.empty()
+  assert reporter.needs_jobs()
+
+  reporter.report({"cpu": 10}, ["/jobs/b"], [], jobs=(["/jobs/a"], ["/jobs/c"]))
+  beat = coordinator.next_beat()
+  assert beat["full"]
+  assert beat["worker"] == "worker-1"
+  assert beat["url"] == "worker:5000"
+  assert beat["changes"] == {"cpu": 10}
+  assert beat["running"] == ["/jobs/a"]
+  assert beat["pending"] == ["/jobs/c"]
+  assert beat["started"] == ["/jobs/b"]
+  assert not reporter.needs_jobs()
+
+def test_only_changes_are_sent(make_json_server):
+  coordinator = _FakeCoordinator(make_json_server)
+  reporter = _start_reporter(coordinator)
+  reporter.report({"cpu": 10, "ram": 20}, [], [], jobs=([], []))
+  assert coordinator.next_beat()["full"]
+
+  reporter.report({"cpu": 10, "ram": 30}, [], ["/jobs/a"])
+  beat = coordinator.next_beat()
+  assert not beat["full"]
+  assert "running" not in beat
+  assert beat["changes"] == {"ram": 30}
+  assert beat["finished"] == ["/jobs/a"]
+  # It doesn't get sent again.
+  assert coordinator.next_beat()["finished"] == []
+
+def test_failed_heartbeats_are_resent(make_json_server):
+  coordinator = _FakeCoordinator(make_json_server)
+  reporter = _start_reporter(coordinator)
+  reporter.report({"cpu": 10}, [], [], jobs=([], []))
+  assert coordinator.next_beat()["full"]
+
+  coordinator.replies.append((500, {}))
+  reporter.report({"cpu": 20}, ["/jobs/a"], [])
+  assert coordinator.next_beat()["started"] == ["/jobs/a"]
+  beat = coordinator.next_beat()
+  assert beat["changes"] == {"cpu": 20}
+  assert beat["started"] == ["/jobs/a"]
+
+def test_resync(make_json_server):
+  coordinator = _FakeCoordinator(make_json_server)
+  reporter = _start_reporter(coordinator)
+  reporter.report({"cpu": 10}, [], [], jobs=([], ["/jobs/a"]))
+  assert coordinator.next_beat()["full"]
+
+  coordinator.replies.append((200, {"resync": True}))
+  reporter.report({"cpu": 10}, ["/jobs/a"], [])
+  assert not coordinator.next_beat()["full"]
+  # The coordinator needs a new list of our jobs.
+  deadline = time.monotonic() + 10.0
+  while not reporter.needs_jobs() and time.monotonic() < deadline:
+    time.sleep(0.01)
+  assert reporter.needs_jobs()
+
+  reporter.report({"cpu": 10}, [], [], jobs=(["/jobs/a"], []))
+  beat = coordinator.next_beat()
+  assert beat["full"]
+  assert beat["changes"] == {"cpu": 10}
+  assert beat["running"] == ["/jobs/a"]
+  # The event was already dealt with.
+  assert beat["started"] == []
+
+def test_cancel_requests_are_taken_once(make_json_server):
+  coordinator = _FakeCoordinator(make_json_server)
+  coordinator.replies = [(200, {"cancel": ["/jobs/a"]})] * 3 + \
+                        [(200, {"cancel": ["/jobs/a", "/jobs/b"]})]
+  reporter = _start_reporter(coordinator)
+  reporter.report({}, [], [], jobs=([], ["/jobs/a", "/jobs/b"]))
+  for _ in range(5):
+    coordinator.next_beat()
+
+  assert reporter.take_cancelled() == {"/jobs/a", "/jobs/b"}
+  assert reporter.take_cancelled() == set()
@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+
+
+import argparse
+import http.server
+import json
+import os
+import signal
+import socketserver
+import struct
+import subprocess
+import threading
+import time
+import urllib.parse
+
+
+""" A stand-in for the Docker Engine API, so that the daemon can be run on
+machines without docker. It listens on a unix socket, and implements just
+enough of the API for the daemon. Instead of running containers, it runs the
+job script directly on the host, from the job directory. Point the daemon at it
+with DOCKER_HOST=unix:///path/to/socket. """
+
+
+def _normalize(image):
+  """ Adds the default tag to an image name if it doesn't have one, or a
+  digest.
+  Args:
+    image: The name of the image.
+  Returns:
+    The name with a tag or a digest. """
+  if "@" not in image and ":" not in image.rpartition("/")[2]:
+    image += ":latest"
+  return image
+
+
+class _Container:
+  """ A fake container. """
+
+  def __init__(self, name, config):
+    """
+    Args:
+      name: The name of the container.
+      config: The configuration it was created with. """
+    self.name = name
+    self.config = config
+    self.process = None
+    self.exit_code = 0
+    self.finished = threading.Event()
+    # Set once the process has closed its output, which can be before it
+    # exits.
+    self.output_closed = threading.Event()
+    # Sockets that are attached to the output.
+    self.attached = []
+    self.lock = threading.Lock()
+
+  def get_state(self):
+    """
+    Returns:
+      The state of the container, as reported by the API. """
+    if self.process is None:
+      return "created"
+    if self.finished.is_set():
+      return "exited"
+    return "running"
+
+  def __forward(self, pipe, stream):
+    """ Forwards output from the process to attached clients.
+    Args:
+      pipe: The pipe to read from.
+      stream: The stream number in the multiplexed output. """
+    while True:
+      data = os.read(pipe.fileno(), 65536)
+      if not data:
+        break
+
+      frame = struct.pack(">BxxxL", stream, len(data)) + data
+      with self.lock:
+        for client in self.attached:
+          try:
+            client.sendall(frame)
+          except OSError:
+            pass
+
+  def start(self):
+    """ Starts running the job script on the host. """
+    # Find the job directory that is mounted under /job_files.
+    host_dir = None
+    for bind in self.config["HostConfig"].get("Binds", []):
+      source, _, target = bind.partition(":")
+      if target == "/job_files":
+        host_dir = source
+    command = self.config["Cmd"][0].replace("/job_files", host_dir, 1)
+
+    environment = dict(os.environ)
+    for variable in self.config.get("Env") or []:
+      name, _, value = variable.partition("=")
+      environment[name] = value
+
+    self.process = subprocess.Popen([command], cwd=host_dir,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, env=environment,
+                                    start_new_session=True)
+    forwarders = [threading.Thread(target=self.__forward,
+                                   args=(self.process.stdout, 1)),
+                  threading.Thread(target=self.__forward,
+                                   args=(self.process.stderr, 2))]
+    for forwarder in forwarders:
+      forwarder.start()
+
+    def wait():
+      for forwarder in forwarders:
+        forwarder.join()
+      self.output_closed.set()
+      self.exit_code = self.process.wait()
+      self.finished.set()
+    threading.Thread(target=wait, daemon=True).start()
+
+
+class _State:
+  """ The state of the fake docker engine. """
+
+  def __init__(self, pull_time, image_size):
+    """
+    Args:
+      pull_time: How long it takes to pull an image, in seconds.
+      image_size: The size that pulled images have, in bytes. """
+    self.pull_time = pull_time
+    self.image_size = image_size
+    # Maps container names to containers.
+    self.containers = {}
+    # Maps image names to their sizes.
+    self.images = {}
+    self.lock = threading.Lock()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+  """ Handles API requests. """
+
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    # Keep quiet.
+    pass
+
+  def __reply(self, status, body=None):
+    """ Sends a JSON reply.
+    Args:
+      status: The HTTP status code.
+      body: The object to send. """
+    data = b""
+    if body is not None:
+      data = json.dumps(body).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def __parse(self):
+    """ Parses the request.
+    Returns:
+      The path components after the API version, the query parameters, and
+      the decoded body. """
+    url = urllib.parse.urlparse(self.path)
+    parts = url.path.strip("/").split("/")[1:]
+    query = dict(urllib.parse.parse_qsl(url.query))
+
+    body = None
+    length = int(self.headers.get("Content-Length", 0))
+    if length:
+      body = json.loads(self.rfile.read(length).decode("utf-8"))
+
+    return parts, query, body
+
+  def __get_container(self, name):
+    """ Finds a container.
+    Args:
+      name: The name of the container.
+    Returns:
+      The container, or None if it doesn't exist, in which case an error is
+      sent. """
+    with self.server.state.lock:
+      container = self.server.state.containers.get(name)
+    if container is None:
+      self.__reply(404, {"message": "No such container: %s" % (name)})
+    return container
+
+  def do_GET(self):
+    parts, query, _ = self.__parse()
+    state = self.server.state
+
+    if parts == ["containers", "json"]:
+      with state.lock:
+        containers = list(state.containers.values())
+      self.__reply(200, [{"Names": ["/" + container.name],
+                          "State": container.get_state()} \
+                         for container in containers])
+    elif parts == ["images", "json"]:
+      with state.lock:
+        images = list(state.images.items())
+      # Images that were pulled by digest have no tags.
+      self.__reply(200, [{"RepoTags": [] if "@" in name else [name],
+                          "RepoDigests": [name] if "@" in name else [],
+                          "Size": size} \
+                         for name, size in images])
+    elif len(parts) > 2 and parts[0] == "images" and parts[-1] == "json":
+      image = "/".join(parts[1:-1])
+      with state.lock:
+        size = state.images.get(image)
+      if size is None:
+        self.__reply(404, {"message": "No such image: %s" % (image)})
+      else:
+        self.__reply(200, {"RepoTags": [image], "Size": size})
+    elif len(parts) == 3 and parts[0] == "containers" and parts[2] == "json":
+      container = self.__get_container(parts[1])
+      if container:
+        self.__reply(200, {"State": {"Status": container.get_state(),
+                                     "Running": container.get_state() == \
+                                                "running",
+                                     "ExitCode": container.exit_code}})
+    else:
+      self.__reply(404, {"message": "Unknown endpoint."})
+
+  def do_POST(self):
+    parts, query, body = self.__parse()
+    state = self.server.state
+
+    if parts == ["containers", "create"]:
+      name = query["name"]
+      with state.lock:
+        if _normalize(body["Image"]) not in state.images:
+          self.__reply(404, {"message": "No such image: %s" % \
+                                        (body["Image"])})
+          return
+        if name in state.containers:
+          self.__reply(409, {"message": "Name in use."})
+          return
+        state.containers[name] = _Container(name, body)
+      self.__reply(201, {"Id": name, "Warnings": []})
+
+    elif parts == ["images", "create"]:
+      time.sleep(state.pull_time)
+      image = query["fromImage"]
+      if "@" not in image:
+        image = "%s:%s" % (image, query.get("tag", "latest"))
+      with state.lock:
+        state.images[image] = state.image_size
+      self.__reply(200, {"status": "Downloaded newer image"})
+
+    elif len(parts) == 3 and parts[0] == "containers":
+      container = self.__get_container(parts[1])
+      if not container:
+        return
+
+      if parts[2] == "start":
+        container.start()
+        self.__reply(204)
+      elif parts[2] == "attach":
+        self.__attach(container)
+      elif parts[2] == "kill":
+        signal_name = query.get("signal", "SIGKILL")
+        if not signal_name.startswith("SIG"):
+          signal_name = "SIG" + signal_name
+        if container.process and not container.finished.is_set():
+          # Signal everything in the container, like docker does.
+          os.killpg(container.process.pid, getattr(signal, signal_name))
+        self.__reply(204)
+      elif parts[2] == "wait":
+        container.finished.wait()
+        self.__reply(200, {"StatusCode": container.exit_code})
+      else:
+        self.__reply(404, {"message": "Unknown endpoint."})
+
+    else:
+      self.__reply(404, {"message": "Unknown endpoint."})
+
+  def do_DELETE(self):
+    parts, query, _ = self.__parse()
+    state = self.server.state
+
+    if len(parts) == 2 and parts[0] == "containers":
+      with state.lock:
+        container = state.containers.get(parts[1])
+        if container and container.get_state() == "running":
+          if query.get("force") != "1":
+            self.__reply(409, {"message": "You cannot remove a running" \
+                                          " container."})
+            return
+          os.killpg(container.process.pid, signal.SIGKILL)
+        state.containers.pop(parts[1], None)
+      self.__reply(204 if container else 404)
+    elif len(parts) >= 2 and parts[0] == "images":
+      image = "/".join(parts[1:])
+      with state.lock:
+        size = state.images.pop(image, None)
+      self.__reply(200 if size else 404, [{"Deleted": image}])
+    else:
+      self.__reply(404, {"message": "Unknown endpoint."})
+
+  def __attach(self, container):
+    """ Hijacks the connection, and streams the output of a container over
+    it until the container closes its output, which is usually when it
+    exits.
+    Args:
+      container: The container to attach to. """
+    self.wfile.write(b"HTTP/1.1 101 UPGRADED\r\n" \
+                     b"Content-Type: application/vnd.docker.raw-stream\r\n" \
+                     b"Connection: Upgrade\r\nUpgrade: tcp\r\n\r\n")
+    self.wfile.flush()
+
+    with container.lock:
+      container.attached.append(self.connection)
+    # Wait for the container to be started and close its output.
+    while not container.output_closed.wait(0.1):
+      pass
+
+    with container.lock:
+      container.attached.remove(self.connection)
+    self.close_connection = True
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Fake Docker Engine API.")
+  parser.add_argument("socket", help="The path of the socket to listen on.")
+  parser.add_argument("--pull-time", type=float, default=0.0,
+                      help="How long pulling an image takes, in seconds.")
+  parser.add_argument("--image-size", type=int, default=100000000,
+                      help="The size of each image, in bytes.")
+  parser.add_argument("--image", action="append", default=[],
+                      help="An image that is already present. Can be given" \
+                           " more than once.")
+  args = parser.parse_args()
+
+  if os.path.exists(args.socket):
+    os.remove(args.socket)
+
+  server = _Server(args.socket, _Handler)
+  server.state = _State(args.pull_time, args.image_size)
+  for image in args.image:
+    server.state.images[_normalize(image)] = args.image_size
+
+  server.serve_forever()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+
+""" Runs a coordinator and several workers on this machine, using the fake
+nvidia-smi and fake docker from this directory, so that multi-node scheduling
+can be tried out without a cluster. Each worker gets its own port, state
+directory and docker socket. Submit jobs to the coordinator with
+add_job.py --server, and kill a worker to see its jobs move elsewhere. """
+
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+_TOOLS = os.path.join(_ROOT, "tools")
+_DAEMON = os.path.join(_ROOT, "daemon")
+
+
+def _start(command, directory, env, log_name):
+  """ Starts a process, with its output going to a log file.
+  Args:
+    command: The command to run.
+    directory: The directory to run it in, which is also where the log goes.
+    env: The environment to run it with.
+    log_name: The name of the log file.
+  Returns:
+    The Popen for the process. """
+  log_file = open(os.path.join(directory, log_name), "w")
+  return subprocess.Popen(command, cwd=directory, env=env, stdout=log_file,
+                          stderr=subprocess.STDOUT, start_new_session=True)
+
+def main():
+  parser = argparse.ArgumentParser( \
+      description="Run a coordinator and several workers on localhost.")
+  parser.add_argument("--gpus", default="2,4,8",
+                      help="Comma-separated number of fake GPUs on each" \
+                           " worker. There is one worker for each entry.")
+  parser.add_argument("--port", type=int, default=5100,
+                      help="Port for the coordinator. Workers use the ports" \
+                           " after it.")
+  parser.add_argument("--pull-time", type=float, default=0.0,
+                      help="Seconds that fake image pulls take.")
+  parser.add_argument("--worker-timeout", type=float, default=10.0,
+                      help="Seconds without a heartbeat before a worker is" \
+                           " considered down.")
+  parser.add_argument("--directory",
+                      help="Directory to keep the state and logs in. A" \
+                           " temporary one is used, and removed afterwards, if" \
+                           " not given.")
+  args = parser.parse_args()
+
+  try:
+    gpu_counts = [int(count) for count in args.gpus.split(",")]
+  except ValueError:
+    parser.error("Invalid GPU counts: '%s'." % (args.gpus))
+
+  directory = args.directory
+  if directory:
+    os.makedirs(directory, exist_ok=True)
+  else:
+    directory = tempfile.mkdtemp(prefix="stoplight-cluster-")
+  directory = os.path.abspath(directory)
+
+  processes = []
+  try:
+    coordinator = "127.0.0.1:%d" % (args.port)
+    processes.append(_start([sys.executable,
+                             os.path.join(_DAEMON, "coordinator.py"),
+                             "--port", str(args.port),
+                             "--worker-timeout", str(args.worker_timeout)],
+                            directory, dict(os.environ), "coordinator.log"))
+    print("Coordinator at %s, logging to %s." % \
+          (coordinator, os.path.join(directory, "coordinator.log")))
+
+    for index, gpu_count in enumerate(gpu_counts):
+      name = "worker-%d" % (index)
+      port = args.port + 1 + index
+      worker_dir = os.path.join(directory, name)
+      os.makedirs(worker_dir, exist_ok=True)
+
+      socket_path = os.path.join(worker_dir, "docker.sock")
+      processes.append(_start([sys.executable,
+                               os.path.join(_TOOLS, "fake_docker.py"),
+                               socket_path,
+                               "--pull-time", str(args.pull_time)],
+                              worker_dir, dict(os.environ), "docker.log"))
+
+      env = dict(os.environ)
+      env["PATH"] = os.path.join(_TOOLS, "fake_gpu") + os.pathsep + \
+                    env.get("PATH", "")
+      env["FAKE_NVIDIA_SMI_GPUS"] = str(gpu_count)
+      env["DOCKER_HOST"] = "unix://" + socket_path
+      processes.append(_start([sys.executable,
+                               os.path.join(_DAEMON, "stoplightd.py"),
+                               "--port", str(port),
+                               "--socket", os.path.join(worker_dir,
+                                                        "stoplight.sock"),
+                               "--state-dir", os.path.join(worker_dir, "state"),
+                               "--coordinator", coordinator,
+                               "--worker-name", name,
+                               "--heartbeat-interval", "1"],
+                              worker_dir, env, "stoplightd.out"))
+      print("%s with %d GPUs at 127.0.0.1:%d, in %s." % \
+            (name, gpu_count, port, worker_dir))
+
+    print("Press Ctrl+C to stop.")
+    while True:
+      for process in processes:
+        if process.poll() is not None:
+          print("%s exited with status %d." % \
+                (" ".join(process.args[1:2]), process.returncode))
+          processes.remove(process)
+          break
+      time.sleep(1)
+
+  except KeyboardInterrupt:
+    pass
+
+  finally:
+    for process in processes:
+      if process.poll() is None:
+        os.killpg(process.pid, signal.SIGTERM)
+    for process in processes:
+      process.wait()
+    if not args.directory:
+      shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+  main()